@@ -1,7 +1,28 @@
 from __future__ import print_function
 
 """
-To use this, get a trace file such as this one:
+Benchmarks for allmydata.util.spans, in the ways the immutable downloader
+(allmydata/immutable/downloader/share.py) uses Spans and DataSpans.
+
+Run it with no arguments to time synthetic versions of the downloader's
+access patterns, each at a few sizes:
+
+ python bench_spans.py
+
+ pending   -- many small reads are sent, so added to Share._pending, and
+              their responses arrive out of order and are removed again
+ desire    -- the 'ask = desired - pending - received.get_spans()'
+              computation done on every pass of Share.loop(), with many
+              outstanding and received ranges
+ received  -- small responses land in Share._received out of order, and
+              hash-sized and block-sized pieces are popped back out of them
+ overwrite -- overlapping reads land in Share._received, each replacing
+              part of the data already held
+
+N is the number of reads in each pattern. Per-operation times which stay
+flat as N grows mean the structure scales.
+
+To replay a real trace instead, get a trace file such as this one:
 
 wget http://tahoe-lafs.org/trac/tahoe-lafs/raw-attachment/ticket/1170/run-112-above28-flog-dump-sh8-on-nsziz.txt
 
@@ -12,9 +33,9 @@ python bench_spans.py run-112-above28-flog-dump-sh8-on-nsziz.txt
 
 from pyutil import benchutil
 
-from allmydata.util.spans import DataSpans
+from allmydata.util.spans import Spans, DataSpans
 
-import re, sys
+import random, re, sys
 
 DUMP_S='_received spans trace .dump()'
 GET_R=re.compile('_received spans trace .get\(([0-9]*), ([0-9]*)\)')
@@ -24,6 +45,9 @@ GET_SPANS_S='_received spans trace .get_spans()'
 ADD_R=re.compile('_received spans trace .add\(([0-9]*), len=([0-9]*)\)')
 INIT_S='_received spans trace = DataSpans'
 
+HASH_SIZE = 32
+READ_SIZE = 1024
+
 class B(object):
     def __init__(self, inf):
         self.inf = inf
@@ -47,7 +71,7 @@ class B(object):
                 mo = ADD_R.search(inline)
                 start = int(mo.group(1))
                 length = int(mo.group(2))
-                self.s.add(start, 'x'*length)
+                self.s.add(start, b'x'*length)
                 # self.stats['add'] = self.stats.get('add', 0) + 1
             elif GET_R.search(inline):
                 mo = GET_R.search(inline)
@@ -76,11 +100,96 @@ class B(object):
 
         # print(self.stats)
 
+
+class Pattern(object):
+    """A synthetic downloader access pattern over N reads of READ_SIZE
+    bytes each, which leave a HASH_SIZE gap after every fourth read, the
+    way the block hash tree and the blocks themselves are asked for
+    separately."""
+    def init(self, N):
+        r = random.Random(N)
+        self.reads = []
+        offset = 0
+        for i in range(N):
+            self.reads.append( (offset, READ_SIZE) )
+            offset += READ_SIZE
+            if i % 4 == 3:
+                offset += HASH_SIZE
+        # responses do not come back in the order the requests went out
+        self.responses = self.reads[:]
+        r.shuffle(self.responses)
+
+class Pending(Pattern):
+    def run(self, N):
+        pending = Spans()
+        for (start, length) in self.reads:
+            pending.add(start, length)
+        for (start, length) in self.responses:
+            pending.remove(start, length)
+
+class Desire(Pattern):
+    def init(self, N):
+        Pattern.init(self, N)
+        self.pending = Spans()
+        self.received = DataSpans()
+        for (start, length) in self.responses[:N//2]:
+            self.received.add(start, b"x" * length)
+        for (start, length) in self.responses[N//2:]:
+            self.pending.add(start, length)
+        (last_start, last_length) = self.reads[-1]
+        self.desired = Spans(0, last_start + last_length + READ_SIZE)
+
+    def run(self, N):
+        for i in range(10):
+            ask = self.desired - self.pending - self.received.get_spans()
+            assert ask.len()
+
+class Received(Pattern):
+    def run(self, N):
+        received = DataSpans()
+        for (start, length) in self.responses:
+            received.add(start, b"x" * length)
+        # pop a hash out of the front of each read, and then the rest of
+        # each group of four reads as one block
+        for j in range(0, N, 4):
+            (start, _) = self.reads[j]
+            assert received.pop(start, HASH_SIZE)
+            (last_start, last_length) = self.reads[min(j+3, N-1)]
+            assert received.pop(start + HASH_SIZE,
+                                last_start + last_length - start - HASH_SIZE)
+
+class Overwrite(Pattern):
+    def run(self, N):
+        received = DataSpans()
+        for (start, length) in self.responses:
+            # each response overlaps half of the read on either side of it
+            received.add(max(start - READ_SIZE // 2, 0),
+                         b"x" * (length + READ_SIZE))
+        assert received.len()
+
+
+def bench_trace(filename):
+    for N in [600, 6000, 60000]:
+        b = B(open(filename, 'rU'))
+        print("%7d" % N, end=' ')
+        benchutil.rep_bench(b.run, N, initfunc=b.init, runreps=10,
+                            UNITS_PER_SECOND=1000000)
+
+def bench_patterns():
+    for (name, klass) in [("pending", Pending),
+                          ("desire", Desire),
+                          ("received", Received),
+                          ("overwrite", Overwrite)]:
+        for N in [100, 1000, 10000]:
+            b = klass()
+            print("%-9s %6d" % (name, N), end=' ')
+            benchutil.rep_bench(b.run, N, initfunc=b.init, runreps=10,
+                                UNITS_PER_SECOND=1000000)
+
 benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
 print("(microseconds)")
 
-for N in [600, 6000, 60000]:
-    b = B(open(sys.argv[1], 'rU'))
-    print("%7d" % N, end=' ')
-    benchutil.rep_bench(b.run, N, b.init, UNITS_PER_SECOND=1000000)
-
+if len(sys.argv) > 1:
+    bench_trace(sys.argv[1])
+else:
+    bench_patterns()
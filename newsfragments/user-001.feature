@@ -0,0 +1 @@
+Immutable uploads now encode and hash segments in a thread pool, keeping up to [client]upload.pipeline_depth segments in flight at once; [client]cpu.threads sets the size of the pool.
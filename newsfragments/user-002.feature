@@ -0,0 +1 @@
+Immutable downloads now fetch up to [client]download.readahead segments ahead of the one being read.
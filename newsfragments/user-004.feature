@@ -0,0 +1 @@
+Convergent encryption keys are now hashed off the reactor thread, and can be remembered across uploads of the same file with [client]upload.convergence_key_cache.
@@ -0,0 +1 @@
+Unpacked directory contents are now cached, up to [client]dirnode.cache_size bytes.
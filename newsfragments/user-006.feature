@@ -0,0 +1 @@
+Mutable file servermaps can now be reused for a while, set by [client]mutable.servermap_cache.read_ttl and .write_ttl, and with [client]mutable.optimistic_reads downloads use the cached servermap of a file however old it is, building a new one only if the shares turn out to have changed.
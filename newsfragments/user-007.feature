@@ -0,0 +1 @@
+Operations which walk a whole directory tree now read up to [client]deep_traverse.concurrency directories at the same time, and keep at most [client]deep_traverse.frontier of the directories still to visit in memory, writing the rest to a temporary file.
@@ -0,0 +1 @@
+Storage server latencies now cover the last hour rather than the last 1000 operations, and /statistics?t=openmetrics reports them as histograms.
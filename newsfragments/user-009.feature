@@ -0,0 +1 @@
+Storage servers can keep an SQLite index of their shares and leases, with [storage]share_index; 'tahoe admin rebuild-share-index' rebuilds it.
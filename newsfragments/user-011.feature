@@ -0,0 +1 @@
+Storage servers can do their disk I/O in a thread pool, with [storage]disk_io.threads and disk_io.per_device.
@@ -0,0 +1 @@
+Storage servers now keep up to [storage]open_file_cache_size share files open between reads.
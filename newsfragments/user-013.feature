@@ -0,0 +1 @@
+PUT uploads of immutable files to /uri with stream=true are now encoded while their body is still arriving.
@@ -0,0 +1 @@
+Downloaded immutable segments can be cached on disk, up to [client]download.segment_cache_size bytes.
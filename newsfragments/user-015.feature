@@ -0,0 +1 @@
+Where the shares of recently uploaded, checked or downloaded files live can be remembered for [client]share_locations.cache_ttl seconds, saving a round of queries when they are used again.
@@ -0,0 +1 @@
+Directory listings now include the sizes of mutable file children, looked up from every storage server in one batch of requests.
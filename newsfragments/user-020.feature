@@ -0,0 +1 @@
+Storage server crawlers can read ahead several prefixes at once, with [storage]crawler.parallel_prefixes, and be held to an I/O budget with crawler.max_entries_per_second, crawler.max_bytes_per_second and crawler.max_foreground_latency.
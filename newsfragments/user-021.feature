@@ -0,0 +1 @@
+Clients can keep a pool of RSA keys ready for new mutable files and directories, with [client]mutable.key_pool.size and mutable.key_pool.persist.
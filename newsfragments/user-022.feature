@@ -0,0 +1 @@
+'tahoe cp' now copies up to four files at a time over connections it keeps open; --concurrency (-j) changes how many.
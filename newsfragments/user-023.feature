@@ -0,0 +1 @@
+'tahoe backup' now backs up up to four files at a time, and creates directories in different parts of the tree at the same time; --concurrency (-j) changes how many.
@@ -0,0 +1 @@
+Repairing an immutable file now makes only the shares which are missing, rather than encoding every share again.
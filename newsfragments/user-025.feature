@@ -0,0 +1 @@
+Files opened read-only over SFTP are now read a block at a time as they are asked for, rather than downloaded whole, except for SDMF mutable files.
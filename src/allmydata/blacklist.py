@@ -33,6 +33,7 @@ class Blacklist(object):
         self.blacklist_fn = blacklist_fn
         self.last_mtime = None
         self.entries = {}
+        self.generation = 0 # bumped whenever .entries changes
         self.read_blacklist() # sets .last_mtime and .entries
 
     def read_blacklist(self):
@@ -40,7 +41,9 @@ class Blacklist(object):
             current_mtime = os.stat(self.blacklist_fn).st_mtime
         except EnvironmentError:
             # unreadable blacklist file means no blacklist
-            self.entries.clear()
+            if self.entries:
+                self.entries.clear()
+                self.generation += 1
             return
         try:
             if self.last_mtime is None or current_mtime > self.last_mtime:
@@ -54,6 +57,7 @@ class Blacklist(object):
                         si = base32.a2b(si_s) # must be valid base32
                         self.entries[si] = reason
                 self.last_mtime = current_mtime
+                self.generation += 1
         except Exception as e:
             twisted_log.err(e, "unparseable blacklist file")
             raise
@@ -39,13 +39,18 @@ from allmydata.crypto.util import remove_prefix
 from allmydata.storage.server import StorageServer
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
+from allmydata.immutable.encode import DEFAULT_PIPELINE_DEPTH
+from allmydata.immutable.downloader.segmentation import DEFAULT_READAHEAD
+from allmydata.immutable.downloader.segcache import SegmentCache
+from allmydata.immutable.keycache import get_convergence_key_cache
 from allmydata.immutable.offloaded import Helper
+from allmydata.immutable.sharelocations import ShareLocationCache
 from allmydata.control import ControlServer
 from allmydata.introducer.client import IntroducerClient
 from allmydata.util import (
     hashutil, base32, pollmixin, log, idlib,
     yamlutil, configutil,
-    fileutil,
+    fileutil, cputhreadpool,
 )
 from allmydata.util.encodingutil import get_filesystem_encoding
 from allmydata.util.abbreviate import parse_abbreviated_size
@@ -63,6 +68,10 @@ from allmydata.interfaces import (
     IAnnounceableStorageServer,
 )
 from allmydata.nodemaker import NodeMaker
+from allmydata.dirnode import DirectoryCache, \
+     DEFAULT_DEEP_TRAVERSE_CONCURRENCY, DEFAULT_DEEP_TRAVERSE_FRONTIER
+from allmydata.mutable.keypool import KeyPool
+from allmydata.mutable.servermap import ServermapCache
 from allmydata.blacklist import Blacklist
 from allmydata import node
 
@@ -88,18 +97,38 @@ def _is_valid_section(section_name):
 _client_config = configutil.ValidConfiguration(
     static_valid_sections={
         "client": (
+            "cpu.threads",
+            "deep_traverse.concurrency",
+            "deep_traverse.frontier",
+            "dirnode.cache_size",
+            "download.readahead",
+            "download.segment_cache_size",
             "helper.furl",
             "introducer.furl",
             "key_generator.furl",
             "mutable.format",
+            "mutable.key_pool.persist",
+            "mutable.key_pool.size",
+            "mutable.optimistic_reads",
+            "mutable.servermap_cache.read_ttl",
+            "mutable.servermap_cache.write_ttl",
             "peers.preferred",
+            "share_locations.cache_ttl",
             "shares.happy",
             "shares.needed",
             "shares.total",
             "storage.plugins",
+            "upload.convergence_key_cache",
+            "upload.pipeline_depth",
         ),
         "storage": (
+            "crawler.max_bytes_per_second",
+            "crawler.max_entries_per_second",
+            "crawler.max_foreground_latency",
+            "crawler.parallel_prefixes",
             "debug_discard",
+            "disk_io.per_device",
+            "disk_io.threads",
             "enabled",
             "anonymous",
             "expire.cutoff_date",
@@ -109,8 +138,10 @@ _client_config = configutil.ValidConfiguration(
             "expire.mode",
             "expire.mutable",
             "expire.override_lease_duration",
+            "open_file_cache_size",
             "readonly",
             "reserved_space",
+            "share_index",
             "storage_dir",
             "plugins",
         ),
@@ -164,6 +195,9 @@ class SecretHolder(object):
     def get_cancel_secret(self):
         return hashutil.my_cancel_secret_hash(self._lease_secret)
 
+    def get_key_pool_secret(self):
+        return hashutil.my_key_pool_secret_hash(self._lease_secret)
+
     def get_convergence_secret(self):
         return self._convergence_secret
 
@@ -649,7 +683,7 @@ class _Client(node.Node, pollmixin.PollMixin):
         self.init_secrets()
         self.init_node_key()
         self.init_control()
-        self._key_generator = KeyGenerator()
+        self.init_key_generator()
         key_gen_furl = config.get_config("client", "key_generator.furl", None)
         if key_gen_furl:
             log.msg("[client]key_generator.furl= is now ignored, see #2783")
@@ -687,6 +721,26 @@ class _Client(node.Node, pollmixin.PollMixin):
     def get_stats(self):
         return { 'node.uptime': time.time() - self.started_timestamp }
 
+    def init_key_generator(self):
+        key_pool_size = int(self.config.get_config("client",
+                                                   "mutable.key_pool.size",
+                                                   "0"))
+        if key_pool_size < 0:
+            raise ValueError("config error: [client]mutable.key_pool.size "
+                             "must not be negative, not %d" % (key_pool_size,))
+        if not key_pool_size:
+            self._key_generator = KeyGenerator()
+            return
+        keyfile = None
+        if self.config.get_config("client", "mutable.key_pool.persist", False,
+                                  boolean=True):
+            keyfile = self.config.get_private_path("key_pool")
+        self._key_generator = KeyPool(
+            key_pool_size, keyfile,
+            self._secret_holder.get_key_pool_secret())
+        self._key_generator.setServiceParent(self)
+        self.stats_provider.register_producer(self._key_generator)
+
     def init_secrets(self):
         # configs are always unicode
         def _unicode_make_secret():
@@ -809,6 +863,48 @@ class _Client(node.Node, pollmixin.PollMixin):
         if self.config.get_config("storage", "expire.mutable", True, boolean=True):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
+        share_index = self.config.get_config("storage", "share_index", False,
+                                             boolean=True)
+        disk_io_threads = int(self.config.get_config("storage",
+                                                     "disk_io.threads", "0"))
+        if disk_io_threads < 0:
+            raise ValueError("config error: [storage]disk_io.threads "
+                             "must not be negative, not %d"
+                             % (disk_io_threads,))
+        disk_io_per_device = self.config.get_config("storage",
+                                                    "disk_io.per_device",
+                                                    False, boolean=True)
+        open_file_cache_size = int(self.config.get_config(
+            "storage", "open_file_cache_size", "100"))
+        if open_file_cache_size < 0:
+            raise ValueError("config error: [storage]open_file_cache_size "
+                             "must not be negative, not %d"
+                             % (open_file_cache_size,))
+        crawler_parallel_prefixes = int(self.config.get_config(
+            "storage", "crawler.parallel_prefixes", "1"))
+        if crawler_parallel_prefixes < 1:
+            raise ValueError("config error: [storage]crawler.parallel_prefixes "
+                             "must be at least 1, not %d"
+                             % (crawler_parallel_prefixes,))
+        crawler_max_entries = self.config.get_config(
+            "storage", "crawler.max_entries_per_second", None)
+        if crawler_max_entries is not None:
+            crawler_max_entries = int(crawler_max_entries)
+            if crawler_max_entries < 1:
+                raise ValueError("config error: "
+                                 "[storage]crawler.max_entries_per_second "
+                                 "must be at least 1, not %d"
+                                 % (crawler_max_entries,))
+        crawler_max_bytes = parse_abbreviated_size(self.config.get_config(
+            "storage", "crawler.max_bytes_per_second", None))
+        if crawler_max_bytes is not None and crawler_max_bytes < 1:
+            raise ValueError("config error: "
+                             "[storage]crawler.max_bytes_per_second "
+                             "must be at least 1 byte")
+        crawler_max_latency = self.config.get_config(
+            "storage", "crawler.max_foreground_latency", None)
+        if crawler_max_latency is not None:
+            crawler_max_latency = float(crawler_max_latency)
 
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
@@ -819,7 +915,15 @@ class _Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           share_index=share_index,
+                           disk_io_threads=disk_io_threads,
+                           disk_io_per_device=disk_io_per_device,
+                           open_file_cache_size=open_file_cache_size,
+                           crawler_parallel_prefixes=crawler_parallel_prefixes,
+                           crawler_max_entries_per_second=crawler_max_entries,
+                           crawler_max_bytes_per_second=crawler_max_bytes,
+                           crawler_max_foreground_latency=crawler_max_latency)
         ss.setServiceParent(self)
         return ss
 
@@ -907,6 +1011,27 @@ class _Client(node.Node, pollmixin.PollMixin):
         DEP["n"] = int(self.config.get_config("client", "shares.total", DEP["n"]))
         DEP["happy"] = int(self.config.get_config("client", "shares.happy", DEP["happy"]))
 
+        cpu_threads = self.config.get_config("client", "cpu.threads", None)
+        if cpu_threads is not None:
+            cputhreadpool.set_max_threads(int(cpu_threads))
+        pipeline_depth = int(self.config.get_config(
+            "client", "upload.pipeline_depth", DEFAULT_PIPELINE_DEPTH))
+        if pipeline_depth < 1:
+            raise ValueError("config error: [client]upload.pipeline_depth "
+                             "must be at least 1, not %d" % (pipeline_depth,))
+        self.convergence_key_cache = None
+        if self.config.get_config("client", "upload.convergence_key_cache",
+                                  False, boolean=True):
+            self.convergence_key_cache = get_convergence_key_cache(
+                self.config.get_private_path("convergence_key_cache.sqlite"))
+
+        share_locations_ttl = float(self.config.get_config(
+            "client", "share_locations.cache_ttl", 0))
+        self.share_location_cache = None
+        if share_locations_ttl > 0:
+            self.share_location_cache = ShareLocationCache(share_locations_ttl)
+            self.stats_provider.register_producer(self.share_location_cache)
+
         # for the CLI to authenticate to local JSON endpoints
         self._create_auth_token()
 
@@ -917,6 +1042,8 @@ class _Client(node.Node, pollmixin.PollMixin):
             helper_furl,
             self.stats_provider,
             self.history,
+            pipeline_depth=pipeline_depth,
+            share_locations=self.share_location_cache,
         )
         uploader.setServiceParent(self)
         self.init_blacklist()
@@ -971,6 +1098,59 @@ class _Client(node.Node, pollmixin.PollMixin):
             self.mutable_file_default = MDMF_VERSION
         else:
             self.mutable_file_default = SDMF_VERSION
+        readahead = int(self.config.get_config(
+            "client", "download.readahead", DEFAULT_READAHEAD))
+        if readahead < 0:
+            raise ValueError("config error: [client]download.readahead "
+                             "must not be negative, not %d" % (readahead,))
+        data = self.config.get_config("client", "dirnode.cache_size", "10MB")
+        try:
+            dirnode_cache_size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]dirnode.cache_size= contains unparseable value %s"
+                    % data)
+            raise
+        self.dirnode_cache = DirectoryCache(dirnode_cache_size or 0)
+        self.stats_provider.register_producer(self.dirnode_cache)
+        read_ttl = float(self.config.get_config(
+            "client", "mutable.servermap_cache.read_ttl", 0))
+        write_ttl = float(self.config.get_config(
+            "client", "mutable.servermap_cache.write_ttl", 0))
+        optimistic_reads = self.config.get_config(
+            "client", "mutable.optimistic_reads", False, boolean=True)
+        self.servermap_cache = None
+        if read_ttl > 0 or write_ttl > 0 or optimistic_reads:
+            self.servermap_cache = ServermapCache(read_ttl, write_ttl,
+                                                  optimistic_reads)
+            self.stats_provider.register_producer(self.servermap_cache)
+        data = self.config.get_config("client", "download.segment_cache_size",
+                                      "0")
+        try:
+            segment_cache_size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]download.segment_cache_size= contains"
+                    " unparseable value %s" % data)
+            raise
+        self.segment_cache = None
+        if segment_cache_size:
+            self.segment_cache = SegmentCache(
+                os.path.join(self._get_tempdir(), "download-segments"),
+                segment_cache_size)
+            self.stats_provider.register_producer(self.segment_cache)
+        traverse_concurrency = int(self.config.get_config(
+            "client", "deep_traverse.concurrency",
+            DEFAULT_DEEP_TRAVERSE_CONCURRENCY))
+        if traverse_concurrency < 1:
+            raise ValueError("config error: [client]deep_traverse.concurrency "
+                             "must be at least 1, not %d"
+                             % (traverse_concurrency,))
+        traverse_frontier = int(self.config.get_config(
+            "client", "deep_traverse.frontier",
+            DEFAULT_DEEP_TRAVERSE_FRONTIER))
+        if traverse_frontier < 2:
+            raise ValueError("config error: [client]deep_traverse.frontier "
+                             "must be at least 2, not %d"
+                             % (traverse_frontier,))
         self.nodemaker = NodeMaker(self.storage_broker,
                                    self._secret_holder,
                                    self.get_history(),
@@ -979,7 +1159,14 @@ class _Client(node.Node, pollmixin.PollMixin):
                                    self.get_encoding_parameters(),
                                    self.mutable_file_default,
                                    self._key_generator,
-                                   self.blacklist)
+                                   self.blacklist,
+                                   download_readahead=readahead,
+                                   dirnode_cache=self.dirnode_cache,
+                                   servermap_cache=self.servermap_cache,
+                                   segment_cache=self.segment_cache,
+                                   share_locations=self.share_location_cache,
+                                   deep_traverse_concurrency=traverse_concurrency,
+                                   deep_traverse_frontier=traverse_frontier)
 
     def get_history(self):
         return self.history
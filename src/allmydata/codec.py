@@ -46,6 +46,14 @@ class CRSEncoder(object):
         return self.share_size
 
     def encode(self, inshares, desired_share_ids=None):
+        return defer.succeed(self.encode_synchronously(inshares, desired_share_ids))
+
+    def encode_synchronously(self, inshares, desired_share_ids=None):
+        """
+        Like ``encode``, but return ``(shares, desired_share_ids)`` directly
+        instead of through a ``Deferred``.  This does not touch any Twisted
+        machinery, so it may be called from a worker thread.
+        """
         precondition(desired_share_ids is None or len(desired_share_ids) <= self.max_shares, desired_share_ids, self.max_shares)
 
         if desired_share_ids is None:
@@ -55,7 +63,7 @@ class CRSEncoder(object):
             assert len(inshare) == self.share_size, (len(inshare), self.share_size, self.data_size, self.required_shares)
         shares = self.encoder.encode(inshares, desired_share_ids)
 
-        return defer.succeed((shares, desired_share_ids))
+        return (shares, desired_share_ids)
 
     def encode_proposal(self, data, desired_share_ids=None):
         raise NotImplementedError()
@@ -78,13 +86,21 @@ class CRSDecoder(object):
         return self.required_shares
 
     def decode(self, some_shares, their_shareids):
+        return defer.succeed(self.decode_synchronously(some_shares,
+                                                       their_shareids))
+
+    def decode_synchronously(self, some_shares, their_shareids):
+        """
+        Like ``decode``, but return the list of decoded buffers directly
+        instead of through a ``Deferred``.  This does not touch any Twisted
+        machinery, so it may be called from a worker thread.
+        """
         precondition(len(some_shares) == len(their_shareids),
                      len(some_shares), len(their_shareids))
         precondition(len(some_shares) == self.required_shares,
                      len(some_shares), self.required_shares)
-        data = self.decoder.decode(some_shares,
+        return self.decoder.decode(some_shares,
                                    [int(s) for s in their_shareids])
-        return defer.succeed(data)
 
 def parse_params(serializedparams):
     pieces = serializedparams.split(b"-")
@@ -82,7 +82,8 @@ class ControlServer(Referenceable, service.Service):
             size -= l
         f.close()
         uploader = self.parent.getServiceNamed("uploader")
-        u = upload.FileName(filename, convergence=convergence)
+        u = upload.FileName(filename, convergence=convergence,
+                            key_cache=self.parent.convergence_key_cache)
         # XXX should pass reactor arg
         d = uploader.upload(u)
         d.addCallback(lambda results: results.get_uri())
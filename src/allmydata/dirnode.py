@@ -13,11 +13,13 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, list, object, range, str, max, min  # noqa: F401
 from past.builtins import unicode
 
+import copy
 import time
+from collections import OrderedDict
 
 from zope.interface import implementer
 from twisted.internet import defer
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, eventually
 
 from allmydata.crypto import aes
 from allmydata.deep_stats import DeepStats
@@ -25,8 +27,10 @@ from allmydata.mutable.common import NotWriteableError
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.unknown import UnknownNode, strip_prefix_for_ro
 from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
+     IStatsProducer, \
      ExistingChildError, NoSuchChildError, ICheckable, IDeepCheckable, \
-     MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError
+     MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError, \
+     NotEnoughSharesError
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
 from allmydata.monitor import Monitor
@@ -37,6 +41,7 @@ from allmydata.util.netstring import netstring, split_netstring
 from allmydata.util.consumer import download_to_data
 from allmydata.uri import wrap_dirnode_cap
 from allmydata.util.dictutil import AuxValueDict
+from allmydata.util.spillstack import SpillStack
 
 from eliot import (
     ActionType,
@@ -80,6 +85,11 @@ class _OnlyFiles(object):
 
 ONLY_FILES = _OnlyFiles()
 
+# how many directories deep_traverse() reads at once, and how many pending
+# directories it keeps in memory before spilling them to disk
+DEFAULT_DEEP_TRAVERSE_CONCURRENCY = 10
+DEFAULT_DEEP_TRAVERSE_FRONTIER = 10000
+
 
 def update_metadata(metadata, new_metadata, now):
     """Updates 'metadata' in-place with the information in 'new_metadata'.
@@ -311,6 +321,80 @@ def _pack_normalized_children(children, writekey, deep_immutable=False):
         entries.append(netstring(entry))
     return b"".join(entries)
 
+@implementer(IStatsProducer)
+class DirectoryCache(object):
+    """I hold the unpacked contents of recently-read directories, so that
+    listing the same directory again does not have to decrypt every rwcap
+    and create a node for every child all over again.
+
+    One of me is shared by every DirectoryNode that a NodeMaker creates. My
+    entries are keyed by (storage index, writeable), and each one remembers
+    the version it was unpacked from: a mutable directory is only served
+    from the cache if a (cheap) servermap update still reports that version
+    as the best one, and an immutable directory can never change. Our own
+    modifications invalidate the entry outright.
+
+    I am bounded by the total size of the serialized directories I hold,
+    evicting the least-recently-used ones first. A max_size of 0 disables
+    caching, but hits and misses are still counted.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = OrderedDict() # (si, writeable) -> (version, size, children)
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        """Return a copy of the children cached for key, if they were
+        unpacked from the given version, or None."""
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] != version:
+            if entry is not None:
+                self._size -= entry[1]
+            self.misses += 1
+            return None
+        self._entries[key] = entry # most-recently used goes last
+        self.hits += 1
+        return _copy_children(entry[2])
+
+    def put(self, key, version, size, children):
+        self.invalidate(key)
+        if not self._max_size or size > self._max_size:
+            return
+        self._entries[key] = (version, size, _copy_children(children))
+        self._size += size
+        while self._size > self._max_size:
+            (oldkey, (_, oldsize, _)) = self._entries.popitem(last=False)
+            self._size -= oldsize
+
+    def invalidate(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def invalidate_storage_index(self, storage_index):
+        for writeable in (True, False):
+            self.invalidate((storage_index, writeable))
+
+    def get_stats(self):
+        return {
+            "dirnode.cache.hits": self.hits,
+            "dirnode.cache.misses": self.misses,
+            "dirnode.cache.entries": len(self._entries),
+            "dirnode.cache.size": self._size,
+        }
+
+def _copy_children(children):
+    # callers are free to modify the dict (and metadata) they are given, so
+    # the cache must neither hand out nor keep the same objects
+    copied = AuxValueDict()
+    for name, (child, metadata) in children.items():
+        copied.set_with_aux(name, (child, copy.deepcopy(metadata)),
+                            children.get_aux(name))
+    return copied
+
 @implementer(IDirectoryNode, ICheckable, IDeepCheckable)
 class DirectoryNode(object):
     filenode_class = MutableFileNode
@@ -341,6 +425,9 @@ class DirectoryNode(object):
         return self._node.get_current_size()
 
     def _read(self):
+        cache = self._nodemaker.dirnode_cache
+        if cache is not None and self._node.get_storage_index() is not None:
+            return self._read_cached(cache, self._node.get_storage_index())
         if self._node.is_mutable():
             # use the IMutableFileNode API.
             d = self._node.download_best_version()
@@ -349,6 +436,62 @@ class DirectoryNode(object):
         d.addCallback(self._unpack_contents)
         return d
 
+    def _read_cached(self, cache, storage_index):
+        key = (storage_index, not self.is_readonly())
+        if not self._node.is_mutable():
+            version = self._cache_version(None)
+            children = cache.get(key, version)
+            if children is not None:
+                return defer.succeed(children)
+            d = download_to_data(self._node)
+            d.addCallback(self._unpack_and_cache, cache, key, version)
+            return d
+
+        d = self._node.get_best_readable_version()
+        def _got_version(mfv):
+            version = self._cache_version((mfv.get_sequence_number(),
+                                           mfv.get_root_hash()))
+            children = cache.get(key, version)
+            if children is not None:
+                return children
+            d = mfv.download_to_data()
+            d.addCallback(self._unpack_and_cache, cache, key, version)
+            def _retry(f):
+                # download_best_version() knows how to try harder
+                f.trap(NotEnoughSharesError)
+                d = self._node.download_best_version()
+                d.addCallback(self._unpack_contents)
+                return d
+            d.addErrback(_retry)
+            return d
+        d.addCallback(_got_version)
+        return d
+
+    def _cache_version(self, version):
+        # cached children are nodes, which are replaced by ProhibitedNodes
+        # when they are blacklisted, so a change to the blacklist makes all
+        # of them stale
+        blacklist = self._nodemaker.blacklist
+        if blacklist is None:
+            return version
+        blacklist.read_blacklist()
+        return (version, blacklist.generation)
+
+    def _unpack_and_cache(self, data, cache, key, version):
+        children = self._unpack_contents(data)
+        cache.put(key, version, len(data), children)
+        return children
+
+    def _modify(self, modifier):
+        d = self._node.modify(modifier)
+        def _invalidate(res):
+            cache = self._nodemaker.dirnode_cache
+            if cache is not None:
+                cache.invalidate_storage_index(self._node.get_storage_index())
+            return res
+        d.addBoth(_invalidate)
+        return d
+
     def _decrypt_rwcapdata(self, encwrcap):
         salt = encwrcap[:16]
         crypttext = encwrcap[16:-32]
@@ -539,7 +682,7 @@ class DirectoryNode(object):
         assert isinstance(metadata, dict)
         s = MetadataSetter(self, name, metadata,
                            create_readonly_node=self._create_readonly_node)
-        d = self._node.modify(s.modify)
+        d = self._modify(s.modify)
         d.addCallback(lambda res: self)
         return d
 
@@ -610,7 +753,7 @@ class DirectoryNode(object):
             # for this type of directory.
             child_node = self._create_and_validate_node(writecap, readcap, namex)
             a.set_node(namex, child_node, metadata)
-        d = self._node.modify(a.modify)
+        d = self._modify(a.modify)
         d.addCallback(lambda ign: self)
         return d
 
@@ -631,7 +774,7 @@ class DirectoryNode(object):
         a = Adder(self, overwrite=overwrite,
                   create_readonly_node=self._create_readonly_node)
         a.set_node(namex, child, metadata)
-        d = self._node.modify(a.modify)
+        d = self._modify(a.modify)
         d.addCallback(lambda res: child)
         return d
 
@@ -641,7 +784,7 @@ class DirectoryNode(object):
             return defer.fail(NotWriteableError())
         a = Adder(self, entries, overwrite=overwrite,
                   create_readonly_node=self._create_readonly_node)
-        d = self._node.modify(a.modify)
+        d = self._modify(a.modify)
         d.addCallback(lambda res: self)
         return d
 
@@ -673,7 +816,7 @@ class DirectoryNode(object):
             return defer.fail(NotWriteableError())
         deleter = Deleter(self, namex, must_exist=must_exist,
                           must_be_directory=must_be_directory, must_be_file=must_be_file)
-        d = self._node.modify(deleter.modify)
+        d = self._modify(deleter.modify)
         d.addCallback(lambda res: deleter.old_child)
         return d
 
@@ -697,7 +840,7 @@ class DirectoryNode(object):
             entries = {name: (child, metadata)}
             a = Adder(self, entries, overwrite=overwrite,
                       create_readonly_node=self._create_readonly_node)
-            d = self._node.modify(a.modify)
+            d = self._modify(a.modify)
             d.addCallback(lambda res: child)
             return d
         d.addCallback(_created)
@@ -770,39 +913,139 @@ class DirectoryNode(object):
         # fanout to 10 simultaneous operations, but the memory load of the
         # queued operations was excessive (in one case, with 330k dirnodes,
         # it caused the process to run into the 3.0GB-ish per-process 32bit
-        # linux memory limit, and crashed). So we use a single big Deferred
-        # chain, and do a strict depth-first traversal, one node at a time.
-        # This can be slower, because we aren't pipelining directory reads,
-        # but it brought the memory footprint down by roughly 50%.
+        # linux memory limit, and crashed). The queue held a Deferred chain
+        # and a dirnode object for every directory that was waiting its
+        # turn. _DeepTraversal instead keeps just the caps and paths of
+        # pending directories, on a depth-first stack that spills to disk
+        # when it gets too big, and reads several directories at a time.
 
         monitor = Monitor()
         walker.set_monitor(monitor)
 
-        found = set([self.get_verify_cap()])
-        d = self._deep_traverse_dirnode(self, [], walker, monitor, found)
+        traversal = _DeepTraversal(self, walker, monitor,
+                                   self._nodemaker.deep_traverse_concurrency,
+                                   self._nodemaker.deep_traverse_frontier)
+        d = traversal.run()
         d.addCallback(lambda ignored: walker.finish())
         d.addBoth(monitor.finish)
         d.addErrback(lambda f: None)
 
         return monitor
 
-    def _deep_traverse_dirnode(self, node, path, walker, monitor, found):
-        # process this directory, then walk its children
-        monitor.raise_if_cancelled()
-        d = defer.maybeDeferred(walker.add_node, node, path)
+    def build_manifest(self):
+        """Return a Monitor, with a ['status'] that will be a list of (path,
+        cap) tuples, for all nodes (directories and files) reachable from
+        this one."""
+        walker = ManifestWalker(self)
+        return self.deep_traverse(walker)
+
+    def start_deep_stats(self):
+        # Since deep_traverse tracks verifier caps, we avoid double-counting
+        # children for which we've got both a write-cap and a read-cap
+        return self.deep_traverse(DeepStats(self))
+
+    def start_deep_check(self, verify=False, add_lease=False):
+        return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease))
+
+    def start_deep_check_and_repair(self, verify=False, add_lease=False):
+        return self.deep_traverse(DeepChecker(self, verify, repair=True, add_lease=add_lease))
+
+
+class _DeepTraversal(object):
+    """I perform DirectoryNode.deep_traverse, keeping up to 'concurrency'
+    directories in progress at once.
+
+    Each directory is handled in the same way (and the walker is called in
+    the same order for it) as by the old strictly depth-first traversal:
+    add_node() for the directory itself, then enter_directory() once its
+    children are known, then add_node() for each of its file-like
+    children. Its subdirectories are pushed onto a SpillStack, in reverse
+    order, so with a concurrency of 1 the directories are visited in the
+    same depth-first order as before. At most 'frontier' of those pending
+    directories are held in memory.
+    """
+
+    def __init__(self, root, walker, monitor, concurrency, frontier):
+        self._root = root
+        self._walker = walker
+        self._monitor = monitor
+        self._concurrency = max(1, concurrency)
+        self._nodemaker = root._nodemaker
+        self._found = set([root.get_verify_cap()])
+        self._pending = SpillStack(frontier) # [writecap, readcap, path]
+        self._active = 0
+        self._done = None
+
+    def run(self):
+        """Return a Deferred that fires when every reachable node has been
+        given to the walker, or fails with the first error."""
+        self._done = defer.Deferred()
+        self._start(self._root, [])
+        return self._done
+
+    def _push(self, node, path):
+        writecap = node.get_write_uri()
+        if writecap is not None:
+            writecap = writecap.decode("ascii")
+        self._pending.push([writecap,
+                            node.get_readonly_uri().decode("ascii"),
+                            path])
+
+    def _pop(self):
+        (writecap, readcap, path) = self._pending.pop()
+        if writecap is not None:
+            writecap = writecap.encode("ascii")
+        node = self._nodemaker.create_from_cap(writecap,
+                                               readcap.encode("ascii"))
+        return (node, path)
+
+    def _start(self, node, path):
+        self._active += 1
+        d = defer.maybeDeferred(self._visit, node, path)
+        d.addCallbacks(self._visited, self._failed)
+
+    def _fill(self):
+        if self._done is None:
+            return # already finished, or failed
+        while self._active < self._concurrency and len(self._pending):
+            (node, path) = self._pop()
+            self._start(node, path)
+        if not self._active:
+            done, self._done = self._done, None
+            self._pending.close()
+            done.callback(None)
+
+    def _visited(self, ignored):
+        self._active -= 1
+        # start the next directories on a new turn, so that a tree full of
+        # directories which are read synchronously does not use up the stack
+        eventually(self._fill)
+
+    def _failed(self, f):
+        self._active -= 1
+        if self._done is not None:
+            done, self._done = self._done, None
+            self._pending.close()
+            done.errback(f)
+
+    def _visit(self, node, path):
+        # process this directory, then push its subdirectories
+        self._monitor.raise_if_cancelled()
+        d = defer.maybeDeferred(self._walker.add_node, node, path)
         d.addCallback(lambda ignored: node.list())
-        d.addCallback(self._deep_traverse_dirnode_children, node, path,
-                      walker, monitor, found)
+        d.addCallback(self._visit_children, node, path)
         return d
 
-    def _deep_traverse_dirnode_children(self, children, parent, path,
-                                        walker, monitor, found):
-        monitor.raise_if_cancelled()
+    def _visit_children(self, children, parent, path):
+        self._monitor.raise_if_cancelled()
+        walker = self._walker
+        found = self._found
         d = defer.maybeDeferred(walker.enter_directory, parent, children)
         # we process file-like children first, so we can drop their FileNode
         # objects as quickly as possible. Tests suggest that a FileNode (held
         # in the client's nodecache) consumes about 2440 bytes. dirnodes (not
-        # in the nodecache) seem to consume about 2000 bytes.
+        # in the nodecache) seem to consume about 2000 bytes, which is why
+        # only their caps are kept while they wait to be visited.
         dirkids = []
         filekids = []
         for name, (child, metadata) in sorted(children.items()):
@@ -830,33 +1073,13 @@ class DirectoryNode(object):
             # Twisted problem as in #237.
             if i % 100 == 99:
                 d.addCallback(lambda ignored: fireEventually())
-        for (child, childpath) in dirkids:
-            d.addCallback(lambda ignored, child=child, childpath=childpath:
-                          self._deep_traverse_dirnode(child, childpath,
-                                                      walker, monitor,
-                                                      found))
+        def _push_dirkids(ignored):
+            for (child, childpath) in reversed(dirkids):
+                self._push(child, childpath)
+        d.addCallback(_push_dirkids)
         return d
 
 
-    def build_manifest(self):
-        """Return a Monitor, with a ['status'] that will be a list of (path,
-        cap) tuples, for all nodes (directories and files) reachable from
-        this one."""
-        walker = ManifestWalker(self)
-        return self.deep_traverse(walker)
-
-    def start_deep_stats(self):
-        # Since deep_traverse tracks verifier caps, we avoid double-counting
-        # children for which we've got both a write-cap and a read-cap
-        return self.deep_traverse(DeepStats(self))
-
-    def start_deep_check(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease))
-
-    def start_deep_check_and_repair(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=True, add_lease=add_lease))
-
-
 class ManifestWalker(DeepStats):
     def __init__(self, origin):
         DeepStats.__init__(self, origin)
@@ -38,10 +38,11 @@ from foolscap.api import eventually
 from allmydata.util import deferredutil
 
 from allmydata.util.assertutil import _assert, precondition
-from allmydata.util.consumer import download_to_data
+from allmydata.util.consumer import MemoryConsumer, download_to_data
 from allmydata.util.encodingutil import get_filesystem_encoding
+from allmydata.util.observer import OneShotObserverList
 from allmydata.interfaces import IFileNode, IDirectoryNode, ExistingChildError, \
-     NoSuchChildError, ChildOfWrongTypeError
+     NoSuchChildError, ChildOfWrongTypeError, SDMF_VERSION
 from allmydata.mutable.common import NotWriteableError
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.immutable.upload import FileHandle
@@ -576,6 +577,12 @@ class OverwriteableFileConsumer(PrefixingLogMixin):
 
 SIZE_THRESHOLD = 1000
 
+# RandomAccessReadOnlySFTPFile reads and caches files in blocks of this size,
+# which is the default segment size, so that a block is usually one segment.
+READ_BLOCK_SIZE = 128*1024
+READ_CACHE_BLOCKS = 8
+READ_AHEAD_BLOCKS = 2
+
 
 @implementer(ISFTPFile)
 class ShortReadOnlySFTPFile(PrefixingLogMixin):
@@ -655,6 +662,145 @@ class ShortReadOnlySFTPFile(PrefixingLogMixin):
         return defer.execute(_denied)
 
 
+@implementer(ISFTPFile)
+class RandomAccessReadOnlySFTPFile(PrefixingLogMixin):
+    """I represent a file handle to a particular file on an SFTP connection.
+    I am used for files opened in read-only mode which are not short
+    immutable files, except for SDMF mutable files (which can only be
+    downloaded as a whole). Rather than downloading the whole file, I serve
+    each read request with only the blocks of the file that it covers, so
+    that reading the end of a large file does not have to wait for the rest
+    of it. I keep the last few blocks that were read, since clients usually
+    read in smaller pieces than a block, and when reads are sequential I
+    start fetching the next blocks before they are asked for.
+    self.async_ is used to delay read requests until the version of the file
+    to be read is known."""
+
+    def __init__(self, userpath, filenode, metadata):
+        PrefixingLogMixin.__init__(self, facility="tahoe.sftp", prefix=userpath)
+        if noisy: self.log(".__init__(%r, %r, %r)" % (userpath, filenode, metadata), level=NOISY)
+
+        precondition(isinstance(userpath, bytes) and IFileNode.providedBy(filenode),
+                     userpath=userpath, filenode=filenode)
+        self.filenode = filenode
+        self.metadata = metadata
+        self.async_ = filenode.get_best_readable_version()
+        self.closed = False
+        self._blocks = {}       # block number -> OneShotObserverList
+        self._block_order = []  # block numbers, least recently used first
+        self._next_offset = 0   # where the next sequential read would start
+
+    def readChunk(self, offset, length):
+        request = ".readChunk(%r, %r)" % (offset, length)
+        self.log(request, level=OPERATIONAL)
+
+        if self.closed:
+            def _closed(): raise createSFTPError(FX_BAD_MESSAGE, "cannot read from a closed file handle")
+            return defer.execute(_closed)
+
+        d = defer.Deferred()
+        def _read(version):
+            if noisy: self.log("_read(%r) in readChunk(%r, %r)" % (version, offset, length), level=NOISY)
+
+            # As for ShortReadOnlySFTPFile, we respond with an EOF error iff
+            # offset is already at EOF.
+            size = version.get_size()
+            if offset >= size:
+                eventually_errback(d)(Failure(createSFTPError(FX_EOF, "read at or past end of file")))
+                return version
+            end = min(offset + length, size)
+            first = offset // READ_BLOCK_SIZE
+            last = max(end - 1, offset) // READ_BLOCK_SIZE
+            dl = [self._get_block(version, blocknum) for blocknum in range(first, last + 1)]
+
+            if offset == self._next_offset:
+                last_block = (size - 1) // READ_BLOCK_SIZE
+                for blocknum in range(last + 1, min(last + READ_AHEAD_BLOCKS, last_block) + 1):
+                    d3 = self._get_block(version, blocknum)
+                    # A block that fails to be read ahead is forgotten, and
+                    # read again if it is asked for.
+                    d3.addErrback(self._read_ahead_failed, blocknum)
+            self._next_offset = end
+
+            d2 = deferredutil.gatherResults(dl)
+            def _got_blocks(blocks):
+                start = offset - first * READ_BLOCK_SIZE
+                return b"".join(blocks)[start:start + end - offset]
+            d2.addCallback(_got_blocks)
+            d2.addBoth(eventually_callback(d))
+            # It is correct to drop d2 here.
+            return version
+        self.async_.addCallbacks(_read, eventually_errback(d))
+        d.addBoth(_convert_error, request)
+        return d
+
+    def _get_block(self, version, blocknum):
+        observer = self._blocks.get(blocknum)
+        if observer is not None:
+            self._block_order.remove(blocknum)
+            self._block_order.append(blocknum)
+            return observer.when_fired()
+
+        if len(self._block_order) >= READ_CACHE_BLOCKS:
+            del self._blocks[self._block_order.pop(0)]
+        observer = self._blocks[blocknum] = OneShotObserverList()
+        self._block_order.append(blocknum)
+
+        offset = blocknum * READ_BLOCK_SIZE
+        length = min(READ_BLOCK_SIZE, version.get_size() - offset)
+        mc = MemoryConsumer()
+        d = version.read(mc, offset, length)
+        def _done(res):
+            if isinstance(res, Failure):
+                # Forget the failure, so that the block will be tried again.
+                if self._blocks.get(blocknum) is observer:
+                    del self._blocks[blocknum]
+                    self._block_order.remove(blocknum)
+                observer.fire(res)
+            else:
+                observer.fire(b"".join(mc.chunks))
+        d.addBoth(_done)
+        return observer.when_fired()
+
+    def _read_ahead_failed(self, f, blocknum):
+        self.log("reading ahead block %r failed: %s" % (blocknum, f), level=NOISY)
+
+    def writeChunk(self, offset, data):
+        self.log(".writeChunk(%r, <data of length %r>) denied" % (offset, len(data)), level=OPERATIONAL)
+
+        def _denied(): raise createSFTPError(FX_PERMISSION_DENIED, "file handle was not opened for writing")
+        return defer.execute(_denied)
+
+    def close(self):
+        self.log(".close()", level=OPERATIONAL)
+
+        self.closed = True
+        self._blocks.clear()
+        del self._block_order[:]
+        return defer.succeed(None)
+
+    def getAttrs(self):
+        request = ".getAttrs()"
+        self.log(request, level=OPERATIONAL)
+
+        if self.closed:
+            def _closed(): raise createSFTPError(FX_BAD_MESSAGE, "cannot get attributes for a closed file handle")
+            return defer.execute(_closed)
+
+        d = defer.Deferred()
+        def _get(version):
+            eventually_callback(d)(_populate_attrs(self.filenode, self.metadata, size=version.get_size()))
+            return version
+        self.async_.addCallbacks(_get, eventually_errback(d))
+        d.addBoth(_convert_error, request)
+        return d
+
+    def setAttrs(self, attrs):
+        self.log(".setAttrs(%r) denied" % (attrs,), level=OPERATIONAL)
+        def _denied(): raise createSFTPError(FX_PERMISSION_DENIED, "file handle was not opened for writing")
+        return defer.execute(_denied)
+
+
 @implementer(ISFTPFile)
 class GeneralSFTPFile(PrefixingLogMixin):
     """I represent a file handle to a particular file on an SFTP connection.
@@ -1280,6 +1426,9 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
 
         if not writing and (flags & FXF_READ) and filenode and not filenode.is_mutable() and filenode.get_size() <= SIZE_THRESHOLD:
             d.addCallback(lambda ign: ShortReadOnlySFTPFile(userpath, filenode, metadata))
+        elif not writing and (flags & FXF_READ) and filenode and not (filenode.is_mutable() and
+                                                                      filenode.get_version() == SDMF_VERSION):
+            d.addCallback(lambda ign: RandomAccessReadOnlySFTPFile(userpath, filenode, metadata))
         else:
             close_notify = None
             if writing:
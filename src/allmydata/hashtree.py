@@ -58,10 +58,14 @@ from future.utils import PY2
 if PY2:
     from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
+import hashlib
+
 from allmydata.util import mathutil # from the pyutil library
 
 from allmydata.util import base32
-from allmydata.util.hashutil import tagged_hash, tagged_pair_hash
+from allmydata.util.hashutil import tagged_hash, tagged_pair_hash, \
+     CRYPTO_VAL_SIZE
+from allmydata.util.netstring import netstring
 
 __version__ = '1.0.0-allmydata'
 
@@ -99,6 +103,8 @@ class CompleteBinaryTreeMixin(object):
 
     """
 
+    __slots__ = ()
+
     def parent(self, i):
         """
         Index of the parent of C{i}.
@@ -184,10 +190,86 @@ def depth_of(i):
 def empty_leaf_hash(i):
     return tagged_hash(b'Merkle tree empty leaf', b"%d" % i)
 
+INTERNAL_NODE_TAG = b'Merkle tree internal node'
+
 def pair_hash(a, b):
-    return tagged_pair_hash(b'Merkle tree internal node', a, b)
+    return tagged_pair_hash(INTERNAL_NODE_TAG, a, b)
+
+# every node of a tree is a SHA-256d hash
+HASH_SIZE = CRYPTO_VAL_SIZE
+
+# the tag, and the netstring framing of each child, are the same for every
+# internal node, so hash the tag once and frame the children by hand
+_internal_node_hasher = hashlib.sha256(netstring(INTERNAL_NODE_TAG))
+_HASH_PREFIX = b"%d:" % HASH_SIZE
+_HASH_SEPARATOR = b",%d:" % HASH_SIZE
+
+def _hash_pairs(children):
+    """Compute a row of parent hashes at once. 'children' holds an even
+    number of HASH_SIZE-byte hashes, back to back, and I return the
+    pair_hash() of each (left, right) pair of them, back to back."""
+    sha256 = hashlib.sha256
+    parents = []
+    for i in range(0, len(children), 2*HASH_SIZE):
+        h = _internal_node_hasher.copy()
+        h.update(_HASH_PREFIX + children[i:i+HASH_SIZE] + _HASH_SEPARATOR
+                 + children[i+HASH_SIZE:i+2*HASH_SIZE] + b",")
+        parents.append(sha256(h.digest()).digest())
+    return b"".join(parents)
+
+
+class _HashSlots(CompleteBinaryTreeMixin):
+    """
+    Storage for the nodes of a complete binary tree of hashes.
+
+    Rather than a list of separate bytes objects, I keep the tree in one
+    contiguous bytearray of HASH_SIZE-byte slots, node i in slot i. I can be
+    indexed and iterated like the list that HashTree used to be: each node
+    reads as bytes, or as None if it is not known, and slicing gives a list.
+    """
+
+    __slots__ = ("first_leaf_num", "_num_nodes", "_slots", "_view",
+                 "_present")
+
+    def _allocate(self, num_leaves):
+        end = roundup_pow2(num_leaves)
+        self.first_leaf_num = end - 1
+        self._num_nodes = 2*end - 1
+        self._slots = bytearray(HASH_SIZE * self._num_nodes)
+        self._view = memoryview(self._slots)
+        # None if every node is known, else a bytearray of one flag per node
+        self._present = None
+
+    def __len__(self):
+        return self._num_nodes
+
+    def _index(self, i):
+        if i < 0:
+            i += self._num_nodes
+        if not 0 <= i < self._num_nodes:
+            raise IndexError('index out of range: ' + repr(i))
+        return i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._num_nodes))]
+        i = self._index(i)
+        if self._present is not None and not self._present[i]:
+            return None
+        return self._view[i*HASH_SIZE:(i+1)*HASH_SIZE].tobytes()
+
+    def __iter__(self):
+        for i in range(self._num_nodes):
+            yield self[i]
 
-class HashTree(CompleteBinaryTreeMixin, list):
+    def _store(self, i, h):
+        if len(h) != HASH_SIZE:
+            raise ValueError("hash [%d] is %d bytes long, not %d"
+                             % (i, len(h), HASH_SIZE))
+        self._slots[i*HASH_SIZE:(i+1)*HASH_SIZE] = h
+
+
+class HashTree(_HashSlots):
     """
     Compute Merkle hashes at any node in a complete binary tree.
 
@@ -204,6 +286,8 @@ class HashTree(CompleteBinaryTreeMixin, list):
 
     """
 
+    __slots__ = ()
+
     def __init__(self, L):
         """
         Create complete binary tree from list of hash strings.
@@ -218,20 +302,18 @@ class HashTree(CompleteBinaryTreeMixin, list):
 
         # Augment the list.
         start = len(L)
-        end   = roundup_pow2(len(L))
-        self.first_leaf_num = end - 1
-        L     = L + [None] * (end - start)
-        for i in range(start, end):
-            L[i] = empty_leaf_hash(i)
-        # Form each row of the tree.
-        rows = [L]
-        while len(rows[-1]) != 1:
-            last = rows[-1]
-            rows += [[pair_hash(last[2*i], last[2*i+1])
-                                for i in range(len(last)//2)]]
-        # Flatten the list of rows into a single list.
-        rows.reverse()
-        self[:] = sum(rows, [])
+        self._allocate(start)
+        end = self.first_leaf_num + 1
+        L = list(L) + [empty_leaf_hash(i) for i in range(start, end)]
+        for i, h in enumerate(L):
+            self._store(self.first_leaf_num + i, h)
+        # Form each row of the tree from the one below it, a row at a time.
+        lo, hi = self.first_leaf_num, self._num_nodes
+        while lo > 0:
+            parent_lo = (lo - 1) // 2
+            self._slots[parent_lo*HASH_SIZE:lo*HASH_SIZE] = _hash_pairs(
+                self._slots[lo*HASH_SIZE:hi*HASH_SIZE])
+            lo, hi = parent_lo, lo
 
     def needed_hashes(self, leafnum, include_leaf=False):
         """Which hashes will someone need to validate a given data block?
@@ -270,7 +352,7 @@ class NotEnoughHashesError(Exception):
 class BadHashError(Exception):
     pass
 
-class IncompleteHashTree(CompleteBinaryTreeMixin, list):
+class IncompleteHashTree(_HashSlots):
     """I am a hash tree which may or may not be complete. I can be used to
     validate inbound data from some untrustworthy provider who has a subset
     of leaves and a sufficient subset of internal nodes.
@@ -293,20 +375,19 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
 
     """
 
+    __slots__ = ()
+
     def __init__(self, num_leaves):
-        L = [None] * num_leaves
-        start = len(L)
-        end   = roundup_pow2(len(L))
-        self.first_leaf_num = end - 1
-        L     = L + [None] * (end - start)
-        rows = [L]
-        while len(rows[-1]) != 1:
-            last = rows[-1]
-            rows += [[None for i in range(len(last)//2)]]
-        # Flatten the list of rows into a single list.
-        rows.reverse()
-        self[:] = sum(rows, [])
+        self._allocate(num_leaves)
+        self._present = bytearray(self._num_nodes)
 
+    def __setitem__(self, i, h):
+        i = self._index(i)
+        if h is None:
+            self._present[i] = 0
+        else:
+            self._store(i, h)
+            self._present[i] = 1
 
     def needed_hashes(self, leafnum, include_leaf=False):
         """Which new hashes do I need to validate a given data block?
@@ -322,7 +403,7 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
         maybe_needed = set(self.needed_for(self.first_leaf_num + leafnum))
         if include_leaf:
             maybe_needed.add(self.first_leaf_num + leafnum)
-        return set([i for i in maybe_needed if self[i] is None])
+        return set([i for i in maybe_needed if not self._present[i]])
 
     def _name_hash(self, i):
         name = "[%d of %d]" % (i, len(self))
@@ -399,88 +480,94 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
                                        % (leafnum, hashnum))
             new_hashes[hashnum] = leafhash
 
-        remove_upon_failure = set() # we'll remove these if the check fails
-
         # visualize this method in the following way:
         #  A: start with the empty or partially-populated tree as shown in
         #     the HashTree docstring
-        #  B: add all of our input hashes to the tree, filling in some of the
-        #     holes. Don't overwrite anything, but new values must equal the
-        #     existing ones. Mark everything that was added with a red dot
-        #     (meaning "not yet validated")
-        #  C: start with the lowest/deepest level. Pick any red-dotted node,
-        #     hash it with its sibling to compute the parent hash. Add the
-        #     parent to the tree just like in step B (if the parent already
-        #     exists, the values must be equal; if not, add our computed
-        #     value with a red dot). If we have no sibling, throw
-        #     NotEnoughHashesError, since we won't be able to validate this
-        #     node. Remove the red dot. If there was a red dot on our
-        #     sibling, remove it too.
-        #  D: finish all red-dotted nodes in one level before moving up to
-        #     the next.
-        #  E: if we hit NotEnoughHashesError or BadHashError before getting
-        #     to the root, discard every hash we've added.
-
-        try:
-            num_levels = depth_of(len(self)-1)
-            # hashes_to_check[level] is set(index). This holds the "red dots"
-            # described above
-            hashes_to_check = [set() for level in range(num_levels+1)]
-
-            # first we provisionally add all hashes to the tree, comparing
-            # any duplicates
-            for i,h in new_hashes.items():
-                if self[i]:
-                    if self[i] != h:
-                        raise BadHashError("new hash %r does not match "
-                                           "existing hash %r at %r"
-                                           % (base32.b2a(h),
-                                              base32.b2a(self[i]),
-                                              self._name_hash(i)))
+        #  B: add all of our input hashes to a scratch copy of the tree,
+        #     filling in some of the holes. Don't overwrite anything, but new
+        #     values must equal the existing ones. Mark everything that was
+        #     added with a red dot (meaning "not yet validated")
+        #  C: start with the lowest/deepest level. Find the parent of every
+        #     red-dotted node, and hash each of them from its two children in
+        #     one batch. If a red-dotted node has no sibling, throw
+        #     NotEnoughHashesError, since we won't be able to validate it.
+        #     Add each parent to the scratch tree just like in step B (if the
+        #     parent already exists, the values must be equal; if not, add
+        #     our computed value with a red dot). The red dots on this level
+        #     are now gone.
+        #  D: finish each level before moving up to the next.
+        #  E: if we get to the root, copy the scratch hashes into the tree.
+        #     If we hit NotEnoughHashesError or BadHashError before then, the
+        #     tree was never touched.
+
+        # the scratch tree: hashes we are adding, by index
+        added = {}
+        def get(i):
+            h = added.get(i)
+            if h is None:
+                h = self[i]
+            return h
+
+        num_levels = depth_of(len(self)-1)
+        # hashes_to_check[level] is set(index). This holds the "red dots"
+        # described above
+        hashes_to_check = [set() for level in range(num_levels+1)]
+
+        # first we provisionally add all hashes to the scratch tree,
+        # comparing any duplicates
+        for i,h in new_hashes.items():
+            i = self._index(i)
+            existing = self[i]
+            if existing is not None:
+                if existing != h:
+                    raise BadHashError("new hash %r does not match "
+                                       "existing hash %r at %r"
+                                       % (base32.b2a(h),
+                                          base32.b2a(existing),
+                                          self._name_hash(i)))
+            elif len(h) != HASH_SIZE:
+                raise BadHashError("new hash %r at %r is %d bytes long"
+                                   % (base32.b2a(h), self._name_hash(i),
+                                      len(h)))
+            else:
+                hashes_to_check[depth_of(i)].add(i)
+                added[i] = h
+
+        # The root has no sibling, and is never checked. How lonely. You
+        # can't really *check* the root; you either accept it because the
+        # caller told you what it is by including it in hashes, or you
+        # accept it because you calculated it from its two children. You
+        # probably want to set the root (from a trusted source) before
+        # adding any children from an untrusted source.
+        for level in reversed(range(1, num_levels+1)):
+            parents = sorted(set([(child-1)//2
+                                  for child in hashes_to_check[level]]))
+            children = []
+            for parentnum in parents:
+                # make sure we know right from left
+                leftnum, rightnum = 2*parentnum+1, 2*parentnum+2
+                left, right = get(leftnum), get(rightnum)
+                if left is None or right is None:
+                    # without a sibling, we can't compute a parent, and we
+                    # can't verify this node
+                    raise NotEnoughHashesError("unable to validate [%d]"
+                                               % (rightnum if left is None
+                                                  else leftnum))
+                children.extend([left, right])
+            new_parent_hashes = _hash_pairs(b"".join(children))
+            for n, parentnum in enumerate(parents):
+                new_parent_hash = new_parent_hashes[n*HASH_SIZE:
+                                                    (n+1)*HASH_SIZE]
+                existing = get(parentnum)
+                if existing is not None:
+                    if existing != new_parent_hash:
+                        raise BadHashError("h([%d]+[%d]) != h[%d]" %
+                                           (2*parentnum+1, 2*parentnum+2,
+                                            parentnum))
                 else:
-                    level = depth_of(i)
-                    hashes_to_check[level].add(i)
-                    self[i] = h
-                    remove_upon_failure.add(i)
-
-            for level in reversed(range(len(hashes_to_check))):
-                this_level = hashes_to_check[level]
-                while this_level:
-                    i = this_level.pop()
-                    if i == 0:
-                        # The root has no sibling. How lonely. You can't
-                        # really *check* the root; you either accept it
-                        # because the caller told you what it is by including
-                        # it in hashes, or you accept it because you
-                        # calculated it from its two children. You probably
-                        # want to set the root (from a trusted source) before
-                        # adding any children from an untrusted source.
-                        continue
-                    siblingnum = self.sibling(i)
-                    if self[siblingnum] is None:
-                        # without a sibling, we can't compute a parent, and
-                        # we can't verify this node
-                        raise NotEnoughHashesError("unable to validate [%d]"%i)
-                    parentnum = self.parent(i)
-                    # make sure we know right from left
-                    leftnum, rightnum = sorted([i, siblingnum])
-                    new_parent_hash = pair_hash(self[leftnum], self[rightnum])
-                    if self[parentnum]:
-                        if self[parentnum] != new_parent_hash:
-                            raise BadHashError("h([%d]+[%d]) != h[%d]" %
-                                               (leftnum, rightnum, parentnum))
-                    else:
-                        self[parentnum] = new_parent_hash
-                        remove_upon_failure.add(parentnum)
-                        parent_level = depth_of(parentnum)
-                        assert parent_level == level-1
-                        hashes_to_check[parent_level].add(parentnum)
-
-                    # our sibling is now as valid as this node
-                    this_level.discard(siblingnum)
-            # we're done!
-
-        except (BadHashError, NotEnoughHashesError):
-            for i in remove_upon_failure:
-                self[i] = None
-            raise
+                    added[parentnum] = new_parent_hash
+                    hashes_to_check[level-1].add(parentnum)
+        # we're done!
+
+        for i,h in added.items():
+            self[i] = h
@@ -66,6 +66,9 @@ class ValidatedExtendedURIProxy(object):
         # optional
         self.crypttext_hash = None
 
+        # the validated UEB itself
+        self.uri_extension = None
+
     def __str__(self):
         return "<%s %r>" % (self.__class__.__name__, self._verifycap.to_string())
 
@@ -80,6 +83,7 @@ class ValidatedExtendedURIProxy(object):
                 self._fetch_failures["uri_extension"] += 1
             raise BadURIExtensionHashValue(msg)
         else:
+            self.uri_extension = data
             return data
 
     def _parse_and_validate(self, data):
@@ -510,17 +514,22 @@ class Checker(log.PrefixingLogMixin):
 
         storage_server = s.get_storage_server()
         lease_seed = s.get_lease_seed()
+        d2 = None
         if self._add_lease:
             renew_secret = self._get_renewal_secret(lease_seed)
             cancel_secret = self._get_cancel_secret(lease_seed)
-            d2 = storage_server.add_lease(
+            # queued, so that the leases added by a deep-check reach each
+            # server a batch at a time
+            d2 = storage_server.queue_add_lease(
                 storageindex,
                 renew_secret,
                 cancel_secret,
             )
             d2.addErrback(self._add_lease_failed, s.get_name(), storageindex)
 
-        d = storage_server.get_buckets(storageindex)
+        # queued too, so that the files a deep-check looks at together are
+        # asked about a batch at a time
+        d = storage_server.queue_get_buckets(storageindex)
         def _wrap_results(res):
             return (res, True)
 
@@ -534,6 +543,10 @@ class Checker(log.PrefixingLogMixin):
             return ({}, False)
 
         d.addCallbacks(_wrap_results, _trap_errs)
+        if d2 is not None:
+            # the queued lease may be sent after get_buckets, so wait for
+            # it before declaring this server checked
+            d.addCallback(lambda res: d2.addCallback(lambda ign: res))
         return d
 
     def _add_lease_failed(self, f, server_name, storage_index):
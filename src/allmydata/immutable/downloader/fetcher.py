@@ -63,6 +63,10 @@ class SegmentFetcher(object):
         self._running = True
 
     def stop(self):
+        if not self._running:
+            # we stop ourselves before handing our blocks to the node, which
+            # may try to stop us again while it is decoding them
+            return
         log.msg("SegmentFetcher(%r).stop" % self._node._si_prefix,
                 level=log.NOISY, parent=self._lp, umid="LWyqpg")
         self._cancel_all_requests()
@@ -80,6 +84,8 @@ class SegmentFetcher(object):
         # previous segment
         self._shares.extend(shares)
         self._shares.sort(key=lambda s: (s._dyhb_rtt, s._shnum) )
+        # and then by how quickly their servers have been answering lately
+        self._shares = self._node.rank_shares(self._shares)
         eventually(self.loop)
 
     def no_more_shares(self):
@@ -40,7 +40,8 @@ class ShareFinder(object):
     OVERDUE_TIMEOUT = 10.0
 
     def __init__(self, storage_broker, verifycap, node, download_status,
-                 logparent=None, max_outstanding_requests=10):
+                 logparent=None, max_outstanding_requests=10,
+                 share_locations=None):
         self.running = True # stopped by Share.stop, from Terminator
         self.verifycap = verifycap
         self._started = False
@@ -48,6 +49,11 @@ class ShareFinder(object):
         self.share_consumer = self.node = node
         self.max_outstanding_requests = max_outstanding_requests
         self._hungry = False
+        # None, or a ShareLocationCache to learn from and to remember what
+        # we find in
+        self._share_locations = share_locations
+        self._cached_shares = [] # (Share, serverid), from cached buckets
+        self._undelivered_shares = []
 
         self._commonshares = {} # shnum to CommonShare instance
         self.pending_requests = set()
@@ -75,9 +81,50 @@ class ShareFinder(object):
         if not self._started:
             si = self.verifycap.storage_index
             servers = self._storage_broker.get_servers_for_psi(si)
+            servers = self._prefer_fast_servers(servers)
+            if self._share_locations:
+                servers = self._use_cached_locations(servers)
             self._servers = iter(servers)
             self._started = True
 
+    def _prefer_fast_servers(self, servers):
+        # the uploader put the shares on the first N servers in permuted
+        # order, so ask the ones of those which have been quickest lately
+        # first
+        n = self.verifycap.total_shares
+        performance = self._storage_broker.get_server_performance()
+        return (performance.rank(servers[:n], lambda s: s.get_serverid())
+                + list(servers[n:]))
+
+    def _use_cached_locations(self, servers):
+        # if we recently found (or put) this file's shares, we can use the
+        # buckets that a previous download got without asking for them
+        # again, and ask the servers we know to have shares before the rest.
+        # The servers whose buckets we use go last, in case they fail.
+        locations = self._share_locations.get(self._storage_index)
+        if locations is None:
+            return servers
+        seeded = []
+        for server in servers:
+            serverid = server.get_serverid()
+            if serverid not in locations.buckets:
+                continue
+            (cached_server, buckets, dyhb_rtt) = locations.buckets[serverid]
+            self.log(format="using cached buckets [%(shnums)s] from [%(name)s]",
+                     shnums=",".join([str(shnum) for shnum in sorted(buckets)]),
+                     name=server.get_name(), level=log.NOISY, umid="dKx1Tw")
+            for shnum, bucket in buckets.items():
+                s = self._create_share(shnum, bucket, server, dyhb_rtt)
+                self._cached_shares.append((s, serverid))
+            seeded.append(server)
+        self._undelivered_shares = [share for (share, _) in self._cached_shares]
+        holders = [server for server in servers
+                   if server.get_serverid() in locations.shares
+                   and server not in seeded]
+        others = [server for server in servers
+                  if server not in holders and server not in seeded]
+        return holders + others + seeded
+
     def log(self, *args, **kwargs):
         if "parent" not in kwargs:
             kwargs["parent"] = self._lp
@@ -94,6 +141,15 @@ class ShareFinder(object):
         self.log(format="ShareFinder[si=%(si)s] hungry",
                  si=self._si_prefix, level=log.NOISY, umid="NywYaQ")
         self.start_finding_servers()
+        if self._undelivered_shares:
+            shares, self._undelivered_shares = self._undelivered_shares, []
+            self._deliver_shares(shares)
+            return
+        for (s, serverid) in self._cached_shares:
+            if not s.is_alive():
+                # the connection it came from is gone, or the share is
+                self._share_locations.forget_buckets(self._storage_index,
+                                                     serverid)
         self._hungry = True
         eventually(self.loop)
 
@@ -178,6 +234,9 @@ class ShareFinder(object):
         time_received = now()
         d_ev.finished(shnums, time_received)
         dyhb_rtt = time_received - time_sent
+        if buckets and self._share_locations:
+            self._share_locations.add_buckets(self._storage_index, server,
+                                              buckets, dyhb_rtt)
         if not buckets:
             self.log(format="no shares from [%(name)s]", name=server.get_name(),
                      level=log.NOISY, parent=lp, umid="U7d4JA")
@@ -19,6 +19,7 @@ from foolscap.api import eventually
 from allmydata import uri
 from allmydata.codec import CRSDecoder
 from allmydata.util import base32, log, hashutil, mathutil, observer
+from allmydata.util.cputhreadpool import defer_to_thread
 from allmydata.interfaces import DEFAULT_MAX_SEGMENT_SIZE
 from allmydata.hashtree import IncompleteHashTree, BadHashError, \
      NotEnoughHashesError
@@ -26,7 +27,7 @@ from allmydata.hashtree import IncompleteHashTree, BadHashError, \
 # local imports
 from .finder import ShareFinder
 from .fetcher import SegmentFetcher
-from .segmentation import Segmentation
+from .segmentation import Segmentation, DEFAULT_READAHEAD
 from .common import BadCiphertextHashError
 
 class IDownloadStatusHandlingConsumer(Interface):
@@ -51,9 +52,12 @@ class DownloadNode(object):
 
     # Share._node points to me
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history, download_status):
+                 terminator, history, download_status,
+                 readahead=DEFAULT_READAHEAD, segment_cache=None,
+                 share_locations=None):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
+        self._vcap_s = verifycap.to_string()
         self._storage_broker = storage_broker
         self._si_prefix = base32.b2a(verifycap.storage_index[:8])[:12]
         self.running = True
@@ -68,6 +72,12 @@ class DownloadNode(object):
         self._secret_holder = secret_holder
         self._history = history
         self._download_status = download_status
+        # how many segments each read() may request ahead of the one it is
+        # currently delivering
+        self._readahead = readahead
+        # None, or a SegmentCache of validated segments that we consult
+        # before going to the grid
+        self._segment_cache = segment_cache
 
         self.share_hash_tree = IncompleteHashTree(self._verifycap.total_shares)
 
@@ -77,6 +87,12 @@ class DownloadNode(object):
         # .ciphertext_hash_tree (with a dummy, to let us guess which hashes
         # we'll need)
         self._build_guessed_tables(DEFAULT_MAX_SEGMENT_SIZE)
+        # unless the segment cache already knows the real segment size, in
+        # which case our guesses will be right
+        if segment_cache:
+            cached_segment_size = segment_cache.get_segment_size(self._vcap_s)
+            if cached_segment_size:
+                self._build_guessed_tables(cached_segment_size)
 
         # filled in when we parse a valid UEB
         self.have_UEB = False
@@ -110,7 +126,8 @@ class DownloadNode(object):
         self._lp = lp
 
         self._sharefinder = ShareFinder(storage_broker, verifycap, self,
-                                        self._download_status, lp)
+                                        self._download_status, lp,
+                                        share_locations=share_locations)
         self._shares = set()
 
     def _build_guessed_tables(self, max_segment_size):
@@ -173,7 +190,8 @@ class DownloadNode(object):
 
         # for concurrent operations, each read() gets its own Segmentation
         # manager
-        s = Segmentation(self, offset, size, consumer, read_ev, lp)
+        s = Segmentation(self, offset, size, consumer, read_ev, lp,
+                         readahead=self._readahead)
 
         # this raises an interesting question: what segments to fetch? if
         # offset=0, always fetch the first segment, and then allow
@@ -215,6 +233,15 @@ class DownloadNode(object):
         seg_ev = self._download_status.add_segment_request(segnum, now())
         d = defer.Deferred()
         c = Cancel(self._cancel_request)
+        if self._segment_cache:
+            cached = self._segment_cache.get(self._vcap_s, segnum)
+            if cached is not None:
+                (offset, segment) = cached
+                when = now()
+                seg_ev.activate(when)
+                seg_ev.deliver(when, offset, len(segment), 0)
+                eventually(self._deliver, d, c, (offset, segment, 0))
+                return (d, c)
         self._segment_requests.append( (segnum, d, c, seg_ev, lp) )
         self._start_new_segment()
         return (d, c)
@@ -223,6 +250,10 @@ class DownloadNode(object):
         """Return a Deferred that fires when we know the real segment size."""
         if self.segment_size:
             return defer.succeed(self.segment_size)
+        if self._segment_cache:
+            segment_size = self._segment_cache.get_segment_size(self._vcap_s)
+            if segment_size:
+                return defer.succeed(segment_size)
         # TODO: this downloads (and discards) the first segment of the file.
         # We could make this more efficient by writing
         # fetcher.SegmentSizeFetcher, with the job of finding a single valid
@@ -406,6 +437,18 @@ class DownloadNode(object):
     def want_more_shares(self):
         self._sharefinder.hungry()
 
+    def rank_shares(self, shares):
+        """Return the given Shares, best first, by how soon each of their
+        servers is expected to deliver a block, given how they have done
+        lately. Shares on servers we know nothing about keep their place."""
+        block_size = self.block_size
+        if block_size is None:
+            block_size = mathutil.div_ceil(self.guessed_segment_size,
+                                           self._verifycap.needed_shares)
+        performance = self._storage_broker.get_server_performance()
+        return performance.rank(shares, lambda s: s._server.get_serverid(),
+                                block_size)
+
     def fetch_failed(self, sf, f):
         assert sf is self._active_segment
         # deliver error upwards
@@ -417,9 +460,18 @@ class DownloadNode(object):
 
     def process_blocks(self, segnum, blocks):
         start = now()
+        fetcher = self._active_segment
         d = defer.maybeDeferred(self._decode_blocks, segnum, blocks)
         d.addCallback(self._check_ciphertext_hash, segnum)
         def _deliver(result):
+            if self._active_segment is not fetcher:
+                # decoding happens in another thread, and we were stopped
+                # (or every request for this segment was cancelled) while it
+                # was running. Whoever is active now is not interested.
+                log.msg(format="discarding segment(%(segnum)d), no longer"
+                        " wanted", segnum=segnum,
+                        level=log.NOISY, parent=self._lp, umid="0g7Cb4")
+                return
             log.msg(format="delivering segment(%(segnum)d)",
                     segnum=segnum,
                     level=log.OPERATIONAL, parent=self._lp,
@@ -432,6 +484,9 @@ class DownloadNode(object):
                     eventually(self._deliver, d, c, result)
             else:
                 (offset, segment, decodetime) = result
+                if self._segment_cache:
+                    self._segment_cache.put(self._vcap_s, self.segment_size,
+                                            segnum, offset, segment)
                 for (d,c,seg_ev) in self._extract_requests(segnum):
                     # when we have two requests for the same segment, the
                     # second one will not be "activated" before the data is
@@ -456,6 +511,7 @@ class DownloadNode(object):
         codec = self._codec
         block_size = self.block_size
         decoded_size = self.segment_size
+        segment_size = self.segment_size
         if tail:
             # account for the padding in the last segment
             codec = CRSDecoder()
@@ -463,6 +519,7 @@ class DownloadNode(object):
             codec.set_params(self.tail_segment_padded, k, N)
             block_size = self.tail_block_size
             decoded_size = self.tail_segment_padded
+            segment_size = self.tail_segment_size
 
         shares = []
         shareids = []
@@ -472,28 +529,23 @@ class DownloadNode(object):
             shares.append(share)
         del blocks
 
-        d = codec.decode(shares, shareids)   # segment
+        # zfec and the hash function release the GIL, so do both in the CPU
+        # thread pool to keep the reactor free while large segments decode
+        d = defer_to_thread(_decode_and_hash_segment, codec, shares, shareids,
+                            decoded_size, segment_size)
         del shares
-        def _process(buffers):
-            decodetime = now() - start
-            segment = b"".join(buffers)
-            assert len(segment) == decoded_size
-            del buffers
-            if tail:
-                segment = segment[:self.tail_segment_size]
+        def _decoded(res):
             self._download_status.add_misc_event("decode", start, now())
-            return (segment, decodetime)
-        d.addCallback(_process)
+            return res
+        d.addCallback(_decoded)
         return d
 
-    def _check_ciphertext_hash(self, segment_and_decodetime, segnum):
-        (segment, decodetime) = segment_and_decodetime
+    def _check_ciphertext_hash(self, decoded, segnum):
+        (segment, h, decodetime) = decoded
         start = now()
-        assert self._active_segment.segnum == segnum
         assert self.segment_size is not None
         offset = segnum * self.segment_size
 
-        h = hashutil.crypttext_segment_hash(segment)
         try:
             self.ciphertext_hash_tree.set_hashes(leaves={segnum: h})
             self._download_status.add_misc_event("CThash", start, now())
@@ -545,3 +597,23 @@ class DownloadNode(object):
         if self.num_segments is None:
             return (self.guessed_num_segments, False)
         return (self.num_segments, True)
+
+
+def _decode_and_hash_segment(codec, shares, shareids, decoded_size,
+                             segment_size):
+    """
+    Decode one segment and compute its ciphertext hash.  This runs in the
+    CPU thread pool, so it must not touch the DownloadNode.
+
+    :return: a tuple of (segment, crypttext segment hash, seconds spent).
+    """
+    start = now()
+    buffers = codec.decode_synchronously(shares, shareids)
+    segment = b"".join(buffers)
+    assert len(segment) == decoded_size
+    del buffers
+    if segment_size != decoded_size:
+        # trim off the padding of the tail segment
+        segment = segment[:segment_size]
+    h = hashutil.crypttext_segment_hash(segment)
+    return (segment, h, now() - start)
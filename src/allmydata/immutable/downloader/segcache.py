@@ -0,0 +1,146 @@
+"""
+A local cache of downloaded immutable-file segments.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from allmydata.crypto import aes
+from allmydata.interfaces import IStatsProducer
+from allmydata.util import fileutil, hashutil, log
+
+SEGMENT_HASH_TAG = b"allmydata_segment_cache_v1"
+
+
+@implementer(IStatsProducer)
+class SegmentCache(object):
+    """I hold ciphertext segments of immutable files that have already been
+    downloaded and validated, in files under a directory of my own, so that
+    reading the same (popular) file again does not have to go back to the
+    grid.
+
+    One of me is shared by every immutable filenode that a NodeMaker
+    creates. My entries are keyed by (verify-cap, segnum): the verify-cap
+    names both the storage index and the encoding, and so pins down where
+    each segment starts.
+
+    Like fileutil.EncryptedTemporaryFile, I encrypt everything I write with
+    a key that only lives in memory, so my files are of no use to anyone
+    who reads them from the disk, and of no use to me after a restart: I
+    empty my directory when I am created. I also remember the hash of each
+    segment, and anything which does not match it when read back is thrown
+    away, so corrupt files are just misses.
+
+    I am bounded by the total size of the segments I hold, evicting the
+    least-recently-used ones first.
+    """
+
+    def __init__(self, cachedir, max_size):
+        self._cachedir = cachedir
+        self._max_size = max_size
+        self._key = os.urandom(16)  # AES-128
+        # (vcap, segnum) -> (filename, offset, length, iv, hash)
+        self._entries = OrderedDict()
+        self._segment_sizes = {} # vcap -> [segment_size, number of entries]
+        self._size = 0
+        self._next_file = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if os.path.exists(cachedir):
+            fileutil.rm_dir(cachedir)
+        fileutil.make_dirs(cachedir)
+
+    def get_segment_size(self, vcap):
+        """Return the segment size of the file with the given verify-cap, if
+        any of its segments are in the cache, else None."""
+        entry = self._segment_sizes.get(vcap)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def get(self, vcap, segnum):
+        """Return (offset, segment) for the given segment of the given file,
+        or None if I do not hold it."""
+        key = (vcap, segnum)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        (filename, offset, length, iv, segment_hash) = entry
+        try:
+            ciphertext = fileutil.read(filename)
+        except EnvironmentError:
+            ciphertext = None
+        segment = None
+        if ciphertext is not None:
+            segment = aes.decrypt_data(aes.create_decryptor(self._key, iv),
+                                       ciphertext)
+        if (segment is None
+            or hashutil.tagged_hash(SEGMENT_HASH_TAG, segment) != segment_hash):
+            log.msg(format="segment cache: unreadable %(filename)s",
+                    filename=filename, level=log.UNUSUAL, umid="W3t0Yg")
+            self._remove(key)
+            self.misses += 1
+            return None
+        del self._entries[key]
+        self._entries[key] = entry # most-recently used goes last
+        self.hits += 1
+        return (offset, segment)
+
+    def put(self, vcap, segment_size, segnum, offset, segment):
+        """Remember a segment of a file, which has been checked against the
+        file's ciphertext hash tree."""
+        key = (vcap, segnum)
+        if key in self._entries or len(segment) > self._max_size:
+            return
+        filename = os.path.join(self._cachedir, "%d" % self._next_file)
+        self._next_file += 1
+        iv = os.urandom(16)
+        ciphertext = aes.encrypt_data(aes.create_encryptor(self._key, iv),
+                                      segment)
+        try:
+            fileutil.write(filename, ciphertext)
+        except EnvironmentError:
+            log.msg(format="segment cache: unable to write %(filename)s",
+                    filename=filename, level=log.UNUSUAL, umid="oY9vVQ")
+            fileutil.remove_if_possible(filename)
+            return
+        self._entries[key] = (filename, offset, len(segment), iv,
+                              hashutil.tagged_hash(SEGMENT_HASH_TAG, segment))
+        self._size += len(segment)
+        self._segment_sizes.setdefault(vcap, [segment_size, 0])[1] += 1
+        while self._size > self._max_size:
+            oldkey = next(iter(self._entries))
+            self._remove(oldkey)
+            self.evictions += 1
+
+    def _remove(self, key):
+        (filename, _, length, _, _) = self._entries.pop(key)
+        self._size -= length
+        entry = self._segment_sizes[key[0]]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._segment_sizes[key[0]]
+        fileutil.remove_if_possible(filename)
+
+    def get_stats(self):
+        return {
+            "downloader.segment_cache.hits": self.hits,
+            "downloader.segment_cache.misses": self.misses,
+            "downloader.segment_cache.evictions": self.evictions,
+            "downloader.segment_cache.entries": len(self._entries),
+            "downloader.segment_cache.size": self._size,
+        }
@@ -22,19 +22,31 @@ from allmydata.interfaces import DownloadStopped
 
 from .common import BadSegmentNumberError, WrongSegmentError
 
+# how many segments beyond the one being delivered we ask for ahead of time
+DEFAULT_READAHEAD = 2
+
 @implementer(IPushProducer)
 class Segmentation(object):
     """I am responsible for a single offset+size read of the file. I handle
     segmentation: I figure out which segments are necessary, request them
     (from my CiphertextDownloader) in order, and trim the segments down to
     match the offset+size span. I use the Producer/Consumer interface to only
-    request one segment at a time.
+    deliver one segment at a time.
+
+    Once the real segment size is known, I also keep up to 'readahead'
+    requests for the following segments outstanding, so the node can fetch
+    and decode them while my consumer is still busy with the current one.
+    No new read-ahead requests are made while I am paused, and any that are
+    outstanding are cancelled when the read stops or fails.
     """
-    def __init__(self, node, offset, size, consumer, read_ev, logparent=None):
+    def __init__(self, node, offset, size, consumer, read_ev, logparent=None,
+                 readahead=DEFAULT_READAHEAD):
         self._node = node
         self._hungry = True
         self._active_segnum = None
         self._cancel_segment_request = None
+        self._readahead = readahead
+        self._readahead_requests = {} # segnum -> (d, cancel)
         # these are updated as we deliver data. At any given time, we still
         # want to download file[offset:offset+size]
         self._offset = offset
@@ -87,8 +99,13 @@ class Segmentation(object):
                 offset=self._offset, guess=guess_s, segnum=wanted_segnum,
                 level=log.NOISY, parent=self._lp, umid="5WfN0w")
         self._active_segnum = wanted_segnum
-        d,c = n.get_segment(wanted_segnum, self._lp)
+        if wanted_segnum in self._readahead_requests:
+            d,c = self._readahead_requests.pop(wanted_segnum)
+        else:
+            d,c = n.get_segment(wanted_segnum, self._lp)
         self._cancel_segment_request = c
+        if have_actual_segment_size:
+            self._fetch_ahead(wanted_segnum, segment_size)
         d.addBoth(self._request_retired)
         d.addCallback(self._got_segment, wanted_segnum)
         if not have_actual_segment_size:
@@ -96,6 +113,29 @@ class Segmentation(object):
             d.addErrback(self._retry_bad_segment)
         d.addErrback(self._error)
 
+    def _fetch_ahead(self, current_segnum, segment_size):
+        # ask for the segments after current_segnum that this read will
+        # need, up to our read-ahead depth
+        last_segnum = (self._offset + self._size - 1) // segment_size
+        last_segnum = min(last_segnum, current_segnum + self._readahead)
+        for segnum in range(current_segnum+1, last_segnum+1):
+            if segnum in self._readahead_requests:
+                continue
+            log.msg(format="_fetch_ahead: requesting segnum=%(segnum)d",
+                    segnum=segnum,
+                    level=log.NOISY, parent=self._lp, umid="sQ8bTk")
+            self._readahead_requests[segnum] = self._node.get_segment(segnum,
+                                                                      self._lp)
+
+    def _cancel_readahead(self):
+        requests = list(self._readahead_requests.values())
+        self._readahead_requests.clear()
+        for (d,c) in requests:
+            c.cancel()
+            # the request might already have failed before being cancelled,
+            # and nobody is going to look at that failure
+            d.addErrback(lambda f: None)
+
     def _request_retired(self, res):
         self._active_segnum = None
         self._cancel_segment_request = None
@@ -154,6 +194,7 @@ class Segmentation(object):
                 level=log.WEIRD, parent=self._lp, umid="EYlXBg")
         self._alive = False
         self._hungry = False
+        self._cancel_readahead()
         self._deferred.errback(f)
 
     def stopProducing(self):
@@ -165,6 +206,7 @@ class Segmentation(object):
         if self._cancel_segment_request:
             self._cancel_segment_request.cancel()
             self._cancel_segment_request = None
+        self._cancel_readahead()
         e = DownloadStopped("our Consumer called stopProducing()")
         self._deferred.errback(e)
 
@@ -71,6 +71,7 @@ class DYHBEvent(object):
         self._ev["success"] = True
         self._ev["response_shnums"] = shnums
         self._ds.update_last_timestamp(when)
+        self._ds.record_server_timing(self._ev, 0)
 
 
 class BlockRequestEvent(object):
@@ -84,6 +85,7 @@ class BlockRequestEvent(object):
         self._ev["success"] = True
         self._ev["response_length"] = received
         self._ds.update_last_timestamp(when)
+        self._ds.record_server_timing(self._ev, received)
 
     def error(self, when):
         self._ev["finish_time"] = when
@@ -102,6 +104,8 @@ class DownloadStatus(object):
         self.size = size
         self.counter = next(self.statusid_counter)
         self.helper = False
+        self.readahead = 0
+        self._server_performance = None
 
         self.first_timestamp = None
         self.last_timestamp = None
@@ -215,6 +219,17 @@ class DownloadStatus(object):
         self.block_requests.append(r)
         return BlockRequestEvent(r, self)
 
+    def set_server_performance(self, server_performance):
+        # the storage broker's ServerPerformance, which learns from the
+        # timings of our DYHB and block requests
+        self._server_performance = server_performance
+
+    def record_server_timing(self, ev, received):
+        if self._server_performance is not None:
+            self._server_performance.record_transfer(
+                ev["server"].get_serverid(), received,
+                ev["finish_time"] - ev["start_time"])
+
     def update_last_timestamp(self, when):
         if self.last_timestamp is None or when > self.last_timestamp:
             self.last_timestamp = when
@@ -225,6 +240,9 @@ class DownloadStatus(object):
     def add_problem(self, p):
         self.problems.append(p)
 
+    def set_readahead(self, readahead):
+        self.readahead = readahead
+
     # IDownloadStatus methods
     def get_counter(self):
         return self.counter
@@ -273,6 +291,9 @@ class DownloadStatus(object):
     def using_helper(self):
         return False
 
+    def get_readahead(self):
+        return self.readahead
+
     def get_active(self):
         # a download is considered active if it has at least one outstanding
         # read() call
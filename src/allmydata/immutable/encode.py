@@ -16,11 +16,13 @@ if PY2:
 import time
 from zope.interface import implementer
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from foolscap.api import fireEventually
 from allmydata import uri
 from allmydata.storage.server import si_b2a
 from allmydata.hashtree import HashTree
 from allmydata.util import mathutil, hashutil, base32, log, happinessutil
+from allmydata.util.cputhreadpool import defer_to_thread
 from allmydata.util.assertutil import _assert, precondition
 from allmydata.codec import CRSEncoder
 from allmydata.interfaces import IEncoder, IStorageBucketWriter, \
@@ -28,6 +30,7 @@ from allmydata.interfaces import IEncoder, IStorageBucketWriter, \
 
 from ..util.eliotutil import (
     log_call_deferred,
+    inline_callbacks,
 )
 
 """
@@ -87,14 +90,22 @@ GiB=1024*MiB
 TiB=1024*GiB
 PiB=1024*TiB
 
+# How many segments the Encoder keeps in flight at once (read and encrypted,
+# being erasure-coded in a worker thread, or being pushed to shareholders).
+# Peak memory is roughly this many times (1 + N/k) segments.
+DEFAULT_PIPELINE_DEPTH = 2
+
 @implementer(IEncoder)
 class Encoder(object):
 
-    def __init__(self, log_parent=None, upload_status=None):
+    def __init__(self, log_parent=None, upload_status=None,
+                 pipeline_depth=DEFAULT_PIPELINE_DEPTH):
         object.__init__(self)
+        precondition(pipeline_depth >= 1, pipeline_depth)
         self.uri_extension_data = {}
         self._codec = None
         self._status = None
+        self._pipeline_depth = pipeline_depth
         if upload_status:
             self._status = IUploadStatus(upload_status)
         precondition(log_parent is None or isinstance(log_parent, int),
@@ -236,6 +247,7 @@ class Encoder(object):
         self.share_root_hashes = [None] * self.num_shares
 
         self._times = {
+            "cumulative_reading": 0.0,
             "cumulative_encoding": 0.0,
             "cumulative_sending": 0.0,
             "hashes_and_close": 0.0,
@@ -246,20 +258,7 @@ class Encoder(object):
         d = fireEventually()
 
         d.addCallback(lambda res: self.start_all_shareholders())
-
-        for i in range(self.num_segments-1):
-            # note to self: this form doesn't work, because lambda only
-            # captures the slot, not the value
-            #d.addCallback(lambda res: self.do_segment(i))
-            # use this form instead:
-            d.addCallback(lambda res, i=i: self._encode_segment(i, is_tail=False))
-            d.addCallback(self._send_segment, i)
-            d.addCallback(self._turn_barrier)
-        last_segnum = self.num_segments - 1
-        d.addCallback(lambda res: self._encode_segment(last_segnum, is_tail=True))
-        d.addCallback(self._send_segment, last_segnum)
-        d.addCallback(self._turn_barrier)
-
+        d.addCallback(lambda res: self._encode_and_send_all_segments())
         d.addCallback(lambda res: self.finish_hashing())
 
         d.addCallback(lambda res:
@@ -314,6 +313,68 @@ class Encoder(object):
             dl.append(d)
         return self._gather_responses(dl)
 
+    @inline_callbacks
+    def _encode_and_send_all_segments(self):
+        """
+        Read, encode and push every segment of the file.
+
+        Segments are read (and hashed) strictly in order, since the
+        ciphertext hashes depend on it, and are pushed to the shareholders
+        in order too.  In between, each segment is erasure-coded in the CPU
+        thread pool, so encoding of later segments overlaps with the network
+        sends of earlier ones.  At most ``self._pipeline_depth`` segments are
+        in flight at any moment, which bounds our memory footprint.
+
+        :return: A ``Deferred`` that fires when the last segment has been
+            sent, or fails with the first error encountered.
+        """
+        limiter = defer.DeferredSemaphore(self._pipeline_depth)
+        failures = []
+        # every segment's send is appended to this one chain, which keeps
+        # them in segnum order
+        sent = defer.succeed(None)
+        for segnum in range(self.num_segments):
+            yield limiter.acquire()
+            if failures:
+                break
+            is_tail = (segnum == self.num_segments - 1)
+            try:
+                chunks = yield self._read_segment(segnum, is_tail)
+            except Exception:
+                failures.append(Failure())
+                break
+            encoded = self._encode_chunks(chunks, is_tail)
+            del chunks
+            self._send_in_order(sent, encoded, segnum, limiter, failures)
+            del encoded
+        yield sent
+        if failures:
+            failures[0].raiseException()
+
+    def _send_in_order(self, sent, encoded, segnum, limiter, failures):
+        """
+        Arrange for segment ``segnum`` to be sent once both it has been
+        encoded and every earlier segment has been sent, then release its
+        slot in the pipeline.  Failures are recorded in ``failures`` rather
+        than propagated, so that segments still in the pipeline are skipped
+        instead of being sent.
+        """
+        def _wait_for_encoding(ignored):
+            return encoded
+        def _send(shares_and_shareids):
+            if failures:
+                return None
+            return self._send_segment(shares_and_shareids, segnum)
+        def _failed(f):
+            failures.append(f)
+        def _release(ignored):
+            limiter.release()
+        sent.addCallback(_wait_for_encoding)
+        sent.addCallback(_send)
+        sent.addCallback(self._turn_barrier)
+        sent.addErrback(_failed)
+        sent.addCallback(_release)
+
     def _encode_segment(self, segnum, is_tail):
         """
         Encode one segment of input into the configured number of shares.
@@ -325,11 +386,24 @@ class Encoder(object):
         :param bool is_tail: ``True`` if this is the last segment, ``False``
             otherwise.
 
-        :return: A ``Deferred`` which fires with a two-tuple.  The first
+        :return: A ``Deferred`` which fires with a three-tuple.  The first
             element is a list of string-y objects representing the encoded
             segment data for one of the shares.  The second element is a list
             of integers giving the share numbers of the shares in the first
-            element.
+            element.  The third element is a list of the block hashes of the
+            shares in the first element.
+        """
+        d = self._read_segment(segnum, is_tail)
+        d.addCallback(self._encode_chunks, is_tail)
+        return d
+
+    def _read_segment(self, segnum, is_tail):
+        """
+        Read the next segment of ciphertext and chop it into pieces for the
+        codec.
+
+        :return: A ``Deferred`` which fires with a list of ``required_shares``
+            input pieces, each of the codec's block size.
         """
         codec = self._tail_codec if is_tail else self._codec
         start = time.time()
@@ -359,8 +433,9 @@ class Encoder(object):
         # given time. We build up a segment's worth of cryptttext, then hand
         # it to the encoder. Assuming 3-of-10 encoding (3.3x expansion) and
         # 1MiB max_segment_size, we get a peak memory footprint of 4.3*1MiB =
-        # 4.3MiB. Lowering max_segment_size to, say, 100KiB would drop the
-        # footprint to 430KiB at the expense of more hash-tree overhead.
+        # 4.3MiB per segment in the pipeline. Lowering max_segment_size to,
+        # say, 100KiB would drop the footprint to 430KiB at the expense of
+        # more hash-tree overhead.
 
         d = self._gather_data(self.required_shares, input_piece_size,
                               crypttext_segment_hasher, allow_short=is_tail)
@@ -370,16 +445,32 @@ class Encoder(object):
                 # by _gather_data
                 assert len(c) == input_piece_size
             self._crypttext_hashes.append(crypttext_segment_hasher.digest())
-            # during this call, we hit 5*segsize memory
-            return codec.encode(chunks)
-        d.addCallback(_done_gathering)
-        def _done(res):
             elapsed = time.time() - start
-            self._times["cumulative_encoding"] += elapsed
-            return res
-        d.addCallback(_done)
+            self._times["cumulative_reading"] += elapsed
+            return chunks
+        d.addCallback(_done_gathering)
+        return d
+
+    def _encode_chunks(self, chunks, is_tail):
+        """
+        Erasure-code one segment's worth of input pieces and hash the
+        resulting blocks, in the CPU thread pool.
+
+        :return: A ``Deferred`` which fires with a three-tuple, as for
+            ``_encode_segment``.
+        """
+        codec = self._tail_codec if is_tail else self._codec
+        d = defer_to_thread(_encode_and_hash_blocks, codec, chunks)
+        d.addCallback(self._encoded)
         return d
 
+    def _encoded(self, result_and_elapsed):
+        (result, elapsed) = result_and_elapsed
+        # this is worker-thread time, so with a deep pipeline it may add up to
+        # more than the wall-clock time of the upload
+        self._times["cumulative_encoding"] += elapsed
+        return result
+
     def _gather_data(self, num_chunks, input_chunk_size,
                      crypttext_segment_hasher,
                      allow_short=False):
@@ -417,24 +508,23 @@ class Encoder(object):
             precondition(len(data) <= read_size, len(data), read_size)
             if not allow_short:
                 precondition(len(data) == read_size, len(data), read_size)
-            crypttext_segment_hasher.update(data)
-            self._crypttext_hasher.update(data)
-            if allow_short and len(data) < read_size:
-                # padding
-                data += b"\x00" * (read_size - len(data))
-            encrypted_pieces = [data[i:i+input_chunk_size]
-                                for i in range(0, len(data), input_chunk_size)]
-            return encrypted_pieces
+            # reads happen one segment at a time, so these hashers see the
+            # ciphertext in order even though the hashing itself happens in
+            # a worker thread
+            return defer_to_thread(_hash_and_split, data,
+                                   [crypttext_segment_hasher,
+                                    self._crypttext_hasher],
+                                   read_size, input_chunk_size)
         d.addCallback(_got)
         return d
 
-    def _send_segment(self, shares_and_shareids, segnum):
+    def _send_segment(self, encoded, segnum):
         # To generate the URI, we must generate the roothash, so we must
         # generate all shares, even if we aren't actually giving them to
         # anybody. This means that the set of shares we create will be equal
         # to or larger than the set of landlords. If we have any landlord who
         # *doesn't* have a share, that's an error.
-        (shares, shareids) = shares_and_shareids
+        (shares, shareids, block_hashes) = encoded
         _assert(set(self.landlords.keys()).issubset(set(shareids)),
                 shareids=shareids, landlords=self.landlords)
         start = time.time()
@@ -449,13 +539,12 @@ class Encoder(object):
             d = self.send_block(shareid, segnum, block, lognum)
             dl.append(d)
 
-            block_hash = hashutil.block_hash(block)
             #from allmydata.util import base32
             #log.msg("creating block (shareid=%d, blocknum=%d) "
             #        "len=%d %r .. %r: %s" %
             #        (shareid, segnum, len(block),
-            #         block[:50], block[-50:], base32.b2a(block_hash)))
-            self.block_hashes[shareid].append(block_hash)
+            #         block[:50], block[-50:], base32.b2a(block_hashes[i])))
+            self.block_hashes[shareid].append(block_hashes[i])
 
         dl = self._gather_responses(dl)
 
@@ -694,3 +783,33 @@ class Encoder(object):
         return self.uri_extension_data
     def get_uri_extension_hash(self):
         return self.uri_extension_hash
+
+
+# The following functions run in the CPU thread pool, so they must only work
+# on their arguments.
+
+def _hash_and_split(data, hashers, read_size, input_chunk_size):
+    """
+    Feed one segment of ciphertext to ``hashers``, pad it out to
+    ``read_size`` if it is short, and chop it into codec input pieces.
+    """
+    for hasher in hashers:
+        hasher.update(data)
+    if len(data) < read_size:
+        # padding
+        data += b"\x00" * (read_size - len(data))
+    return [data[i:i+input_chunk_size]
+            for i in range(0, len(data), input_chunk_size)]
+
+def _encode_and_hash_blocks(codec, chunks, desired_share_ids=None):
+    """
+    Erasure-code one segment and compute the block hash of each share, or of
+    each of ``desired_share_ids`` only.
+
+    :return: ``((shares, shareids, block_hashes), elapsed)``
+    """
+    start = time.time()
+    # during this call, we hit 5*segsize memory
+    (shares, shareids) = codec.encode_synchronously(chunks, desired_share_ids)
+    block_hashes = [hashutil.block_hash(block) for block in shares]
+    return ((shares, shareids, block_hashes), time.time() - start)
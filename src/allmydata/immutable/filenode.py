@@ -33,16 +33,21 @@ from allmydata.immutable.repairer import Repairer
 from allmydata.immutable.downloader.node import DownloadNode, \
      IDownloadStatusHandlingConsumer
 from allmydata.immutable.downloader.status import DownloadStatus
+from allmydata.immutable.downloader.segmentation import DEFAULT_READAHEAD
 
 class CiphertextFileNode(object):
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history):
+                 terminator, history, readahead=DEFAULT_READAHEAD,
+                 segment_cache=None, share_locations=None):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._terminator = terminator
         self._history = history
+        self._readahead = readahead
+        self._segment_cache = segment_cache
+        self._share_locations = share_locations
         self._download_status = None
         self._node = None # created lazily, on read()
 
@@ -50,6 +55,9 @@ class CiphertextFileNode(object):
         if not self._download_status:
             ds = DownloadStatus(self._verifycap.storage_index,
                                 self._verifycap.size)
+            ds.set_readahead(self._readahead)
+            ds.set_server_performance(
+                self._storage_broker.get_server_performance())
             if self._history:
                 self._history.add_download(ds)
             self._download_status = ds
@@ -57,7 +65,10 @@ class CiphertextFileNode(object):
             self._node = DownloadNode(self._verifycap, self._storage_broker,
                                       self._secret_holder,
                                       self._terminator,
-                                      self._history, self._download_status)
+                                      self._history, self._download_status,
+                                      readahead=self._readahead,
+                                      segment_cache=self._segment_cache,
+                                      share_locations=self._share_locations)
 
     def read(self, consumer, offset=0, size=None):
         """I am the main entry point, from which FileNode.read() can get
@@ -110,9 +121,20 @@ class CiphertextFileNode(object):
                     secret_holder=self._secret_holder,
                     monitor=monitor)
         d = c.start()
+        d.addCallback(self._remember_locations)
         d.addCallback(self._maybe_repair, monitor)
         return d
 
+    def _remember_locations(self, cr):
+        # a check asks every server, so it knows where all the shares are
+        if self._share_locations:
+            sharemap = dict((shnum, set(server.get_serverid()
+                                        for server in servers))
+                            for (shnum, servers) in cr.get_sharemap().items())
+            self._share_locations.add_sharemap(cr.get_storage_index(),
+                                               sharemap)
+        return cr
+
     def _maybe_repair(self, cr, monitor):
         crr = CheckAndRepairResults(self._verifycap.storage_index)
         crr.pre_repair_results = cr
@@ -130,7 +152,7 @@ class CiphertextFileNode(object):
             return f
         r = Repairer(self, storage_broker=self._storage_broker,
                      secret_holder=self._secret_holder,
-                     monitor=monitor)
+                     monitor=monitor, check_results=cr)
         d = r.start()
         d.addCallbacks(self._gather_repair_results, _repair_error,
                        callbackArgs=(cr, crr,))
@@ -181,6 +203,7 @@ class CiphertextFileNode(object):
                            servermap=None)
         crr.repair_successful = is_healthy
         crr.post_repair_results = prr
+        self._remember_locations(prr)
         return crr
 
     def check(self, monitor, verify=False, add_lease=False):
@@ -192,7 +215,9 @@ class CiphertextFileNode(object):
         v = Checker(verifycap=verifycap, servers=servers,
                     verify=verify, add_lease=add_lease, secret_holder=sh,
                     monitor=monitor)
-        return v.start()
+        d = v.start()
+        d.addCallback(self._remember_locations)
+        return d
 
 @implementer(IConsumer, IDownloadStatusHandlingConsumer)
 class DecryptingConsumer(object):
@@ -245,11 +270,15 @@ class ImmutableFileNode(object):
 
     # I wrap a CiphertextFileNode with a decryption key
     def __init__(self, filecap, storage_broker, secret_holder, terminator,
-                 history):
+                 history, readahead=DEFAULT_READAHEAD, segment_cache=None,
+                 share_locations=None):
         assert isinstance(filecap, uri.CHKFileURI)
         verifycap = filecap.get_verify_cap()
         self._cnode = CiphertextFileNode(verifycap, storage_broker,
-                                         secret_holder, terminator, history)
+                                         secret_holder, terminator, history,
+                                         readahead=readahead,
+                                         segment_cache=segment_cache,
+                                         share_locations=share_locations)
         assert isinstance(filecap, uri.CHKFileURI)
         self.u = filecap
         self._readkey = filecap.key
@@ -0,0 +1,106 @@
+"""
+A persistent cache of convergent encryption keys for local files.
+
+Computing the convergent key of a file means reading all of it, before
+encryption can begin. When the same unchanged file is uploaded again, this
+cache lets the uploader skip that pass. A file is considered unchanged if
+its path, size, mtime and inode number all match what was recorded when its
+key was computed; a different convergence secret or encoding parameters
+give a different key, so those are part of the index too.
+
+The cached keys are as sensitive as the filecaps they lead to, so the
+database belongs in the node's private directory.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from allmydata.util import base32
+from allmydata.util.dbutil import get_db
+from allmydata.util.hashutil import convergence_key_cache_params
+
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE convergence_keys
+(
+ path   VARCHAR(1024), -- absolute local filename
+ params VARCHAR(64),   -- base32(convergence_key_cache_params(k,n,segsize,convergence))
+ size   INTEGER,       -- os.stat(fn).st_size
+ mtime  NUMBER,        -- os.stat(fn).st_mtime
+ inode  INTEGER,       -- os.stat(fn).st_ino
+ key    VARCHAR(32),   -- base32(AES key)
+ PRIMARY KEY (path, params)
+);
+"""
+
+
+def get_convergence_key_cache(dbfile):
+    """
+    Open or create the key cache database at ``dbfile``, whose parent
+    directory must exist.
+
+    :raise DBError: If the file cannot be opened or is not a key cache.
+    :return ConvergenceKeyCache:
+    """
+    (sqlite3, db) = get_db(dbfile, create_version=(SCHEMA_v1, 1),
+                           dbname="convergence key cache")
+    return ConvergenceKeyCache(db)
+
+
+class ConvergenceKeyCache(object):
+    def __init__(self, db):
+        self._db = db
+        self._cursor = db.cursor()
+
+    def _params(self, encoding_parameters, convergence):
+        (k, happy, n, segsize) = encoding_parameters
+        params = convergence_key_cache_params(k, n, segsize, convergence)
+        return base32.b2a(params).decode("ascii")
+
+    def get_key(self, path, stat, encoding_parameters, convergence):
+        """
+        :param path: The absolute local filename.
+        :param stat: The ``os.stat`` result for the file as it is now.
+        :param encoding_parameters: (k, happy, n, segsize) for the upload.
+        :param bytes convergence: The convergence secret.
+
+        :return: The convergent key recorded for this file, or None if
+            there is none or the file has changed since it was recorded.
+        """
+        c = self._cursor
+        c.execute("SELECT size,mtime,inode,key FROM convergence_keys"
+                  " WHERE path=? AND params=?",
+                  (path, self._params(encoding_parameters, convergence)))
+        row = c.fetchone()
+        if not row:
+            return None
+        (size, mtime, inode, key) = row
+        if (size, mtime, inode) != (stat.st_size, stat.st_mtime, stat.st_ino):
+            return None
+        return base32.a2b(key.encode("ascii"))
+
+    def set_key(self, path, stat, encoding_parameters, convergence, key):
+        """
+        Record ``key`` as the convergent key of the file at ``path``, which
+        had the given ``os.stat`` result when it was read.
+        """
+        c = self._cursor
+        c.execute("INSERT OR REPLACE INTO convergence_keys"
+                  " (path,params,size,mtime,inode,key)"
+                  " VALUES (?,?,?,?,?,?)",
+                  (path, self._params(encoding_parameters, convergence),
+                   stat.st_size, stat.st_mtime, stat.st_ino,
+                   base32.b2a(key).decode("ascii")))
+        self._db.commit()
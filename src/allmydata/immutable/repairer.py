@@ -12,12 +12,197 @@ if PY2:
 
 from zope.interface import implementer
 from twisted.internet import defer
+from foolscap.api import DeadReferenceError, RemoteException
+from allmydata import hashtree, uri
+from allmydata.hashtree import HashTree, IncompleteHashTree
 from allmydata.storage.server import si_b2a
-from allmydata.util import log, consumer
+from allmydata.util import log, consumer, deferredutil, hashutil
 from allmydata.util.assertutil import precondition
+from allmydata.util.cputhreadpool import defer_to_thread
+from allmydata.util.happinessutil import servers_of_happiness
 from allmydata.interfaces import IEncryptedUploadable
 
-from allmydata.immutable import upload
+from allmydata.immutable import encode, layout, upload
+from allmydata.immutable.checker import ValidatedExtendedURIProxy, \
+     ValidatedReadBucketProxy, IntegrityCheckReject
+from allmydata.immutable.layout import LayoutInvalid, \
+     RidiculouslyLargeURIExtensionBlock
+
+# what a server or a share we read hashes from may fail with. The repair
+# goes on without that share.
+_SHARE_ERRORS = (DeadReferenceError, RemoteException, IntegrityCheckReject,
+                 layout.ShareVersionIncompatible, LayoutInvalid,
+                 RidiculouslyLargeURIExtensionBlock)
+
+
+def _leaves_under(t, i):
+    """Return the numbers of the leaves of hash tree 't' below node 'i'."""
+    nodes = [i]
+    leaves = []
+    while nodes:
+        n = nodes.pop()
+        if n >= t.first_leaf_num:
+            leaves.append(n - t.first_leaf_num)
+        else:
+            nodes.extend([t.lchild(n), t.rchild(n)])
+    return sorted(leaves)
+
+
+def _nearest_to(shnum):
+    """Return a sort key which puts the shares whose leaves are nearest to
+    that of share 'shnum' in the share hash tree first."""
+    return lambda other: ((shnum ^ other).bit_length(), other)
+
+
+class RepairEncoder(encode.Encoder):
+    """I am an Encoder which makes only some of the shares of a file that
+    already exists, to go alongside the shares which are still out there.
+
+    I am given the file's validated UEB and the part of its share hash tree
+    which could be read from the existing shares. Rather than all N shares,
+    I erasure-code the ones being placed, plus any whose share hash I need
+    to work out a node of the tree which the placed shares must carry and
+    which was not read. The share hashes I make must fit the existing tree,
+    and the ciphertext I read must match the UEB, or I fail rather than
+    write shares which could never be downloaded. Each new share gets a copy
+    of the original UEB, so the file's verify cap is unchanged.
+    """
+
+    def __init__(self, ueb, share_hash_tree, *args, **kwargs):
+        super(RepairEncoder, self).__init__(*args, **kwargs)
+        self._ueb = ueb
+        self._share_hash_tree = share_hash_tree
+        self._encode_shnums = None
+        self._padding_leaves = {}
+
+    def set_shareholders(self, landlords, servermap):
+        super(RepairEncoder, self).set_shareholders(landlords, servermap)
+        t = self._share_hash_tree
+        encode_shnums = set(landlords)
+        for shnum in landlords:
+            for i in t.needed_for(t.get_leaf_index(shnum)):
+                if t[i] is not None:
+                    continue
+                for leafnum in _leaves_under(t, i):
+                    if leafnum >= self.num_shares:
+                        # the leaves past the last share are padding, as in
+                        # HashTree
+                        self._padding_leaves[leafnum] = \
+                            hashtree.empty_leaf_hash(leafnum)
+                    elif t.get_leaf(leafnum) is None:
+                        encode_shnums.add(leafnum)
+        self._encode_shnums = sorted(encode_shnums)
+        self.log(format="repair will encode shares %(shnums)s of %(N)d",
+                 shnums=self._encode_shnums, N=self.num_shares,
+                 level=log.OPERATIONAL)
+
+    def _encode_chunks(self, chunks, is_tail):
+        codec = self._tail_codec if is_tail else self._codec
+        d = defer_to_thread(encode._encode_and_hash_blocks, codec, chunks,
+                            self._encode_shnums)
+        d.addCallback(self._encoded)
+        return d
+
+    def send_crypttext_hash_tree_to_all_shareholders(self):
+        crypttext_root_hash = HashTree(self._crypttext_hashes)[0]
+        if crypttext_root_hash != self._ueb.crypttext_root_hash:
+            raise hashtree.BadHashError("repaired ciphertext does not match "
+                                        "the crypttext_root_hash in the UEB")
+        return super(RepairEncoder,
+                     self).send_crypttext_hash_tree_to_all_shareholders()
+
+    def send_all_block_hash_trees(self):
+        self.log("sending block hash trees", level=log.NOISY)
+        self.set_status("Sending Subshare Hash Trees")
+        self.set_encode_and_push_progress(extra=0.4)
+        dl = []
+        for shareid in self._encode_shnums:
+            dl.append(self.send_one_block_hash_tree(shareid,
+                                                    self.block_hashes[shareid]))
+        return self._gather_responses(dl)
+
+    def send_all_share_hash_trees(self):
+        self.log("sending all share hash trees", level=log.NOISY)
+        self.set_status("Sending Share Hash Trees")
+        self.set_encode_and_push_progress(extra=0.6)
+        t = self._share_hash_tree
+        leaves = dict(self._padding_leaves)
+        for shareid in self._encode_shnums:
+            leaves[shareid] = self.share_root_hashes[shareid]
+        # this raises BadHashError unless the shares we made are the ones
+        # the existing tree (and so the verify cap) describes
+        t.set_hashes(leaves=leaves)
+        dl = []
+        for shareid in list(self.landlords):
+            leafnum = t.get_leaf_index(shareid)
+            needed_hash_indices = t.needed_for(leafnum) + [leafnum]
+            hashes = [(hi, t[hi]) for hi in sorted(needed_hash_indices)]
+            dl.append(self.send_one_share_hash_tree(shareid, hashes))
+        return self._gather_responses(dl)
+
+    def send_uri_extension_to_all_shareholders(self):
+        self.log("sending uri_extension", level=log.NOISY)
+        self.set_status("Sending URI Extensions")
+        self.set_encode_and_push_progress(extra=0.8)
+        crypttext_hash = self.uri_extension_data["crypttext_hash"]
+        if (self._ueb.crypttext_hash is not None
+            and crypttext_hash != self._ueb.crypttext_hash):
+            raise hashtree.BadHashError("repaired ciphertext does not match "
+                                        "the crypttext_hash in the UEB")
+        uri_extension = self._ueb.uri_extension
+        self.uri_extension_data = uri.unpack_extension(uri_extension)
+        self.uri_extension_hash = hashutil.uri_extension_hash(uri_extension)
+        dl = []
+        for shareid in list(self.landlords):
+            dl.append(self.send_uri_extension(shareid, uri_extension))
+        return self._gather_responses(dl)
+
+
+class RepairUploader(upload.CHKUploader):
+    """I am a CHKUploader which puts the shares of an existing file which
+    are missing, using a RepairEncoder."""
+
+    def __init__(self, ueb, share_hash_tree, *args, **kwargs):
+        super(RepairUploader, self).__init__(*args, **kwargs)
+        self._ueb = ueb
+        self._share_hash_tree = share_hash_tree
+
+    def set_shareholders(self, upload_trackers, already_serverids, encoder):
+        # the server selector may also have found room for more copies of
+        # shares which are still out there. Making those costs as much as
+        # making the missing ones, so keep only the copies which spread the
+        # shares over more servers, and give the space for the rest back.
+        # A copy may only help along with others (when the selector moves
+        # every share one server along, say), so start from the happiness
+        # of all of them, and drop each one that it does not depend on.
+        servermap = dict((shnum, set(serverids))
+                         for (shnum, serverids) in already_serverids.items())
+        copies = []
+        for tracker in upload_trackers:
+            for shnum in sorted(tracker.buckets):
+                if shnum in already_serverids:
+                    copies.append((tracker, shnum))
+                servermap.setdefault(shnum, set()).add(tracker.get_serverid())
+        happiness = servers_of_happiness(servermap)
+        for (tracker, shnum) in copies:
+            servermap[shnum].discard(tracker.get_serverid())
+            if servers_of_happiness(servermap) < happiness:
+                servermap[shnum].add(tracker.get_serverid())
+            else:
+                tracker.buckets.pop(shnum).abort()
+        super(RepairUploader, self).set_shareholders(upload_trackers,
+                                                     already_serverids,
+                                                     encoder)
+
+    def make_encoder(self):
+        return RepairEncoder(
+            self._ueb,
+            self._share_hash_tree,
+            self._log_number,
+            self._upload_status,
+            pipeline_depth=self._pipeline_depth,
+        )
+
 
 @implementer(IEncryptedUploadable)
 class Repairer(log.PrefixingLogMixin):
@@ -50,9 +235,17 @@ class Repairer(log.PrefixingLogMixin):
     Before I send any new request to a server, I always ask the 'monitor'
     object that was passed into my constructor whether this task has been
     cancelled (by invoking its raise_if_cancelled() method).
+
+    If I am given the 'check_results' which found the file unhealthy, I
+    first read the UEB and some share hash tree nodes from the shares it
+    found, and then erasure-code only the shares which are to be placed
+    (see RepairEncoder), rather than all N of them, and upload only the
+    missing ones. If that cannot be done, for example because none of those
+    shares can be read any more, I make all N shares as described above.
     """
 
-    def __init__(self, filenode, storage_broker, secret_holder, monitor):
+    def __init__(self, filenode, storage_broker, secret_holder, monitor,
+                 check_results=None):
         logprefix = si_b2a(filenode.get_storage_index())[:5]
         log.PrefixingLogMixin.__init__(self, "allmydata.immutable.repairer",
                                        prefix=logprefix)
@@ -60,25 +253,163 @@ class Repairer(log.PrefixingLogMixin):
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._monitor = monitor
+        self._check_results = check_results
         self._offset = 0
 
     def start(self):
         self.log("starting repair")
-        d = self._filenode.get_segment_size()
-        def _got_segsize(segsize):
+        d = defer.maybeDeferred(self._collect_hashes)
+        def _got_hashes(res):
             vcap = self._filenode.get_verify_cap()
             k = vcap.needed_shares
             N = vcap.total_shares
             # Per ticket #1212
             # (http://tahoe-lafs.org/trac/tahoe-lafs/ticket/1212)
             happy = 0
-            self._encodingparams = (k, happy, N, segsize)
-            # XXX should pass a reactor to this
-            ul = upload.CHKUploader(self._storage_broker, self._secret_holder)
-            return ul.start(self) # I am the IEncryptedUploadable
-        d.addCallback(_got_segsize)
+            if res is None:
+                d = self._filenode.get_segment_size()
+                def _got_segsize(segsize):
+                    self._encodingparams = (k, happy, N, segsize)
+                    # XXX should pass a reactor to this
+                    return upload.CHKUploader(self._storage_broker,
+                                              self._secret_holder)
+                d.addCallback(_got_segsize)
+                return d
+            (ueb, share_hash_tree) = res
+            self._encodingparams = (k, happy, N, ueb.segment_size)
+            return RepairUploader(ueb, share_hash_tree,
+                                  self._storage_broker, self._secret_holder)
+        d.addCallback(_got_hashes)
+        d.addCallback(lambda ul: ul.start(self)) # I am the IEncryptedUploadable
+        return d
+
+    def _collect_hashes(self):
+        """Read the UEB, and enough of the share hash tree to place the
+        missing shares, from the shares which the check found. I return a
+        Deferred that fires with (validated UEB proxy, IncompleteHashTree),
+        or with None if that is not possible."""
+        if self._check_results is None:
+            return defer.succeed(None)
+        vcap = self._filenode.get_verify_cap()
+        sharemap = self._check_results.get_sharemap()
+        servers = set()
+        for shnum_servers in sharemap.values():
+            servers.update(shnum_servers)
+        dl = []
+        for server in servers:
+            self._monitor.raise_if_cancelled()
+            dl.append(self._get_buckets(server, vcap.get_storage_index()))
+        d = deferredutil.gatherResults(dl)
+        def _got_buckets(res):
+            rbps = {}
+            for server_rbps in res:
+                for (shnum, rbp) in server_rbps:
+                    rbps.setdefault(shnum, []).append(rbp)
+            return rbps
+        d.addCallback(_got_buckets)
+        d.addCallback(self._read_hashes, vcap)
+        def _err(f):
+            f.trap(*_SHARE_ERRORS)
+            self.log("unable to read hashes from the existing shares, so "
+                     "making all of them", failure=f, level=log.UNUSUAL,
+                     umid="b0Lqvw")
+            return None
+        d.addErrback(_err)
         return d
 
+    def _get_buckets(self, server, storage_index):
+        d = server.get_storage_server().get_buckets(storage_index)
+        def _got(buckets):
+            return [(shnum, layout.ReadBucketProxy(bucket, server,
+                                                   storage_index))
+                    for (shnum, bucket) in buckets.items()]
+        def _trap(f):
+            f.trap(*_SHARE_ERRORS)
+            self.log("failure from server %s on get_buckets"
+                     % (server.get_name(),), failure=f, level=log.UNUSUAL)
+            return []
+        d.addCallbacks(_got, _trap)
+        return d
+
+    def _read_hashes(self, rbps, vcap):
+        present = sorted(rbps)
+        if not present:
+            raise LayoutInvalid("no shares left to read hashes from")
+        missing = [shnum for shnum in range(vcap.total_shares)
+                   if shnum not in rbps]
+        # the UEB is the same in every share, so any one which validates
+        # will do. The share nearest the first missing one is about to be
+        # read anyway.
+        if missing:
+            present.sort(key=_nearest_to(missing[0]))
+        candidates = [(shnum, rbp) for shnum in present
+                      for rbp in rbps[shnum]]
+        d = self._get_ueb(candidates, vcap)
+        def _got_ueb(ueb):
+            share_hash_tree = IncompleteHashTree(vcap.total_shares)
+            share_hash_tree.set_hashes({0: ueb.share_root_hash})
+            d = self._read_share_hashes(ueb, share_hash_tree, missing, rbps,
+                                        set())
+            d.addCallback(lambda ign: (ueb, share_hash_tree))
+            return d
+        d.addCallback(_got_ueb)
+        return d
+
+    def _read_share_hashes(self, ueb, share_hash_tree, missing, rbps, tried):
+        # A share holds the share hash tree nodes which validate it: its own
+        # leaf and the sibling of each node on its path to the root. So the
+        # surviving share nearest in the tree to a missing one gives all of
+        # the nodes the missing share must carry, except those over subtrees
+        # which have no surviving shares at all, and the RepairEncoder
+        # works those out by encoding their shares too. Missing shares are
+        # taken one at a time, since one read usually serves several.
+        while missing and not share_hash_tree.needed_hashes(missing[0]):
+            missing = missing[1:]
+        if not missing:
+            return defer.succeed(None)
+        sources = [shnum for shnum in rbps if shnum not in tried]
+        if not sources:
+            return defer.succeed(None)
+        self._monitor.raise_if_cancelled()
+        shnum = min(sources, key=_nearest_to(missing[0]))
+        tried.add(shnum)
+        d = self._get_share_hashes(ueb, share_hash_tree, shnum, rbps[shnum])
+        d.addCallback(lambda ign:
+                      self._read_share_hashes(ueb, share_hash_tree, missing,
+                                              rbps, tried))
+        return d
+
+    def _get_ueb(self, candidates, vcap):
+        if not candidates:
+            raise LayoutInvalid("no share has a valid UEB")
+        self._monitor.raise_if_cancelled()
+        (shnum, rbp) = candidates[0]
+        d = ValidatedExtendedURIProxy(rbp, vcap).start()
+        def _bad(f):
+            f.trap(*_SHARE_ERRORS)
+            self.log("share %d in %r has no valid UEB" % (shnum, rbp),
+                     failure=f, level=log.UNUSUAL)
+            return self._get_ueb(candidates[1:], vcap)
+        d.addErrback(_bad)
+        return d
+
+    def _get_share_hashes(self, ueb, share_hash_tree, shnum, rbps):
+        # try each copy of the share in turn. If none of them has a valid
+        # chain, the next nearest share will be read instead.
+        if not rbps:
+            return defer.succeed(None)
+        vrbp = ValidatedReadBucketProxy(shnum, rbps[0], share_hash_tree,
+                                        ueb.num_segments, ueb.block_size,
+                                        ueb.share_size)
+        d = vrbp.get_all_sharehashes()
+        def _bad(f):
+            f.trap(*_SHARE_ERRORS)
+            self.log("share %d in %r has no valid share hash chain"
+                     % (shnum, rbps[0]), failure=f, level=log.UNUSUAL)
+            return self._get_share_hashes(ueb, share_hash_tree, shnum,
+                                          rbps[1:])
+        d.addErrback(_bad)
+        return d
 
     # methods to satisfy the IEncryptedUploader interface
     # (From the perspective of an uploader I am an IEncryptedUploadable.)
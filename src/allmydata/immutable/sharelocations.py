@@ -0,0 +1,122 @@
+"""
+A cache of where the shares of recently-used immutable files are.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import time
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from allmydata.interfaces import IStatsProducer
+
+
+class ShareLocations(object):
+    """I describe which servers were recently seen to hold shares of one
+    storage index.
+
+    'shares' maps serverid to the set of shnums that server holds. If I am
+    'complete', every server that an upload would have asked was asked, so
+    servers I do not mention held no shares. 'buckets' maps serverid to
+    (server, {shnum: bucket reader}, dyhb_rtt) for the servers which
+    answered a DYHB query from a downloader: the bucket readers can be used
+    to read those shares without asking again, for as long as the
+    connection they came from lasts.
+    """
+
+    def __init__(self, when, complete):
+        self.when = when
+        self.complete = complete
+        self.shares = {}
+        self.buckets = {}
+
+    def add_shares(self, serverid, shnums):
+        self.shares.setdefault(serverid, set()).update(shnums)
+
+
+@implementer(IStatsProducer)
+class ShareLocationCache(object):
+    """I remember where the shares of each immutable file were found (or
+    put) recently, so that downloading or uploading the same file again
+    soon afterwards can skip the DYHB ('do you have block') round of
+    queries.
+
+    One of me is shared by every uploader, downloader and checker that a
+    client creates. My entries come from uploads and checks, which learn
+    about every server that holds shares, and from the DYHB responses that
+    downloaders receive, and are used for ttl seconds after they were
+    made. Users must cope with an entry being wrong: a downloader falls
+    back to asking the servers in the usual way when the shares it was
+    given fail, and an uploader always asks each server to allocate (and so
+    confirm) the shares it expects it to hold.
+    """
+
+    MAX_ENTRIES = 1000
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._entries = OrderedDict() # storage index -> ShareLocations
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, storage_index):
+        """Return the ShareLocations for storage_index, or None if there is
+        no fresh entry."""
+        entry = self._entries.pop(storage_index, None)
+        if entry is None or time.time() - entry.when > self._ttl:
+            self.misses += 1
+            return None
+        self._entries[storage_index] = entry # most-recently used goes last
+        self.hits += 1
+        return entry
+
+    def add_sharemap(self, storage_index, sharemap):
+        """Remember the result of an upload or check, which found every
+        share: sharemap maps shnum to a set of serverids."""
+        entry = ShareLocations(time.time(), complete=True)
+        for (shnum, serverids) in sharemap.items():
+            for serverid in serverids:
+                entry.add_shares(serverid, [shnum])
+        self._put(storage_index, entry)
+
+    def add_buckets(self, storage_index, server, buckets, dyhb_rtt):
+        """Remember that a downloader got buckets (a dict of shnum to bucket
+        reader) from server."""
+        entry = self._entries.get(storage_index)
+        if entry is None or time.time() - entry.when > self._ttl:
+            entry = ShareLocations(time.time(), complete=False)
+            self._put(storage_index, entry)
+        serverid = server.get_serverid()
+        entry.add_shares(serverid, buckets.keys())
+        entry.buckets[serverid] = (server, dict(buckets), dyhb_rtt)
+
+    def forget_buckets(self, storage_index, serverid):
+        """The bucket readers that serverid gave us do not work (any more)."""
+        entry = self._entries.get(storage_index)
+        if entry is not None:
+            entry.buckets.pop(serverid, None)
+
+    def forget(self, storage_index):
+        self._entries.pop(storage_index, None)
+
+    def _put(self, storage_index, entry):
+        self._entries.pop(storage_index, None)
+        self._entries[storage_index] = entry
+        while len(self._entries) > self.MAX_ENTRIES:
+            self._entries.popitem(last=False)
+
+    def get_stats(self):
+        return {
+            "share_locations.cache.hits": self.hits,
+            "share_locations.cache.misses": self.misses,
+            "share_locations.cache.entries": len(self._entries),
+        }
@@ -45,6 +45,7 @@ from allmydata.util.happinessutil import servers_of_happiness, \
     merge_servers, failure_message
 from allmydata.util.assertutil import precondition, _assert
 from allmydata.util.rrefutil import add_version_to_remote_reference
+from allmydata.util.cputhreadpool import defer_to_thread
 from allmydata.interfaces import IUploadable, IUploader, IUploadResults, \
      IEncryptedUploadable, RIEncryptedUploadable, IUploadStatus, \
      NoServersError, InsufficientVersionError, UploadUnhappinessError, \
@@ -425,8 +426,12 @@ class _QueryStatistics(object):
 
 class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
-    def __init__(self, upload_id, logparent=None, upload_status=None, reactor=None):
+    def __init__(self, upload_id, logparent=None, upload_status=None, reactor=None,
+                 share_locations=None):
         self.upload_id = upload_id
+        # None, or a ShareLocationCache that may tell us which servers
+        # already hold shares, so we need not ask them
+        self._share_locations = share_locations
         self._query_stats = _QueryStatistics()
         self.last_failure_msg = None
         self._status = IUploadStatus(upload_status)
@@ -571,6 +576,18 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         # The spec doesn't say what to do for timeouts/errors. This
         # adds a timeout to each request, and rejects any that reply
         # with error (i.e. just removed from the list)
+        #
+        # If we uploaded or checked this file moments ago, we already know
+        # the answers. They are only hints: allocate_buckets() below tells
+        # us about each share we expect a server to hold, and allocates it
+        # again if it is gone. Readonly servers never get allocate_buckets(),
+        # so they are always asked.
+
+        locations = None
+        if self._share_locations:
+            locations = self._share_locations.get(storage_index)
+            if locations is not None and not locations.complete:
+                locations = None
 
         ds = []
         if self._status and readonly_trackers:
@@ -587,7 +604,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
         for tracker in readonly_trackers:
             assert isinstance(tracker, ServerTracker)
-            d = timeout_call(self._reactor, tracker.ask_about_existing_shares(), 15)
+            d = self._ask_about_existing_shares(tracker, None)
             d.addBoth(self._handle_existing_response, tracker)
             ds.append(d)
             self.log("asking server %r for any existing shares" %
@@ -595,7 +612,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
         for tracker in write_trackers:
             assert isinstance(tracker, ServerTracker)
-            d = timeout_call(self._reactor, tracker.ask_about_existing_shares(), 15)
+            d = self._ask_about_existing_shares(tracker, locations)
 
             def timed_out(f, tracker):
                 # print("TIMEOUT {}: {}".format(tracker, f))
@@ -735,6 +752,12 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         self.log(msg, level=log.OPERATIONAL)
         defer.returnValue((self.use_trackers, self.peer_selector.get_sharemap_of_preexisting_shares()))
 
+    def _ask_about_existing_shares(self, tracker, locations):
+        if locations is not None:
+            shnums = locations.shares.get(tracker.get_serverid(), ())
+            return defer.succeed(dict.fromkeys(shnums))
+        return timeout_call(self._reactor, tracker.ask_about_existing_shares(), 15)
+
     def _handle_existing_response(self, res, tracker):
         """
         I handle responses to the queries sent by
@@ -1038,6 +1061,12 @@ class EncryptAnUploadable(object):
         return p, self._segment_size
 
     def _update_segment_hash(self, chunk):
+        """
+        Feed ``chunk`` to the plaintext segment hashers.  This may run in a
+        worker thread, so rather than logging it returns a list of
+        ``(segnum, digest, hashed_bytes)`` for each segment it closed.
+        """
+        closed = []
         offset = 0
         while offset < len(chunk):
             p, segment_left = self._get_segment_hasher()
@@ -1050,17 +1079,21 @@ class EncryptAnUploadable(object):
                 # we've filled this segment
                 self._plaintext_segment_hashes.append(p.digest())
                 self._plaintext_segment_hasher = None
-                self.log("closed hash [%d]: %dB" %
-                         (len(self._plaintext_segment_hashes)-1,
-                          self._plaintext_segment_hashed_bytes),
-                         level=log.NOISY)
-                self.log(format="plaintext leaf hash [%(segnum)d] is %(hash)s",
-                         segnum=len(self._plaintext_segment_hashes)-1,
-                         hash=base32.b2a(p.digest()),
-                         level=log.NOISY)
+                closed.append((len(self._plaintext_segment_hashes)-1,
+                               p.digest(),
+                               self._plaintext_segment_hashed_bytes))
 
             offset += this_segment
+        return closed
 
+    def _log_closed_segment_hashes(self, closed):
+        for (segnum, digest, hashed_bytes) in closed:
+            self.log("closed hash [%d]: %dB" % (segnum, hashed_bytes),
+                     level=log.NOISY)
+            self.log(format="plaintext leaf hash [%(segnum)d] is %(hash)s",
+                     segnum=segnum,
+                     hash=base32.b2a(digest),
+                     level=log.NOISY)
 
     def read_encrypted(self, length, hash_only):
         # make sure our parameters have been set up first
@@ -1104,10 +1137,9 @@ class EncryptAnUploadable(object):
 
         # read a chunk of plaintext..
         d = defer.maybeDeferred(self.original.read, size)
-        def _good(plaintext):
-            # and encrypt it..
-            # o/' over the fields we go, hashing all the way, sHA! sHA! sHA! o/'
-            ct = self._hash_and_encrypt_plaintext(plaintext, hash_only)
+        # and encrypt it..
+        d.addCallback(self._hash_and_encrypt_plaintext, hash_only)
+        def _good(ct):
             # Intentionally tell the accumulator about the expected size, not
             # the actual size.  If we run out of data we still want remaining
             # to drop otherwise it will never reach 0 and the loop will never
@@ -1119,34 +1151,53 @@ class EncryptAnUploadable(object):
     def _hash_and_encrypt_plaintext(self, data, hash_only):
         assert isinstance(data, (tuple, list)), type(data)
         data = list(data)
+        self.log(" read_encrypted handling %d chunks, %dB" %
+                 (len(data), sum(len(chunk) for chunk in data)),
+                 level=log.NOISY)
+        if hash_only:
+            self.log("  skipping encryption", level=log.NOISY)
+        # Reads are strictly sequential, so only one of these runs at a time
+        # and the hashers and the AES-CTR state see the data in order.
+        d = defer_to_thread(self._hash_and_encrypt_chunks, data, hash_only)
+        def _done(result):
+            (cryptdata, bytes_processed, closed) = result
+            self._log_closed_segment_hashes(closed)
+            self._ciphertext_bytes_read += bytes_processed
+            if self._status:
+                progress = float(self._ciphertext_bytes_read) / self._file_size
+                self._status.set_progress(1, progress)
+            return cryptdata
+        d.addCallback(_done)
+        return d
+
+    def _hash_and_encrypt_chunks(self, data, hash_only):
+        """
+        Hash and encrypt a list of plaintext chunks.  This runs in the CPU
+        thread pool.
+
+        :return: ``(ciphertext_chunks, bytes_processed, closed_segments)``
+        """
         cryptdata = []
+        closed = []
         # we use data.pop(0) instead of 'for chunk in data' to save
         # memory: each chunk is destroyed as soon as we're done with it.
         bytes_processed = 0
         while data:
             chunk = data.pop(0)
-            self.log(" read_encrypted handling %dB-sized chunk" % len(chunk),
-                     level=log.NOISY)
             bytes_processed += len(chunk)
             self._plaintext_hasher.update(chunk)
-            self._update_segment_hash(chunk)
+            closed.extend(self._update_segment_hash(chunk))
             # TODO: we have to encrypt the data (even if hash_only==True)
             # because the AES-CTR implementation doesn't offer a
             # way to change the counter value. Once it acquires
             # this ability, change this to simply update the counter
             # before each call to (hash_only==False) encrypt_data
             ciphertext = aes.encrypt_data(self._encryptor, chunk)
-            if hash_only:
-                self.log("  skipping encryption", level=log.NOISY)
-            else:
+            if not hash_only:
                 cryptdata.append(ciphertext)
             del ciphertext
             del chunk
-        self._ciphertext_bytes_read += bytes_processed
-        if self._status:
-            progress = float(self._ciphertext_bytes_read) / self._file_size
-            self._status.set_progress(1, progress)
-        return cryptdata
+        return (cryptdata, bytes_processed, closed)
 
 
     def get_plaintext_hashtree_leaves(self, first, last, num_segments):
@@ -1226,10 +1277,14 @@ class UploadStatus(object):
 
 class CHKUploader(object):
 
-    def __init__(self, storage_broker, secret_holder, reactor=None):
+    def __init__(self, storage_broker, secret_holder, reactor=None,
+                 pipeline_depth=encode.DEFAULT_PIPELINE_DEPTH,
+                 share_locations=None):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        self._share_locations = share_locations
+        self._pipeline_depth = pipeline_depth
         self._log_number = self.log("CHKUploader starting", parent=None)
         self._encoder = None
         self._storage_index = None
@@ -1287,10 +1342,7 @@ class CHKUploader(object):
         started = time.time()
         # would be Really Nice to make Encoder just a local; only
         # abort() really needs self._encoder ...
-        self._encoder = encode.Encoder(
-            self._log_number,
-            self._upload_status,
-        )
+        self._encoder = self.make_encoder()
         # this just returns itself
         yield self._encoder.set_encrypted_uploadable(eu)
         with LOCATE_ALL_SHAREHOLDERS() as action:
@@ -1301,6 +1353,13 @@ class CHKUploader(object):
         results = self._encrypted_done(verifycap)
         defer.returnValue(results)
 
+    def make_encoder(self):
+        return encode.Encoder(
+            self._log_number,
+            self._upload_status,
+            pipeline_depth=self._pipeline_depth,
+        )
+
     def locate_all_shareholders(self, encoder, started):
         server_selection_started = now = time.time()
         self._storage_index_elapsed = now - started
@@ -1315,6 +1374,7 @@ class CHKUploader(object):
             self._log_number,
             self._upload_status,
             reactor=self._reactor,
+            share_locations=self._share_locations,
         )
 
         share_size = encoder.get_param("share_size")
@@ -1350,6 +1410,7 @@ class CHKUploader(object):
         self.log(msgtempl % values, level=log.OPERATIONAL)
         # record already-present shares in self._results
         self._count_preexisting_shares = len(already_serverids)
+        self._already_serverids = already_serverids
 
         self._server_trackers = {} # k: shnum, v: instance of ServerTracker
         for tracker in upload_trackers:
@@ -1382,6 +1443,13 @@ class CHKUploader(object):
             server = self._server_trackers[shnum].get_server()
             sharemap.add(shnum, server)
             servermap.add(server, shnum)
+        if self._share_locations:
+            locations = dictutil.DictOfSets()
+            locations.update(self._already_serverids)
+            for (shnum, servers) in sharemap.items():
+                for server in servers:
+                    locations.add(shnum, server.get_serverid())
+            self._share_locations.add_sharemap(self._storage_index, locations)
         now = time.time()
         timings = {}
         timings["total"] = now - self._started
@@ -1748,6 +1816,9 @@ class BaseUploadable(object):
 
 @implementer(IUploadable)
 class FileHandle(BaseUploadable):
+    # how much of the file is read and hashed in each trip to the CPU thread
+    # pool while computing a convergent key
+    CONVERGENT_HASH_CHUNK_SIZE = 1024*1024
 
     def __init__(self, filehandle, convergence):
         """
@@ -1769,34 +1840,43 @@ class FileHandle(BaseUploadable):
         d = self.get_size()
         # that sets self._size as a side-effect
         d.addCallback(lambda size: self.get_all_encoding_parameters())
-        def _got(params):
-            k, happy, n, segsize = params
-            f = self._filehandle
-            enckey_hasher = convergence_hasher(k, n, segsize, self.convergence)
-            f.seek(0)
-            BLOCKSIZE = 64*1024
-            bytes_read = 0
-            while True:
-                data = f.read(BLOCKSIZE)
-                if not data:
-                    break
-                enckey_hasher.update(data)
-                # TODO: setting progress in a non-yielding loop is kind of
-                # pointless, but I'm anticipating (perhaps prematurely) the
-                # day when we use a slowjob or twisted's CooperatorService to
-                # make this yield time to other jobs.
-                bytes_read += len(data)
-                if self._status:
-                    self._status.set_progress(0, float(bytes_read)/self._size)
-            f.seek(0)
-            self._key = enckey_hasher.digest()
-            if self._status:
-                self._status.set_progress(0, 1.0)
-            assert len(self._key) == 16
-            return self._key
+        d.addCallback(self._compute_convergent_key)
+        def _got(key):
+            assert len(key) == 16
+            self._key = key
+            return key
         d.addCallback(_got)
         return d
 
+    @inline_callbacks
+    def _compute_convergent_key(self, params):
+        k, happy, n, segsize = params
+        f = self._filehandle
+        enckey_hasher = convergence_hasher(k, n, segsize, self.convergence)
+        f.seek(0)
+        bytes_read = 0
+        chunk_size = self.CONVERGENT_HASH_CHUNK_SIZE
+        while True:
+            if self._size <= chunk_size:
+                # small enough that a trip to the thread pool would cost
+                # more than it saves
+                count = _read_and_hash(f, enckey_hasher, chunk_size)
+            else:
+                # The reading and hashing happen in the CPU thread pool, a
+                # chunk at a time, so that hashing a large file neither
+                # freezes the reactor nor hides our progress until the end.
+                count = yield defer_to_thread(_read_and_hash, f,
+                                              enckey_hasher, chunk_size)
+            if not count:
+                break
+            bytes_read += count
+            if self._status:
+                self._status.set_progress(0, float(bytes_read)/self._size)
+        f.seek(0)
+        if self._status:
+            self._status.set_progress(0, 1.0)
+        defer.returnValue(enckey_hasher.digest())
+
     def _get_encryption_key_random(self):
         if self._key is None:
             self._key = os.urandom(16)
@@ -1825,15 +1905,44 @@ class FileHandle(BaseUploadable):
         pass
 
 class FileName(FileHandle):
-    def __init__(self, filename, convergence):
+    def __init__(self, filename, convergence, key_cache=None):
         """
         Upload the data from the filename.  If convergence is None then a
         random encryption key will be used, else the plaintext will be hashed,
         then the hash will be hashed together with the string in the
         "convergence" argument to form the encryption key.
+
+        If a ``ConvergenceKeyCache`` is given as ``key_cache``, the
+        convergent key is looked up there first, and recorded there after it
+        is computed, so an unchanged file need not be read twice when it is
+        uploaded again.
         """
         assert convergence is None or isinstance(convergence, bytes), (convergence, type(convergence))
         FileHandle.__init__(self, open(filename, "rb"), convergence=convergence)
+        self._path = os.path.abspath(filename)
+        self._key_cache = key_cache
+
+    def _compute_convergent_key(self, params):
+        if self._key_cache is None:
+            return FileHandle._compute_convergent_key(self, params)
+        before = os.fstat(self._filehandle.fileno())
+        key = self._key_cache.get_key(self._path, before, params,
+                                      self.convergence)
+        if key is not None:
+            if self._status:
+                self._status.set_progress(0, 1.0)
+            return defer.succeed(key)
+        d = FileHandle._compute_convergent_key(self, params)
+        def _computed(key):
+            after = os.fstat(self._filehandle.fileno())
+            # don't record a key for a file that changed while we read it
+            if _stat_fingerprint(before) == _stat_fingerprint(after):
+                self._key_cache.set_key(self._path, before, params,
+                                        self.convergence, key)
+            return key
+        d.addCallback(_computed)
+        return d
+
     def close(self):
         FileHandle.close(self)
         self._filehandle.close()
@@ -1849,6 +1958,53 @@ class Data(FileHandle):
         assert convergence is None or isinstance(convergence, bytes), (convergence, type(convergence))
         FileHandle.__init__(self, BytesIO(data), convergence=convergence)
 
+@implementer(IUploadable)
+class Stream(BaseUploadable):
+    def __init__(self, stream, size):
+        """
+        Upload ``size`` bytes from ``stream``, whose ``read(length)`` returns
+        a Deferred that fires with the next ``length`` bytes (or fewer, at
+        the end), as they arrive: for example the body of an HTTP request
+        which is still being received. A random encryption key is always
+        used, since a convergent one could only be computed once all of the
+        data had arrived.
+        """
+        self._stream = stream
+        self._size = size
+        self._key = None
+
+    def get_encryption_key(self):
+        if self._key is None:
+            self._key = os.urandom(16)
+        return defer.succeed(self._key)
+
+    def get_size(self):
+        return defer.succeed(self._size)
+
+    def read(self, length):
+        d = self._stream.read(length)
+        d.addCallback(lambda data: [data])
+        return d
+
+    def close(self):
+        pass
+
+def _read_and_hash(f, hasher, size):
+    """
+    Read up to ``size`` bytes from ``f`` and feed them to ``hasher``.  This
+    runs in the CPU thread pool.
+
+    :return int: The number of bytes read, 0 at the end of the file.
+    """
+    data = f.read(size)
+    hasher.update(data)
+    return len(data)
+
+
+def _stat_fingerprint(stat):
+    return (stat.st_size, stat.st_mtime, stat.st_ino)
+
+
 @implementer(IUploader)
 class Uploader(service.MultiService, log.PrefixingLogMixin):
     """I am a service that allows file uploading. I am a service-child of the
@@ -1857,10 +2013,14 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
     name = "uploader"
     URI_LIT_SIZE_THRESHOLD = 55
 
-    def __init__(self, helper_furl=None, stats_provider=None, history=None):
+    def __init__(self, helper_furl=None, stats_provider=None, history=None,
+                 pipeline_depth=encode.DEFAULT_PIPELINE_DEPTH,
+                 share_locations=None):
         self._helper_furl = helper_furl
         self.stats_provider = stats_provider
         self._history = history
+        self._pipeline_depth = pipeline_depth
+        self._share_locations = share_locations
         self._helper = None
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         log.PrefixingLogMixin.__init__(self, facility="tahoe.immutable.upload")
@@ -1929,7 +2089,10 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder, reactor=reactor)
+                    uploader = CHKUploader(storage_broker, secret_holder,
+                                           reactor=reactor,
+                                           pipeline_depth=self._pipeline_depth,
+                                           share_locations=self._share_locations)
                     d2.addCallback(lambda x: uploader.start(eu))
 
                 self._all_uploads[uploader] = None
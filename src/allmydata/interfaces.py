@@ -40,6 +40,8 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_LEASE_BATCH = 1000 # leases per add_leases() call
+MAX_INDEX_BATCH = 100 # storage indexes per get_buckets_batch() call
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -154,6 +156,24 @@ class RIStorageServer(RemoteInterface):
         """
         return Any() # returns None now, but future versions might change
 
+    def add_leases(leases=ListOf(TupleOf(StorageIndex,
+                                         LeaseRenewSecret,
+                                         LeaseCancelSecret),
+                                 maxLength=MAX_LEASE_BATCH)):
+        """
+        Do what add_lease() does for each (storage_index, renew_secret,
+        cancel_secret) tuple in 'leases', in a single message. Servers
+        which implement this advertise the largest batch they accept as
+        'maximum-add-leases-batch-size' in their version information.
+
+        @return: a list with one element per tuple, in the same order: the
+                 number of shares which now hold that lease (zero if there
+                 is no bucket for the storage index), or None if the server
+                 was unable to add it. A failure for one tuple does not
+                 affect the others.
+        """
+        return ListOf(ChoiceOf(int, None), maxLength=MAX_LEASE_BATCH)
+
     def renew_lease(storage_index=StorageIndex, renew_secret=LeaseRenewSecret):
         """
         Renew the lease on a given bucket, resetting the timer to 31 days.
@@ -171,6 +191,19 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_buckets_batch(storage_indexes=ListOf(StorageIndex,
+                                                 maxLength=MAX_INDEX_BATCH)):
+        """
+        Do what get_buckets() does for each of 'storage_indexes', in a single
+        message. Servers which implement this (and slot_readv_batch())
+        advertise the largest batch they accept as
+        'maximum-storage-index-batch-size' in their version information.
+
+        @return: a list with one element per storage index, in the same
+                 order: the dictionary get_buckets() would return for it.
+        """
+        return ListOf(DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS),
+                      maxLength=MAX_INDEX_BATCH)
 
 
     def slot_readv(storage_index=StorageIndex,
@@ -180,6 +213,20 @@ class RIStorageServer(RemoteInterface):
         known shares. Returns a dictionary with one key per share."""
         return DictOf(int, ReadData) # shnum -> results
 
+    def slot_readv_batch(reads=ListOf(TupleOf(StorageIndex,
+                                              ListOf(int),
+                                              ReadVector),
+                                      maxLength=MAX_INDEX_BATCH)):
+        """
+        Do what slot_readv() does for each (storage_index, shares, readv)
+        tuple in 'reads', in a single message. See get_buckets_batch() for
+        how servers advertise this.
+
+        @return: a list with one element per tuple, in the same order: the
+                 dictionary slot_readv() would return for it.
+        """
+        return ListOf(DictOf(int, ReadData), maxLength=MAX_INDEX_BATCH)
+
     def slot_testv_and_readv_and_writev(storage_index=StorageIndex,
                                         secrets=TupleOf(WriteEnablerSecret,
                                                         LeaseRenewSecret,
@@ -343,6 +390,28 @@ class IStorageServer(Interface):
         :see: ``RIStorageServer.add_lease``
         """
 
+    def add_leases(
+            leases,
+    ):
+        """
+        :see: ``RIStorageServer.add_leases``
+        """
+
+    def queue_add_lease(
+            storage_index,
+            renew_secret,
+            cancel_secret,
+    ):
+        """
+        Add a lease like ``add_lease``, but send it along with any others
+        queued during the same reactor turn, using ``add_leases`` if the
+        server supports it. This is meant for walkers (such as a deep-check
+        with add-lease) which add leases to many files at once.
+
+        :return Deferred: Fires with the result for this one lease: see
+            ``RIStorageServer.add_leases``.
+        """
+
     def renew_lease(
             storage_index,
             renew_secret,
@@ -358,6 +427,25 @@ class IStorageServer(Interface):
         :see: ``RIStorageServer.get_buckets``
         """
 
+    def get_buckets_batch(
+            storage_indexes,
+    ):
+        """
+        :see: ``RIStorageServer.get_buckets_batch``
+        """
+
+    def queue_get_buckets(
+            storage_index,
+    ):
+        """
+        Call ``get_buckets``, but send the request along with any others
+        queued during the same reactor turn, using ``get_buckets_batch`` if
+        the server supports it. This is meant for walkers (such as a
+        deep-check) which look at many files at once.
+
+        :return Deferred: Fires with the buckets for this one storage index.
+        """
+
     def slot_readv(
             storage_index,
             shares,
@@ -367,6 +455,27 @@ class IStorageServer(Interface):
         :see: ``RIStorageServer.slot_readv``
         """
 
+    def slot_readv_batch(
+            reads,
+    ):
+        """
+        :see: ``RIStorageServer.slot_readv_batch``
+        """
+
+    def queue_slot_readv(
+            storage_index,
+            shares,
+            readv,
+    ):
+        """
+        Call ``slot_readv``, but send the request along with any others
+        queued during the same reactor turn, using ``slot_readv_batch`` if
+        the server supports it.
+
+        :return Deferred: Fires with the data read for this one storage
+            index.
+        """
+
     def slot_testv_and_readv_and_writev(
             storage_index,
             secrets,
@@ -499,6 +608,13 @@ class IStorageBroker(Interface):
         """
         @return: unicode nickname, or None
         """
+    def get_server_performance():
+        """
+        @return: a ServerPerformance, which keeps estimates of how quickly
+                 each server answers, for downloaders choosing between the
+                 servers which hold the shares they need. Where shares are
+                 placed does not depend on it.
+        """
 
     # methods moved from IntroducerClient, need review
     def get_all_connections():
@@ -883,6 +999,10 @@ class IMutableFileVersion(IReadable):
     def get_sequence_number():
         """Return the sequence number of this version."""
 
+    def get_root_hash():
+        """Return the root hash of this version. Together with the sequence
+        number, this identifies the contents of the version."""
+
     def get_servermap():
         """Return the IMutableFileServerMap instance that was used to create
         this object.
@@ -2146,7 +2266,11 @@ class IUploadResults(Interface):
           helper_total : initial helper query to helper finished pushing
           cumulative_fetch : helper waiting for ciphertext requests
           total_fetch : helper start to last ciphertext response
-          cumulative_encoding : just time spent in zfec
+          cumulative_reading : just time spent reading and encrypting
+          cumulative_encoding : just time spent in zfec and block hashing
+                                (summed over worker threads, so with a
+                                pipelined encoder this may exceed the
+                                wall-clock time)
           cumulative_sending : just time spent waiting for storage servers
           hashes_and_close : last segment push to shareholder close
           total_encode_and_push : first encode to shareholder close
@@ -2743,6 +2867,10 @@ class IDownloadStatus(Interface):
     def using_helper():
         """Return True if this download is using a Helper, False if not."""
 
+    def get_readahead():
+        """Return the number of segments that each read of this file may
+        request ahead of the one it is currently delivering."""
+
     def get_status():
         """Return a string describing the current state of the download
         process."""
@@ -64,11 +64,12 @@ class BackoffAgent(object):
 class MutableFileNode(object):
 
     def __init__(self, storage_broker, secret_holder,
-                 default_encoding_parameters, history):
+                 default_encoding_parameters, history, servermap_cache=None):
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._default_encoding_parameters = default_encoding_parameters
         self._history = history
+        self._servermap_cache = servermap_cache # None, or a ServermapCache
         self._pubkey = None # filled in upon first read
         self._privkey = None # filled in if we're mutable
         # we keep track of the last encoding parameters that we use. These
@@ -271,7 +272,8 @@ class MutableFileNode(object):
         if self.is_readonly():
             return self
         ro = MutableFileNode(self._storage_broker, self._secret_holder,
-                             self._default_encoding_parameters, self._history)
+                             self._default_encoding_parameters, self._history,
+                             self._servermap_cache)
         ro.init_from_cap(self._uri.get_readonly())
         return ro
 
@@ -334,7 +336,8 @@ class MutableFileNode(object):
         representing the best readable version of the file that I
         represent
         """
-        return self.get_readable_version()
+        d = self.get_readable_version()
+        return d.addCallback(self._record_size)
 
 
     def get_readable_version(self, servermap=None, version=None):
@@ -351,7 +354,18 @@ class MutableFileNode(object):
         If no version is provided, then I return a MutableFileVersion
         representing the best recoverable version of the file.
         """
-        d = self._get_version_from_servermap(MODE_READ, servermap, version)
+        return self._get_readable_version(servermap, version)
+
+
+    def _get_readable_version(self, servermap=None, version=None,
+                              optimistic=False):
+        """
+        I am get_readable_version, except that I will accept a cached
+        servermap of any age if optimistic is True and the servermap cache
+        allows optimistic reads.
+        """
+        d = self._get_version_from_servermap(MODE_READ, servermap, version,
+                                             optimistic)
         def _build_version(servermap_and_their_version):
             (servermap, their_version) = servermap_and_their_version
             assert their_version in servermap.recoverable_versions()
@@ -375,7 +389,8 @@ class MutableFileNode(object):
     def _get_version_from_servermap(self,
                                     mode,
                                     servermap=None,
-                                    version=None):
+                                    version=None,
+                                    optimistic=False):
         """
         I return a Deferred that fires with (servermap, version).
 
@@ -404,7 +419,7 @@ class MutableFileNode(object):
         if servermap and servermap.get_last_update()[0] == mode:
             d = defer.succeed(servermap)
         else:
-            d = self._get_servermap(mode)
+            d = self._get_servermap(mode, optimistic)
 
         def _get_version(servermap, v):
             if v and v not in servermap.recoverable_versions():
@@ -430,7 +445,7 @@ class MutableFileNode(object):
         """
         I am the serialized sibling of download_best_version.
         """
-        d = self.get_best_readable_version()
+        d = self._get_readable_version(optimistic=True)
         d.addCallback(self._record_size)
         d.addCallback(lambda version: version.download_to_data())
 
@@ -445,6 +460,11 @@ class MutableFileNode(object):
         def _maybe_retry(failure):
             failure.trap(NotEnoughSharesError)
 
+            # if the servermap came from the cache, the file may have been
+            # modified since: don't use it again.
+            if self._servermap_cache is not None:
+                self._servermap_cache.invalidate(self._storage_index,
+                                                 remap=True)
             d = self.get_best_mutable_version()
             d.addCallback(self._record_size)
             d.addCallback(lambda version: version.download_to_data())
@@ -616,12 +636,23 @@ class MutableFileNode(object):
         return self._do_serialized(self._get_servermap, mode)
 
 
-    def _get_servermap(self, mode):
+    def _get_servermap(self, mode, optimistic=False):
         """
         I am a serialized twin to get_servermap.
         """
-        servermap = ServerMap()
-        d = self._update_servermap(servermap, mode)
+        cached = None
+        if self._servermap_cache is not None:
+            cached = self._servermap_cache.get(self, mode, optimistic)
+        if cached is not None:
+            (servermap, status) = cached
+            if self._history:
+                self._history.notify_mapupdate(status)
+            d = defer.succeed(servermap)
+        else:
+            servermap = ServerMap()
+            d = self._update_servermap(servermap, mode)
+            if self._servermap_cache is not None:
+                d.addCallback(self._cache_servermap)
         # The servermap will tell us about the most recent size of the
         # file, so we may as well set that so that callers might get
         # more data about us.
@@ -651,6 +682,21 @@ class MutableFileNode(object):
         return u.update()
 
 
+    def _cache_servermap(self, servermap):
+        self._servermap_cache.put(self, servermap)
+        return servermap
+
+
+    def _did_publish(self, res):
+        """
+        I forget any cached servermap, since a publish (successful or
+        not) has changed what is on the servers. I return res.
+        """
+        if self._servermap_cache is not None:
+            self._servermap_cache.invalidate(self._storage_index)
+        return res
+
+
     #def set_version(self, version):
         # I can be set in two ways:
         #  1. When the node is created.
@@ -699,6 +745,7 @@ class MutableFileNode(object):
             self._history.notify_publish(p.get_status(),
                                          new_contents.get_size())
         d = p.publish(new_contents)
+        d.addBoth(self._did_publish)
         d.addCallback(self._did_upload, new_contents.get_size())
         return d
 
@@ -759,6 +806,14 @@ class MutableFileVersion(object):
         return self._version[0] # verinfo[0] == the sequence number
 
 
+    def get_root_hash(self):
+        """
+        Get the root hash of the mutable version that I represent. Together
+        with the sequence number, this identifies its contents.
+        """
+        return self._version[1] # verinfo[1] == the root hash
+
+
     # TODO: Terminology?
     def get_writekey(self):
         """
@@ -1023,6 +1078,7 @@ class MutableFileVersion(object):
             self._history.notify_publish(p.get_status(),
                                          new_contents.get_size())
         d = p.publish(new_contents)
+        d.addBoth(self._node._did_publish)
         d.addCallback(self._did_upload, new_contents.get_size())
         return d
 
@@ -1187,7 +1243,8 @@ class MutableFileVersion(object):
                                    segments_and_bht[0],
                                    segments_and_bht[1])
         p = Publish(self._node, self._storage_broker, self._servermap)
-        return p.update(u, offset, segments_and_bht[2], self._version)
+        d = p.update(u, offset, segments_and_bht[2], self._version)
+        return d.addBoth(self._node._did_publish)
 
 
     def _update_servermap(self, mode=MODE_WRITE, update_range=None):
@@ -0,0 +1,185 @@
+"""
+A pool of RSA keypairs for new mutable files, generated in the background.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, struct, time
+
+from zope.interface import implementer
+from twisted.application import service
+from twisted.internet import defer
+
+from allmydata.crypto import aes, rsa
+from allmydata.interfaces import IStatsProducer
+from allmydata.util import fileutil, hashutil, log
+from allmydata.util.cputhreadpool import defer_to_thread
+
+KEY_POOL_FILE_TAG = b"allmydata_key_pool_file_v1"
+KEY_POOL_HASH_TAG = b"allmydata_key_pool_contents_v1"
+
+
+def _make_keypair(keysize):
+    """Create a keypair: this is what takes seconds, so it runs in the CPU
+    thread pool."""
+    start = time.time()
+    signer, verifier = rsa.create_signing_keypair(keysize)
+    return (verifier, signer, time.time() - start)
+
+
+@implementer(IStatsProducer)
+class KeyPool(service.Service):
+    """I create RSA keys for mutable files, like client.KeyGenerator, but
+    keep up to 'size' keypairs of the default size ready ahead of time.
+    Creating one takes seconds of CPU, which a mutable file or directory
+    created on the reactor thread would otherwise spend with every client
+    and server connection waiting.
+
+    While I am running, I make keys one at a time in the CPU thread pool,
+    whenever the pool is short. generate() hands out a pooled key at once
+    if it can; otherwise (a miss) it has one made in the thread pool too.
+
+    If 'keyfile' is given, the keys left in the pool when I stop are saved
+    there, encrypted with a key derived from 'secret', and taken back when I
+    start. The file is removed as soon as it has been read, so that no key
+    can ever be handed out twice, even if the node crashes.
+    """
+
+    def __init__(self, size, keyfile=None, secret=None):
+        self.default_keysize = 2048
+        self._size = size
+        self._keyfile = keyfile
+        self._secret = secret
+        self._keys = [] # (verifier, signer) pairs of default_keysize bits
+        self._refilling = False
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.generating_time = 0.0
+
+    def set_default_keysize(self, keysize):
+        """Set the size of the keys I make for calls to generate() which do
+        not give one. Any pooled keys of the old size are thrown away."""
+        if keysize != self.default_keysize:
+            del self._keys[:]
+        self.default_keysize = keysize
+        self._refill()
+
+    def startService(self):
+        service.Service.startService(self)
+        if self._keyfile is not None:
+            self._keys.extend(self._load())
+        self._refill()
+
+    def stopService(self):
+        if self._keyfile is not None:
+            self._save()
+        return service.Service.stopService(self)
+
+    def generate(self, keysize=None):
+        """I return a Deferred that fires with a (verifyingkey, signingkey)
+        pair, of 'keysize' bits or my default size."""
+        keysize = keysize or self.default_keysize
+        if keysize == self.default_keysize and self._keys:
+            self.hits += 1
+            pair = self._keys.pop(0)
+            self._refill()
+            return defer.succeed(pair)
+        if keysize == self.default_keysize:
+            self.misses += 1
+        d = defer_to_thread(_make_keypair, keysize)
+        d.addCallback(lambda res: (res[0], res[1]))
+        return d
+
+    def _refill(self):
+        if (self._refilling or not self.running
+            or len(self._keys) >= self._size):
+            return
+        self._refilling = True
+        keysize = self.default_keysize
+        d = defer_to_thread(_make_keypair, keysize)
+        def _made(res):
+            (verifier, signer, elapsed) = res
+            self._refilling = False
+            self.generated += 1
+            self.generating_time += elapsed
+            if keysize == self.default_keysize:
+                self._keys.append( (verifier, signer) )
+            self._refill()
+        def _failed(f):
+            self._refilling = False
+            log.err(f, "key pool: unable to make a keypair", umid="Zq3kVw")
+        d.addCallbacks(_made, _failed)
+
+    def _get_cipher_key(self):
+        return hashutil.tagged_hash(KEY_POOL_FILE_TAG, self._secret, 16)
+
+    def _save(self):
+        keys, self._keys = self._keys, []
+        if not keys:
+            return
+        chunks = []
+        for (verifier, signer) in keys:
+            der = rsa.der_string_from_signing_key(signer)
+            chunks.append(struct.pack(">L", len(der)) + der)
+        plaintext = b"".join(chunks)
+        plaintext = hashutil.tagged_hash(KEY_POOL_HASH_TAG, plaintext) + plaintext
+        iv = os.urandom(16)
+        encryptor = aes.create_encryptor(self._get_cipher_key(), iv)
+        try:
+            fileutil.write_atomically(self._keyfile,
+                                      iv + aes.encrypt_data(encryptor, plaintext),
+                                      mode="b")
+        except EnvironmentError:
+            log.msg(format="key pool: unable to write %(filename)s",
+                    filename=self._keyfile, level=log.UNUSUAL, umid="p1rWmA")
+
+    def _load(self):
+        if not os.path.exists(self._keyfile):
+            return []
+        keys = []
+        try:
+            try:
+                data = fileutil.read(self._keyfile)
+            finally:
+                # never hand out the same key again, whatever happens
+                fileutil.remove_if_possible(self._keyfile)
+            (iv, ciphertext) = (data[:16], data[16:])
+            decryptor = aes.create_decryptor(self._get_cipher_key(), iv)
+            plaintext = aes.decrypt_data(decryptor, ciphertext)
+            (expected, plaintext) = (plaintext[:32], plaintext[32:])
+            if hashutil.tagged_hash(KEY_POOL_HASH_TAG, plaintext) != expected:
+                raise ValueError("corrupt or from another node")
+            offset = 0
+            while offset < len(plaintext):
+                (length,) = struct.unpack(">L", plaintext[offset:offset+4])
+                der = plaintext[offset+4:offset+4+length]
+                offset += 4 + length
+                signer, verifier = rsa.create_signing_keypair_from_string(der)
+                if signer.key_size == self.default_keysize:
+                    keys.append( (verifier, signer) )
+        except (EnvironmentError, ValueError, struct.error):
+            log.msg(format="key pool: unreadable %(filename)s",
+                    filename=self._keyfile, level=log.UNUSUAL, umid="fW4CqA")
+            return []
+        return keys
+
+    def get_stats(self):
+        stats = {
+            "mutable.key_pool.depth": len(self._keys),
+            "mutable.key_pool.hits": self.hits,
+            "mutable.key_pool.misses": self.misses,
+            "mutable.key_pool.generated": self.generated,
+        }
+        if self.generating_time:
+            stats["mutable.key_pool.refill_rate"] = (self.generated /
+                                                      self.generating_time)
+        return stats
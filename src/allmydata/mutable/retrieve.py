@@ -27,6 +27,7 @@ from allmydata.interfaces import IRetrieveStatus, NotEnoughSharesError, \
      DownloadStopped, MDMF_VERSION, SDMF_VERSION
 from allmydata.util.assertutil import _assert, precondition
 from allmydata.util import hashutil, log, mathutil, deferredutil
+from allmydata.util.cputhreadpool import defer_to_thread
 from allmydata.util.dictutil import DictOfSets
 from allmydata import hashtree, codec
 from allmydata.storage.server import si_b2a
@@ -166,6 +167,7 @@ class Retrieve(object):
         self._status.set_size(datalength)
         self._status.set_encoding(k, N)
         self.readers = {}
+        self._prefix_checked = set() # shnums, for servermaps from the cache
         self._stopped = False
         self._pause_deferred = None
         self._offset = None
@@ -473,25 +475,12 @@ class Retrieve(object):
         downloading starts, and (eventually) after each validation
         error, connection error, or other problem in the download.
         """
-        # TODO: It would be cool to investigate other heuristics for
-        # reader selection. For instance, the cost (in time the user
-        # spends waiting for their file) of selecting a really slow server
-        # that happens to have a primary share is probably more than
-        # selecting a really fast server that doesn't have a primary
-        # share. Maybe the servermap could be extended to provide this
-        # information; it could keep track of latency information while
-        # it gathers more important data, and then this routine could
-        # use that to select active readers.
-        #
-        # (these and other questions would be easier to answer with a
-        #  robust, configurable tahoe-lafs simulator, which modeled node
-        #  failures, differences in node speed, and other characteristics
-        #  that we expect storage servers to have.  You could have
-        #  presets for really stable grids (like allmydata.com),
-        #  friendnets, make it easy to configure your own settings, and
-        #  then simulate the effect of big changes on these use cases
-        #  instead of just reasoning about what the effect might be. Out
-        #  of scope for MDMF, though.)
+        # Readers are chosen by how soon their servers should deliver a
+        # block, judged by the storage broker from the requests it has seen
+        # them answer lately. The cost (in time the user spends waiting for
+        # their file) of selecting a really slow server that happens to have
+        # a primary share is probably more than that of selecting a really
+        # fast server that doesn't have a primary share.
 
         # XXX: Why don't format= log messages work here?
 
@@ -504,11 +493,17 @@ class Retrieve(object):
         elif len(self._active_readers) < self._required_shares:
             # need more shares
             more = self._required_shares - len(self._active_readers)
-            # We favor lower numbered shares, since FEC is faster with
-            # primary shares than with other shares, and lower-numbered
-            # shares are more likely to be primary than higher numbered
-            # shares.
-            new_shnums = sorted(unused_shnums)[:more]
+            # Among servers which look equally quick, we favor lower
+            # numbered shares, since FEC is faster with primary shares than
+            # with other shares, and lower-numbered shares are more likely
+            # to be primary than higher numbered shares.
+            performance = self._storage_broker.get_server_performance()
+            block_size = mathutil.div_ceil(self._segment_size,
+                                           self._required_shares)
+            new_shnums = performance.rank(
+                sorted(unused_shnums),
+                lambda shnum: self.readers[shnum].server.get_serverid(),
+                block_size)[:more]
             if len(new_shnums) < more:
                 # We don't have enough readers to retrieve the file; fail.
                 self._raise_notenoughshareserror()
@@ -628,9 +623,12 @@ class Retrieve(object):
         ds = []
         for reader in self._active_readers:
             started = time.time()
-            d1 = reader.get_block_and_salt(segnum)
-            d2,d3 = self._get_needed_hashes(reader, segnum)
-            d = deferredutil.gatherResults([d1,d2,d3])
+            d = self._maybe_check_prefix(reader)
+            def _fetch(ign, reader=reader):
+                d1 = reader.get_block_and_salt(segnum)
+                d2,d3 = self._get_needed_hashes(reader, segnum)
+                return deferredutil.gatherResults([d1,d2,d3])
+            d.addCallback(_fetch)
             d.addCallback(self._validate_block, segnum, reader, reader.server, started)
             # _handle_bad_share takes care of recoverable errors (by dropping
             # that share and returning None). Any other errors (i.e. code
@@ -646,6 +644,23 @@ class Retrieve(object):
         return dl
 
 
+    def _maybe_check_prefix(self, reader):
+        """
+        If my servermap came from the cache, the file may have been
+        modified since it was made. Before using a share for the first
+        time, I check that it still holds the version I am retrieving, so
+        that a newer version shows up as a mismatched prefix rather than
+        as a corrupt share.
+        """
+        if (not self.servermap.from_cache
+            or reader.shnum in self._prefix_checked):
+            return defer.succeed(None)
+        self._prefix_checked.add(reader.shnum)
+        d = reader.get_prefix(force_remote=False)
+        d.addCallback(self._try_to_validate_prefix, reader)
+        return d
+
+
     def _maybe_decode_and_decrypt_segment(self, results, segnum):
         """
         I take the results of fetching and validating the blocks from
@@ -722,14 +737,16 @@ class Retrieve(object):
         # these are the errors we can tolerate: by giving up on this share
         # and finding others to replace it. Any other errors (i.e. coding
         # bugs) are re-raised, causing the download to fail.
-        f.trap(DeadReferenceError, RemoteException, BadShareError)
+        f.trap(DeadReferenceError, RemoteException, BadShareError,
+               UncoordinatedWriteError)
 
         # DeadReferenceError happens when we try to fetch data from a server
         # that has gone away. RemoteException happens if the server had an
         # internal error. BadShareError encompasses: (UnknownVersionError,
         # LayoutInvalid, struct.error) which happen when we get obviously
         # wrong data, and CorruptShareError which happens later, when we
-        # perform integrity checks on the data.
+        # perform integrity checks on the data. UncoordinatedWriteError means
+        # the share holds some other version than the one we're retrieving.
 
         precondition(isinstance(readers, list), readers)
         bad_shnums = [reader.shnum for reader in readers]
@@ -757,6 +774,8 @@ class Retrieve(object):
         block_and_salt, blockhashes, sharehashes = results
         block, salt = block_and_salt
         _assert(isinstance(block, bytes), (block, salt))
+        self._storage_broker.get_server_performance().record_transfer(
+            server.get_serverid(), len(block), elapsed)
 
         blockhashes = dict(enumerate(blockhashes))
         self.log("the reader gave me the following blockhashes: %s" % \
@@ -872,31 +891,30 @@ class Retrieve(object):
             shares.append(share)
 
         self._set_current_status("decoding")
-        started = time.time()
         _assert(len(shareids) >= self._required_shares, len(shareids))
         # zfec really doesn't want extra shares
         shareids = shareids[:self._required_shares]
         shares = shares[:self._required_shares]
         self.log("decoding segment %d" % segnum)
         if segnum == self._num_segments - 1:
-            d = defer.maybeDeferred(self._tail_decoder.decode, shares, shareids)
+            decoder = self._tail_decoder
+            size_to_use = self._tail_data_size
         else:
-            d = defer.maybeDeferred(self._segment_decoder.decode, shares, shareids)
-        def _process(buffers):
-            segment = b"".join(buffers)
-            self.log(format="now decoding segment %(segnum)s of %(numsegs)s",
+            decoder = self._segment_decoder
+            size_to_use = self._segment_size
+        # the decode happens in the CPU thread pool, leaving the reactor
+        # free for other work
+        d = defer_to_thread(_decode_segment, decoder, shares, shareids,
+                            size_to_use)
+        def _process(segment_and_elapsed):
+            (segment, elapsed) = segment_and_elapsed
+            self.log(format="decoded segment %(segnum)s of %(numsegs)s",
                      segnum=segnum,
                      numsegs=self._num_segments,
                      level=log.NOISY)
-            self.log(" joined length %d, datalength %d" %
+            self.log(" segment len=%d, datalength %d" %
                      (len(segment), self._data_length))
-            if segnum == self._num_segments - 1:
-                size_to_use = self._tail_data_size
-            else:
-                size_to_use = self._segment_size
-            segment = segment[:size_to_use]
-            self.log(" segment len=%d" % len(segment))
-            self._status.accumulate_decode_time(time.time() - started)
+            self._status.accumulate_decode_time(elapsed)
             return segment, salt
         d.addCallback(_process)
         return d
@@ -910,12 +928,14 @@ class Retrieve(object):
         segment, salt = segment_and_salt
         self._set_current_status("decrypting")
         self.log("decrypting segment %d" % self._current_segment)
-        started = time.time()
-        key = hashutil.ssk_readkey_data_hash(salt, self._node.get_readkey())
-        decryptor = aes.create_decryptor(key)
-        plaintext = aes.decrypt_data(decryptor, segment)
-        self._status.accumulate_decrypt_time(time.time() - started)
-        return plaintext
+        d = defer_to_thread(_decrypt_segment, self._node.get_readkey(), salt,
+                            segment)
+        def _decrypted(plaintext_and_elapsed):
+            (plaintext, elapsed) = plaintext_and_elapsed
+            self._status.accumulate_decrypt_time(elapsed)
+            return plaintext
+        d.addCallback(_decrypted)
+        return d
 
 
     def notify_server_corruption(self, server, shnum, reason):
@@ -1018,3 +1038,32 @@ class Retrieve(object):
         self._status.timings['fetch'] = now - self._started_fetching
         self._status.set_status("Failed")
         eventually(self._done_deferred.errback, f)
+
+
+def _decode_segment(decoder, shares, shareids, size_to_use):
+    """
+    Decode and join one segment, trimmed to ``size_to_use``.  This runs in
+    the CPU thread pool.
+
+    :return: a tuple of (segment, seconds spent).
+    """
+    started = time.time()
+    buffers = decoder.decode_synchronously(shares, shareids)
+    segment = b"".join(buffers)
+    del buffers
+    segment = segment[:size_to_use]
+    return (segment, time.time() - started)
+
+
+def _decrypt_segment(readkey, salt, segment):
+    """
+    Decrypt one segment with the key derived from ``readkey`` and its
+    ``salt``.  This runs in the CPU thread pool.
+
+    :return: a tuple of (plaintext, seconds spent).
+    """
+    started = time.time()
+    key = hashutil.ssk_readkey_data_hash(salt, readkey)
+    decryptor = aes.create_decryptor(key)
+    plaintext = aes.decrypt_data(decryptor, segment)
+    return (plaintext, time.time() - started)
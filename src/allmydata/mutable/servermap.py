@@ -16,7 +16,7 @@ from six import ensure_str
 import sys, time, copy
 from zope.interface import implementer
 from itertools import count
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from twisted.internet import defer
 from twisted.python import failure
 from foolscap.api import DeadReferenceError, RemoteException, eventually, \
@@ -26,7 +26,7 @@ from allmydata.crypto import rsa
 from allmydata.util import base32, hashutil, log, deferredutil
 from allmydata.util.dictutil import DictOfSets
 from allmydata.storage.server import si_b2a
-from allmydata.interfaces import IServermapUpdaterStatus
+from allmydata.interfaces import IServermapUpdaterStatus, IStatsProducer
 
 from allmydata.mutable.common import MODE_CHECK, MODE_ANYTHING, MODE_WRITE, \
      MODE_READ, MODE_REPAIR, CorruptShareError
@@ -49,6 +49,7 @@ class UpdateStatus(object):
         self.counter = next(self.statusid_counter)
         self.started = time.time()
         self.finished = None
+        self.cached_age = None # set if the servermap came from the cache
 
     def add_per_server_time(self, server, op, sent, elapsed):
         assert op in ("query", "late", "privkey")
@@ -78,6 +79,8 @@ class UpdateStatus(object):
         return self.active
     def get_counter(self):
         return self.counter
+    def get_cached_age(self):
+        return self.cached_age
 
     def set_storage_index(self, si):
         self.storage_index = si
@@ -93,6 +96,8 @@ class UpdateStatus(object):
         self.active = value
     def set_finished(self, when):
         self.finished = when
+    def set_cached_age(self, age):
+        self.cached_age = age
 
 class ServerMap(object):
     """I record the placement of mutable shares.
@@ -134,6 +139,9 @@ class ServerMap(object):
         self._last_update_mode = None
         self._last_update_time = 0
         self.proxies = {}
+        # set on the copies handed out by ServermapCache: Retrieve must then
+        # check that each share still holds the version we expect
+        self.from_cache = False
         self.update_data = {} # shnum -> [(verinfo,(blockhashes,start,end)),..]
         # where blockhashes is a list of bytestrings (the result of
         # layout.MDMFSlotReadProxy.get_blockhashes), and start/end are both
@@ -393,6 +401,128 @@ class ServerMap(object):
         self.update_data.setdefault(shnum , []).append((verinfo, data))
 
 
+@implementer(IStatsProducer)
+class ServermapCache(object):
+    """I remember the most recent servermap of each mutable file that this
+    node has mapped, so that reading (or writing) the same file again soon
+    afterwards does not have to query every server all over again.
+
+    A map updated in MODE_READ or MODE_WRITE is served to MODE_READ requests
+    for read_ttl seconds, and a MODE_WRITE map to MODE_WRITE requests for
+    write_ttl seconds. Other modes (checking, repair) always get a fresh
+    map. Callers get a copy, so they can mark bad shares or add new ones.
+
+    If optimistic_reads is set, downloads of the best version will use a
+    cached map of any age. Retrieve re-reads the header of every share it
+    uses from a cached map and compares it with the version it expects, so
+    a file that has been modified since shows up as missing or mismatched
+    shares, which makes the downloader discard the map and update a new one.
+
+    Within read_ttl, the share data fetched by the original update is
+    reused too, so a small file may be read without contacting any server.
+
+    A cached map is only handed to a node which could have produced it
+    itself: it must know (or be able to verify) the public key, and for
+    MODE_WRITE it must already hold the private key.
+    """
+
+    MAX_ENTRIES = 1000
+
+    def __init__(self, read_ttl=0, write_ttl=0, optimistic_reads=False):
+        self._ttls = {MODE_READ: read_ttl, MODE_WRITE: write_ttl}
+        self._optimistic_reads = optimistic_reads
+        # storage index -> (servermap, fingerprint, pubkey, sharedata)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.remaps = 0
+
+    def get(self, node, mode, optimistic=False):
+        """Return a (servermap, UpdateStatus) tuple describing a cached map
+        that is fresh enough for mode, or None."""
+        if mode not in self._ttls:
+            return None
+        storage_index = node.get_storage_index()
+        entry = self._entries.pop(storage_index, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries[storage_index] = entry # most-recently used goes last
+        (servermap, fingerprint, pubkey, sharedata) = entry
+        (last_mode, when) = servermap.get_last_update()
+        age = time.time() - when
+        fresh = age <= self._ttls[MODE_READ]
+        if mode == MODE_READ:
+            usable = fresh or (optimistic and self._optimistic_reads)
+        else:
+            usable = (last_mode == MODE_WRITE
+                      and age <= self._ttls[MODE_WRITE]
+                      and node.get_privkey() is not None)
+        if usable and not node.get_pubkey():
+            # the fingerprint was checked against this pubkey when the map
+            # was made
+            usable = node.get_fingerprint() == fingerprint
+            if usable:
+                node._populate_pubkey(pubkey)
+        if not usable:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        servermap = servermap.copy()
+        servermap.from_cache = True
+        if fresh:
+            servers = dict((server.get_serverid(), server)
+                           for server in servermap.all_servers())
+            for (key, (data, is_everything)) in sharedata.items():
+                (verinfo, serverid, si, shnum) = key
+                if serverid in servers:
+                    servermap.proxies[key] = MDMFSlotReadProxy(
+                        servers[serverid].get_storage_server(), si, shnum,
+                        data, data_is_everything=is_everything)
+        status = UpdateStatus()
+        status.set_storage_index(storage_index)
+        status.set_mode(mode)
+        status.servermap = servermap
+        status.set_cached_age(age)
+        status.set_progress(1.0)
+        status.set_status("Finished (from cache)")
+        status.set_active(False)
+        status.set_finished(status.get_started())
+        return (servermap, status)
+
+    def put(self, node, servermap):
+        """Remember a servermap that node has just updated."""
+        if (servermap.get_last_update()[0] not in self._ttls
+            or not servermap.recoverable_versions()
+            or not node.get_pubkey()):
+            return
+        storage_index = node.get_storage_index()
+        self._entries.pop(storage_index, None)
+        sharedata = dict((key, (reader._data, reader._data_is_everything))
+                         for (key, reader) in servermap.proxies.items())
+        self._entries[storage_index] = (servermap.copy(),
+                                        node.get_fingerprint(),
+                                        node.get_pubkey(),
+                                        sharedata)
+        while len(self._entries) > self.MAX_ENTRIES:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, storage_index, remap=False):
+        """Forget the map for storage_index, because this node has modified
+        the file or, if remap is True, because reading it failed."""
+        if self._entries.pop(storage_index, None) is not None and remap:
+            self.remaps += 1
+
+    def get_stats(self):
+        return {
+            "mutable.servermap_cache.hits": self.hits,
+            "mutable.servermap_cache.misses": self.misses,
+            "mutable.servermap_cache.remaps": self.remaps,
+            "mutable.servermap_cache.entries": len(self._entries),
+        }
+
+
 class ServermapUpdater(object):
     def __init__(self, filenode, storage_broker, monitor, servermap,
                  mode=MODE_READ, add_lease=False, update_range=None):
@@ -608,22 +738,28 @@ class ServermapUpdater(object):
 
     def _do_read(self, server, storage_index, shnums, readv):
         ss = server.get_storage_server()
+        d2 = None
         if self._add_lease:
-            # send an add-lease message in parallel. The results are handled
-            # separately. This is sent before the slot_readv() so that we can
-            # be sure the add_lease is retired by the time slot_readv comes
-            # back (this relies upon our knowledge that the server code for
-            # add_lease is synchronous).
+            # queue an add-lease message, to be sent (along with any others
+            # queued for this server during this turn, as when a deep-check
+            # adds leases to many files at once) in parallel with the
+            # slot_readv(). The results are handled separately.
             renew_secret = self._node.get_renewal_secret(server)
             cancel_secret = self._node.get_cancel_secret(server)
-            d2 = ss.add_lease(
+            d2 = ss.queue_add_lease(
                 storage_index,
                 renew_secret,
                 cancel_secret,
             )
             # we ignore success
             d2.addErrback(self._add_lease_failed, server, storage_index)
-        d = ss.slot_readv(storage_index, shnums, readv)
+        # queued, so that the reads of the many small files (such as
+        # directories) mapped together reach each server in one message
+        d = ss.queue_slot_readv(storage_index, shnums, readv)
+        if d2 is not None:
+            # make sure the lease has been added by the time the answer
+            # comes back
+            d.addBoth(lambda res: d2.addCallback(lambda ign: res))
         return d
 
 
@@ -659,6 +795,8 @@ class ServermapUpdater(object):
         ss = server.get_storage_server()
         now = time.time()
         elapsed = now - started
+        self._storage_broker.get_server_performance().record_rtt(
+            server.get_serverid(), elapsed)
         def _done_processing(ignored=None):
             self._queries_outstanding.discard(server)
             self._servermap.mark_server_reachable(server)
@@ -16,10 +16,12 @@ from allmydata.util.assertutil import precondition
 from allmydata.interfaces import INodeMaker
 from allmydata.immutable.literal import LiteralFileNode
 from allmydata.immutable.filenode import ImmutableFileNode, CiphertextFileNode
+from allmydata.immutable.downloader.segmentation import DEFAULT_READAHEAD
 from allmydata.immutable.upload import Data
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.mutable.publish import MutableData
-from allmydata.dirnode import DirectoryNode, pack_children
+from allmydata.dirnode import DirectoryNode, pack_children, \
+     DEFAULT_DEEP_TRAVERSE_CONCURRENCY, DEFAULT_DEEP_TRAVERSE_FRONTIER
 from allmydata.unknown import UnknownNode
 from allmydata.blacklist import ProhibitedNode
 from allmydata import uri
@@ -31,7 +33,11 @@ class NodeMaker(object):
     def __init__(self, storage_broker, secret_holder, history,
                  uploader, terminator,
                  default_encoding_parameters, mutable_file_default,
-                 key_generator, blacklist=None):
+                 key_generator, blacklist=None,
+                 download_readahead=DEFAULT_READAHEAD, dirnode_cache=None,
+                 servermap_cache=None, segment_cache=None, share_locations=None,
+                 deep_traverse_concurrency=DEFAULT_DEEP_TRAVERSE_CONCURRENCY,
+                 deep_traverse_frontier=DEFAULT_DEEP_TRAVERSE_FRONTIER):
         self.storage_broker = storage_broker
         self.secret_holder = secret_holder
         self.history = history
@@ -41,6 +47,13 @@ class NodeMaker(object):
         self.mutable_file_default = mutable_file_default
         self.key_generator = key_generator
         self.blacklist = blacklist
+        self.download_readahead = download_readahead
+        self.dirnode_cache = dirnode_cache # None, or a DirectoryCache
+        self.servermap_cache = servermap_cache # None, or a ServermapCache
+        self.segment_cache = segment_cache # None, or a SegmentCache
+        self.share_locations = share_locations # None, or a ShareLocationCache
+        self.deep_traverse_concurrency = deep_traverse_concurrency
+        self.deep_traverse_frontier = deep_traverse_frontier
 
         self._node_cache = weakref.WeakValueDictionary() # uri -> node
 
@@ -48,14 +61,20 @@ class NodeMaker(object):
         return LiteralFileNode(cap)
     def _create_immutable(self, cap):
         return ImmutableFileNode(cap, self.storage_broker, self.secret_holder,
-                                 self.terminator, self.history)
+                                 self.terminator, self.history,
+                                 readahead=self.download_readahead,
+                                 segment_cache=self.segment_cache,
+                                 share_locations=self.share_locations)
     def _create_immutable_verifier(self, cap):
         return CiphertextFileNode(cap, self.storage_broker, self.secret_holder,
-                                  self.terminator, self.history)
+                                  self.terminator, self.history,
+                                  readahead=self.download_readahead,
+                                  segment_cache=self.segment_cache,
+                                  share_locations=self.share_locations)
     def _create_mutable(self, cap):
         n = MutableFileNode(self.storage_broker, self.secret_holder,
                             self.default_encoding_parameters,
-                            self.history)
+                            self.history, self.servermap_cache)
         return n.init_from_cap(cap)
     def _create_dirnode(self, filenode):
         return DirectoryNode(filenode, self, self.uploader)
@@ -130,7 +149,8 @@ class NodeMaker(object):
         if version is None:
             version = self.mutable_file_default
         n = MutableFileNode(self.storage_broker, self.secret_holder,
-                            self.default_encoding_parameters, self.history)
+                            self.default_encoding_parameters, self.history,
+                            self.servermap_cache)
         d = self.key_generator.generate(keysize)
         d.addCallback(n.create_with_keys, contents, version=version)
         d.addCallback(lambda res: n)
@@ -10,6 +10,7 @@ except ImportError:
 
 from twisted.python import usage
 from allmydata.scripts.common import BaseOptions
+from allmydata.util.encodingutil import argv_to_abspath, quote_local_unicode_path
 
 class GenerateKeypairOptions(BaseOptions):
 
@@ -56,12 +57,52 @@ def derive_pubkey(options):
     print("public:", unicode(ed25519.string_from_verifying_key(public_key), "ascii"), file=out)
     return 0
 
+class RebuildShareIndexOptions(BaseOptions):
+    def parseArgs(self, nodedir):
+        self.nodedir = argv_to_abspath(nodedir)
+
+    def getSynopsis(self):
+        return "Usage: tahoe [global-options] admin rebuild-share-index NODEDIR"
+
+    def getUsage(self, width=None):
+        t = BaseOptions.getUsage(self, width)
+        t += """
+Build the share index of the storage server in NODEDIR afresh from its share
+files. The node must not be running. See [storage]share_index in
+docs/configuration.rst.
+
+"""
+        return t
+
+def rebuild_share_index(options):
+    import os
+    from allmydata.client import read_config
+    from allmydata.storage.shareindex import open_share_index
+    out = options.stdout
+    config = read_config(options.nodedir, u"client.port")
+    storedir = config.get_config_path(
+        config.get_config("storage", "storage_dir", "storage"))
+    sharedir = os.path.join(storedir, "shares")
+    if not os.path.isdir(sharedir):
+        print("%s has no shares directory" % quote_local_unicode_path(storedir),
+              file=options.stderr)
+        return 1
+    index = open_share_index(os.path.join(storedir, "share_index.sqlite"))
+    try:
+        count = index.rebuild(sharedir)
+    finally:
+        index.close()
+    print("indexed %d shares" % (count,), file=out)
+    return 0
+
 class AdminCommand(BaseOptions):
     subCommands = [
         ("generate-keypair", None, GenerateKeypairOptions,
          "Generate a public/private keypair, write to stdout."),
         ("derive-pubkey", None, DerivePubkeyOptions,
          "Derive a public key from a private key."),
+        ("rebuild-share-index", None, RebuildShareIndexOptions,
+         "Rebuild a storage server's share index from its share files."),
         ]
     def postOptions(self):
         if not hasattr(self, 'subOptions'):
@@ -79,6 +120,7 @@ each subcommand.
 subDispatch = {
     "generate-keypair": print_keypair,
     "derive-pubkey": derive_pubkey,
+    "rebuild-share-index": rebuild_share_index,
     }
 
 def do_admin(options):
@@ -1,6 +1,7 @@
 from __future__ import print_function
 
-import os.path, sys, time, random, stat
+import os.path, sys, time, random, stat, threading
+from functools import wraps
 
 from allmydata.util.netstring import netstring
 from allmydata.util.hashutil import backupdb_dirhash
@@ -71,13 +72,22 @@ def get_backupdb(dbfile, stderr=sys.stderr,
     # exist.
     try:
         (sqlite3, db) = get_db(dbfile, stderr, create_version, updaters=UPDATERS,
-                               just_create=just_create, dbname="backupdb")
+                               just_create=just_create, dbname="backupdb",
+                               check_same_thread=False)
         return BackupDB_v2(sqlite3, db)
     except DBError as e:
         print(e, file=stderr)
         return None
 
 
+def _locked(f):
+    @wraps(f)
+    def _f(self, *args, **kwargs):
+        with self._lock:
+            return f(self, *args, **kwargs)
+    return _f
+
+
 class FileResult(object):
     def __init__(self, bdb, filecap, should_check,
                  path, mtime, ctime, size):
@@ -129,15 +139,40 @@ class DirectoryResult(object):
 
 
 class BackupDB_v2(object):
+    """My methods may be called from any thread, but only one runs at a
+    time. Changes are committed in batches, of up to COMMIT_BATCH_SIZE
+    changes or COMMIT_INTERVAL seconds' worth, rather than one at a time:
+    call commit() when you are done with me, to write out the last batch.
+    A batch lost in a crash only means some files are uploaded again.
+    """
     VERSION = 2
     NO_CHECK_BEFORE = 1*MONTH
     ALWAYS_CHECK_AFTER = 2*MONTH
+    COMMIT_BATCH_SIZE = 500
+    COMMIT_INTERVAL = 10.0
 
     def __init__(self, sqlite_module, connection):
         self.sqlite_module = sqlite_module
         self.connection = connection
         self.cursor = connection.cursor()
+        self._lock = threading.RLock()
+        self._uncommitted = 0
+        self._last_commit = time.time()
+
+    @_locked
+    def commit(self):
+        """Commit the changes made so far."""
+        self.connection.commit()
+        self._uncommitted = 0
+        self._last_commit = time.time()
+
+    def _changed(self):
+        self._uncommitted += 1
+        if (self._uncommitted >= self.COMMIT_BATCH_SIZE
+            or time.time() - self._last_commit >= self.COMMIT_INTERVAL):
+            self.commit()
 
+    @_locked
     def check_file(self, path, use_timestamps=True):
         """I will tell you if a given local file needs to be uploaded or not,
         by looking in a database and seeing if I have a record of this file
@@ -206,7 +241,7 @@ class BackupDB_v2(object):
             or (not row2) # we somehow forgot where we put the file last time
             ):
             c.execute("DELETE FROM local_files WHERE path=?", (path,))
-            self.connection.commit()
+            self._changed()
             return FileResult(self, None, False, path, mtime, ctime, size)
 
         # at this point, we're allowed to assume the file hasn't been changed
@@ -221,6 +256,7 @@ class BackupDB_v2(object):
         return FileResult(self, to_bytes(filecap), should_check,
                           path, mtime, ctime, size)
 
+    @_locked
     def get_or_allocate_fileid_for_cap(self, filecap):
         # find an existing fileid for this filecap, or insert a new one. The
         # caller is required to commit() afterwards.
@@ -241,6 +277,7 @@ class BackupDB_v2(object):
         fileid = foundrow[0]
         return fileid
 
+    @_locked
     def did_upload_file(self, filecap, path, mtime, ctime, size):
         now = time.time()
         fileid = self.get_or_allocate_fileid_for_cap(filecap)
@@ -260,8 +297,9 @@ class BackupDB_v2(object):
                                 " SET size=?, mtime=?, ctime=?, fileid=?"
                                 " WHERE path=?",
                                 (size, mtime, ctime, fileid, path))
-        self.connection.commit()
+        self._changed()
 
+    @_locked
     def did_check_file_healthy(self, filecap, results):
         now = time.time()
         fileid = self.get_or_allocate_fileid_for_cap(filecap)
@@ -269,8 +307,9 @@ class BackupDB_v2(object):
                             " SET last_checked=?"
                             " WHERE fileid=?",
                             (now, fileid))
-        self.connection.commit()
+        self._changed()
 
+    @_locked
     def check_directory(self, contents):
         """I will tell you if a new directory needs to be created for a given
         set of directory contents, or if I know of an existing (immutable)
@@ -323,6 +362,7 @@ class BackupDB_v2(object):
 
         return DirectoryResult(self, dirhash_s, to_bytes(dircap), should_check)
 
+    @_locked
     def did_create_directory(self, dircap, dirhash):
         now = time.time()
         # if the dirhash is already present (i.e. we've re-uploaded an
@@ -330,12 +370,13 @@ class BackupDB_v2(object):
         # update the record in place. Otherwise create a new record.)
         self.cursor.execute("REPLACE INTO directories VALUES (?,?,?,?)",
                             (dirhash, dircap, now, now))
-        self.connection.commit()
+        self._changed()
 
+    @_locked
     def did_check_directory_healthy(self, dircap, results):
         now = time.time()
         self.cursor.execute("UPDATE directories"
                             " SET last_checked=?"
                             " WHERE dircap=?",
                             (now, dircap))
-        self.connection.commit()
+        self._changed()
@@ -12,6 +12,7 @@ except ImportError:
 from twisted.python import usage
 from allmydata.scripts.common import get_aliases, get_default_nodedir, \
      DEFAULT_ALIAS, BaseOptions
+from allmydata.scripts.common_http import DEFAULT_CONCURRENCY
 from allmydata.util.encodingutil import argv_to_unicode, argv_to_abspath, quote_local_unicode_path
 from .tahoe_status import TahoeStatusCommand
 
@@ -19,6 +20,14 @@ NODEURL_RE=re.compile("http(s?)://([^:]*)(:([1-9][0-9]*))?")
 
 _default_nodedir = get_default_nodedir()
 
+def _parse_concurrency(options):
+    try:
+        options["concurrency"] = int(options["concurrency"])
+    except ValueError:
+        raise usage.UsageError("--concurrency must be an integer")
+    if options["concurrency"] < 1:
+        raise usage.UsageError("--concurrency must be at least 1")
+
 class FileStoreOptions(BaseOptions):
     optParameters = [
         ["node-url", "u", None,
@@ -222,10 +231,15 @@ class CpOptions(FileStoreOptions):
          "When copying to local files, write out filecaps instead of actual "
          "data (only useful for debugging and tree-comparison purposes)."),
         ]
+    optParameters = [
+        ("concurrency", "j", DEFAULT_CONCURRENCY,
+         "Copy up to this many files at a time."),
+        ]
 
     def parseArgs(self, *args):
         if len(args) < 2:
             raise usage.UsageError("cp requires at least two arguments")
+        _parse_concurrency(self)
         self.sources = [argv_to_unicode(arg) for arg in args[:-1]]
         self.destination = argv_to_unicode(args[-1])
 
@@ -324,6 +338,10 @@ class BackupOptions(FileStoreOptions):
         ("verbose", "v", "Be noisy about what is happening."),
         ("ignore-timestamps", None, "Do not use backupdb timestamps to decide whether a local file is unchanged."),
         ]
+    optParameters = [
+        ("concurrency", "j", DEFAULT_CONCURRENCY,
+         "Upload up to this many files, or create this many directories, at a time."),
+        ]
 
     vcs_patterns = ('CVS', 'RCS', 'SCCS', '.git', '.gitignore', '.cvsignore',
                     '.svn', '.arch-ids','{arch}', '=RELEASE-ID',
@@ -337,6 +355,7 @@ class BackupOptions(FileStoreOptions):
     def parseArgs(self, localdir, topath):
         self.from_dir = argv_to_abspath(localdir)
         self.to_dir = argv_to_unicode(topath)
+        _parse_concurrency(self)
 
     synopsis = "[options] FROM ALIAS:TO"
 
@@ -1,8 +1,8 @@
 from __future__ import print_function
 
-import os
+import io, os, stat, sys, threading
 from io import BytesIO
-from six.moves import urllib, http_client
+from six.moves import urllib, http_client, queue
 import six
 import allmydata # for __full_version__
 
@@ -10,6 +10,10 @@ from allmydata.util.encodingutil import quote_output
 from allmydata.scripts.common import TahoeError
 from socket import error as socket_error
 
+# how many requests at once the commands which can make many of them ('tahoe
+# cp', 'tahoe backup') keep in flight by default
+DEFAULT_CONCURRENCY = 4
+
 # copied from twisted/web/client.py
 def parse_url(url, defaultPort=None):
     url = url.strip()
@@ -38,49 +42,214 @@ class BadResponse(object):
         return ""
 
 
-def do_http(method, url, body=b""):
-    if isinstance(body, bytes):
-        body = BytesIO(body)
-    elif isinstance(body, six.text_type):
-        raise TypeError("do_http body must be a bytestring, not unicode")
-    else:
-        # We must give a Content-Length header to twisted.web, otherwise it
-        # seems to get a zero-length file. I suspect that "chunked-encoding"
-        # may fix this.
-        assert body.tell
-        assert body.seek
-        assert body.read
-    scheme, host, port, path = parse_url(url)
-    if scheme == "http":
-        c = http_client.HTTPConnection(host, port)
-    elif scheme == "https":
-        c = http_client.HTTPSConnection(host, port)
-    else:
-        raise ValueError("unknown scheme '%s', need http or https" % scheme)
-    c.putrequest(method, path)
-    c.putheader("Hostname", host)
-    c.putheader("User-Agent", allmydata.__full_version__ + " (tahoe-client)")
-    c.putheader("Accept", "text/plain, application/octet-stream")
-    c.putheader("Connection", "close")
-
-    old = body.tell()
-    body.seek(0, os.SEEK_END)
-    length = body.tell()
-    body.seek(old)
-    c.putheader("Content-Length", str(length))
-
+def _body_length(body):
+    """Return how many bytes are left to read from a file-like body, if that
+    can be found without reading it (i.e. it is a regular file), else None."""
     try:
+        st = os.fstat(body.fileno())
+        position = body.tell()
+    except (AttributeError, ValueError, EnvironmentError,
+            io.UnsupportedOperation):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st.st_size - position
+
+
+class PooledResponse(object):
+    """I wrap an HTTPResponse whose connection can be used again: once the
+    response has been read to the end, the connection goes back to the pool.
+    A response which is never read to the end keeps its connection, which is
+    closed when the response is garbage-collected."""
+
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        if self._connection is not None and self._response.isclosed():
+            connection, self._connection = self._connection, None
+            if self._response.will_close:
+                connection.close()
+            else:
+                self._pool.release(self._key, connection)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class HTTPConnectionPool(object):
+    """I make HTTP requests for the CLI commands, keeping connections to the
+    node open between them (HTTP keep-alive) instead of making a new one for
+    each request. Several threads can use me at once, each request getting a
+    connection of its own.
+
+    Bodies are sent with a Content-Length when it is known (byte strings and
+    regular files), and with chunked transfer-encoding otherwise, so that a
+    body can be any file-like object with a read() method.
+    """
+
+    def __init__(self, max_idle=8):
+        self._max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = {} # (scheme, host, port) -> [HTTPConnection]
+
+    def _get(self, key, reuse):
+        if reuse:
+            with self._lock:
+                idle = self._idle.get(key)
+                if idle:
+                    return idle.pop(), True
+        (scheme, host, port) = key
+        if scheme == "http":
+            return http_client.HTTPConnection(host, port), False
+        return http_client.HTTPSConnection(host, port), False
+
+    def release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def do_http(self, method, url, body=b""):
+        if isinstance(body, bytes):
+            body = BytesIO(body)
+        elif isinstance(body, six.text_type):
+            raise TypeError("do_http body must be a bytestring, not unicode")
+        else:
+            assert body.read
+        scheme, host, port, path = parse_url(url)
+        if scheme not in ("http", "https"):
+            raise ValueError("unknown scheme '%s', need http or https" % scheme)
+        key = (scheme, host, port)
+        if isinstance(body, BytesIO):
+            length = len(body.getvalue()) - body.tell()
+        else:
+            length = _body_length(body)
+        start = None
+        if length is not None:
+            start = body.tell()
+
+        while True:
+            # a body we cannot rewind gets a new connection, which the node
+            # cannot have closed while it was idle
+            c, reused = self._get(key, start is not None)
+            try:
+                response = self._request(c, method, host, path, body, length)
+            except (socket_error, http_client.HTTPException) as err:
+                c.close()
+                if reused and start is not None:
+                    # the node closed an idle connection: try a new one
+                    body.seek(start)
+                    continue
+                if isinstance(err, http_client.HTTPException):
+                    raise
+                return BadResponse(url, err)
+            return PooledResponse(self, key, c, response)
+
+    def _request(self, c, method, host, path, body, length):
+        c.putrequest(method, path)
+        c.putheader("Hostname", host)
+        c.putheader("User-Agent", allmydata.__full_version__ + " (tahoe-client)")
+        c.putheader("Accept", "text/plain, application/octet-stream")
+        if length is not None:
+            c.putheader("Content-Length", str(length))
+        else:
+            c.putheader("Transfer-Encoding", "chunked")
         c.endheaders()
-    except socket_error as err:
-        return BadResponse(url, err)
 
-    while True:
-        data = body.read(8192)
-        if not data:
-            break
-        c.send(data)
+        while True:
+            data = body.read(8192)
+            if not data:
+                break
+            if length is None:
+                c.send(("%x\r\n" % len(data)).encode("ascii") + data + b"\r\n")
+            else:
+                c.send(data)
+        if length is None:
+            c.send(b"0\r\n\r\n")
+        return c.getresponse()
+
+
+_pool = HTTPConnectionPool()
+
+def do_http(method, url, body=b""):
+    """Make an HTTP request, re-using a connection from an earlier one if
+    possible. 'body' is a byte string or a file-like object. Returns the
+    response, or a BadResponse if the node could not be reached."""
+    return _pool.do_http(method, url, body)
+
+def close_connections():
+    """Close the idle connections kept by do_http(), as each command does
+    when it finishes."""
+    _pool.close()
+
+
+def concurrently(f, items, concurrency=DEFAULT_CONCURRENCY):
+    """Call f(item) for each of 'items', in up to 'concurrency' threads at
+    once, and yield (item, result) pairs as the calls finish.
 
-    return c.getresponse()
+    If a call raises an exception, no more calls are started, and the
+    exception is raised once the calls already started have finished.
+    """
+    items = iter(items)
+    if concurrency <= 1:
+        for item in items:
+            yield (item, f(item))
+        return
+    lock = threading.Lock()
+    finished = queue.Queue()
+    failed = []
+    def _work():
+        while True:
+            with lock:
+                if failed:
+                    break
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+            try:
+                finished.put((item, f(item), None))
+            except Exception:
+                with lock:
+                    failed.append(True)
+                finished.put((item, None, sys.exc_info()))
+        finished.put(None)
+    workers = [threading.Thread(target=_work) for i in range(concurrency)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    running = len(workers)
+    error = None
+    while running:
+        done = finished.get()
+        if done is None:
+            running -= 1
+            continue
+        (item, result, exc_info) = done
+        if exc_info is not None:
+            if error is None:
+                error = exc_info
+        elif error is None:
+            yield (item, result)
+    if error is not None:
+        six.reraise(*error)
 
 
 def format_http_success(resp):
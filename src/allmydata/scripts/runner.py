@@ -21,7 +21,7 @@ from twisted.internet import defer, task, threads
 
 from allmydata.scripts.common import get_default_nodedir
 from allmydata.scripts import debug, create_node, cli, \
-    admin, tahoe_run, tahoe_invite
+    admin, tahoe_run, tahoe_invite, common_http
 from allmydata.util.encodingutil import quote_local_unicode_path, argv_to_unicode
 from allmydata.util.eliotutil import (
     opt_eliot_destination,
@@ -156,7 +156,13 @@ def dispatch(config,
     elif command in cli.dispatch:
         # these are blocking, and must be run in a thread
         f0 = cli.dispatch[command]
-        f = lambda so: threads.deferToThread(f0, so)
+        def _run_cli_command(so):
+            try:
+                return f0(so)
+            finally:
+                # don't leave the node holding our kept-alive connections
+                common_http.close_connections()
+        f = lambda so: threads.deferToThread(_run_cli_command, so)
     elif command in tahoe_invite.dispatch:
         f = tahoe_invite.dispatch[command]
     else:
@@ -4,12 +4,14 @@ from past.builtins import unicode
 
 import os.path
 import time
+import threading
 from urllib.parse import quote as url_quote
 import datetime
 
 from allmydata.scripts.common import get_alias, escape_path, DEFAULT_ALIAS, \
                                      UnknownAliasError
-from allmydata.scripts.common_http import do_http, HTTPError, format_http_error
+from allmydata.scripts.common_http import do_http, HTTPError, format_http_error, \
+     concurrently
 from allmydata.util import time_format, jsonbytes as json
 from allmydata.scripts import backupdb
 from allmydata.util.encodingutil import listdir_unicode, quote_output, \
@@ -72,6 +74,9 @@ class BackerUpper(object):
         self.options = options
         self._files_checked = 0
         self._directories_checked = 0
+        # files are uploaded, and directories created, in several threads
+        # at once
+        self._lock = threading.Lock()
 
     def run(self):
         options = self.options
@@ -124,14 +129,18 @@ class BackerUpper(object):
             listdir_unicode,
             self.options.filter_listdir,
         ))
-        completed = run_backup(
-            warn=self.warn,
-            upload_file=self.upload,
-            upload_directory=self.upload_directory,
-            targets=targets,
-            start_timestamp=start_timestamp,
-            stdout=stdout,
-        )
+        try:
+            completed = run_backup(
+                warn=self.warn,
+                upload_file=self.upload,
+                upload_directory=self.upload_directory,
+                targets=targets,
+                start_timestamp=start_timestamp,
+                stdout=stdout,
+                concurrency=options["concurrency"],
+            )
+        finally:
+            self.backupdb.commit()
         new_backup_dircap = completed.dircap
 
         # third: attach the new backup to the list
@@ -155,11 +164,13 @@ class BackerUpper(object):
     def verboseprint(self, msg):
         precondition(isinstance(msg, str), msg)
         if self.verbosity >= 2:
-            print(msg, file=self.options.stdout)
+            with self._lock:
+                print(msg, file=self.options.stdout)
 
     def warn(self, msg):
         precondition(isinstance(msg, str), msg)
-        print(msg, file=self.options.stderr)
+        with self._lock:
+            print(msg, file=self.options.stderr)
 
     def upload_directory(self, path, compare_contents, create_contents):
         must_create, r = self.check_backupdb_directory(compare_contents)
@@ -194,7 +205,8 @@ class BackerUpper(object):
         self.verboseprint("checking %s" % quote_output(filecap))
         nodeurl = self.options['node-url']
         checkurl = nodeurl + "uri/%s?t=check&output=JSON" % url_quote(filecap)
-        self._files_checked += 1
+        with self._lock:
+            self._files_checked += 1
         resp = do_http("POST", checkurl)
         if resp.status != 200:
             # can't check, so we must assume it's bad
@@ -227,7 +239,8 @@ class BackerUpper(object):
         self.verboseprint("checking %s" % quote_output(dircap))
         nodeurl = self.options['node-url']
         checkurl = nodeurl + "uri/%s?t=check&output=JSON" % url_quote(dircap)
-        self._directories_checked += 1
+        with self._lock:
+            self._directories_checked += 1
         resp = do_http("POST", checkurl)
         if resp.status != 200:
             # can't check, so we must assume it's bad
@@ -312,6 +325,27 @@ def collect_backup_targets(root, listdir, filter_children):
         yield DirectoryTarget(root)
 
 
+def backup_waves(targets):
+    """
+    Split the targets from collect_backup_targets into lists which can each
+    be backed up all at once: every directory comes in a later list than
+    everything in it.
+    """
+    heights = {}
+    waves = []
+    for target in targets:
+        height = 0
+        if isinstance(target, DirectoryTarget):
+            # collect_backup_targets yields the directory's children first
+            height = heights.pop(target._path, -1) + 1
+        parent = os.path.dirname(target._path)
+        heights[parent] = max(heights.get(parent, -1), height)
+        while len(waves) <= height:
+            waves.append([])
+        waves[height].append(target)
+    return waves
+
+
 def run_backup(
         warn,
         upload_file,
@@ -319,16 +353,24 @@ def run_backup(
         targets,
         start_timestamp,
         stdout,
+        concurrency=1,
 ):
     progress = BackupProgress(warn, start_timestamp, len(targets))
-    for target in targets:
-        # Pass in the progress and get back a progress.  It would be great if
-        # progress objects were immutable.  Then the target's backup would
-        # make a new progress with the desired changes and return it to us.
-        # Currently, BackupProgress is mutable, though, and everything just
-        # mutates it.
-        progress = target.backup(progress, upload_file, upload_directory)
-        print(progress.report(datetime.datetime.now()), file=stdout)
+    if concurrency <= 1:
+        waves = [targets]
+    else:
+        waves = backup_waves(targets)
+    def _upload(target):
+        return target.upload(progress, upload_file, upload_directory)
+    for wave in waves:
+        for (target, record) in concurrently(_upload, wave, concurrency):
+            # Pass in the progress and get back a progress.  It would be
+            # great if progress objects were immutable.  Then the target's
+            # backup would make a new progress with the desired changes and
+            # return it to us.  Currently, BackupProgress is mutable, though,
+            # and everything just mutates it.
+            progress = record(progress)
+            print(progress.report(datetime.datetime.now()), file=stdout)
     return progress.backup_finished()
 
 
@@ -339,17 +381,28 @@ class FileTarget(object):
     def __repr__(self):
         return "<File {}>".format(self._path)
 
-    def backup(self, progress, upload_file, upload_directory):
+    def upload(self, progress, upload_file, upload_directory):
+        """
+        Do whatever uploading or checking backing me up needs. This may be
+        called in any thread, along with the upload() of other targets.
+        Every kind of target has this method.
+
+        :return: A function which records the outcome in a BackupProgress,
+            and returns that progress. It is called in the thread running
+            the backup.
+        """
         try:
             created, childcap, metadata = upload_file(self._path)
         except EnvironmentError:
             target = PermissionDeniedTarget(self._path, isdir=False)
-            return target.backup(progress, upload_file, upload_directory)
+            return target.upload(progress, upload_file, upload_directory)
         else:
             assert isinstance(childcap, bytes)
             if created:
-                return progress.created_file(self._path, childcap, metadata)
-            return progress.reused_file(self._path, childcap, metadata)
+                return lambda progress: progress.created_file(
+                    self._path, childcap, metadata)
+            return lambda progress: progress.reused_file(
+                self._path, childcap, metadata)
 
 
 class DirectoryTarget(object):
@@ -359,13 +412,15 @@ class DirectoryTarget(object):
     def __repr__(self):
         return "<Directory {}>".format(self._path)
 
-    def backup(self, progress, upload_file, upload_directory):
+    def upload(self, progress, upload_file, upload_directory):
         metadata = get_local_metadata(self._path)
         progress, create, compare = progress.consume_directory(self._path)
         did_create, dircap = upload_directory(self._path, compare, create)
         if did_create:
-            return progress.created_directory(self._path, dircap, metadata)
-        return progress.reused_directory(self._path, dircap, metadata)
+            return lambda progress: progress.created_directory(
+                self._path, dircap, metadata)
+        return lambda progress: progress.reused_directory(
+            self._path, dircap, metadata)
 
 
 class _ErrorTarget(object):
@@ -374,19 +429,23 @@ class _ErrorTarget(object):
         self._quoted_path = quote_local_unicode_path(path)
         self._isdir = isdir
 
+    def upload(self, progress, upload_file, upload_directory):
+        # nothing to upload: the warning is given when it is recorded
+        return self.skip
+
 
 class PermissionDeniedTarget(_ErrorTarget):
-    def backup(self, progress, upload_file, upload_directory):
+    def skip(self, progress):
         return progress.permission_denied(self._isdir, self._quoted_path)
 
 
 class FilenameUndecodableTarget(_ErrorTarget):
-    def backup(self, progress, upload_file, upload_directory):
+    def skip(self, progress):
         return progress.decoding_failed(self._isdir, self._quoted_path)
 
 
 class LinkTarget(_ErrorTarget):
-    def backup(self, progress, upload_file, upload_directory):
+    def skip(self, progress):
         return progress.unsupported_filetype(
             self._isdir,
             self._quoted_path,
@@ -395,7 +454,7 @@ class LinkTarget(_ErrorTarget):
 
 
 class SpecialTarget(_ErrorTarget):
-    def backup(self, progress, upload_file, upload_directory):
+    def skip(self, progress):
         return progress.unsupported_filetype(
             self._isdir,
             self._quoted_path,
@@ -466,6 +525,9 @@ class BackupProgress(object):
     # Would be nice if this data structure were immutable and its methods were
     # transformations that created a new slightly different object.  Not there
     # yet, though.
+    #
+    # Directories are consumed in other threads while the results of other
+    # targets are being recorded, so the contents are kept under a lock.
     def __init__(self, warn, start_timestamp, target_count):
         self._warn = warn
         self._start_timestamp = start_timestamp
@@ -477,6 +539,8 @@ class BackupProgress(object):
         self._directories_reused = 0
         self._directories_skipped = 0
         self.last_dircap = None
+        self._lock = threading.Lock()
+        # dirpath -> {childname: value}
         self._create_contents = {}
         self._compare_contents = {}
 
@@ -523,41 +587,39 @@ class BackupProgress(object):
         )
 
     def consume_directory(self, dirpath):
-        return self, {
-            os.path.basename(create_path): create_value
-            for (create_path, create_value)
-            in self._create_contents.items()
-            if os.path.dirname(create_path) == dirpath
-        }, {
-            os.path.basename(compare_path): compare_value
-            for (compare_path, compare_value)
-            in self._compare_contents.items()
-            if os.path.dirname(compare_path) == dirpath
-        }
+        with self._lock:
+            return (
+                self,
+                self._create_contents.pop(dirpath, {}),
+                self._compare_contents.pop(dirpath, {}),
+            )
+
+    def _add_child(self, path, kind, cap, metadata):
+        (dirpath, name) = os.path.split(path)
+        with self._lock:
+            self._create_contents.setdefault(dirpath, {})[name] = (
+                kind, cap, metadata)
+            self._compare_contents.setdefault(dirpath, {})[name] = cap
 
     def created_directory(self, path, dircap, metadata):
-        self._create_contents[path] = ("dirnode", dircap, metadata)
-        self._compare_contents[path] = dircap
+        self._add_child(path, "dirnode", dircap, metadata)
         self._directories_created += 1
         self.last_dircap = dircap
         return self
 
     def reused_directory(self, path, dircap, metadata):
-        self._create_contents[path] = ("dirnode", dircap, metadata)
-        self._compare_contents[path] = dircap
+        self._add_child(path, "dirnode", dircap, metadata)
         self._directories_reused += 1
         self.last_dircap = dircap
         return self
 
     def created_file(self, path, cap, metadata):
-        self._create_contents[path] = ("filenode", cap, metadata)
-        self._compare_contents[path] = cap
+        self._add_child(path, "filenode", cap, metadata)
         self._files_created += 1
         return self
 
     def reused_file(self, path, cap, metadata):
-        self._create_contents[path] = ("filenode", cap, metadata)
-        self._compare_contents[path] = cap
+        self._add_child(path, "filenode", cap, metadata)
         self._files_reused += 1
         return self
 
@@ -10,7 +10,7 @@ from io import BytesIO
 from twisted.python.failure import Failure
 from allmydata.scripts.common import get_alias, escape_path, \
                                      DefaultAliasMarker, TahoeError
-from allmydata.scripts.common_http import do_http, HTTPError
+from allmydata.scripts.common_http import do_http, HTTPError, concurrently
 from allmydata import uri
 from allmydata.util import fileutil
 from allmydata.util.fileutil import abspath_expanduser_unicode, precondition_abspath
@@ -209,13 +209,6 @@ class TahoeFileSource(object):
         return self.writecap or self.readcap
 
 
-def seekable(file_like):
-    """Return whether the file-like object is seekable."""
-    return hasattr(file_like, "seek") and (
-        not hasattr(file_like, "seekable") or file_like.seekable()
-    )
-
-
 class TahoeFileTarget(object):
     def __init__(self, nodeurl, mutable, writecap, readcap, url):
         self.nodeurl = nodeurl
@@ -227,10 +220,6 @@ class TahoeFileTarget(object):
     def put_file(self, inf):
         # We want to replace this object in-place.
         assert self.url
-        # our do_http() call currently requires a string or a filehandle with
-        # a real .seek
-        if not seekable(inf):
-            inf = inf.read()
         PUT(self.url, inf)
         # TODO: this always creates immutable files. We might want an option
         # to always create mutable files, or to copy mutable files into new
@@ -315,8 +304,6 @@ class TahoeMissingTarget(object):
 
     def put_file(self, inf):
         # We want to replace this object in-place.
-        if not seekable(inf):
-            inf = inf.read()
         PUT(self.url, inf)
         # TODO: this always creates immutable files. We might want an option
         # to always create mutable files, or to copy mutable files into new
@@ -426,8 +413,6 @@ class TahoeDirectoryTarget(object):
     def put_file(self, name, inf):
         precondition(isinstance(name, unicode), name)
         url = self.nodeurl + "uri"
-        if not seekable(inf):
-            inf = inf.read()
 
         if self.children is None:
             self.populate(recurse=False)
@@ -495,6 +480,7 @@ class Copier(object):
                 print(message, file=self.stderr)
             self.progressfunc = progress
         self.caps_only = options["caps-only"]
+        self.concurrency = options["concurrency"]
         self.cache = {}
         try:
             status = self.try_copy()
@@ -835,16 +821,40 @@ class Copier(object):
         files_copied = 0
         targets_finished = 0
 
+        # several files are copied at once, and then each target directory
+        # gets its new children once all of its files are in the grid. The
+        # targets learn what they already hold first, so that the threads
+        # copying into them need only add to it.
+        copies = []
+        remaining = {}
         for target, sources in targetmap.items():
             _assert(isinstance(target, DirectoryTargets), target)
+            target.populate(recurse=False)
             for source in sources:
                 _assert(isinstance(source, FileSources), source)
-                self.copy_file_into_dir(source, source.basename(), target)
-                files_copied += 1
-                self.progress("%d/%d files, %d/%d directories" %
-                              (files_copied, files_to_copy,
-                               targets_finished, len(targetmap)))
+                copies.append((source, target))
+            remaining[target] = len(sources)
+
+        def _set_children(target):
             target.set_children()
+            return target
+
+        finished = [target for (target, count) in remaining.items()
+                    if not count]
+        def _copy(copy):
+            (source, target) = copy
+            self.copy_file_into_dir(source, source.basename(), target)
+        for ((source, target), ignored) in concurrently(_copy, copies,
+                                                        self.concurrency):
+            files_copied += 1
+            self.progress("%d/%d files, %d/%d directories" %
+                          (files_copied, files_to_copy,
+                           targets_finished, len(targetmap)))
+            remaining[target] -= 1
+            if not remaining[target]:
+                finished.append(target)
+        for (target, ignored) in concurrently(_set_children, finished,
+                                              self.concurrency):
             targets_finished += 1
             self.progress("%d/%d directories" %
                           (targets_finished, len(targetmap)))
@@ -3,7 +3,6 @@ from __future__ import print_function
 from future.utils import PY2
 from past.builtins import unicode
 
-from io import BytesIO
 from urllib.parse import quote as url_quote
 
 from allmydata.scripts.common_http import do_http, format_http_success, format_http_error
@@ -80,17 +79,15 @@ def put(options):
     if from_file:
         infileobj = open(from_file, "rb")
     else:
-        # do_http() can't use stdin directly: for one thing, we need a
-        # Content-Length field. So we currently must copy it.
+        # do_http() sends stdin as it is read, with chunked encoding, since
+        # its length is not known ahead of time.
         if verbosity > 0:
             print("waiting for file data on stdin..", file=stderr)
         # We're uploading arbitrary files, so this had better be bytes:
         if PY2:
-            stdinb = stdin
+            infileobj = stdin
         else:
-            stdinb = stdin.buffer
-        data = stdinb.read()
-        infileobj = BytesIO(data)
+            infileobj = stdin.buffer
 
     resp = do_http("PUT", url, infileobj)
 
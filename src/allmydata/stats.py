@@ -101,3 +101,20 @@ class StatsProvider(service.MultiService):
         ret = { 'counters': self.counters, 'stats': stats }
         log.msg(format='get_stats() -> %(stats)s', stats=ret, level=log.NOISY)
         return ret
+
+    def get_histograms(self):
+        """
+        Collect the histograms of those producers which keep any (in
+        addition to the numbers they return from get_stats), such as the
+        storage server's latencies.
+
+        :return: A dict mapping a histogram name to a dict which maps a
+            label value to a ``(buckets, count, sum)`` tuple, as returned
+            by ``LatencyHistogram.get_cumulative``.
+        """
+        histograms = {}
+        for sp in self.stats_producers:
+            get_histograms = getattr(sp, "get_histograms", None)
+            if get_histograms is not None:
+                histograms.update(get_histograms())
+        return histograms
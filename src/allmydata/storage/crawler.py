@@ -20,14 +20,46 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle  # type: ignore
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
 from twisted.application import service
 from allmydata.storage.common import si_b2a
-from allmydata.util import fileutil
+from allmydata.util import fileutil, log
+
+# os.scandir() is new in Python 3.5
+scandir = getattr(os, "scandir", None)
+
+# the StorageServer latency categories of the requests which clients are
+# waiting for, and which the crawler should get out of the way of
+FOREGROUND_LATENCY_CATEGORIES = ("allocate", "write", "close", "read",
+                                 "get", "writev", "readv")
 
 class TimeSliceExceeded(Exception):
     pass
 
+class WaitingForListing(TimeSliceExceeded):
+    """The next prefixdir is still being listed, by the Deferred in
+    self.listing."""
+    def __init__(self, listing):
+        TimeSliceExceeded.__init__(self)
+        self.listing = listing
+
+def list_prefixdir(prefixdir):
+    """Return the sorted names of the buckets in a prefixdir, or [] if it
+    cannot be listed. This does the blocking I/O, so the crawler runs it with
+    the server's disk_io."""
+    try:
+        if scandir is not None:
+            # the entry types come with the listing, so we can leave out
+            # stray files without stat()ing anything
+            buckets = [entry.name for entry in scandir(prefixdir)
+                       if entry.is_dir()]
+        else:
+            buckets = os.listdir(prefixdir)
+    except EnvironmentError:
+        buckets = []
+    buckets.sort()
+    return buckets
+
 class ShareCrawler(service.MultiService):
     """A ShareCrawler subclass is attached to a StorageServer, and
     periodically walks all of its shares, processing each one in some
@@ -40,6 +72,22 @@ class ShareCrawler(service.MultiService):
     after it has worked for 'cpu_slice' seconds, and not resuming right away,
     always trying to use less than 'allowed_cpu_percentage'.
 
+    The crawler can also be held to an I/O budget: with
+    allowed_entries_per_second= (directory entries listed) or
+    allowed_bytes_per_second= (share data read, as reported by subclasses
+    through count_io()) set, it ends a time slice early once the slice has
+    used its share of the budget, and sleeps long enough afterwards to keep
+    the average under it. With max_foreground_latency= set, it also backs off
+    (doubling its sleep each slice, up to MAX_LATENCY_BACKOFF times) while the
+    90th percentile latency of the server's client requests over the last
+    minute is above that many seconds, and speeds up again once it is not.
+
+    With parallel_prefixes= above 1, the crawler lists that many prefixdirs
+    at once, ahead of the one it is processing, using the server's disk_io.
+    This only helps when the server has disk I/O threads: the buckets
+    themselves are still processed one prefix at a time, in order, on the
+    reactor thread.
+
     Once the crawler finishes a cycle, it will put off starting the next one
     long enough to ensure that 'minimum_cycle_time' elapses between the start
     of two consecutive cycles.
@@ -83,6 +131,14 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    # and so can these. None means no limit.
+    allowed_entries_per_second = None # directory entries listed
+    allowed_bytes_per_second = None # share data read, see count_io()
+    max_foreground_latency = None # back off while clients wait longer
+    parallel_prefixes = 1 # how many prefixdirs to list at once
+
+    MAX_LATENCY_BACKOFF = 64
+    LATENCY_WINDOW = 60
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
@@ -99,6 +155,14 @@ class ShareCrawler(service.MultiService):
         self.prefixes.sort()
         self.timer = None
         self.bucket_cache = (None, [])
+        self.listings = {} # prefix index -> sorted buckets, or a Deferred
+        # bumped by stopService(), so that listings which were still being
+        # done then are dropped when they arrive
+        self.listing_generation = 0
+        self.waiting_for = None
+        self.slice_entries = 0
+        self.slice_bytes = 0
+        self.latency_backoff = 1
         self.current_sleep_time = None
         self.next_wake_time = None
         self.last_prefix_finished_time = None
@@ -268,6 +332,11 @@ class ShareCrawler(service.MultiService):
         if self.timer:
             self.timer.cancel()
             self.timer = None
+        self.waiting_for = None
+        # the shares may change while we are stopped, so list them again
+        self.listings.clear()
+        self.listing_generation += 1
+        self.bucket_cache = (None, [])
         self.save_state()
         return service.MultiService.stopService(self)
 
@@ -277,9 +346,13 @@ class ShareCrawler(service.MultiService):
         self.sleeping_between_cycles = False
         self.current_sleep_time = None
         self.next_wake_time = None
+        waiting_for = None
         try:
             self.start_current_prefix(start_slice)
             finished_cycle = True
+        except WaitingForListing as e:
+            waiting_for = e.listing
+            finished_cycle = False
         except TimeSliceExceeded:
             finished_cycle = False
         self.save_state()
@@ -293,6 +366,9 @@ class ShareCrawler(service.MultiService):
         # this_slice/percentage = this_slice+sleep_time
         # sleep_time = (this_slice/percentage) - this_slice
         sleep_time = (this_slice / self.allowed_cpu_percentage) - this_slice
+        sleep_time = max(sleep_time, self.io_sleep_time(this_slice))
+        self.slice_entries = self.slice_bytes = 0
+        sleep_time = self.back_off(sleep_time)
         # if the math gets weird, or a timequake happens, don't sleep
         # forever. Note that this means that, while a cycle is running, we
         # will process at least one bucket every 5 minutes, no matter how
@@ -309,8 +385,118 @@ class ShareCrawler(service.MultiService):
         self.current_sleep_time = sleep_time # for status page
         self.next_wake_time = now + sleep_time
         self.yielding(sleep_time)
+        if waiting_for is not None:
+            # sleep until the listing we need arrives, if that is longer
+            self.waiting_for = waiting_for
+            waiting_for.addBoth(self._listing_arrived, waiting_for,
+                                self.next_wake_time)
+            return
         self.timer = reactor.callLater(sleep_time, self.start_slice)
 
+    def _listing_arrived(self, res, listing, wake_time):
+        if self.waiting_for is listing:
+            self.waiting_for = None
+            if self.running:
+                sleep_time = max(0.0, wake_time - time.time())
+                self.timer = reactor.callLater(sleep_time, self.start_slice)
+        return res
+
+    def io_sleep_time(self, this_slice):
+        """How long to sleep after a slice of 'this_slice' seconds, to keep
+        the I/O it did within the budget."""
+        needed = 0.0
+        if self.allowed_entries_per_second:
+            needed = max(needed,
+                         self.slice_entries / self.allowed_entries_per_second)
+        if self.allowed_bytes_per_second:
+            needed = max(needed,
+                         self.slice_bytes / self.allowed_bytes_per_second)
+        return needed - this_slice
+
+    def get_foreground_latency(self):
+        """Return the worst 90th percentile latency of the server's client
+        requests over the last LATENCY_WINDOW seconds, or None if there have
+        not been enough of them to say."""
+        latencies = self.server.get_latencies(window=self.LATENCY_WINDOW)
+        worst = None
+        for category in FOREGROUND_LATENCY_CATEGORIES:
+            latency = latencies.get(category, {}).get("90_0_percentile")
+            if latency is not None and (worst is None or latency > worst):
+                worst = latency
+        return worst
+
+    def back_off(self, sleep_time):
+        """Stretch 'sleep_time' while client requests are slow."""
+        if self.max_foreground_latency is None:
+            self.latency_backoff = 1
+            return sleep_time
+        latency = self.get_foreground_latency()
+        if latency is not None and latency > self.max_foreground_latency:
+            self.latency_backoff = min(self.latency_backoff * 2,
+                                       self.MAX_LATENCY_BACKOFF)
+        else:
+            self.latency_backoff = max(self.latency_backoff // 2, 1)
+        if self.latency_backoff > 1:
+            sleep_time = max(sleep_time, self.cpu_slice) * self.latency_backoff
+        return sleep_time
+
+    def count_io(self, entries=0, bytes_read=0):
+        """Charge I/O done by the crawler against its budget. The crawler
+        counts the entries of the prefixdirs it lists itself: subclasses
+        should call this for the bucket directories they list and the share
+        data they read in process_bucket()."""
+        self.slice_entries += entries
+        self.slice_bytes += bytes_read
+
+    def slice_exceeded(self, start_slice):
+        """Has this time slice used up its CPU time or its I/O budget?"""
+        if time.time() >= start_slice + self.cpu_slice:
+            return True
+        if (self.allowed_entries_per_second and self.slice_entries >=
+            self.allowed_entries_per_second * self.cpu_slice):
+            return True
+        if (self.allowed_bytes_per_second and self.slice_bytes >=
+            self.allowed_bytes_per_second * self.cpu_slice):
+            return True
+        return False
+
+    def _start_listing(self, i):
+        prefixdir = os.path.join(self.sharedir, self.prefixes[i])
+        if self.parallel_prefixes <= 1:
+            self.listings[i] = list_prefixdir(prefixdir)
+            return
+        listing = self.server.disk_io.run(prefixdir, None,
+                                          list_prefixdir, prefixdir)
+        self.listings[i] = listing
+        generation = self.listing_generation
+        if isinstance(listing, defer.Deferred):
+            def _failed(f):
+                log.err(f, "crawler: unable to list %s" % (prefixdir,),
+                        umid="c0QW6g")
+                return []
+            def _listed(buckets):
+                if (self.listing_generation == generation and
+                    self.listings.get(i) is listing):
+                    self.listings[i] = buckets
+                return buckets
+            listing.addErrback(_failed)
+            listing.addCallback(_listed)
+
+    def get_listing(self, i):
+        """Return the sorted buckets of prefix number 'i', starting to list
+        the next few prefixdirs too if parallel_prefixes says to. Raises
+        WaitingForListing if it is still being listed."""
+        for j in range(i, min(i + max(self.parallel_prefixes, 1),
+                              len(self.prefixes))):
+            if j not in self.listings:
+                self._start_listing(j)
+        buckets = self.listings[i]
+        if isinstance(buckets, defer.Deferred):
+            raise WaitingForListing(buckets)
+        del self.listings[i]
+        self.count_io(entries=len(buckets))
+        return buckets
+
     def start_current_prefix(self, start_slice):
         state = self.state
         if state["current-cycle"] is None:
@@ -330,11 +516,7 @@ class ShareCrawler(service.MultiService):
             if i == self.bucket_cache[0]:
                 buckets = self.bucket_cache[1]
             else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
+                buckets = self.get_listing(i)
                 self.bucket_cache = (i, buckets)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
@@ -347,11 +529,12 @@ class ShareCrawler(service.MultiService):
             self.last_prefix_finished_time = now
 
             self.finished_prefix(cycle, prefix)
-            if time.time() >= start_slice + self.cpu_slice:
+            if self.slice_exceeded(start_slice):
                 raise TimeSliceExceeded()
 
         # yay! we finished the whole cycle
         self.last_complete_prefix_index = -1
+        self.listings.clear()
         self.last_prefix_finished_time = None # don't include the sleep
         now = time.time()
         if self.last_cycle_started_time is not None:
@@ -380,7 +563,7 @@ class ShareCrawler(service.MultiService):
                 continue
             self.process_bucket(cycle, prefix, prefixdir, bucket)
             self.state["last-complete-bucket"] = bucket
-            if time.time() >= start_slice + self.cpu_slice:
+            if self.slice_exceeded(start_slice):
                 raise TimeSliceExceeded()
 
     # the remaining methods are explictly for subclasses to implement.
@@ -0,0 +1,194 @@
+"""
+Executors for a storage server's disk I/O.
+
+Reading and writing share files blocks, so a storage server doing it on the
+reactor thread stops talking to every client while it waits for a slow
+disk. ``ThreadedDiskIO`` does that work in a pool of threads instead (or in
+one pool for each device holding shares, so that one slow device does not
+hold up the others), while ``InlineDiskIO`` keeps the traditional
+behaviour.
+
+Both run a function as ``run(path, key, f, *args)``: ``path`` is a directory
+on the device the function will use, and the functions run with the same
+(non-None) ``key`` run one at a time, in the order they were given.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os
+
+from twisted.application import service
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+
+def then(result, f, *args, **kwargs):
+    """
+    Call ``f(result, *args, **kwargs)`` now, or when ``result`` is ready if it
+    is a Deferred, and return what it returns (or a Deferred for it).
+    """
+    if isinstance(result, defer.Deferred):
+        return result.addCallback(f, *args, **kwargs)
+    return f(result, *args, **kwargs)
+
+
+def gather(results):
+    """
+    Turn a list of results, some of which may be Deferreds, into a list of
+    results, or a Deferred for one.
+    """
+    if not any(isinstance(result, defer.Deferred) for result in results):
+        return list(results)
+    return defer.gatherResults([result if isinstance(result, defer.Deferred)
+                                else defer.succeed(result)
+                                for result in results],
+                               consumeErrors=True)
+
+
+class InlineDiskIO(object):
+    """
+    I run disk I/O functions immediately, on the calling thread, and return
+    their results (or raise their exceptions) directly.
+    """
+
+    def run(self, path, key, f, *args, **kwargs):
+        return f(*args, **kwargs)
+
+    def get_stats(self):
+        return {}
+
+
+inline_disk_io = InlineDiskIO()
+
+
+class ThreadedDiskIO(service.Service):
+    """
+    I run disk I/O functions in a pool of ``threads`` threads, or (with
+    ``per_device=True``) in a pool of that size for each device, and return
+    a Deferred for each result.
+    """
+
+    def __init__(self, threads, per_device=False, reactor=None):
+        if threads < 1:
+            raise ValueError("ThreadedDiskIO needs at least one thread, not %d"
+                             % (threads,))
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._threads = threads
+        self._per_device = per_device
+        self._pools = {} # device -> ThreadPool
+        self._devices = {} # directory -> device
+        self._tails = {} # key -> Deferred fired when its last function is done
+        self._outstanding = {} # device -> functions given to us but not done
+        self._max_outstanding = 0
+        self._waiting = 0 # functions waiting for another with the same key
+        self._completed = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        for (device, pool) in list(self._pools.items()):
+            if pool.joined:
+                # a stopped ThreadPool cannot be started again
+                pool = self._pools[device] = self._new_pool(device)
+            pool.start()
+
+    def stopService(self):
+        for pool in self._pools.values():
+            pool.stop()
+        return service.Service.stopService(self)
+
+    def _get_device(self, path):
+        if not self._per_device:
+            return 0
+        # ``path`` is a prefix directory, which may not exist yet, and every
+        # prefix directory of a share directory is on its device: look the
+        # share directory up, so that we only stat it the first time.
+        sharedir = os.path.dirname(path)
+        device = self._devices.get(sharedir)
+        if device is None:
+            existing = sharedir
+            while not os.path.exists(existing):
+                parent = os.path.dirname(existing)
+                if parent == existing:
+                    break
+                existing = parent
+            device = os.stat(existing).st_dev
+            if existing == sharedir:
+                self._devices[sharedir] = device
+        return device
+
+    def _new_pool(self, device):
+        return ThreadPool(0, self._threads,
+                          name="storage-disk-io-%s" % (device,))
+
+    def _get_pool(self, device):
+        pool = self._pools.get(device)
+        if pool is None:
+            pool = self._new_pool(device)
+            self._pools[device] = pool
+            if self.running:
+                pool.start()
+        return pool
+
+    def run(self, path, key, f, *args, **kwargs):
+        device = self._get_device(path)
+        pool = self._get_pool(device)
+        self._outstanding[device] = self._outstanding.get(device, 0) + 1
+        self._max_outstanding = max(self._max_outstanding,
+                                    sum(self._outstanding.values()))
+        d = defer.Deferred()
+        def _submit(ign=None):
+            d2 = threads.deferToThreadPool(self._reactor, pool,
+                                           f, *args, **kwargs)
+            d2.addBoth(_finished)
+            d2.chainDeferred(d)
+        def _finished(res):
+            self._outstanding[device] -= 1
+            self._completed += 1
+            return res
+
+        if key is None:
+            _submit()
+            return d
+
+        previous = self._tails.get(key)
+        done = defer.Deferred()
+        self._tails[key] = done
+        def _next(res):
+            if self._tails.get(key) is done:
+                del self._tails[key]
+            done.callback(None)
+            return res
+        d.addBoth(_next)
+        if previous is None:
+            _submit()
+        else:
+            self._waiting += 1
+            def _go(ign):
+                self._waiting -= 1
+                _submit()
+            previous.addCallback(_go)
+        return d
+
+    def get_stats(self):
+        stats = {
+            "storage_server.disk_io.threads": self._threads * max(1, len(self._pools)),
+            "storage_server.disk_io.queue_depth": sum(self._outstanding.values()),
+            "storage_server.disk_io.max_queue_depth": self._max_outstanding,
+            "storage_server.disk_io.waiting_for_order": self._waiting,
+            "storage_server.disk_io.completed": self._completed,
+        }
+        if self._per_device:
+            for (device, outstanding) in self._outstanding.items():
+                stats["storage_server.disk_io.queue_depth.dev%d" % (device,)] = outstanding
+        return stats
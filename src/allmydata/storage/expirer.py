@@ -12,8 +12,12 @@ import time, os, pickle, struct
 from allmydata.storage.crawler import ShareCrawler
 from allmydata.storage.shares import get_share_file
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
+     UnknownImmutableContainerVersionError, si_a2b, storage_index_to_dir
+from allmydata.storage.diskio import then, gather
 from twisted.python import log as twlog
+from twisted.python.failure import Failure
+from twisted.application import service
+from twisted.application.internet import TimerService
 
 class LeaseCheckingCrawler(ShareCrawler):
     """I examine the leases on all shares, determining which are still valid
@@ -127,7 +131,9 @@ class LeaseCheckingCrawler(ShareCrawler):
         would_keep_shares = []
         wks = None
 
-        for fn in os.listdir(bucketdir):
+        names = os.listdir(bucketdir)
+        self.count_io(entries=len(names))
+        for fn in names:
             try:
                 shnum = int(fn)
             except ValueError:
@@ -168,7 +174,7 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     def process_share(self, sharefilename):
         # first, find out what kind of a share it is
-        sf = get_share_file(sharefilename)
+        sf = get_share_file(sharefilename, self.server.open_files)
         sharetype = sf.sharetype
         now = time.time()
         s = self.stat(sharefilename)
@@ -180,44 +186,30 @@ class LeaseCheckingCrawler(ShareCrawler):
 
         for li in sf.get_leases():
             num_leases += 1
-            original_expiration_time = li.get_expiration_time()
-            grant_renew_time = li.get_grant_renew_time_time()
-            age = li.get_age()
-            self.add_lease_age_to_histogram(age)
+            self.add_lease_age_to_histogram(li.get_age())
 
             #  expired-or-not according to original expiration time
-            if original_expiration_time > now:
+            if li.get_expiration_time() > now:
                 num_valid_leases_original += 1
 
             #  expired-or-not according to our configured age limit
-            expired = False
-            if self.mode == "age":
-                age_limit = original_expiration_time
-                if self.override_lease_duration is not None:
-                    age_limit = self.override_lease_duration
-                if age > age_limit:
-                    expired = True
-            else:
-                assert self.mode == "cutoff-date"
-                if grant_renew_time < self.cutoff_date:
-                    expired = True
-            if sharetype not in self.sharetypes_to_expire:
-                expired = False
-
-            if expired:
+            if self.lease_has_expired(li, sharetype):
                 expired_leases_configured.append(li)
             else:
                 num_valid_leases_configured += 1
 
+        self.count_io(bytes_read=num_leases * sf.LEASE_SIZE)
+
         so_far = self.state["cycle-to-date"]
         self.increment(so_far["leases-per-share-histogram"], num_leases, 1)
         self.increment_space("examined", s, sharetype)
 
         would_keep_share = [1, 1, 1, sharetype]
 
-        if self.expiration_enabled:
-            for li in expired_leases_configured:
-                sf.cancel_lease(li.cancel_secret)
+        if self.expiration_enabled and expired_leases_configured:
+            self.cancel_leases(sharefilename,
+                               [li.cancel_secret
+                                for li in expired_leases_configured])
 
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
@@ -232,6 +224,52 @@ class LeaseCheckingCrawler(ShareCrawler):
 
         return would_keep_share
 
+    def lease_has_expired(self, li, sharetype):
+        if sharetype not in self.sharetypes_to_expire:
+            return False
+        if self.mode == "age":
+            age_limit = li.get_expiration_time()
+            if self.override_lease_duration is not None:
+                age_limit = self.override_lease_duration
+            return li.get_age() > age_limit
+        assert self.mode == "cutoff-date"
+        return li.get_grant_renew_time_time() < self.cutoff_date
+
+    def cancel_leases(self, sharefilename, cancel_secrets):
+        """Cancel the given expired leases on a share, with the server's disk
+        I/O executor, so that it happens in turn with the clients' requests
+        for the same bucket."""
+        bucketdir = os.path.dirname(sharefilename)
+        storage_index = si_a2b(os.path.basename(bucketdir).encode("ascii"))
+        result = self.server.disk_io.run(os.path.dirname(bucketdir),
+                                         storage_index,
+                                         self._cancel_expired_leases,
+                                         sharefilename, cancel_secrets)
+        return then(result, self._cancelled_leases, sharefilename)
+
+    def _cancel_expired_leases(self, sharefilename, cancel_secrets):
+        # a client may have renewed some of these leases since we looked at
+        # them, so look again
+        try:
+            if not os.path.exists(sharefilename):
+                return None
+            sf = get_share_file(sharefilename, self.server.open_files)
+            for li in list(sf.get_leases()):
+                if (li.cancel_secret in cancel_secrets and
+                    self.lease_has_expired(li, sf.sharetype)):
+                    sf.cancel_lease(li.cancel_secret)
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error, EnvironmentError):
+            return Failure()
+        return None
+
+    def _cancelled_leases(self, f, sharefilename):
+        if f is not None:
+            twlog.msg("lease-checker error cancelling leases on %s"
+                      % (sharefilename,))
+            twlog.err(f)
+
     def increment_space(self, a, s, sharetype):
         sharebytes = s.st_size
         try:
@@ -433,3 +471,108 @@ class LeaseCheckingCrawler(ShareCrawler):
         state["estimated-remaining-cycle"] = remaining
         state["estimated-current-cycle"] = cycle
         return state
+
+
+class IndexedLeaseExpirer(service.MultiService):
+    """I remove expired leases (and so, when the last lease on a share is
+    removed, the share itself) from a storage server which keeps a share
+    index, using the same rules as a LeaseCheckingCrawler with
+    expiration_enabled=True.
+
+    Rather than visiting every share, I ask the index which shares have
+    leases old enough to have expired, every ``check_interval`` seconds.
+    """
+    check_interval = 60*60
+
+    def __init__(self, server, mode, override_lease_duration, cutoff_date,
+                 sharetypes):
+        service.MultiService.__init__(self)
+        self.server = server
+        self.mode = mode
+        if mode not in ("age", "cutoff-date"):
+            raise ValueError("GC mode '%s' must be 'age' or 'cutoff-date'" % mode)
+        self.override_lease_duration = override_lease_duration
+        self.cutoff_date = cutoff_date
+        self.sharetypes_to_expire = sharetypes
+        self.counters = {"leases-cancelled": 0,
+                         "shares-removed": 0,
+                         "sharebytes-removed": 0}
+        TimerService(self.check_interval, self.expire_leases).setServiceParent(self)
+
+    def get_expiration_threshold(self, now):
+        """Return the time before which a lease must expire (by its own
+        expiration time) for it to be expired under the configured rules.
+        Leases are granted for 31 days, so the grant/renew time is 31 days
+        before the expiration time."""
+        lease_duration = 31*24*60*60
+        if self.mode == "age":
+            if self.override_lease_duration is None:
+                return now
+            return now + lease_duration - self.override_lease_duration
+        return self.cutoff_date + lease_duration
+
+    def expire_leases(self):
+        now = time.time()
+        threshold = self.get_expiration_threshold(now)
+        index = self.server.share_index
+        candidates = index.get_shares_with_leases_expiring_before(
+            threshold, self.sharetypes_to_expire)
+        results = []
+        for (storage_index, shnum) in candidates:
+            bucketdir = os.path.join(self.server.sharedir,
+                                     storage_index_to_dir(storage_index))
+            filename = os.path.join(bucketdir, "%d" % shnum)
+            # this runs in turn with the clients' requests for the bucket,
+            # which may renew the leases we are about to cancel
+            result = self.server.disk_io.run(os.path.dirname(bucketdir),
+                                             storage_index, self._expire_share,
+                                             storage_index, shnum, filename,
+                                             threshold)
+            results.append(then(result, self._expired_share, filename))
+        return gather(results)
+
+    def _expire_share(self, storage_index, shnum, filename, threshold):
+        """
+        :return: A tuple of (Failure or None, number of leases cancelled,
+            size of the share if it was removed or None).
+        """
+        try:
+            result = (None,) + self._expire_share_leases(filename, threshold)
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error, EnvironmentError):
+            result = (Failure(), 0, None)
+        # whatever happened, the index should now match the share file
+        self.server.share_index.index_share_file(storage_index, shnum, filename)
+        return result
+
+    def _expire_share_leases(self, filename, threshold):
+        if not os.path.exists(filename):
+            return (0, None)
+        sf = get_share_file(filename, self.server.open_files)
+        size = os.stat(filename).st_size
+        cancelled = 0
+        for li in list(sf.get_leases()):
+            if li.get_expiration_time() < threshold:
+                sf.cancel_lease(li.cancel_secret)
+                cancelled += 1
+        if not os.path.exists(filename):
+            return (cancelled, size)
+        return (cancelled, None)
+
+    def _expired_share(self, result, filename):
+        (f, cancelled, removed_size) = result
+        if f is not None:
+            twlog.msg("lease-expirer: unable to process share %s"
+                      % (filename,))
+            twlog.err(f)
+        self.counters["leases-cancelled"] += cancelled
+        if removed_size is not None:
+            self.counters["shares-removed"] += 1
+            self.counters["sharebytes-removed"] += removed_size
+
+    def get_stats(self):
+        stats = {}
+        for (k, v) in self.counters.items():
+            stats["storage_server.lease_expirer." + k] = v
+        return stats
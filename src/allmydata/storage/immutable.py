@@ -21,6 +21,8 @@ from allmydata.util import base32, fileutil, log
 from allmydata.util.assertutil import precondition
 from allmydata.util.hashutil import timing_safe_compare
 from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.diskio import inline_disk_io, then
+from allmydata.storage.openfiles import uncached_files
 from allmydata.storage.common import UnknownImmutableContainerVersionError, \
      DataTooLargeError
 
@@ -53,11 +55,13 @@ class ShareFile(object):
     LEASE_SIZE = struct.calcsize(">L32s32sL")
     sharetype = "immutable"
 
-    def __init__(self, filename, max_size=None, create=False):
-        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. """
+    def __init__(self, filename, max_size=None, create=False,
+                 open_files=uncached_files):
+        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. Share data is read through open_files (see allmydata.storage.openfiles). """
         precondition((max_size is not None) or (not create), max_size, create)
         self.home = filename
         self._max_size = max_size
+        self._open_files = open_files
         if create:
             # touch the file, so later callers will see that we're working on
             # it. Also construct the metadata.
@@ -77,9 +81,9 @@ class ShareFile(object):
             self._lease_offset = max_size + 0x0c
             self._num_leases = 0
         else:
-            with open(self.home, 'rb') as f:
-                filesize = os.path.getsize(self.home)
-                (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
+            filesize = os.path.getsize(self.home)
+            (version, unused, num_leases) = struct.unpack(
+                ">LLL", open_files.pread(self.home, 0, 0xc))
             if version != 1:
                 msg = "sharefile %s had version %d but we wanted 1" % \
                       (filename, version)
@@ -89,6 +93,7 @@ class ShareFile(object):
         self._data_offset = 0xc
 
     def unlink(self):
+        self._open_files.invalidate(self.home)
         os.unlink(self.home)
 
     def read_share_data(self, offset, length):
@@ -99,9 +104,7 @@ class ShareFile(object):
         actuallength = max(0, min(length, self._lease_offset-seekpos))
         if actuallength == 0:
             return b""
-        with open(self.home, 'rb') as f:
-            f.seek(seekpos)
-            return f.read(actuallength)
+        return self._open_files.pread(self.home, seekpos, actuallength)
 
     def write_share_data(self, offset, data):
         length = len(data)
@@ -204,10 +207,14 @@ class ShareFile(object):
 @implementer(RIBucketWriter)
 class BucketWriter(Referenceable):  # type: ignore # warner/foolscap#78
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary):
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary,
+                 disk_io=inline_disk_io):
         self.ss = ss
         self.incominghome = incominghome
         self.finalhome = finalhome
+        self._disk_io = disk_io
+        # writes go to incoming/$PREFIX/$STORAGEINDEX/$SHNUM
+        self._prefixdir = os.path.dirname(os.path.dirname(incominghome))
         self._max_size = max_size # don't allow the client to write more than this
         self._canary = canary
         self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
@@ -226,14 +233,25 @@ class BucketWriter(Referenceable):  # type: ignore # warner/foolscap#78
         precondition(not self.closed)
         if self.throw_out_all_data:
             return
-        self._sharefile.write_share_data(offset, data)
+        # our writes and close happen in the order they arrive
+        result = self._disk_io.run(self._prefixdir, self,
+                                   self._sharefile.write_share_data,
+                                   offset, data)
+        return then(result, self._written, start)
+
+    def _written(self, ign, start):
         self.ss.add_latency("write", time.time() - start)
         self.ss.count("write")
 
     def remote_close(self):
         precondition(not self.closed)
         start = time.time()
+        # no more writes, and nothing to abort if the client goes away now
+        self.closed = True
+        result = self._disk_io.run(self._prefixdir, self, self._move_to_final)
+        return then(result, self._closed, start)
 
+    def _move_to_final(self):
         fileutil.make_dirs(os.path.dirname(self.finalhome))
         fileutil.rename(self.incominghome, self.finalhome)
         try:
@@ -260,11 +278,11 @@ class BucketWriter(Referenceable):  # type: ignore # warner/foolscap#78
             # exceptions, those are normal consequences of the
             # above-mentioned conditions.
             pass
+        return os.stat(self.finalhome)[stat.ST_SIZE]
+
+    def _closed(self, filelen, start):
         self._sharefile = None
-        self.closed = True
         self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
         self.ss.bucket_writer_closed(self, filelen)
         self.ss.add_latency("close", time.time() - start)
         self.ss.count("close")
@@ -278,36 +296,44 @@ class BucketWriter(Referenceable):  # type: ignore # warner/foolscap#78
                 facility="tahoe.storage", level=log.UNUSUAL)
         if not self.closed:
             self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-        self._abort()
+        result = self._abort()
         self.ss.count("abort")
+        return result
 
     def _abort(self):
         if self.closed:
             return
+        # We are now considered closed for further writing.
+        self.closed = True
+        result = self._disk_io.run(self._prefixdir, self, self._remove_incoming)
+        return then(result, self._aborted)
 
+    def _remove_incoming(self):
         os.remove(self.incominghome)
         # if we were the last share to be moved, remove the incoming/
         # directory that was our parent
         parentdir = os.path.split(self.incominghome)[0]
         if not os.listdir(parentdir):
             os.rmdir(parentdir)
-        self._sharefile = None
 
-        # We are now considered closed for further writing. We must tell
-        # the storage server about this so that it stops expecting us to
-        # use the space it allocated for us earlier.
-        self.closed = True
+    def _aborted(self, ign):
+        self._sharefile = None
+        # We must tell the storage server about this so that it stops
+        # expecting us to use the space it allocated for us earlier.
         self.ss.bucket_writer_closed(self, 0)
 
 
 @implementer(RIBucketReader)
 class BucketReader(Referenceable):  # type: ignore # warner/foolscap#78
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, sharefname, storage_index=None, shnum=None,
+                 disk_io=inline_disk_io, open_files=uncached_files):
         self.ss = ss
-        self._share_file = ShareFile(sharefname)
+        self._share_file = ShareFile(sharefname, open_files=open_files)
         self.storage_index = storage_index
         self.shnum = shnum
+        self._disk_io = disk_io
+        self._prefixdir = os.path.dirname(os.path.dirname(sharefname))
 
     def __repr__(self):
         return "<%s %s %s>" % (self.__class__.__name__,
@@ -318,7 +344,14 @@ class BucketReader(Referenceable):  # type: ignore # warner/foolscap#78
 
     def remote_read(self, offset, length):
         start = time.time()
-        data = self._share_file.read_share_data(offset, length)
+        # immutable shares do not change, so reads need not wait for each
+        # other
+        result = self._disk_io.run(self._prefixdir, None,
+                                   self._share_file.read_share_data,
+                                   offset, length)
+        return then(result, self._read, start)
+
+    def _read(self, data, start):
         self.ss.add_latency("read", time.time() - start)
         self.ss.count("read")
         return data
@@ -20,6 +20,7 @@ from allmydata.util.hashutil import timing_safe_compare
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
      DataTooLargeError
+from allmydata.storage.openfiles import uncached_files
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
 
 
@@ -67,12 +68,12 @@ class MutableShareFile(object):
     MAX_SIZE = MAX_MUTABLE_SHARE_SIZE
     # TODO: decide upon a policy for max share size
 
-    def __init__(self, filename, parent=None):
+    def __init__(self, filename, parent=None, open_files=uncached_files):
         self.home = filename
+        self._open_files = open_files
         if os.path.exists(self.home):
             # we don't cache anything, just check the magic
-            with open(self.home, 'rb') as f:
-                data = f.read(self.HEADER_SIZE)
+            data = open_files.pread(self.home, 0, self.HEADER_SIZE)
             (magic,
              write_enabler_nodeid, write_enabler,
              data_length, extra_least_offset) = \
@@ -107,6 +108,7 @@ class MutableShareFile(object):
             # extra leases go here, none at creation
 
     def unlink(self):
+        self._open_files.invalidate(self.home)
         os.unlink(self.home)
 
     def _read_data_length(self, f):
@@ -160,6 +162,7 @@ class MutableShareFile(object):
         if new_extra_lease_offset < old_extra_lease_offset:
             # TODO: allow containers to shrink. For now they remain large.
             return
+        self._open_files.invalidate(self.home)
         num_extra_leases = self._read_num_extra_leases(f)
         f.seek(old_extra_lease_offset)
         leases_size = 4 + num_extra_leases * self.LEASE_SIZE
@@ -380,12 +383,20 @@ class MutableShareFile(object):
         assert magic == self.MAGIC
         return (write_enabler, write_enabler_nodeid)
 
+    def _pread_share_data(self, offset, length):
+        # like _read_share_data, but through self._open_files
+        precondition(offset >= 0)
+        (data_length,) = struct.unpack(">Q", self._open_files.pread(
+            self.home, self.DATA_LENGTH_OFFSET, 8))
+        length = max(0, min(length, data_length-offset))
+        if length == 0:
+            return b""
+        return self._open_files.pread(self.home, self.DATA_OFFSET+offset,
+                                      length)
+
     def readv(self, readv):
-        datav = []
-        with open(self.home, 'rb') as f:
-            for (offset, length) in readv:
-                datav.append(self._read_share_data(f, offset, length))
-        return datav
+        return [self._pread_share_data(offset, length)
+                for (offset, length) in readv]
 
 #    def remote_get_length(self):
 #        f = open(self.home, 'rb')
@@ -413,12 +424,11 @@ class MutableShareFile(object):
 
     def check_testv(self, testv):
         test_good = True
-        with open(self.home, 'rb+') as f:
-            for (offset, length, operator, specimen) in testv:
-                data = self._read_share_data(f, offset, length)
-                if not testv_compare(data, operator, specimen):
-                    test_good = False
-                    break
+        for (offset, length, operator, specimen) in testv:
+            data = self._pread_share_data(offset, length)
+            if not testv_compare(data, operator, specimen):
+                test_good = False
+                break
         return test_good
 
     def writev(self, datav, new_length):
@@ -460,9 +470,10 @@ class EmptyShare(object):
                 break
         return test_good
 
-def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent):
-    ms = MutableShareFile(filename, parent)
+def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent,
+                             open_files=uncached_files):
+    ms = MutableShareFile(filename, parent, open_files)
     ms.create(my_nodeid, write_enabler)
     del ms
-    return MutableShareFile(filename, parent)
+    return MutableShareFile(filename, parent, open_files)
 
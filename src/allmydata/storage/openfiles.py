@@ -0,0 +1,189 @@
+"""
+Positional reads of share files, optionally through a cache of open file
+descriptors.
+
+A client downloading a share asks for it in many small pieces (the offset
+table, the URI extension block, hash chains, and then each block), and
+opening and closing the share file for each piece costs more than reading
+it. ``OpenFileCache`` keeps up to a fixed number of share files open
+(evicting the least recently used) and reads them with ``pread``, so that
+concurrent readers of one file share a descriptor. ``UncachedFiles`` opens
+the file for every read, as storage servers always have.
+
+Whatever removes a share file, or changes its size in a way its readers
+care about, must ``invalidate`` it first.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class UncachedFiles(object):
+    """
+    I read files by opening them for each read.
+    """
+
+    def pread(self, path, offset, length):
+        """
+        :return: Up to ``length`` bytes of ``path``, starting at ``offset``:
+            fewer only if the file ends first.
+        """
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def invalidate(self, path):
+        pass
+
+    def close(self):
+        pass
+
+    def get_stats(self):
+        return {}
+
+
+uncached_files = UncachedFiles()
+
+
+class _OpenFile(object):
+    def __init__(self, fd):
+        self.fd = fd
+        self.users = 0 # reads in progress
+        self.evicted = False
+        # without os.pread, a read is a seek then a read, and two of them
+        # must not be interleaved
+        self.lock = threading.Lock()
+
+
+def _pread(open_file, offset, length):
+    chunks = []
+    while length > 0:
+        if hasattr(os, "pread"):
+            chunk = os.pread(open_file.fd, length, offset)
+        else:
+            with open_file.lock:
+                os.lseek(open_file.fd, offset, os.SEEK_SET)
+                chunk = os.read(open_file.fd, length)
+        if not chunk:
+            break # end of file
+        chunks.append(chunk)
+        offset += len(chunk)
+        length -= len(chunk)
+    return b"".join(chunks)
+
+
+class OpenFileCache(object):
+    """
+    I read files through a descriptor for each, keeping at most
+    ``max_open`` of them open and closing the least recently used when I
+    need another. I may be used from any thread.
+    """
+
+    def __init__(self, max_open):
+        if max_open < 1:
+            raise ValueError("OpenFileCache needs room for at least one file,"
+                             " not %d" % (max_open,))
+        self._max_open = max_open
+        self._files = OrderedDict() # path -> _OpenFile, least recently used first
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def _acquire(self, path):
+        with self._lock:
+            open_file = self._files.pop(path, None)
+            if open_file is not None:
+                self._hits += 1
+                self._files[path] = open_file
+                open_file.users += 1
+                return open_file
+            self._misses += 1
+            invalidations = self._invalidations
+        # opening may be slow, and must not hold up reads of other files
+        open_file = _OpenFile(os.open(path, os.O_RDONLY
+                                      | getattr(os, "O_BINARY", 0)))
+        with self._lock:
+            cached = self._files.pop(path, None)
+            if cached is not None:
+                # another reader opened it while we did
+                os.close(open_file.fd)
+                open_file = cached
+            elif invalidations != self._invalidations:
+                # the file may have been replaced while we opened it, so
+                # this descriptor is used for this read only
+                open_file.evicted = True
+                open_file.users += 1
+                return open_file
+            else:
+                while len(self._files) >= self._max_open:
+                    (ign, evicted) = self._files.popitem(last=False)
+                    self._evictions += 1
+                    self._evict(evicted)
+            self._files[path] = open_file
+            open_file.users += 1
+            return open_file
+
+    def _release(self, open_file):
+        with self._lock:
+            open_file.users -= 1
+            if open_file.evicted and not open_file.users:
+                os.close(open_file.fd)
+
+    def _evict(self, open_file):
+        # a descriptor still being read is closed by its last reader
+        open_file.evicted = True
+        if not open_file.users:
+            os.close(open_file.fd)
+
+    def pread(self, path, offset, length):
+        """
+        :return: Up to ``length`` bytes of ``path``, starting at ``offset``:
+            fewer only if the file ends first.
+        """
+        open_file = self._acquire(path)
+        try:
+            return _pread(open_file, offset, length)
+        finally:
+            self._release(open_file)
+
+    def invalidate(self, path):
+        """
+        Forget any descriptor for ``path``, because the file is about to be
+        removed or replaced or has been resized.
+        """
+        with self._lock:
+            self._invalidations += 1
+            open_file = self._files.pop(path, None)
+            if open_file is not None:
+                self._evict(open_file)
+
+    def close(self):
+        with self._lock:
+            self._invalidations += 1
+            while self._files:
+                (ign, open_file) = self._files.popitem()
+                self._evict(open_file)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "storage_server.open_files.open": len(self._files),
+                "storage_server.open_files.max_open": self._max_open,
+                "storage_server.open_files.hits": self._hits,
+                "storage_server.open_files.misses": self._misses,
+                "storage_server.open_files.evictions": self._evictions,
+            }
@@ -19,21 +19,30 @@ import six
 
 from foolscap.api import Referenceable
 from twisted.application import service
+from twisted.python.failure import Failure
 
 from zope.interface import implementer
-from allmydata.interfaces import RIStorageServer, IStatsProducer
+from allmydata.interfaces import RIStorageServer, IStatsProducer, \
+     MAX_LEASE_BATCH, MAX_INDEX_BATCH
 from allmydata.util import fileutil, idlib, log, time_format
+from allmydata.util.histogram import LatencyHistogram
 import allmydata # for __full_version__
 
-from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
+from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir, \
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
 _pyflakes_hush = [si_b2a, si_a2b, storage_index_to_dir] # re-exported
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
      create_mutable_sharefile
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
 from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
+from allmydata.storage.openfiles import OpenFileCache, uncached_files
 from allmydata.storage.crawler import BucketCountingCrawler
-from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.expirer import LeaseCheckingCrawler, \
+     IndexedLeaseExpirer
+from allmydata.storage.shareindex import open_share_index
+from allmydata.storage.diskio import ThreadedDiskIO, inline_disk_io, \
+     then, gather
 
 # storage/
 # storage/shares/incoming
@@ -62,7 +71,15 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 share_index=False,
+                 disk_io_threads=0,
+                 disk_io_per_device=False,
+                 open_file_cache_size=0,
+                 crawler_parallel_prefixes=1,
+                 crawler_max_entries_per_second=None,
+                 crawler_max_bytes_per_second=None,
+                 crawler_max_foreground_latency=None):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, bytes)
         assert len(nodeid) == 20
@@ -82,6 +99,20 @@ class StorageServer(service.MultiService, Referenceable):
         if self.stats_provider:
             self.stats_provider.register_producer(self)
         self.incomingdir = os.path.join(sharedir, 'incoming')
+        if disk_io_threads:
+            self.disk_io = ThreadedDiskIO(disk_io_threads, disk_io_per_device)
+            self.disk_io.setServiceParent(self)
+        else:
+            self.disk_io = inline_disk_io
+        if open_file_cache_size:
+            self.open_files = OpenFileCache(open_file_cache_size)
+        else:
+            self.open_files = uncached_files
+        self.share_index = None
+        if share_index:
+            self.share_index = self._open_share_index()
+        else:
+            self._remove_share_index()
         self._clean_incomplete()
         fileutil.make_dirs(self.incomingdir)
         self._active_writers = weakref.WeakKeyDictionary()
@@ -92,28 +123,42 @@ class StorageServer(service.MultiService, Referenceable):
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
+        self.latencies = {"allocate": LatencyHistogram(), # immutable
+                          "write": LatencyHistogram(),
+                          "close": LatencyHistogram(),
+                          "read": LatencyHistogram(),
+                          "get": LatencyHistogram(),
+                          "writev": LatencyHistogram(), # mutable
+                          "readv": LatencyHistogram(),
+                          "add-lease": LatencyHistogram(), # both
+                          "renew": LatencyHistogram(),
+                          "cancel": LatencyHistogram(),
                           }
         self.add_bucket_counter()
 
         statefile = os.path.join(self.storedir, "lease_checker.state")
         historyfile = os.path.join(self.storedir, "lease_checker.history")
         klass = self.LeaseCheckerClass
+        # with a share index, leases are expired by (much cheaper) queries
+        # of the index instead, and the lease checker only reports on them
         self.lease_checker = klass(self, statefile, historyfile,
-                                   expiration_enabled, expiration_mode,
+                                   expiration_enabled and not share_index,
+                                   expiration_mode,
                                    expiration_override_lease_duration,
                                    expiration_cutoff_date,
                                    expiration_sharetypes)
         self.lease_checker.setServiceParent(self)
+        self.lease_expirer = None
+        if share_index and expiration_enabled:
+            self.lease_expirer = IndexedLeaseExpirer(
+                self, expiration_mode, expiration_override_lease_duration,
+                expiration_cutoff_date, expiration_sharetypes)
+            self.lease_expirer.setServiceParent(self)
+        for crawler in (self.bucket_counter, self.lease_checker):
+            crawler.parallel_prefixes = crawler_parallel_prefixes
+            crawler.allowed_entries_per_second = crawler_max_entries_per_second
+            crawler.allowed_bytes_per_second = crawler_max_bytes_per_second
+            crawler.max_foreground_latency = crawler_max_foreground_latency
 
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
@@ -123,6 +168,34 @@ class StorageServer(service.MultiService, Referenceable):
         # permutation-seed or if we should use a new one
         return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
 
+    def _open_share_index(self):
+        dbfile = os.path.join(self.storedir, "share_index.sqlite")
+        index = open_share_index(dbfile)
+        # a new index is incomplete too, as is one that was not closed
+        # cleanly: shares may have been written since it was last updated
+        if not index.start_updating():
+            # this reads every share, which takes a while on a big server:
+            # 'tahoe admin rebuild-share-index' can do it ahead of time
+            lp = log.msg("building the share index from %s" % (self.sharedir,),
+                         umid="f3yzKA")
+            count = index.rebuild(self.sharedir)
+            log.msg("indexed %d shares" % (count,), parent=lp, umid="AmsxLg")
+        return index
+
+    def _remove_share_index(self):
+        # nothing keeps an index in step with the shares written from now
+        # on, so it could never be trusted again
+        dbfile = os.path.join(self.storedir, "share_index.sqlite")
+        for filename in (dbfile, dbfile + "-wal", dbfile + "-shm"):
+            fileutil.remove_if_possible(filename)
+
+    def stopService(self):
+        d = service.MultiService.stopService(self)
+        d.addCallback(lambda ign: self.open_files.close())
+        if self.share_index is not None:
+            d.addCallback(lambda ign: self.share_index.close())
+        return d
+
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
         self.bucket_counter = BucketCountingCrawler(self, statefile)
@@ -133,51 +206,59 @@ class StorageServer(service.MultiService, Referenceable):
             self.stats_provider.count("storage_server." + name, delta)
 
     def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+        self.latencies[category].add(latency)
+
+    def _add_latency_since(self, result, category, start):
+        self.add_latency(category, time.time() - start)
+        return result
 
-    def get_latencies(self):
+    def _run_io(self, storage_index, category, f, *args):
+        """
+        Run ``f(*args)``, which reads or writes the shares of
+        ``storage_index``, with my disk I/O executor: after anything given
+        to it earlier for the same storage index. Record the time it took,
+        including any time spent waiting, as a ``category`` latency.
+
+        :return: The result of ``f``, or a Deferred for it.
+        """
+        start = time.time()
+        prefixdir = os.path.dirname(os.path.join(
+            self.sharedir, storage_index_to_dir(storage_index)))
+        result = self.disk_io.run(prefixdir, storage_index, f, *args)
+        return then(result, self._add_latency_since, category, start)
+
+    def get_latencies(self, window=3600):
         """Return a dict, indexed by category, that contains a dict of
-        latency numbers for each category. If there are sufficient samples
-        for unambiguous interpretation, each dict will contain the
+        latency numbers for each category, covering the operations of the
+        last 'window' seconds (at most an hour). If there are sufficient
+        samples for unambiguous interpretation, each dict will contain the
         following keys: mean, 01_0_percentile, 10_0_percentile,
         50_0_percentile (median), 90_0_percentile, 95_0_percentile,
         99_0_percentile, 99_9_percentile.  If there are insufficient
         samples for a given percentile to be interpreted unambiguously
         that percentile will be reported as None. If no samples have been
         collected for the given category, then that category name will
-        not be present in the return value. """
+        not be present in the return value. Percentiles are accurate to
+        within about 6%: the samples themselves are not kept, only a
+        histogram of them."""
         # note that Amazon's Dynamo paper says they use 99.9% percentile.
         output = {}
-        for category in self.latencies:
-            if not self.latencies[category]:
-                continue
-            stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
-            stats["samplesize"] = count
-            samples.sort()
-            if count > 1:
-                stats["mean"] = sum(samples) / count
-            else:
-                stats["mean"] = None
-
-            orderstatlist = [(0.01, "01_0_percentile", 100), (0.1, "10_0_percentile", 10),\
-                             (0.50, "50_0_percentile", 10), (0.90, "90_0_percentile", 10),\
-                             (0.95, "95_0_percentile", 20), (0.99, "99_0_percentile", 100),\
-                             (0.999, "99_9_percentile", 1000)]
-
-            for percentile, percentilestring, minnumtoobserve in orderstatlist:
-                if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
-                else:
-                    stats[percentilestring] = None
-
-            output[category] = stats
+        for category, histogram in self.latencies.items():
+            summary = histogram.summarize(window)
+            if summary is not None:
+                output[category] = dict(summary)
         return output
 
+    def get_histograms(self):
+        """Return the latencies of every operation since startup, as
+        cumulative histograms for export: a dict mapping
+        'storage_server.latencies' to a dict which maps each category to
+        the (buckets, count, sum) tuple of LatencyHistogram.get_cumulative.
+        """
+        return {"storage_server.latencies":
+                dict((category, histogram.get_cumulative())
+                     for category, histogram in self.latencies.items())}
+
     def log(self, *args, **kwargs):
         if "facility" not in kwargs:
             kwargs["facility"] = "tahoe.storage"
@@ -216,6 +297,16 @@ class StorageServer(service.MultiService, Referenceable):
             writeable = False
 
         stats['storage_server.accepting_immutable_shares'] = int(writeable)
+        stats.update(self.disk_io.get_stats())
+        stats.update(self.open_files.get_stats())
+        if self.share_index is not None:
+            totals = self.share_index.get_totals()
+            stats['storage_server.total_bucket_count'] = totals["buckets"]
+            stats['storage_server.total_share_count'] = totals["shares"]
+            stats['storage_server.total_share_bytes'] = totals["sharebytes"]
+            if self.lease_expirer is not None:
+                stats.update(self.lease_expirer.get_stats())
+            return stats
         s = self.bucket_counter.get_state()
         bucket_count = s.get("last-complete-bucket-count")
         if bucket_count:
@@ -252,6 +343,8 @@ class StorageServer(service.MultiService, Referenceable):
                       b"delete-mutable-shares-with-zero-length-writev": True,
                       b"fills-holes-with-zero-bytes": True,
                       b"prevents-read-past-end-of-share-data": True,
+                      b"maximum-add-leases-batch-size": MAX_LEASE_BATCH,
+                      b"maximum-storage-index-batch-size": MAX_INDEX_BATCH,
                       },
                     b"application-version": allmydata.__full_version__.encode("utf-8"),
                     }
@@ -266,8 +359,6 @@ class StorageServer(service.MultiService, Referenceable):
         # to a particular owner.
         start = time.time()
         self.count("allocate")
-        alreadygot = set()
-        bucketwriters = {} # k: shnum, v: BucketWriter
         si_dir = storage_index_to_dir(storage_index)
         si_s = si_b2a(storage_index)
 
@@ -282,6 +373,31 @@ class StorageServer(service.MultiService, Referenceable):
                                renew_secret, cancel_secret,
                                expire_time, self.my_nodeid)
 
+        # fill alreadygot with all shares that we have, not just the ones
+        # they asked about: this will save them a lot of work. Add or update
+        # leases for all of them: if they want us to hold shares for this
+        # file, they'll want us to hold leases for this file.
+        result = self.disk_io.run(os.path.dirname(os.path.join(self.sharedir, si_dir)),
+                                  storage_index, self._renew_existing_shares,
+                                  storage_index, lease_info)
+        return then(result, self._allocate_buckets, storage_index, sharenums,
+                    allocated_size, canary, lease_info, start)
+
+    def _renew_existing_shares(self, storage_index, lease_info):
+        alreadygot = set()
+        for (shnum, fn) in self._get_bucket_shares(storage_index):
+            alreadygot.add(shnum)
+            sf = ShareFile(fn, open_files=self.open_files)
+            sf.add_or_renew_lease(lease_info)
+        if alreadygot and self.share_index is not None:
+            self.share_index.add_or_renew_lease(storage_index, alreadygot,
+                                                lease_info)
+        return alreadygot
+
+    def _allocate_buckets(self, alreadygot, storage_index, sharenums,
+                          allocated_size, canary, lease_info, start):
+        bucketwriters = {} # k: shnum, v: BucketWriter
+        si_dir = storage_index_to_dir(storage_index)
         max_space_per_bucket = allocated_size
 
         remaining_space = self.get_available_space()
@@ -293,15 +409,6 @@ class StorageServer(service.MultiService, Referenceable):
             remaining_space -= self.allocated_size()
         # self.readonly_storage causes remaining_space <= 0
 
-        # fill alreadygot with all shares that we have, not just the ones
-        # they asked about: this will save them a lot of work. Add or update
-        # leases for all of them: if they want us to hold shares for this
-        # file, they'll want us to hold leases for this file.
-        for (shnum, fn) in self._get_bucket_shares(storage_index):
-            alreadygot.add(shnum)
-            sf = ShareFile(fn)
-            sf.add_or_renew_lease(lease_info)
-
         for shnum in sharenums:
             incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
             finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
@@ -317,7 +424,8 @@ class StorageServer(service.MultiService, Referenceable):
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
                 bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
+                                  max_space_per_bucket, lease_info, canary,
+                                  disk_io=self.disk_io)
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
@@ -335,42 +443,128 @@ class StorageServer(service.MultiService, Referenceable):
         return alreadygot, bucketwriters
 
     def _iter_share_files(self, storage_index):
+        for shnum, sf in self._iter_shares(storage_index):
+            yield sf
+
+    def _iter_shares(self, storage_index):
         for shnum, filename in self._get_bucket_shares(storage_index):
-            with open(filename, 'rb') as f:
-                header = f.read(32)
+            header = self.open_files.pread(filename, 0, 32)
             if header[:32] == MutableShareFile.MAGIC:
-                sf = MutableShareFile(filename, self)
+                sf = MutableShareFile(filename, self, self.open_files)
                 # note: if the share has been migrated, the renew_lease()
                 # call will throw an exception, with information to help the
                 # client update the lease.
             elif header[:4] == struct.pack(">L", 1):
-                sf = ShareFile(filename)
+                sf = ShareFile(filename, open_files=self.open_files)
             else:
                 continue # non-sharefile
-            yield sf
+            yield shnum, sf
 
     def remote_add_lease(self, storage_index, renew_secret, cancel_secret,
                          owner_num=1):
-        start = time.time()
         self.count("add-lease")
         new_expire_time = time.time() + 31*24*60*60
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
-        for sf in self._iter_share_files(storage_index):
+        return self._run_io(storage_index, "add-lease",
+                            self._add_lease, storage_index, lease_info)
+
+    def _add_lease(self, storage_index, lease_info):
+        shnums = []
+        for shnum, sf in self._iter_shares(storage_index):
             sf.add_or_renew_lease(lease_info)
-        self.add_latency("add-lease", time.time() - start)
+            shnums.append(shnum)
+        if shnums and self.share_index is not None:
+            self.share_index.add_or_renew_lease(storage_index, shnums,
+                                                lease_info)
         return None
 
-    def remote_renew_lease(self, storage_index, renew_secret):
+    def remote_add_leases(self, leases, owner_num=1):
         start = time.time()
+        self.count("add-lease", len(leases))
+        new_expire_time = time.time() + 31*24*60*60
+        by_storage_index = {}
+        for (i, (storage_index, renew_secret, cancel_secret)) in enumerate(leases):
+            lease_info = LeaseInfo(owner_num,
+                                   renew_secret, cancel_secret,
+                                   new_expire_time, self.my_nodeid)
+            by_storage_index.setdefault(storage_index, []).append((i, lease_info))
+        # visit each bucket once, in order, so neighbouring storage indexes
+        # share their prefix directory lookups
+        results = []
+        for storage_index in sorted(by_storage_index):
+            prefixdir = os.path.dirname(os.path.join(
+                self.sharedir, storage_index_to_dir(storage_index)))
+            result = self.disk_io.run(
+                prefixdir, storage_index, self._add_leases_to_bucket,
+                storage_index, by_storage_index[storage_index])
+            results.append(then(result, self._log_add_leases_failure,
+                                storage_index))
+        return then(gather(results), self._added_leases, len(leases), start)
+
+    def _add_leases_to_bucket(self, storage_index, leases):
+        """
+        :param leases: A list of (position in the request, LeaseInfo).
+        :return: A tuple of (Failure or None, list of (storage index, share
+            numbers, position, LeaseInfo or None if it could not be added)).
+        """
+        try:
+            shares = list(self._iter_shares(storage_index))
+            for (i, lease_info) in leases:
+                for (shnum, sf) in shares:
+                    sf.add_or_renew_lease(lease_info)
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error, EnvironmentError):
+            return (Failure(), [(storage_index, [], i, None)
+                                for (i, lease_info) in leases])
+        shnums = [shnum for (shnum, sf) in shares]
+        return (None, [(storage_index, shnums, i, lease_info)
+                       for (i, lease_info) in leases])
+
+    def _log_add_leases_failure(self, result, storage_index):
+        # _add_leases_to_bucket may run in a disk I/O thread, so it leaves
+        # the logging to us
+        (f, bucket_result) = result
+        if f is not None:
+            log.err(f, "storage: unable to add leases on %r"
+                    % (si_b2a(storage_index),), umid="h7EZxA")
+        return bucket_result
+
+    def _added_leases(self, bucket_results, count, start):
+        results = [None] * count
+        indexed = []
+        for bucket_result in bucket_results:
+            for (storage_index, shnums, i, lease_info) in bucket_result:
+                if lease_info is None:
+                    continue
+                results[i] = len(shnums)
+                if shnums:
+                    indexed.append((storage_index, shnums, lease_info))
+        if indexed and self.share_index is not None:
+            self.share_index.add_or_renew_leases(indexed)
+        self.add_latency("add-lease", time.time() - start)
+        return results
+
+    def remote_renew_lease(self, storage_index, renew_secret):
         self.count("renew")
         new_expire_time = time.time() + 31*24*60*60
+        return self._run_io(storage_index, "renew", self._renew_lease,
+                            storage_index, renew_secret, new_expire_time)
+
+    def _renew_lease(self, storage_index, renew_secret, new_expire_time):
         found_buckets = False
-        for sf in self._iter_share_files(storage_index):
-            found_buckets = True
-            sf.renew_lease(renew_secret, new_expire_time)
-        self.add_latency("renew", time.time() - start)
+        shnums = []
+        try:
+            for shnum, sf in self._iter_shares(storage_index):
+                found_buckets = True
+                sf.renew_lease(renew_secret, new_expire_time)
+                shnums.append(shnum)
+        finally:
+            if shnums and self.share_index is not None:
+                self.share_index.renew_lease(storage_index, shnums,
+                                             renew_secret, new_expire_time)
         if not found_buckets:
             raise IndexError("no such lease to renew")
 
@@ -378,12 +572,22 @@ class StorageServer(service.MultiService, Referenceable):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
         del self._active_writers[bw]
+        if self.share_index is not None and consumed_size:
+            # finalhome is sharedir/$PREFIX/$STORAGEINDEX/$SHNUM
+            (bucketdir, shnum_s) = os.path.split(bw.finalhome)
+            storage_index = si_a2b(os.path.basename(bucketdir).encode("ascii"))
+            self.share_index.index_share_file(storage_index, int(shnum_s),
+                                              bw.finalhome)
 
     def _get_bucket_shares(self, storage_index):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
         the integer form of the last component of 'pathname'."""
         storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+        if self.share_index is not None:
+            for shnum in self.share_index.get_shares(storage_index):
+                yield (shnum, os.path.join(storagedir, "%d" % shnum))
+            return
         try:
             for f in os.listdir(storagedir):
                 if NUM_RE.match(f):
@@ -394,15 +598,26 @@ class StorageServer(service.MultiService, Referenceable):
             pass
 
     def remote_get_buckets(self, storage_index):
-        start = time.time()
         self.count("get")
         si_s = si_b2a(storage_index)
         log.msg("storage: get_buckets %r" % si_s)
+        return self._run_io(storage_index, "get", self._get_buckets,
+                            storage_index)
+
+    def remote_get_buckets_batch(self, storage_indexes):
+        self.count("get", len(storage_indexes))
+        log.msg("storage: get_buckets_batch of %d" % len(storage_indexes))
+        return gather([self._run_io(storage_index, "get", self._get_buckets,
+                                    storage_index)
+                       for storage_index in storage_indexes])
+
+    def _get_buckets(self, storage_index):
         bucketreaders = {} # k: sharenum, v: BucketReader
         for shnum, filename in self._get_bucket_shares(storage_index):
             bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
-        self.add_latency("get", time.time() - start)
+                                                storage_index, shnum,
+                                                disk_io=self.disk_io,
+                                                open_files=self.open_files)
         return bucketreaders
 
     def get_leases(self, storage_index):
@@ -453,17 +668,10 @@ class StorageServer(service.MultiService, Referenceable):
             from integer share numbers to ``MutableShareFile`` instances.
         """
         shares = {}
-        if os.path.isdir(bucketdir):
-            # shares exist if there is a file for them
-            for sharenum_s in os.listdir(bucketdir):
-                try:
-                    sharenum = int(sharenum_s)
-                except ValueError:
-                    continue
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
-                shares[sharenum] = msf
+        for (sharenum, filename) in self._get_bucket_shares(si_a2b(si_s)):
+            msf = MutableShareFile(filename, self, self.open_files)
+            msf.check_write_enabler(write_enabler, si_s)
+            shares[sharenum] = msf
         return shares
 
     def _evaluate_test_vectors(self, test_and_write_vectors, shares):
@@ -599,10 +807,17 @@ class StorageServer(service.MultiService, Referenceable):
         See ``allmydata.interfaces.RIStorageServer`` for details about other
         parameters and return value.
         """
-        start = time.time()
         self.count("writev")
+        log.msg("storage: slot_writev %r" % si_b2a(storage_index))
+        return self._run_io(storage_index, "writev",
+                            self._slot_testv_and_readv_and_writev,
+                            storage_index, secrets, test_and_write_vectors,
+                            read_vector, renew_leases)
+
+    def _slot_testv_and_readv_and_writev(self, storage_index, secrets,
+                                         test_and_write_vectors, read_vector,
+                                         renew_leases):
         si_s = si_b2a(storage_index)
-        log.msg("storage: slot_writev %r" % si_s)
         si_dir = storage_index_to_dir(storage_index)
         (write_enabler, renew_secret, cancel_secret) = secrets
         bucketdir = os.path.join(self.sharedir, si_dir)
@@ -638,9 +853,13 @@ class StorageServer(service.MultiService, Referenceable):
             if renew_leases:
                 lease_info = self._make_lease_info(renew_secret, cancel_secret)
                 self._add_or_renew_leases(remaining_shares, lease_info)
+            if self.share_index is not None:
+                for sharenum in set(test_and_write_vectors) | set(remaining_shares):
+                    filename = os.path.join(bucketdir, "%d" % sharenum)
+                    self.share_index.index_share_file(storage_index, sharenum,
+                                                      filename)
 
         # all done
-        self.add_latency("writev", time.time() - start)
         return (testv_is_good, read_data)
 
     def remote_slot_testv_and_readv_and_writev(self, storage_index,
@@ -662,34 +881,39 @@ class StorageServer(service.MultiService, Referenceable):
         fileutil.make_dirs(bucketdir)
         filename = os.path.join(bucketdir, "%d" % sharenum)
         share = create_mutable_sharefile(filename, my_nodeid, write_enabler,
-                                         self)
+                                         self, self.open_files)
         return share
 
     def remote_slot_readv(self, storage_index, shares, readv):
-        start = time.time()
         self.count("readv")
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %r %r" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
-        # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
-            self.add_latency("readv", time.time() - start)
-            return {}
+        result = self._run_io(storage_index, "readv", self._slot_readv,
+                              storage_index, shares, readv)
+        return then(result, self._log_slot_readv, lp)
+
+    def remote_slot_readv_batch(self, reads):
+        self.count("readv", len(reads))
+        lp = log.msg("storage: slot_readv_batch of %d" % len(reads),
+                     facility="tahoe.storage", level=log.OPERATIONAL)
+        return gather([then(self._run_io(storage_index, "readv",
+                                         self._slot_readv,
+                                         storage_index, shares, readv),
+                            self._log_slot_readv, lp)
+                       for (storage_index, shares, readv) in reads])
+
+    def _slot_readv(self, storage_index, shares, readv):
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        for (sharenum, filename) in self._get_bucket_shares(storage_index):
             if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
+                msf = MutableShareFile(filename, self, self.open_files)
                 datavs[sharenum] = msf.readv(readv)
+        return datavs
+
+    def _log_slot_readv(self, datavs, lp):
         log.msg("returning shares %s" % (list(datavs.keys()),),
                 facility="tahoe.storage", level=log.NOISY, parent=lp)
-        self.add_latency("readv", time.time() - start)
         return datavs
 
     def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
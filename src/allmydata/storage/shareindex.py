@@ -0,0 +1,342 @@
+"""
+An optional SQLite index of the shares held by a storage server, and of
+their leases.
+
+The share files remain the authoritative record: the index is kept in step
+with them by the StorageServer as it creates, modifies and deletes shares
+and leases, and can be rebuilt from them at any time (with ``tahoe admin
+rebuild-share-index``). With it, finding the shares of a storage index is
+a lookup rather than a directory listing, and questions about every share
+(how many are there, how much space do they use, which leases have
+expired) are indexed queries rather than walks of the whole share
+directory.
+
+The index stores a hash of each lease's renew secret, never the secrets
+themselves.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, struct, threading
+from functools import wraps
+
+from allmydata.storage.common import si_b2a, si_a2b, \
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+from allmydata.storage.shares import get_share_file
+from allmydata.util import base32, log
+from allmydata.util.dbutil import get_db
+from allmydata.util.hashutil import tagged_hash
+
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32
+ shnum         INTEGER NOT NULL,
+ sharetype     VARCHAR(9) NOT NULL,  -- "mutable" or "immutable"
+ size          INTEGER NOT NULL,     -- of the share file, in bytes
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE TABLE leases
+(
+ storage_index   VARCHAR(26) NOT NULL,
+ shnum           INTEGER NOT NULL,
+ lease_id        VARCHAR(52) NOT NULL, -- base32(hash(renew_secret))
+ owner_num       INTEGER NOT NULL,
+ expiration_time INTEGER NOT NULL,
+ PRIMARY KEY (storage_index, shnum, lease_id),
+ FOREIGN KEY (storage_index, shnum) REFERENCES shares (storage_index, shnum)
+  ON DELETE CASCADE
+);
+
+CREATE INDEX leases_by_expiration ON leases (expiration_time);
+"""
+
+
+def _si(storage_index):
+    return si_b2a(storage_index).decode("ascii")
+
+
+def _lease_id(renew_secret):
+    return base32.b2a(tagged_hash(b"allmydata_share_index_lease_v1",
+                                  renew_secret)).decode("ascii")
+
+
+def _locked(f):
+    @wraps(f)
+    def _f(self, *args, **kwargs):
+        with self._lock:
+            return f(self, *args, **kwargs)
+    return _f
+
+
+def open_share_index(dbfile):
+    """
+    Open or create the share index database at ``dbfile``, whose parent
+    directory must exist.
+
+    :raise DBError: If the file cannot be opened or is not a share index.
+    :return ShareIndex:
+    """
+    (sqlite3, db) = get_db(dbfile, create_version=(SCHEMA_v1, 1),
+                           dbname="share index", check_same_thread=False)
+    # the index can always be rebuilt from the share files, so it need not
+    # survive a power failure, and renewing a lease should not wait for a
+    # sync to disk
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    return ShareIndex(db)
+
+
+class ShareIndex(object):
+    """
+    I answer questions about the shares in one storage server's share
+    directory. Each of my methods which changes the index does so in a
+    single transaction. My methods may be called from any thread, but only
+    one runs at a time.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._lock = threading.RLock()
+        # whether I match the share files, and will be kept in step with
+        # them until I am closed
+        self._complete = False
+
+    @_locked
+    def start_updating(self):
+        """
+        Record that the share files may change from now on, until I am
+        closed: if the process stops before then, the next call will find
+        me incomplete.
+
+        :return: ``True`` if I am known to match the share files, because I
+            was closed cleanly after last being kept in step with them (or
+            rebuilt from them).
+        """
+        # a marker in the database header says whether it is complete
+        (complete,) = self._db.execute("PRAGMA user_version").fetchone()
+        self._set_marker(0)
+        self._complete = bool(complete)
+        return self._complete
+
+    def _set_marker(self, complete):
+        self._db.execute("PRAGMA user_version = %d" % (complete,))
+        self._db.commit()
+
+    @_locked
+    def close(self):
+        if self._complete:
+            self._set_marker(1)
+        self._db.close()
+
+    @_locked
+    def get_shares(self, storage_index):
+        """
+        :return: A sorted list of the share numbers held for
+            ``storage_index``.
+        """
+        c = self._db.execute("SELECT shnum FROM shares WHERE storage_index=?"
+                             " ORDER BY shnum", (_si(storage_index),))
+        return [shnum for (shnum,) in c.fetchall()]
+
+    @_locked
+    def add_share(self, storage_index, shnum, sharetype, size, leases):
+        """
+        Record a share, replacing anything already recorded about it.
+
+        :param leases: An iterable of the share's ``LeaseInfo`` objects.
+        """
+        with self._db:
+            self._add_share(storage_index, shnum, sharetype, size, leases)
+
+    def _add_share(self, storage_index, shnum, sharetype, size, leases):
+        si = _si(storage_index)
+        self._db.execute("DELETE FROM shares WHERE storage_index=? AND shnum=?",
+                         (si, shnum))
+        self._db.execute("INSERT INTO shares VALUES (?,?,?,?)",
+                         (si, shnum, sharetype, size))
+        for lease in leases:
+            self._db.execute("INSERT OR REPLACE INTO leases VALUES (?,?,?,?,?)",
+                             (si, shnum, _lease_id(lease.renew_secret),
+                              lease.owner_num,
+                              int(lease.get_expiration_time())))
+
+    @_locked
+    def set_share_size(self, storage_index, shnum, size):
+        with self._db:
+            self._db.execute("UPDATE shares SET size=?"
+                             " WHERE storage_index=? AND shnum=?",
+                             (size, _si(storage_index), shnum))
+
+    @_locked
+    def remove_share(self, storage_index, shnum):
+        with self._db:
+            self._db.execute("DELETE FROM shares WHERE storage_index=? AND shnum=?",
+                             (_si(storage_index), shnum))
+
+    def add_or_renew_lease(self, storage_index, shnums, lease_info):
+        """
+        Record that ``lease_info`` has been added to, or renewed on, each of
+        the given shares, the same way their share files do it: a lease with
+        the same renew secret gets the later of the two expiration times.
+        """
+        self.add_or_renew_leases([(storage_index, shnums, lease_info)])
+
+    @_locked
+    def add_or_renew_leases(self, leases):
+        """
+        Do what ``add_or_renew_lease`` does for each ``(storage_index,
+        shnums, lease_info)`` in ``leases``, in one transaction.
+        """
+        with self._db:
+            for (storage_index, shnums, lease_info) in leases:
+                self._add_or_renew_lease(storage_index, shnums, lease_info)
+
+    def _add_or_renew_lease(self, storage_index, shnums, lease_info):
+        si = _si(storage_index)
+        lease_id = _lease_id(lease_info.renew_secret)
+        expiration_time = int(lease_info.get_expiration_time())
+        for shnum in shnums:
+            self._db.execute("INSERT OR IGNORE INTO leases"
+                             " SELECT ?,?,?,?,? WHERE EXISTS"
+                             " (SELECT 1 FROM shares"
+                             "  WHERE storage_index=? AND shnum=?)",
+                             (si, shnum, lease_id, lease_info.owner_num,
+                              expiration_time, si, shnum))
+            self._db.execute("UPDATE leases"
+                             " SET expiration_time=MAX(expiration_time, ?)"
+                             " WHERE storage_index=? AND shnum=? AND lease_id=?",
+                             (expiration_time, si, shnum, lease_id))
+
+    @_locked
+    def renew_lease(self, storage_index, shnums, renew_secret, expiration_time):
+        si = _si(storage_index)
+        with self._db:
+            for shnum in shnums:
+                self._db.execute("UPDATE leases"
+                                 " SET expiration_time=MAX(expiration_time, ?)"
+                                 " WHERE storage_index=? AND shnum=? AND lease_id=?",
+                                 (int(expiration_time), si, shnum,
+                                  _lease_id(renew_secret)))
+
+    @_locked
+    def get_shares_with_leases_expiring_before(self, when, sharetypes):
+        """
+        :return: A list of ``(storage_index, shnum)`` for every share of one
+            of the given types with a lease whose expiration time is earlier
+            than ``when``.
+        """
+        marks = ",".join("?" * len(sharetypes))
+        c = self._db.execute(
+            "SELECT DISTINCT shares.storage_index, shares.shnum FROM leases"
+            " JOIN shares USING (storage_index, shnum)"
+            " WHERE leases.expiration_time < ?"
+            " AND shares.sharetype IN (%s)"
+            " ORDER BY shares.storage_index, shares.shnum" % (marks,),
+            [int(when)] + list(sharetypes))
+        return [(si_a2b(si.encode("ascii")), shnum)
+                for (si, shnum) in c.fetchall()]
+
+    @_locked
+    def get_totals(self):
+        """
+        :return: A dict with the number of ``buckets`` (storage indexes),
+            ``shares`` and ``sharebytes`` held, in total and (with a
+            ``-mutable`` or ``-immutable`` suffix) for each type of share.
+        """
+        totals = {}
+        for suffix in ("", "-mutable", "-immutable"):
+            for k in ("buckets", "shares", "sharebytes"):
+                totals[k + suffix] = 0
+        c = self._db.execute("SELECT sharetype, COUNT(DISTINCT storage_index),"
+                             " COUNT(*), SUM(size) FROM shares GROUP BY sharetype")
+        for (sharetype, buckets, shares, sharebytes) in c.fetchall():
+            totals["buckets-" + sharetype] = buckets
+            totals["shares-" + sharetype] = shares
+            totals["sharebytes-" + sharetype] = sharebytes
+            totals["shares"] += shares
+            totals["sharebytes"] += sharebytes
+        (totals["buckets"],) = self._db.execute(
+            "SELECT COUNT(DISTINCT storage_index) FROM shares").fetchone()
+        return totals
+
+    @_locked
+    def index_share_file(self, storage_index, shnum, filename):
+        """
+        Record the share in ``filename`` (or forget it, if the file no longer
+        exists) by reading its type, size and leases.
+        """
+        with self._db:
+            self._index_share_file(storage_index, shnum, filename)
+
+    def _index_share_file(self, storage_index, shnum, filename):
+        if not os.path.exists(filename):
+            self._db.execute("DELETE FROM shares WHERE storage_index=? AND shnum=?",
+                             (_si(storage_index), shnum))
+            return
+        sf = get_share_file(filename)
+        self._add_share(storage_index, shnum, sf.sharetype,
+                        os.stat(filename).st_size, list(sf.get_leases()))
+
+    @_locked
+    def rebuild(self, sharedir):
+        """
+        Forget everything, then record every share found in ``sharedir``.
+
+        :return: The number of shares recorded.
+        """
+        # this is all one transaction, so an interrupted rebuild leaves the
+        # index as it was
+        count = 0
+        with self._db:
+            self._db.execute("DELETE FROM leases")
+            self._db.execute("DELETE FROM shares")
+            for prefix in sorted(os.listdir(sharedir)):
+                if prefix == "incoming":
+                    continue
+                prefixdir = os.path.join(sharedir, prefix)
+                if not os.path.isdir(prefixdir):
+                    continue
+                for si_s in sorted(os.listdir(prefixdir)):
+                    try:
+                        storage_index = si_a2b(si_s.encode("ascii"))
+                    except (AssertionError, UnicodeError, TypeError):
+                        continue # not a storage index
+                    count += self._rebuild_bucket(storage_index,
+                                                  os.path.join(prefixdir, si_s))
+        self._complete = True
+        return count
+
+    def _rebuild_bucket(self, storage_index, bucketdir):
+        count = 0
+        for shnum_s in os.listdir(bucketdir):
+            try:
+                shnum = int(shnum_s)
+            except ValueError:
+                continue # not a share file
+            filename = os.path.join(bucketdir, shnum_s)
+            try:
+                self._index_share_file(storage_index, shnum, filename)
+            except (UnknownMutableContainerVersionError,
+                    UnknownImmutableContainerVersionError,
+                    struct.error, EnvironmentError):
+                log.err(None, "share index: unable to read %s" % (filename,),
+                        umid="V7TJrA")
+                continue
+            count += 1
+        return count
@@ -13,12 +13,12 @@ if PY2:
 
 from allmydata.storage.mutable import MutableShareFile
 from allmydata.storage.immutable import ShareFile
+from allmydata.storage.openfiles import uncached_files
 
-def get_share_file(filename):
-    with open(filename, "rb") as f:
-        prefix = f.read(32)
+def get_share_file(filename, open_files=uncached_files):
+    prefix = open_files.pread(filename, 0, 32)
     if prefix == MutableShareFile.MAGIC:
-        return MutableShareFile(filename)
+        return MutableShareFile(filename, open_files=open_files)
     # otherwise assume it's immutable
-    return ShareFile(filename)
+    return ShareFile(filename, open_files=open_files)
 
@@ -146,6 +146,85 @@ class StorageClientConfig(object):
         )
 
 
+class ServerPerformance(object):
+    """
+    I keep a rolling estimate of the round-trip time and bandwidth of each
+    storage server, from the timings of the requests recently made to it,
+    and use them to rank servers by how long they should take to answer.
+
+    The estimates are exponentially-weighted moving averages, so they follow
+    a server which gets slower (or faster) within a few requests.
+    """
+
+    # the weight given to each new sample
+    WEIGHT = 0.25
+
+    # replies smaller than this say more about latency than bandwidth
+    MIN_BANDWIDTH_SAMPLE = 16*1024
+
+    def __init__(self):
+        self._rtt = {} # serverid -> seconds
+        self._bandwidth = {} # serverid -> bytes per second
+
+    def _update(self, estimates, serverid, sample):
+        old = estimates.get(serverid)
+        if old is None:
+            estimates[serverid] = sample
+        else:
+            estimates[serverid] = old + self.WEIGHT * (sample - old)
+
+    def record_rtt(self, serverid, rtt):
+        """Record the time taken by a request with a small reply."""
+        self._update(self._rtt, serverid, rtt)
+
+    def record_transfer(self, serverid, size, elapsed):
+        """Record the time taken by a request which returned 'size' bytes."""
+        if size < self.MIN_BANDWIDTH_SAMPLE:
+            self.record_rtt(serverid, elapsed)
+            return
+        # one round trip of it was not spent moving data
+        transfer_time = elapsed - self._rtt.get(serverid, 0)
+        if transfer_time > 0:
+            self._update(self._bandwidth, serverid, size / transfer_time)
+
+    def get_rtt(self, serverid):
+        return self._rtt.get(serverid)
+
+    def get_bandwidth(self, serverid):
+        return self._bandwidth.get(serverid)
+
+    def expected_time(self, serverid, size=0):
+        """
+        Return how long fetching 'size' bytes from the given server should
+        take, or None if I know nothing about it.
+        """
+        rtt = self._rtt.get(serverid)
+        if rtt is None:
+            return None
+        bandwidth = self._bandwidth.get(serverid)
+        if size and bandwidth:
+            return rtt + size / bandwidth
+        return rtt
+
+    def rank(self, items, get_serverid, size=0):
+        """
+        Return 'items' sorted so that the ones on the servers which should
+        answer a request for 'size' bytes soonest come first. Servers I know
+        nothing about are taken to be middling, and the sort is stable, so
+        items whose servers look the same stay in the order they were given.
+        """
+        items = list(items)
+        times = [self.expected_time(get_serverid(item), size)
+                 for item in items]
+        known = sorted(t for t in times if t is not None)
+        if not known:
+            return items
+        middling = known[len(known) // 2]
+        order = sorted(range(len(items)),
+                       key=lambda i: middling if times[i] is None else times[i])
+        return [items[i] for i in order]
+
+
 @implementer(IStorageBroker)
 class StorageFarmBroker(service.MultiService):
     """I live on the client, and know about storage servers. For each server
@@ -192,6 +271,7 @@ class StorageFarmBroker(service.MultiService):
         self.introducer_client = None
         self._threshold_listeners = [] # tuples of (threshold, Deferred)
         self._connected_high_water_mark = 0
+        self._performance = ServerPerformance()
 
     @log_call(action_type=u"storage-client:broker:set-static-servers")
     def set_static_servers(self, servers):
@@ -431,6 +511,9 @@ class StorageFarmBroker(service.MultiService):
                     permute_server_hash(peer_selection_index, seed))
         return sorted(connected_servers, key=_permuted)
 
+    def get_server_performance(self):
+        return self._performance
+
     def get_all_serverids(self):
         return frozenset(self.servers.keys())
 
@@ -923,6 +1006,19 @@ class _StorageServer(object):
     a ``RemoteReference``.
     """
     _get_rref = attr.ib()
+    # for each kind of request in _BATCHES, the (arguments, Deferred) pairs
+    # waiting for queue_*() to send them
+    _queued = attr.ib(default=attr.Factory(dict), init=False,
+                      repr=False, cmp=False)
+
+    # request -> (batched request, version key advertising its size limit)
+    _BATCHES = {
+        "add_lease": ("add_leases", b"maximum-add-leases-batch-size"),
+        "get_buckets": ("get_buckets_batch",
+                        b"maximum-storage-index-batch-size"),
+        "slot_readv": ("slot_readv_batch",
+                       b"maximum-storage-index-batch-size"),
+    }
 
     @property
     def _rref(self):
@@ -965,6 +1061,72 @@ class _StorageServer(object):
             cancel_secret,
         )
 
+    def add_leases(
+            self,
+            leases,
+    ):
+        return self._rref.callRemote(
+            "add_leases",
+            leases,
+        )
+
+    def queue_add_lease(
+            self,
+            storage_index,
+            renew_secret,
+            cancel_secret,
+    ):
+        return self._queue("add_lease",
+                           (storage_index, renew_secret, cancel_secret))
+
+    def _queue(self, request, args):
+        queued = self._queued.setdefault(request, [])
+        if not queued:
+            eventually(self._send_queued, request)
+        d = defer.Deferred()
+        queued.append((args, d))
+        return d
+
+    def _send_queued(self, request):
+        queued = self._queued.pop(request)
+        (batched_request, size_key) = self._BATCHES[request]
+        rref = self._rref
+        batch_size = None
+        if rref is not None:
+            v1 = rref.version.get(b"http://allmydata.org/tahoe/protocols/storage/v1",
+                                  BytesKeyDict())
+            batch_size = v1.get(size_key)
+        if not batch_size:
+            # an older server, which only knows the single request (or one
+            # which has gone away, which the single requests will report)
+            self._send_singly(request, queued)
+            return
+        for i in range(0, len(queued), batch_size):
+            batch = queued[i:i+batch_size]
+            batch_args = [args for (args, ign) in batch]
+            if request == "get_buckets":
+                batch_args = [storage_index for (storage_index,) in batch_args]
+            d = getattr(self, batched_request)(batch_args)
+            d.addCallbacks(self._deliver_batch_results,
+                           self._batch_failed,
+                           callbackArgs=(batch,),
+                           errbackArgs=(request, batch))
+
+    def _send_singly(self, request, queued):
+        for (args, d) in queued:
+            defer.maybeDeferred(getattr(self, request), *args).chainDeferred(d)
+
+    def _deliver_batch_results(self, results, batch):
+        for ((args, d), result) in zip(batch, results):
+            d.callback(result)
+
+    def _batch_failed(self, f, request, batch):
+        # one bad storage index spoils the whole batch: ask about each of
+        # them separately, so that only the callers of the bad ones fail
+        log.msg(format="batched %(request)s failed, retrying singly: %(f)s",
+                request=request, f=str(f), level=log.UNUSUAL, umid="cR4lQw")
+        self._send_singly(request, batch)
+
     def renew_lease(
             self,
             storage_index,
@@ -985,6 +1147,21 @@ class _StorageServer(object):
             storage_index,
         )
 
+    def get_buckets_batch(
+            self,
+            storage_indexes,
+    ):
+        return self._rref.callRemote(
+            "get_buckets_batch",
+            storage_indexes,
+        )
+
+    def queue_get_buckets(
+            self,
+            storage_index,
+    ):
+        return self._queue("get_buckets", (storage_index,))
+
     def slot_readv(
             self,
             storage_index,
@@ -998,6 +1175,23 @@ class _StorageServer(object):
             readv,
         )
 
+    def slot_readv_batch(
+            self,
+            reads,
+    ):
+        return self._rref.callRemote(
+            "slot_readv_batch",
+            reads,
+        )
+
+    def queue_slot_readv(
+            self,
+            storage_index,
+            shares,
+            readv,
+    ):
+        return self._queue("slot_readv", (storage_index, shares, readv))
+
     def slot_testv_and_readv_and_writev(
             self,
             storage_index,
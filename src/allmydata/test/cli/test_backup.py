@@ -20,12 +20,15 @@ import re
 
 from twisted.trial import unittest
 from twisted.python.monkey import MonkeyPatcher
+from twisted.python import usage
 
 from allmydata.util import fileutil
 from allmydata.util.fileutil import abspath_expanduser_unicode
-from allmydata.util.encodingutil import get_io_encoding, unicode_to_argv
+from allmydata.util.encodingutil import get_io_encoding, unicode_to_argv, \
+     listdir_unicode
 from allmydata.util.namespace import Namespace
-from allmydata.scripts import cli, backupdb
+from allmydata.scripts import cli, backupdb, tahoe_backup
+from allmydata.scripts.common_http import DEFAULT_CONCURRENCY
 from ..common_util import StallMixin
 from ..no_network import GridTestMixin
 from .common import (
@@ -46,21 +49,21 @@ class Backup(GridTestMixin, CLITestMixin, StallMixin, unittest.TestCase):
         fileutil.write(full_path, data)
 
     def count_output(self, out):
-        mo = re.search(r"(\d)+ files uploaded \((\d+) reused\), "
-                        "(\d)+ files skipped, "
+        mo = re.search(r"(\d+) files uploaded \((\d+) reused\), "
+                        "(\d+) files skipped, "
                         "(\d+) directories created \((\d+) reused\), "
                         "(\d+) directories skipped", out)
         return [int(s) for s in mo.groups()]
 
     def count_output2(self, out):
-        mo = re.search(r"(\d)+ files checked, (\d+) directories checked", out)
+        mo = re.search(r"(\d+) files checked, (\d+) directories checked", out)
         return [int(s) for s in mo.groups()]
 
     def progress_output(self, out):
         def parse_timedelta(h, m, s):
             return timedelta(int(h), int(m), int(s))
         mos = re.findall(
-            r"Backing up (\d)+/(\d)+\.\.\. (\d+)h (\d+)m (\d+)s elapsed\.\.\.",
+            r"Backing up (\d+)/(\d+)\.\.\. (\d+)h (\d+)m (\d+)s elapsed\.\.\.",
             out,
         )
         return list(
@@ -328,6 +331,79 @@ class Backup(GridTestMixin, CLITestMixin, StallMixin, unittest.TestCase):
         self.failUnlessReallyEqual(filtered, included)
         self.failUnlessReallyEqual(all.difference(filtered), excluded)
 
+    def test_backup_waves(self):
+        # every directory is backed up in a later wave than its contents
+        source = abspath_expanduser_unicode(os.path.join(self.mktemp(), "home"))
+        for path in ["a/b/c/deep.txt", "a/shallow.txt", "top.txt", "d/e.txt"]:
+            full_path = os.path.join(source, path)
+            fileutil.make_dirs(os.path.dirname(full_path))
+            fileutil.write(full_path, "data")
+        fileutil.make_dirs(os.path.join(source, "empty"))
+        targets = list(tahoe_backup.collect_backup_targets(
+            source, listdir_unicode, lambda children: children))
+        waves = tahoe_backup.backup_waves(targets)
+        self.failUnlessEqual(sum(len(wave) for wave in waves), len(targets))
+        def names(wave):
+            return sorted(os.path.relpath(t._path, source) for t in wave)
+        self.failUnlessEqual(names(waves[0]), ["a/b/c/deep.txt",
+                                               "a/shallow.txt", "d/e.txt",
+                                               "empty", "top.txt"])
+        self.failUnlessEqual(names(waves[1]), ["a/b/c", "d"])
+        self.failUnlessEqual(names(waves[2]), ["a/b"])
+        self.failUnlessEqual(names(waves[3]), ["a"])
+        self.failUnlessEqual(names(waves[4]), ["."])
+
+    def test_backup_concurrently(self):
+        self.basedir = "cli/Backup/backup_concurrently"
+        self.set_up_grid(oneshare=True)
+        source = os.path.join(self.basedir, "home")
+        for d in range(3):
+            for f in range(4):
+                self.writeto("dir%d/sub/file%d" % (d, f), "%d %d" % (d, f))
+            self.writeto("dir%d/file" % (d,), "%d" % (d,))
+
+        def do_backup(concurrency):
+            return self.do_cli("backup", "-j", "%d" % (concurrency,), source,
+                               "tahoe:backups")
+
+        d = self.do_cli("create-alias", "tahoe")
+        d.addCallback(lambda res: do_backup(5))
+        def _check(args, uploaded, reused):
+            (rc, out, err) = args
+            self.assertEqual(err, "")
+            self.failUnlessReallyEqual(rc, 0)
+            fu, fr, fs, dc, dr, ds = self.count_output(out)
+            self.failUnlessReallyEqual((fu, fr, fs), (uploaded, reused, 0))
+            # home, and dir0..2 and each of their sub directories
+            self.failUnlessReallyEqual((dc + dr, ds), (7, 0))
+            progress = self.progress_output(out)
+            # one report as each target finishes, counting up to the total
+            self.assertEqual([p[0] for p in progress], list(range(1, 23)))
+            self.assertEqual(set(p[1] for p in progress), {22})
+        d.addCallback(_check, 15, 0)
+        d.addCallback(lambda res: self.do_cli(
+            "get", "tahoe:backups/Latest/dir2/sub/file3"))
+        d.addCallback(lambda args: self.assertEqual(args[1], "2 3"))
+
+        # everything recorded in the backupdb by the threads can be reused
+        d.addCallback(self.stall, 1.1)
+        d.addCallback(lambda res: do_backup(1))
+        d.addCallback(_check, 0, 15)
+        return d
+
+    def test_concurrency_option(self):
+        basedir = "cli/Backup/concurrency_option"
+        fileutil.make_dirs(basedir)
+        fileutil.write(os.path.join(basedir, 'node.url'),
+                       'http://example.net:2357/')
+        def parse(args): return parse_options(basedir, "backup", args)
+
+        self.assertEqual(parse(["from", "to"])["concurrency"],
+                         DEFAULT_CONCURRENCY)
+        self.assertEqual(parse(["-j", "8", "from", "to"])["concurrency"], 8)
+        self.assertRaises(usage.UsageError, parse,
+                          ["--concurrency", "0", "from", "to"])
+
     def test_exclude_options(self):
         root_listdir = (u'lib.a', u'_darcs', u'subdir', u'nice_doc.lyx')
         subdir_listdir = (u'another_doc.lyx', u'run_snake_run.py', u'CVS', u'.svn', u'_darcs')
@@ -12,7 +12,7 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, dict, list, object, range, str, max, min  # noqa: F401
 
 import sys
-import os.path, time
+import os.path, time, threading
 from six.moves import cStringIO as StringIO
 from twisted.trial import unittest
 
@@ -170,6 +170,36 @@ class BackupDB(unittest.TestCase):
         self.failUnlessEqual(stderr.strip(),
                              "Unable to handle backupdb version 0")
 
+    def test_batched_commits(self):
+        self.basedir = basedir = os.path.join("backupdb", "batched_commits")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        bdb = self.create(dbfile)
+        bdb.COMMIT_BATCH_SIZE = 10
+        bdb.COMMIT_INTERVAL = 3600
+
+        def count_committed():
+            return backupdb.get_backupdb(dbfile).cursor.execute(
+                "SELECT COUNT(*) FROM directories").fetchone()[0]
+
+        # the results are recorded from several threads at once
+        def _create(i):
+            r = bdb.check_directory({u"file": b"URI:CHK:%d" % i})
+            r.did_create(b"URI:DIR2-CHK:%d" % i)
+        threads = [threading.Thread(target=_create, args=(i,))
+                   for i in range(15)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # one batch of ten has been committed, and the rest wait for the next
+        self.failUnlessEqual(count_committed(), 10)
+        bdb.commit()
+        self.failUnlessEqual(count_committed(), 15)
+        for i in range(15):
+            r = bdb.check_directory({u"file": b"URI:CHK:%d" % i})
+            self.failUnlessEqual(r.was_created(), b"URI:DIR2-CHK:%d" % i)
+
     def test_directory(self):
         self.basedir = basedir = os.path.join("backupdb", "directory")
         fileutil.make_dirs(basedir)
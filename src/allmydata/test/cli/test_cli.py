@@ -763,6 +763,20 @@ class Admin(unittest.TestCase):
         d.addCallback(_done)
         return d
 
+    def test_rebuild_share_index(self):
+        nodedir = self.mktemp()
+        sharedir = os.path.join(nodedir, "storage", "shares")
+        fileutil.make_dirs(os.path.join(sharedir, "aa", "aaaaaaaaaaaaaaaaaaaaaaaaaa"))
+        d = run_cli("admin", "rebuild-share-index", nodedir)
+        def _done(args):
+            (rc, stdout, stderr) = args
+            self.assertEqual(rc, 0, stderr)
+            self.assertEqual(stdout.strip(), "indexed 0 shares")
+            self.failUnless(os.path.exists(os.path.join(
+                nodedir, "storage", "share_index.sqlite")))
+        d.addCallback(_done)
+        return d
+
 
 class Errors(GridTestMixin, CLITestMixin, unittest.TestCase):
     def test_get(self):
@@ -826,6 +840,57 @@ class Errors(GridTestMixin, CLITestMixin, unittest.TestCase):
         return d
 
 
+class HTTP(GridTestMixin, CLITestMixin, unittest.TestCase):
+    def test_concurrently(self):
+        concurrently = allmydata.scripts.common_http.concurrently
+        for concurrency in [1, 3]:
+            results = dict(concurrently(lambda i: i * 2, range(10), concurrency))
+            self.failUnlessEqual(results, dict((i, i * 2) for i in range(10)))
+
+        started = []
+        def _fail(i):
+            started.append(i)
+            if i == 2:
+                raise ValueError("item %d" % i)
+            return i
+        e = self.failUnlessRaises(ValueError, list,
+                                  concurrently(_fail, range(100), 3))
+        self.failUnlessEqual(str(e), "item 2")
+        # nothing much was started after the failure
+        self.failUnless(len(started) < 100, started)
+
+    def test_keep_alive(self):
+        # the requests a command makes share connections to the node
+        self.basedir = "cli/HTTP/keep_alive"
+        self.set_up_grid(oneshare=True)
+        source = os.path.join(self.basedir, "source")
+        fileutil.make_dirs(source)
+        for i in range(6):
+            fileutil.write(os.path.join(source, "file%d" % i), "data %d" % i)
+
+        connects = []
+        HTTPConnection = allmydata.scripts.common_http.http_client.HTTPConnection
+        original_connect = HTTPConnection.connect
+        def _connect(connection):
+            connects.append(connection)
+            return original_connect(connection)
+        self.patch(HTTPConnection, "connect", _connect)
+
+        d = self.do_cli("create-alias", "tahoe")
+        def _copy(ign):
+            del connects[:]
+            return self.do_cli("cp", "-r", "-j", "2", source, "tahoe:")
+        d.addCallback(_copy)
+        def _check(args):
+            (rc, stdout, stderr) = args
+            self.failUnlessEqual(rc, 0, stderr)
+            # six uploads, and the directory's listing and creation, went
+            # over no more connections than there were requests at once
+            self.failUnless(len(connects) <= 2, connects)
+        d.addCallback(_check)
+        return d
+
+
 class Get(GridTestMixin, CLITestMixin, unittest.TestCase):
     def test_get_without_alias(self):
         # 'tahoe get' should output a useful error message when invoked
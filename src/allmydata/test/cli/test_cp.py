@@ -16,12 +16,13 @@ from twisted.python import usage
 from twisted.internet import defer
 
 from allmydata.scripts import cli
+from allmydata.scripts.common_http import DEFAULT_CONCURRENCY
 from allmydata.util import fileutil
 from allmydata.util.encodingutil import (quote_output, get_io_encoding,
                                          unicode_to_output, to_bytes)
 from allmydata.util.assertutil import _assert
 from ..no_network import GridTestMixin
-from .common import CLITestMixin
+from .common import CLITestMixin, parse_options
 from ..common_util import skip_if_cannot_represent_filename
 
 class Cp(GridTestMixin, CLITestMixin, unittest.TestCase):
@@ -662,6 +663,48 @@ starting copy, 2 files, 1 directories
         d.addCallback(_check_local_fs)
         return d
 
+    def test_concurrency_option(self):
+        url = ["--node-url", "http://localhost:8080"]
+        o = parse_options("nodedir", "cp", url + ["a", "b"])
+        self.failUnlessEqual(o["concurrency"], DEFAULT_CONCURRENCY)
+        o = parse_options("nodedir", "cp", url + ["-j", "3", "a", "b"])
+        self.failUnlessEqual(o["concurrency"], 3)
+        for bad in ["0", "many"]:
+            self.failUnlessRaises(usage.UsageError, parse_options, "nodedir",
+                                  "cp", url + ["--concurrency", bad, "a", "b"])
+
+    def test_cp_concurrently(self):
+        self.basedir = "cli/Cp/cp_concurrently"
+        self.set_up_grid(oneshare=True)
+        source = os.path.join(self.basedir, "source")
+        contents = {}
+        for subdir in ["one", "two", "three"]:
+            fileutil.make_dirs(os.path.join(source, subdir))
+            for i in range(5):
+                name = os.path.join(subdir, "file%d" % i)
+                contents[name] = ("%s %d" % (subdir, i)) * 100
+                fileutil.write(os.path.join(source, name), contents[name])
+
+        d = self.do_cli("create-alias", "tahoe")
+        d.addCallback(lambda ign:
+            self.do_cli("cp", "-r", "-j", "3", source, "tahoe:"))
+        def _copied(res):
+            (rc, out, err) = res
+            self.failUnlessEqual(rc, 0, str(res))
+            self.failUnlessIn("Success: files copied", out, str(res))
+        d.addCallback(_copied)
+        copy = os.path.join(self.basedir, "copy")
+        d.addCallback(lambda ign:
+            self.do_cli("cp", "-r", "-j", "3", "tahoe:source", copy))
+        d.addCallback(_copied)
+        def _check_local_fs(ign):
+            for (name, data) in contents.items():
+                self.failUnlessEqual(fileutil.read(os.path.join(copy, "source",
+                                                                name)),
+                                     data.encode("ascii"))
+        d.addCallback(_check_local_fs)
+        return d
+
     def test_ticket_2027(self):
         # This test ensures that tahoe will copy a file from the grid to
         # a local directory without a specified file name.
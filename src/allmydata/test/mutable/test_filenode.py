@@ -12,11 +12,14 @@ if PY2:
 
 from six.moves import cStringIO as StringIO
 from twisted.internet import defer, reactor
+from twisted.python import threadable
 from twisted.trial import unittest
+from foolscap.api import flushEventualQueue
 from allmydata import uri, client
 from allmydata.util.consumer import MemoryConsumer
 from allmydata.interfaces import SDMF_VERSION, MDMF_VERSION, DownloadStopped
 from allmydata.mutable.filenode import MutableFileNode, BackoffAgent
+from allmydata.mutable import retrieve
 from allmydata.mutable.common import MODE_ANYTHING, MODE_WRITE, MODE_READ, UncoordinatedWriteError
 
 from allmydata.mutable.publish import MutableData
@@ -45,6 +48,11 @@ class Filenode(unittest.TestCase, testutil.ShouldFailMixin):
         )
         self.nodemaker = make_nodemaker_with_peers(self._peers)
 
+    def tearDown(self):
+        # a MODE_READ servermap update can finish before all of its queries
+        # have been answered
+        return flushEventualQueue()
+
     def test_create(self):
         d = self.nodemaker.create_mutable_file()
         def _created(n):
@@ -298,6 +306,34 @@ class Filenode(unittest.TestCase, testutil.ShouldFailMixin):
         return d
 
 
+    def test_decode_and_decrypt_off_reactor_thread(self):
+        """
+        Retrieve decodes and decrypts each segment in a worker thread, in
+        segment order.
+        """
+        calls = []
+        original_decode = retrieve._decode_segment
+        original_decrypt = retrieve._decrypt_segment
+        def _decode_segment(decoder, shares, shareids, size_to_use):
+            calls.append(("decode", threadable.isInIOThread()))
+            return original_decode(decoder, shares, shareids, size_to_use)
+        def _decrypt_segment(readkey, salt, segment):
+            calls.append(("decrypt", threadable.isInIOThread()))
+            return original_decrypt(readkey, salt, segment)
+        self.patch(retrieve, "_decode_segment", _decode_segment)
+        self.patch(retrieve, "_decrypt_segment", _decrypt_segment)
+
+        contents = b"".join(b"%06d" % (i,) for i in range(50000)) # 3 segs
+        d = self.nodemaker.create_mutable_file(MutableData(contents),
+                                               version=MDMF_VERSION)
+        d.addCallback(lambda n: n.download_best_version())
+        def _downloaded(data):
+            self.failUnlessEqual(data, contents)
+            self.failUnlessEqual(calls, [("decode", False),
+                                         ("decrypt", False)] * 3)
+        d.addCallback(_downloaded)
+        return d
+
     def test_retrieve_producer_mdmf(self):
         # We should make sure that the retriever is able to pause and stop
         # correctly.
@@ -0,0 +1,123 @@
+"""
+Tests for allmydata.mutable.keypool.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os
+
+from twisted.trial import unittest
+
+from allmydata.crypto import rsa
+from allmydata.mutable.keypool import KeyPool
+from allmydata.util import cputhreadpool, fileutil
+from ..common import TEST_RSA_KEY_SIZE
+
+
+class KeyPoolTests(unittest.TestCase):
+    def setUp(self):
+        # make keys synchronously, so the pool refills before we look at it
+        cputhreadpool.disable_thread_pool_for_test(self)
+
+    def make_pool(self, size, keyfile=None, secret=b"\x01" * 32):
+        pool = KeyPool(size, keyfile, secret)
+        pool.set_default_keysize(TEST_RSA_KEY_SIZE)
+        return pool
+
+    def test_refill(self):
+        pool = self.make_pool(3)
+        # nothing is made until the pool is started
+        self.assertEqual(pool.get_stats()["mutable.key_pool.depth"], 0)
+        pool.startService()
+        self.addCleanup(pool.stopService)
+        self.assertEqual(pool.get_stats()["mutable.key_pool.depth"], 3)
+
+        (verifier, signer) = self.successResultOf(pool.generate())
+        self.assertEqual(signer.key_size, TEST_RSA_KEY_SIZE)
+        rsa.verify_signature(verifier, rsa.sign_data(signer, b"data"), b"data")
+        stats = pool.get_stats()
+        self.assertEqual(stats["mutable.key_pool.hits"], 1)
+        self.assertEqual(stats["mutable.key_pool.misses"], 0)
+        self.assertEqual(stats["mutable.key_pool.depth"], 3)
+        self.assertEqual(stats["mutable.key_pool.generated"], 4)
+        self.assertTrue(stats["mutable.key_pool.refill_rate"] > 0)
+
+        # every key is different
+        keys = set()
+        for i in range(5):
+            (verifier, signer) = self.successResultOf(pool.generate())
+            keys.add(rsa.der_string_from_signing_key(signer))
+        self.assertEqual(len(keys), 5)
+
+    def test_miss(self):
+        pool = self.make_pool(0)
+        pool.startService()
+        self.addCleanup(pool.stopService)
+        (verifier, signer) = self.successResultOf(pool.generate())
+        self.assertEqual(signer.key_size, TEST_RSA_KEY_SIZE)
+        # keys of other sizes are made as they are asked for, and are neither
+        # hits nor misses
+        (verifier, signer) = self.successResultOf(pool.generate(1024))
+        self.assertEqual(signer.key_size, 1024)
+        stats = pool.get_stats()
+        self.assertEqual(stats["mutable.key_pool.hits"], 0)
+        self.assertEqual(stats["mutable.key_pool.misses"], 1)
+        self.assertEqual(stats["mutable.key_pool.generated"], 0)
+
+    def test_keysize(self):
+        pool = self.make_pool(2)
+        pool.startService()
+        self.addCleanup(pool.stopService)
+        pool.set_default_keysize(1024)
+        (verifier, signer) = self.successResultOf(pool.generate())
+        self.assertEqual(signer.key_size, 1024)
+        self.assertEqual(pool.get_stats()["mutable.key_pool.hits"], 1)
+
+    def test_persist(self):
+        basedir = self.mktemp()
+        fileutil.make_dirs(basedir)
+        keyfile = os.path.join(basedir, "key_pool")
+        pool = self.make_pool(2, keyfile)
+        pool.startService()
+        saved = set(rsa.der_string_from_signing_key(signer)
+                    for (verifier, signer) in pool._keys)
+        pool.stopService()
+        self.assertEqual(pool.get_stats()["mutable.key_pool.depth"], 0)
+        self.assertTrue(os.path.exists(keyfile))
+        self.assertNotIn(list(saved)[0], fileutil.read(keyfile))
+
+        pool = self.make_pool(2, keyfile)
+        pool.startService()
+        self.addCleanup(pool.stopService)
+        # the keys come back, and the file is gone so they cannot come back
+        # again
+        self.assertFalse(os.path.exists(keyfile))
+        self.assertEqual(pool.get_stats()["mutable.key_pool.generated"], 0)
+        loaded = set()
+        for i in range(2):
+            (verifier, signer) = self.successResultOf(pool.generate())
+            loaded.add(rsa.der_string_from_signing_key(signer))
+        self.assertEqual(loaded, saved)
+
+    def test_persist_wrong_secret(self):
+        basedir = self.mktemp()
+        fileutil.make_dirs(basedir)
+        keyfile = os.path.join(basedir, "key_pool")
+        pool = self.make_pool(2, keyfile)
+        pool.startService()
+        pool.stopService()
+
+        pool = self.make_pool(2, keyfile, secret=b"\x02" * 32)
+        pool.startService()
+        self.addCleanup(pool.stopService)
+        self.assertFalse(os.path.exists(keyfile))
+        # it made new keys instead
+        self.assertEqual(pool.get_stats()["mutable.key_pool.generated"], 2)
@@ -17,7 +17,9 @@ from allmydata.monitor import Monitor
 from allmydata.mutable.common import \
      MODE_CHECK, MODE_ANYTHING, MODE_WRITE, MODE_READ
 from allmydata.mutable.publish import MutableData
-from allmydata.mutable.servermap import ServerMap, ServermapUpdater
+from allmydata.mutable.filenode import MutableFileNode
+from allmydata.mutable.servermap import ServerMap, ServermapUpdater, \
+     ServermapCache
 from .util import PublishMixin
 
 class Servermap(unittest.TestCase, PublishMixin):
@@ -246,3 +248,102 @@ class Servermap(unittest.TestCase, PublishMixin):
         d.addCallback(lambda servermap:
             self.failUnlessEqual(len(servermap.recoverable_versions()), 1))
         return d
+
+
+class Cache(unittest.TestCase, PublishMixin):
+    def setUp(self):
+        d = self.publish_one()
+        def _published(ign):
+            self.reads = 0
+            original_read = self._storage.read
+            def _read(peerid, storage_index):
+                self.reads += 1
+                return original_read(peerid, storage_index)
+            self._storage.read = _read
+        d.addCallback(_published)
+        return d
+
+    def make_node(self, cache, cap=None):
+        # a node which has not mapped the file yet, so it knows nothing
+        # about it (such as its pubkey) but what its cap tells it
+        n = MutableFileNode(self._storage_broker,
+                            self._nodemaker.secret_holder,
+                            self._nodemaker.default_encoding_parameters,
+                            None, cache)
+        return n.init_from_cap(cap or self._fn.get_cap())
+
+    def test_read_ttl(self):
+        cache = ServermapCache(read_ttl=60)
+        d = self.make_node(cache).download_best_version()
+        def _first(contents):
+            self.failUnlessEqual(contents, self.CONTENTS)
+            self.failUnlessEqual(cache.get_stats()["mutable.servermap_cache.misses"], 1)
+            self.first_reads, self.reads = self.reads, 0
+            # another node for the same file can use the map too
+            return self.make_node(cache).download_best_version()
+        d.addCallback(_first)
+        def _second(contents):
+            self.failUnlessEqual(contents, self.CONTENTS)
+            self.failUnlessEqual(cache.get_stats()["mutable.servermap_cache.hits"], 1)
+            # only the retrieve's reads were needed
+            self.failUnless(self.reads < self.first_reads,
+                            (self.reads, self.first_reads))
+            # but a map for writing must be fresh
+            return self.make_node(cache).get_servermap(MODE_WRITE)
+        d.addCallback(_second)
+        def _write_map(sm):
+            self.failUnlessEqual(sm.get_last_update()[0], MODE_WRITE)
+            self.failUnlessEqual(cache.get_stats()["mutable.servermap_cache.misses"], 2)
+        d.addCallback(_write_map)
+        return d
+
+    def test_write_ttl(self):
+        cache = ServermapCache(write_ttl=60)
+        n = self.make_node(cache)
+        d = n.get_servermap(MODE_WRITE)
+        d.addCallback(lambda ign: n.get_servermap(MODE_WRITE))
+        def _mapped(sm):
+            self.failUnlessEqual(sm.get_last_update()[0], MODE_WRITE)
+            self.failUnlessEqual(cache.get_stats()["mutable.servermap_cache.hits"], 1)
+            # a node without the privkey can't use a map for writing
+            return self.make_node(cache).get_servermap(MODE_WRITE)
+        d.addCallback(_mapped)
+        d.addCallback(lambda ign:
+            self.failUnlessEqual(cache.get_stats()["mutable.servermap_cache.hits"], 1))
+        return d
+
+    def test_publish_invalidates(self):
+        cache = ServermapCache(read_ttl=60)
+        n = self.make_node(cache)
+        d = n.download_best_version()
+        d.addCallback(lambda ign: n.overwrite(MutableData(b"new contents")))
+        d.addCallback(lambda ign:
+            self.failUnlessEqual(cache.get_stats()["mutable.servermap_cache.entries"], 0))
+        d.addCallback(lambda ign: n.download_best_version())
+        d.addCallback(self.failUnlessEqual, b"new contents")
+        return d
+
+    def test_optimistic_read(self):
+        cache = ServermapCache(optimistic_reads=True)
+        n = self.make_node(cache)
+        d = n.download_best_version()
+        def _read(ign):
+            # MODE_READ maps are only reused by downloads
+            return n.get_servermap(MODE_READ)
+        d.addCallback(_read)
+        d.addCallback(lambda ign: n.download_best_version())
+        def _optimistic(contents):
+            self.failUnlessEqual(contents, self.CONTENTS)
+            stats = cache.get_stats()
+            self.failUnlessEqual(stats["mutable.servermap_cache.hits"], 1)
+            self.failUnlessEqual(stats["mutable.servermap_cache.misses"], 2)
+            # someone else modifies the file
+            other = self.make_node(None)
+            return other.overwrite(MutableData(b"new contents"))
+        d.addCallback(_optimistic)
+        d.addCallback(lambda ign: n.download_best_version())
+        def _remapped(contents):
+            self.failUnlessEqual(contents, b"new contents")
+            self.failUnlessEqual(cache.get_stats()["mutable.servermap_cache.remaps"], 1)
+        d.addCallback(_remapped)
+        return d
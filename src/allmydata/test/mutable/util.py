@@ -102,6 +102,8 @@ class FakeStorageServer(object):
         self.peerid = peerid
         self.storage = storage
         self.queries = 0
+        # like an older server: no batched requests
+        self.version = {}
 
     def callRemote(self, methname, *args, **kwargs):
         self.queries += 1
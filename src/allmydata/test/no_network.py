@@ -52,6 +52,7 @@ from allmydata.util.hashutil import permute_server_hash
 from allmydata.util.fileutil import abspath_expanduser_unicode
 from allmydata.interfaces import IStorageBroker, IServer
 from allmydata.storage_client import (
+    ServerPerformance,
     _StorageServer,
 )
 from .common import (
@@ -150,6 +151,10 @@ class LocalWrapper(object):
             if methname == "get_buckets":
                 for shnum in res:
                     res[shnum] = self._wrap(res[shnum])
+            if methname == "get_buckets_batch":
+                for buckets in res:
+                    for shnum in buckets:
+                        buckets[shnum] = self._wrap(buckets[shnum])
             return res
         d.addCallback(_return_membrane)
         if self.post_call_notifier:
@@ -181,6 +186,9 @@ class NoNetworkServer(object):
     def __init__(self, serverid, rref):
         self.serverid = serverid
         self.rref = rref
+        # one per server, as with NativeStorageServer, so that leases queued
+        # by different callers get sent together
+        self._storage_server = _StorageServer(lambda: self.rref)
     def __repr__(self):
         return "<NoNetworkServer for %s>" % self.get_name()
     # Special method used by copy.copy() and copy.deepcopy(). When those are
@@ -211,7 +219,7 @@ class NoNetworkServer(object):
     def get_storage_server(self):
         if self.rref is None:
             return None
-        return _StorageServer(lambda: self.rref)
+        return self._storage_server
     def get_version(self):
         return self.rref.version
     def start_connecting(self, trigger_cb):
@@ -220,6 +228,8 @@ class NoNetworkServer(object):
 
 @implementer(IStorageBroker)
 class NoNetworkStorageBroker(object):  # type: ignore # missing many methods
+    def __init__(self):
+        self._performance = ServerPerformance()
     def get_servers_for_psi(self, peer_selection_index):
         def _permuted(server):
             seed = server.get_permutation_seed()
@@ -229,6 +239,8 @@ class NoNetworkStorageBroker(object):  # type: ignore # missing many methods
         return self.client._servers
     def get_nickname_for_serverid(self, serverid):
         return None
+    def get_server_performance(self):
+        return self._performance
     def when_connected_enough(self, threshold):
         return defer.Deferred()
     def get_all_serverids(self):
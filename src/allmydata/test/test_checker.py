@@ -780,6 +780,8 @@ class AddLease(GridTestMixin, unittest.TestCase):
                 raise KeyError("intentional failure, should be ignored")
             assert self.g.servers_by_number[0].remote_add_lease
             self.g.servers_by_number[0].remote_add_lease = broken_add_lease
+            # checkers use the batched form when the server offers it
+            self.g.servers_by_number[0].remote_add_leases = broken_add_lease
         d.addCallback(_break_add_lease)
 
         # and confirm that the files still look healthy
@@ -62,6 +62,7 @@ from allmydata.nodemaker import (
     NodeMaker,
 )
 from allmydata.node import OldConfigError, UnescapedHashError, create_node_dir
+from allmydata.mutable.keypool import KeyPool
 from allmydata import client
 from allmydata.storage_client import (
     StorageClientConfig,
@@ -400,6 +401,163 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         with self.assertRaises(ValueError):
             yield client.create_client(basedir)
 
+    @defer.inlineCallbacks
+    def test_disk_io_threads(self):
+        """
+        disk_io.threads gives the storage server a thread pool for its disk
+        I/O
+        """
+        basedir = "client.Basic.test_disk_io_threads"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "disk_io.threads = 3\n")
+        c = yield client.create_client(basedir)
+        stats = c.getServiceNamed("storage").get_stats()
+        self.failUnlessEqual(stats["storage_server.disk_io.threads"], 3)
+
+    @defer.inlineCallbacks
+    def test_crawler_limits(self):
+        """
+        The [storage]crawler.* options are applied to both storage crawlers,
+        and a parallel_prefixes below 1 is rejected
+        """
+        basedir = "client.Basic.test_crawler_limits"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "crawler.parallel_prefixes = 4\n" + \
+                           "crawler.max_entries_per_second = 500\n" + \
+                           "crawler.max_bytes_per_second = 2MB\n" + \
+                           "crawler.max_foreground_latency = 0.25\n")
+        c = yield client.create_client(basedir)
+        ss = c.getServiceNamed("storage")
+        for crawler in (ss.bucket_counter, ss.lease_checker):
+            self.failUnlessEqual(crawler.parallel_prefixes, 4)
+            self.failUnlessEqual(crawler.allowed_entries_per_second, 500)
+            self.failUnlessEqual(crawler.allowed_bytes_per_second, 2000000)
+            self.failUnlessEqual(crawler.max_foreground_latency, 0.25)
+
+        basedir = "client.Basic.test_crawler_limits_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "crawler.parallel_prefixes = 0\n")
+        with self.assertRaises(ValueError):
+            yield client.create_client(basedir)
+
+    @defer.inlineCallbacks
+    def test_key_pool(self):
+        """
+        mutable.key_pool.size gives the nodemaker a pool of ready-made keys,
+        reported in the stats, and there is none by default
+        """
+        basedir = "client.Basic.test_key_pool"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[client]\n" + \
+                           "mutable.key_pool.size = 4\n" + \
+                           "mutable.key_pool.persist = true\n")
+        c = yield client.create_client(basedir)
+        self.failUnless(isinstance(c.nodemaker.key_generator, KeyPool))
+        self.failUnlessEqual(c.nodemaker.key_generator._keyfile,
+                             os.path.join(os.path.abspath(basedir),
+                                          "private", "key_pool"))
+        stats = c.stats_provider.get_stats()["stats"]
+        self.failUnlessEqual(stats["mutable.key_pool.depth"], 0)
+
+        basedir = "client.Basic.test_key_pool_default"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.failUnless(isinstance(c.nodemaker.key_generator,
+                                   client.KeyGenerator))
+
+    @defer.inlineCallbacks
+    def test_segment_cache_size(self):
+        """
+        download.segment_cache_size gives downloads a cache of segments under
+        the tempdir, and there is none by default
+        """
+        basedir = "client.Basic.test_segment_cache_size"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[client]\n" + \
+                           "download.segment_cache_size = 10MB\n")
+        c = yield client.create_client(basedir)
+        self.failUnlessEqual(c.nodemaker.segment_cache, c.segment_cache)
+        self.failUnless(os.path.isdir(os.path.join(basedir, "tmp",
+                                                   "download-segments")))
+        stats = c.stats_provider.get_stats()["stats"]
+        self.failUnlessEqual(stats["downloader.segment_cache.entries"], 0)
+
+        basedir = "client.Basic.test_segment_cache_size_default"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.failUnlessEqual(c.nodemaker.segment_cache, None)
+
+    @defer.inlineCallbacks
+    def test_share_locations_cache_ttl(self):
+        """
+        share_locations.cache_ttl gives uploads and downloads a shared cache
+        of share locations, and there is none by default
+        """
+        basedir = "client.Basic.test_share_locations_cache_ttl"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[client]\n" + \
+                           "share_locations.cache_ttl = 30\n")
+        c = yield client.create_client(basedir)
+        self.failUnless(c.share_location_cache)
+        self.failUnlessEqual(c.nodemaker.share_locations,
+                             c.share_location_cache)
+        self.failUnlessEqual(c.getServiceNamed("uploader")._share_locations,
+                             c.share_location_cache)
+
+        basedir = "client.Basic.test_share_locations_cache_ttl_default"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.failUnlessEqual(c.share_location_cache, None)
+
+    @defer.inlineCallbacks
+    def test_open_file_cache_size(self):
+        """
+        open_file_cache_size limits how many share files the storage server
+        keeps open, and 0 turns the cache off
+        """
+        basedir = "client.Basic.test_open_file_cache_size"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "open_file_cache_size = 7\n")
+        c = yield client.create_client(basedir)
+        stats = c.getServiceNamed("storage").get_stats()
+        self.failUnlessEqual(stats["storage_server.open_files.max_open"], 7)
+
+        basedir = "client.Basic.test_open_file_cache_size_0"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "open_file_cache_size = 0\n")
+        c = yield client.create_client(basedir)
+        stats = c.getServiceNamed("storage").get_stats()
+        self.assertNotIn("storage_server.open_files.max_open", stats)
+
     @defer.inlineCallbacks
     def test_web_apiauthtoken(self):
         """
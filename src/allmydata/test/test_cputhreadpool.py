@@ -0,0 +1,66 @@
+"""
+Tests for allmydata.util.cputhreadpool.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import threading
+
+from twisted.trial import unittest
+from twisted.python import threadable
+
+from allmydata.util import cputhreadpool
+
+
+class DeferToThreadTests(unittest.TestCase):
+    """
+    Tests for ``defer_to_thread``.
+    """
+    def test_runs_in_worker_thread(self):
+        """
+        The function runs outside the reactor thread and its result is
+        delivered by the returned ``Deferred``.
+        """
+        def f(a, b=0):
+            return (threadable.isInIOThread(), a + b)
+        d = cputhreadpool.defer_to_thread(f, 1, b=2)
+        d.addCallback(self.assertEqual, (False, 3))
+        return d
+
+    def test_exception(self):
+        """
+        An exception raised by the function fails the ``Deferred``.
+        """
+        def f():
+            raise ZeroDivisionError()
+        d = cputhreadpool.defer_to_thread(f)
+        return self.assertFailure(d, ZeroDivisionError)
+
+    def test_disabled_for_test(self):
+        """
+        ``disable_thread_pool_for_test`` makes ``defer_to_thread`` run the
+        function synchronously in the calling thread.
+        """
+        cputhreadpool.disable_thread_pool_for_test(self)
+        d = cputhreadpool.defer_to_thread(threading.current_thread)
+        self.assertIs(self.successResultOf(d), threading.current_thread())
+
+    def test_set_max_threads(self):
+        """
+        ``set_max_threads`` changes the maximum pool size and rejects values
+        less than 1.
+        """
+        self.addCleanup(cputhreadpool.set_max_threads,
+                        cputhreadpool.get_max_threads())
+        cputhreadpool.set_max_threads(3)
+        self.assertEqual(cputhreadpool.get_max_threads(), 3)
+        self.assertRaises(ValueError, cputhreadpool.set_max_threads, 0)
@@ -25,7 +25,8 @@ from foolscap.api import eventually, fireEventually
 
 from allmydata.util import fileutil, hashutil, pollmixin
 from allmydata.storage.server import StorageServer, si_b2a
-from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded, \
+     WaitingForListing
 
 from allmydata.test.common_util import StallMixin, FakeCanary
 
@@ -431,6 +432,128 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         return d
 
 
+    def test_parallel_prefixes(self):
+        self.basedir = "crawler/Basic/parallel_prefixes"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+        ss = StorageServer(self.basedir, serverid, disk_io_threads=2)
+        ss.setServiceParent(self.s)
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        c.parallel_prefixes = 8
+        c.load_state()
+        # the listings are done on the disk I/O threads, so the crawler has
+        # to wait for the first one, having asked for the next few as well
+        e = self.assertRaises(WaitingForListing,
+                              c.start_current_prefix, time.time())
+        self.failUnlessEqual(sorted(c.listings.keys()), list(range(8)))
+
+        d = e.listing
+        def _listed(ignored):
+            c.setServiceParent(self.s)
+            return c.finished_d
+        d.addCallback(_listed)
+        def _check(ignored):
+            # the buckets are still processed in order
+            self.failUnlessEqual(sorted(sis), c.all_buckets)
+            self.failUnlessEqual(c.listings, {})
+            stats = ss.disk_io.get_stats()
+            self.failUnless(stats["storage_server.disk_io.completed"]
+                            >= len(c.prefixes))
+        d.addCallback(_check)
+        return d
+
+    def test_stale_listings(self):
+        self.basedir = "crawler/Basic/stale_listings"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid, disk_io_threads=2)
+        ss.setServiceParent(self.s)
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        c.parallel_prefixes = 8
+        c.load_state()
+        e = self.assertRaises(WaitingForListing,
+                              c.start_current_prefix, time.time())
+        # stopping drops the listings, including those still being done
+        c.stopService()
+        self.failUnlessEqual(c.listings, {})
+        d = e.listing
+        def _listed(ignored):
+            self.failUnlessEqual(c.listings, {})
+        d.addCallback(_listed)
+        return d
+
+    def test_io_budget(self):
+        self.basedir = "crawler/Basic/io_budget"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        c.cpu_slice = 1.0
+        c.allowed_entries_per_second = 3
+        c.load_state()
+        # the slice ends once it has listed its 3 entries, not after a second
+        self.assertRaises(TimeSliceExceeded,
+                          c.start_current_prefix, time.time())
+        self.failUnlessEqual(len(c.all_buckets), 3)
+        self.failUnlessEqual(c.slice_entries, 3)
+        # and then the crawler sleeps for the rest of that second
+        self.failUnlessAlmostEqual(c.io_sleep_time(0.25), 0.75)
+
+        c.allowed_entries_per_second = None
+        c.allowed_bytes_per_second = 100
+        c.count_io(bytes_read=200)
+        self.failUnlessAlmostEqual(c.io_sleep_time(0.25), 1.75)
+        c.slice_entries = c.slice_bytes = 0
+        c.start_current_prefix(time.time())
+        self.failUnlessEqual(sorted(sis), sorted(c.all_buckets))
+
+    def test_latency_backoff(self):
+        self.basedir = "crawler/Basic/latency_backoff"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        c.cpu_slice = 1.0
+        self.failUnlessEqual(c.back_off(0.5), 0.5)
+        c.max_foreground_latency = 0.1
+        # not enough samples to say yet
+        ss.add_latency("read", 0.5)
+        self.failUnlessEqual(c.get_foreground_latency(), None)
+        self.failUnlessEqual(c.back_off(0.5), 0.5)
+
+        for i in range(20):
+            ss.add_latency("read", 0.5)
+            ss.add_latency("get", 0.01)
+        self.failUnless(c.get_foreground_latency() > 0.1)
+        # slow clients: each slice doubles the sleep, of at least cpu_slice
+        self.failUnlessEqual(c.back_off(0.5), 2.0)
+        self.failUnlessEqual(c.back_off(0.5), 4.0)
+        for i in range(10):
+            c.back_off(0.5)
+        self.failUnlessEqual(c.latency_backoff, c.MAX_LATENCY_BACKOFF)
+
+        # and the crawler comes back gradually once they are fast again
+        c.max_foreground_latency = 1.0
+        self.failUnlessEqual(c.back_off(0.5), 32.0)
+        self.failUnlessEqual(c.latency_backoff, 32)
+        for i in range(5):
+            c.back_off(0.5)
+        self.failUnlessEqual(c.back_off(0.5), 0.5)
+
     def test_oneshot(self):
         self.basedir = "crawler/Basic/oneshot"
         fileutil.make_dirs(self.basedir)
@@ -32,8 +32,9 @@ from allmydata.interfaces import IImmutableFileNode, IMutableFileNode, \
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.mutable.common import UncoordinatedWriteError
 from allmydata.util import hashutil, base32
+from allmydata.util.dictutil import AuxValueDict
 from allmydata.util.netstring import split_netstring
-from allmydata.monitor import Monitor
+from allmydata.monitor import Monitor, OperationCancelledError
 from allmydata.test.common import make_chk_file_uri, make_mutable_file_uri, \
      ErrorMixin
 from allmydata.test.no_network import GridTestMixin
@@ -1129,7 +1130,8 @@ class Dirnode(GridTestMixin, unittest.TestCase,
                            in self.g.wrappers_by_id.values()] or rootnode)
         d.addCallback(lambda rootnode: rootnode.start_deep_check().when_done())
         def _check(ign):
-            count = sum([ss.counter_by_methname['slot_readv']
+            count = sum([ss.counter_by_methname.get('slot_readv', 0)
+                         + ss.counter_by_methname.get('slot_readv_batch', 0)
                          for ss in self.g.wrappers_by_id.values()])
             self.failIf(count > 60, 'Expected only 60 cache misses,'
                                     'unfortunately there were %d' % (count,))
@@ -1988,3 +1990,201 @@ class Adder(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
 
         d.addCallback(_test_adder)
         return d
+
+
+class DirectoryCache(unittest.TestCase):
+
+    def _children(self, name):
+        children = AuxValueDict()
+        children.set_with_aux(name, (None, {"key": "value"}), b"packed")
+        return children
+
+    def test_versions(self):
+        cache = dirnode.DirectoryCache(100)
+        cache.put(b"a", 1, 10, self._children(u"one"))
+        self.assertIsNone(cache.get(b"a", 2))
+        # a stale version is dropped rather than kept around
+        self.assertIsNone(cache.get(b"a", 1))
+        cache.put(b"a", 2, 10, self._children(u"two"))
+        children = cache.get(b"a", 2)
+        self.assertEqual(list(children.keys()), [u"two"])
+        self.assertEqual(children.get_aux(u"two"), b"packed")
+        self.assertEqual(cache.get_stats(),
+                         {"dirnode.cache.hits": 1,
+                          "dirnode.cache.misses": 2,
+                          "dirnode.cache.entries": 1,
+                          "dirnode.cache.size": 10})
+
+    def test_copies(self):
+        cache = dirnode.DirectoryCache(100)
+        original = self._children(u"one")
+        cache.put(b"a", 1, 10, original)
+        original[u"one"][1]["key"] = "changed"
+        children = cache.get(b"a", 1)
+        children[u"one"][1]["key"] = "changed"
+        del children[u"one"]
+        self.assertEqual(cache.get(b"a", 1)[u"one"][1], {"key": "value"})
+
+    def test_lru(self):
+        cache = dirnode.DirectoryCache(25)
+        cache.put(b"a", 1, 10, self._children(u"one"))
+        cache.put(b"b", 1, 10, self._children(u"one"))
+        self.assertIsNotNone(cache.get(b"a", 1))
+        cache.put(b"c", 1, 10, self._children(u"one"))
+        self.assertIsNone(cache.get(b"b", 1))
+        self.assertIsNotNone(cache.get(b"a", 1))
+        self.assertIsNotNone(cache.get(b"c", 1))
+        # too big to cache at all
+        cache.put(b"d", 1, 30, self._children(u"one"))
+        self.assertIsNone(cache.get(b"d", 1))
+        self.assertEqual(cache.get_stats()["dirnode.cache.size"], 20)
+
+    def test_disabled(self):
+        cache = dirnode.DirectoryCache(0)
+        # not even an empty directory is kept
+        cache.put(b"a", 1, 0, self._children(u"one"))
+        self.assertIsNone(cache.get(b"a", 1))
+        self.assertEqual(cache.get_stats()["dirnode.cache.entries"], 0)
+
+    def test_invalidate(self):
+        cache = dirnode.DirectoryCache(100)
+        cache.put((b"si", True), 1, 10, self._children(u"one"))
+        cache.put((b"si", False), 1, 10, self._children(u"one"))
+        cache.invalidate_storage_index(b"si")
+        self.assertIsNone(cache.get((b"si", True), 1))
+        self.assertIsNone(cache.get((b"si", False), 1))
+        self.assertEqual(cache.get_stats()["dirnode.cache.size"], 0)
+
+
+class CachedDirnode(GridTestMixin, unittest.TestCase):
+
+    def _stats(self, client):
+        stats = client.nodemaker.dirnode_cache.get_stats()
+        return (stats["dirnode.cache.hits"], stats["dirnode.cache.misses"])
+
+    def test_cached_list(self):
+        self.basedir = "dirnode/CachedDirnode/test_cached_list"
+        self.set_up_grid(num_clients=2, oneshare=True)
+        c0, c1 = self.g.clients[0], self.g.clients[1]
+        kids = {u"one": (c0.nodemaker.create_from_cap(make_chk_file_uri(1)),
+                         {"key": "value"})}
+        d = c0.create_dirnode(kids)
+        def _created(n):
+            self.node = n
+            return n.list()
+        d.addCallback(_created)
+        def _listed(children):
+            self.assertEqual(self._stats(c0), (0, 1))
+            # the caller may do what it likes with its copy
+            children[u"one"][1]["key"] = "changed"
+            # a hit does not unpack anything
+            self.node._unpack_contents = None
+            return self.node.list()
+        d.addCallback(_listed)
+        def _listed_again(children):
+            self.assertEqual(self._stats(c0), (1, 1))
+            self.assertEqual(children[u"one"][1]["key"], "value")
+            del self.node._unpack_contents
+            # our own modifications drop the cached copy
+            return self.node.set_node(
+                u"two", c0.nodemaker.create_from_cap(make_chk_file_uri(2)))
+        d.addCallback(_listed_again)
+        d.addCallback(lambda ign: self.node.list())
+        def _listed_after_set(children):
+            self.assertEqual(self._stats(c0), (1, 2))
+            self.assertEqual(set(children), {u"one", u"two"})
+            # and other writers' modifications show up as a new version
+            other = c1.create_node_from_uri(self.node.get_uri())
+            return other.delete(u"one")
+        d.addCallback(_listed_after_set)
+        d.addCallback(lambda ign: self.node.list())
+        def _listed_after_other(children):
+            self.assertEqual(self._stats(c0), (1, 3))
+            self.assertEqual(set(children), {u"two"})
+        d.addCallback(_listed_after_other)
+        return d
+
+    def test_cached_immutable(self):
+        self.basedir = "dirnode/CachedDirnode/test_cached_immutable"
+        self.set_up_grid(oneshare=True)
+        c0 = self.g.clients[0]
+        kids = {u"one": (c0.nodemaker.create_from_cap(make_chk_file_uri(1)),
+                         {})}
+        d = c0.create_immutable_dirnode(kids)
+        d.addCallback(lambda n: n.list().addCallback(lambda ign: n.list()))
+        def _listed(children):
+            self.assertEqual(set(children), {u"one"})
+            self.assertEqual(self._stats(c0), (1, 1))
+        d.addCallback(_listed)
+        return d
+
+
+class DeepTraversal(GridTestMixin, unittest.TestCase):
+
+    def _make_tree(self):
+        # / has subdirectories a, b and c, each of which has subdirectories
+        # x and y and a file, and c/y also appears as b/z
+        self.basedir = "dirnode/DeepTraversal/" + self._testMethodName
+        self.set_up_grid(oneshare=True)
+        c0 = self.g.clients[0]
+        self.nodemaker = c0.nodemaker
+        d = c0.create_dirnode()
+        def _created_root(root):
+            self.root = root
+            subdirs = {}
+            d = defer.succeed(None)
+            for name in [u"a", u"b", u"c"]:
+                d.addCallback(lambda ign, name=name:
+                              root.create_subdirectory(name))
+                def _created(sub, name=name):
+                    subdirs[name] = sub
+                    filenode = c0.create_node_from_uri(
+                        make_chk_file_uri(len(subdirs)))
+                    d2 = sub.set_node(u"file", filenode)
+                    d2.addCallback(lambda ign: sub.create_subdirectory(u"x"))
+                    d2.addCallback(lambda ign: sub.create_subdirectory(u"y"))
+                    return d2
+                d.addCallback(_created)
+            d.addCallback(lambda ign: subdirs[u"c"].get(u"y"))
+            d.addCallback(lambda y: subdirs[u"b"].set_node(u"z", y))
+            return d
+        d.addCallback(_created_root)
+        return d
+
+    def _manifest(self, concurrency, frontier):
+        self.nodemaker.deep_traverse_concurrency = concurrency
+        self.nodemaker.deep_traverse_frontier = frontier
+        d = self.root.build_manifest().when_done()
+        d.addCallback(lambda res: [path for (path, cap) in res["manifest"]])
+        return d
+
+    def test_concurrent(self):
+        d = self._make_tree()
+        d.addCallback(lambda ign: self._manifest(1, 10000))
+        def _serial(paths):
+            # depth-first, files before subdirectories, as it always was
+            self.assertEqual(paths[:6], [(), (u"a",), (u"a", u"file"),
+                                         (u"a", u"x"), (u"a", u"y"),
+                                         (u"b",)])
+            self.assertEqual(len(paths), 13)
+            self.serial = paths
+            return self._manifest(4, 2)
+        d.addCallback(_serial)
+        def _concurrent(paths):
+            self.assertEqual(len(paths), len(set(paths)))
+            # b/z and c/y are the same directory, found under either name
+            self.assertEqual(set(paths) - {(u"b", u"z"), (u"c", u"y")},
+                             set(self.serial) - {(u"b", u"z"), (u"c", u"y")})
+        d.addCallback(_concurrent)
+        return d
+
+    def test_cancel(self):
+        d = self._make_tree()
+        def _traverse(ign):
+            self.nodemaker.deep_traverse_concurrency = 4
+            monitor = self.root.build_manifest()
+            monitor.cancel()
+            return self.assertFailure(monitor.when_done(),
+                                      OperationCancelledError)
+        d.addCallback(_traverse)
+        return d
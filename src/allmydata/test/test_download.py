@@ -16,21 +16,29 @@ if PY2:
 
 import six
 import os
+import threading
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
+from twisted.python import threadable
 from allmydata import uri
 from allmydata.storage.server import storage_index_to_dir
 from allmydata.util import base32, fileutil, spans, log, hashutil
 from allmydata.util.consumer import download_to_data, MemoryConsumer
 from allmydata.immutable import upload, layout
+from allmydata.immutable.downloader import node as download_node
 from allmydata.test.no_network import GridTestMixin, NoNetworkServer
 from allmydata.test.common import ShouldFailMixin
+from allmydata.util.pollmixin import PollMixin
 from allmydata.interfaces import NotEnoughSharesError, NoSharesError, \
      DownloadStopped
 from allmydata.immutable.downloader.common import BadSegmentNumberError, \
      BadCiphertextHashError, COMPLETE, OVERDUE, DEAD
 from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.immutable.downloader.fetcher import SegmentFetcher
+from allmydata.immutable.downloader.segcache import SegmentCache
+from allmydata.immutable.sharelocations import ShareLocationCache
+from allmydata.monitor import Monitor
+from allmydata.storage_client import ServerPerformance
 from allmydata.codec import CRSDecoder
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
 
@@ -203,7 +211,7 @@ class _Base(GridTestMixin, ShouldFailMixin):
         d.addCallback(_got_data)
         return d
 
-class DownloadTest(_Base, unittest.TestCase):
+class DownloadTest(_Base, PollMixin, unittest.TestCase):
     def test_download(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
@@ -882,17 +890,401 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(_got_ciphertext)
         return d
 
-class BrokenDecoder(CRSDecoder):
-    def decode(self, shares, shareids):
-        d = CRSDecoder.decode(self, shares, shareids)
-        def _decoded(buffers):
-            def _corruptor(s, which):
-                return s[:which] + bchr(ord(s[which:which+1])^0x01) + s[which+1:]
-            buffers[0] = _corruptor(buffers[0], 0) # flip lsb of first byte
-            return buffers
-        d.addCallback(_decoded)
+    def _upload_for_readahead(self, readahead):
+        # upload a file with 6 segments. Segment 0 is fetched before the
+        # downloader knows the real segment size, so read-ahead only starts
+        # once segment 1 is requested.
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.c0.nodemaker.download_readahead = readahead
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 60
+        d = self.c0.upload(u)
+        d.addCallback(lambda ur: self.c0.create_node_from_uri(ur.get_uri()))
+        return d
+
+    def test_readahead(self):
+        c = SegmentRecordingConsumer()
+        d = self._upload_for_readahead(2)
+        def _uploaded(n):
+            c.node = n
+            return n.read(c)
+        d.addCallback(_uploaded)
+        def _downloaded(ign):
+            self.failUnlessEqual(b"".join(c.chunks), plaintext)
+            # while segment 1 was being delivered, segments 2 and 3 (but
+            # not 4) had already been asked for
+            self.failUnlessEqual(c.requested[1], [0, 1, 2, 3])
+            self.failUnlessEqual(c.requested[3], [0, 1, 2, 3, 4, 5])
+            ds = c.node._cnode._download_status
+            self.failUnlessEqual(ds.get_readahead(), 2)
+        d.addCallback(_downloaded)
+        return d
+
+    def test_no_readahead(self):
+        c = SegmentRecordingConsumer()
+        d = self._upload_for_readahead(0)
+        def _uploaded(n):
+            c.node = n
+            return n.read(c)
+        d.addCallback(_uploaded)
+        def _downloaded(ign):
+            self.failUnlessEqual(b"".join(c.chunks), plaintext)
+            self.failUnlessEqual(c.requested[1], [0, 1])
+            self.failUnlessEqual(c.requested[3], [0, 1, 2, 3])
+        d.addCallback(_downloaded)
+        return d
+
+    def test_readahead_paused(self):
+        c = SegmentRecordingConsumer(pause_at=1)
+        d = self._upload_for_readahead(1)
+        reads = []
+        def _uploaded(n):
+            c.node = n
+            reads.append(n.read(c))
+            return self.poll(lambda: c.segment_finished(2))
+        d.addCallback(_uploaded)
+        def _paused(ign):
+            # the read-ahead request finished while we were paused, but
+            # nothing beyond it was asked for
+            self.failUnlessEqual(c.segments_requested(), [0, 1, 2])
+            c.producer.resumeProducing()
+            return reads[0]
+        d.addCallback(_paused)
+        def _downloaded(ign):
+            self.failUnlessEqual(b"".join(c.chunks), plaintext)
+            self.failUnlessEqual(c.segments_requested(), [0, 1, 2, 3, 4, 5])
+        d.addCallback(_downloaded)
+        return d
+
+    def test_readahead_stop(self):
+        c = SegmentRecordingConsumer(stop_at=1)
+        d = self._upload_for_readahead(2)
+        def _uploaded(n):
+            c.node = n
+            return self.shouldFail(DownloadStopped, "test_readahead_stop",
+                                   "our Consumer called stopProducing()",
+                                   n.read, c)
+        d.addCallback(_uploaded)
+        d.addCallback(flushEventualQueue)
+        def _stopped(ign):
+            self.failUnlessEqual(c.requested[1], [0, 1, 2, 3])
+            # the read-ahead requests were all cancelled
+            self.failUnlessEqual(c.node._cnode._node._segment_requests, [])
+            self.failUnlessEqual(c.node._cnode._node._active_segment, None)
+        d.addCallback(_stopped)
+        return d
+
+    def test_decode_off_reactor_thread(self):
+        in_io_thread = []
+        original = download_node._decode_and_hash_segment
+        def _decode_and_hash_segment(*args):
+            in_io_thread.append(threadable.isInIOThread())
+            return original(*args)
+        self.patch(download_node, "_decode_and_hash_segment",
+                   _decode_and_hash_segment)
+        d = self._upload_for_readahead(2)
+        d.addCallback(download_to_data)
+        def _downloaded(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnlessEqual(in_io_thread, [False] * 6)
+        d.addCallback(_downloaded)
+        return d
+
+    def test_cancel_during_decode(self):
+        # a segment request that is cancelled while its blocks are being
+        # decoded must not be delivered, nor disturb the next request
+        decoding = defer.Deferred()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        original = download_node._decode_and_hash_segment
+        def _decode_and_hash_segment(*args):
+            if not decoding.called:
+                reactor.callFromThread(decoding.callback, None)
+                release.wait()
+            return original(*args)
+        self.patch(download_node, "_decode_and_hash_segment",
+                   _decode_and_hash_segment)
+        fired = []
+        results = []
+        d = self._upload_for_readahead(0)
+        def _uploaded(n):
+            cn = n._cnode
+            (d0,c0) = cn.get_segment(0)
+            d0.addBoth(fired.append)
+            def _cancel(ign):
+                c0.cancel()
+                (d1,c1) = cn.get_segment(1)
+                release.set()
+                return d1
+            decoding.addCallback(_cancel)
+            return decoding
+        d.addCallback(_uploaded)
+        d.addCallback(results.append)
+        d.addCallback(fireEventually)
+        d.addCallback(flushEventualQueue)
+        def _check(ign):
+            self.failUnlessEqual(fired, [])
+            (offset, segment, decodetime) = results[0]
+            self.failUnlessEqual(offset, 60)
+            self.failUnlessEqual(len(segment), 60)
+        d.addCallback(_check)
+        return d
+
+class SegmentCacheTest(_Base, unittest.TestCase):
+
+    def _upload(self, max_size):
+        # upload a file with 6 segments of 60 bytes (the last one is 10)
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.cache = SegmentCache(os.path.join(self.basedir, "segments"),
+                                  max_size)
+        self.c0.nodemaker.segment_cache = self.cache
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 60
+        d = self.c0.upload(u)
+        d.addCallback(lambda ur: ur.get_uri())
+        return d
+
+    def _new_node(self, cap):
+        # a node which has not downloaded anything yet
+        return self.c0.nodemaker._create_immutable(uri.from_string(cap))
+
+    def test_hits(self):
+        d = self._upload(1000)
+        def _uploaded(cap):
+            self.cap = cap
+            return download_to_data(self._new_node(cap))
+        d.addCallback(_uploaded)
+        def _downloaded(data):
+            self.failUnlessEqual(data, plaintext)
+            stats = self.cache.get_stats()
+            self.failUnlessEqual(stats["downloader.segment_cache.hits"], 0)
+            self.failUnlessEqual(stats["downloader.segment_cache.entries"], 6)
+            self.failUnlessEqual(stats["downloader.segment_cache.size"],
+                                 len(plaintext))
+            # the segments are not stored in the clear
+            for fn in os.listdir(os.path.join(self.basedir, "segments")):
+                cached = fileutil.read(os.path.join(self.basedir, "segments",
+                                                    fn))
+                self.failIfIn(cached, plaintext)
+            # with all of its shares gone, the file can still be read, in
+            # whole or in part
+            for (i,ss,ssdir) in self.iterate_servers():
+                self.delete_all_shares(ssdir)
+            return download_to_data(self._new_node(self.cap))
+        d.addCallback(_downloaded)
+        def _downloaded_again(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnlessEqual(
+                self.cache.get_stats()["downloader.segment_cache.hits"], 6)
+            return download_to_data(self._new_node(self.cap), 130, 100)
+        d.addCallback(_downloaded_again)
+        def _read_range(data):
+            self.failUnlessEqual(data, plaintext[130:230])
+            self.failUnlessEqual(
+                self.cache.get_stats()["downloader.segment_cache.hits"], 8)
+            return self._new_node(self.cap).get_best_readable_version()
+        d.addCallback(_read_range)
+        d.addCallback(lambda n: n._cnode.get_segment_size())
+        d.addCallback(lambda segsize: self.failUnlessEqual(segsize, 60))
+        return d
+
+    def test_eviction(self):
+        d = self._upload(150)
+        d.addCallback(lambda cap: download_to_data(self._new_node(cap)))
+        def _downloaded(data):
+            self.failUnlessEqual(data, plaintext)
+            stats = self.cache.get_stats()
+            # only the last segments fit
+            self.failUnlessEqual(stats["downloader.segment_cache.entries"], 3)
+            self.failUnlessEqual(stats["downloader.segment_cache.size"], 130)
+            self.failUnlessEqual(stats["downloader.segment_cache.evictions"],
+                                 3)
+            self.failUnlessEqual(
+                len(os.listdir(os.path.join(self.basedir, "segments"))), 3)
+        d.addCallback(_downloaded)
+        return d
+
+    def test_corrupt(self):
+        d = self._upload(1000)
+        def _uploaded(cap):
+            self.cap = cap
+            return download_to_data(self._new_node(cap))
+        d.addCallback(_uploaded)
+        def _downloaded(data):
+            segdir = os.path.join(self.basedir, "segments")
+            for fn in os.listdir(segdir):
+                fileutil.write(os.path.join(segdir, fn), b"x" * 60)
+            return download_to_data(self._new_node(self.cap))
+        d.addCallback(_downloaded)
+        def _downloaded_again(data):
+            # the corrupt segments were fetched from the grid instead
+            self.failUnlessEqual(data, plaintext)
+            stats = self.cache.get_stats()
+            self.failUnlessEqual(stats["downloader.segment_cache.hits"], 0)
+            self.failUnlessEqual(stats["downloader.segment_cache.entries"], 6)
+        d.addCallback(_downloaded_again)
+        return d
+
+class ShareLocationTest(_Base, unittest.TestCase):
+
+    def setUp(self):
+        super(ShareLocationTest, self).setUp()
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.cache = ShareLocationCache(60)
+        self.c0.nodemaker.share_locations = self.cache
+        self.c0.getServiceNamed("uploader")._share_locations = self.cache
+
+    def _new_node(self, cap):
+        # a node which has not downloaded anything yet
+        return self.c0.nodemaker._create_immutable(uri.from_string(cap))
+
+    def _count(self, methname):
+        return sum([w.counter_by_methname.get(methname, 0)
+                    for w in self.g.wrappers_by_id.values()])
+
+    def _upload(self):
+        u = upload.Data(plaintext, b"convergence")
+        u.max_segment_size = 60
+        return self.c0.upload(u)
+
+    def test_upload(self):
+        # uploading a file we have just uploaded asks nobody about existing
+        # shares, but still finds them all
+        d = self._upload()
+        def _uploaded(ur):
+            self.failUnlessEqual(ur.get_pushed_shares(), 10)
+            self.failUnless(self._count("get_buckets") > 0)
+            [w._clear_counters() for w in self.g.wrappers_by_id.values()]
+            return self._upload()
+        d.addCallback(_uploaded)
+        def _uploaded_again(ur):
+            self.failUnlessEqual(self._count("get_buckets"), 0)
+            self.failUnlessEqual(ur.get_pushed_shares(), 0)
+            self.failUnlessEqual(ur.get_preexisting_shares(), 10)
+            self.failUnlessEqual(self.cache.get_stats()
+                                 ["share_locations.cache.hits"], 1)
+        d.addCallback(_uploaded_again)
+        return d
+
+    def test_upload_missing_share(self):
+        # a share which has gone away since is uploaded again
+        d = self._upload()
+        def _uploaded(ur):
+            self.delete_shares_numbered(ur.get_uri(), [0])
+            [w._clear_counters() for w in self.g.wrappers_by_id.values()]
+            return self._upload()
+        d.addCallback(_uploaded)
+        def _uploaded_again(ur):
+            self.failUnlessEqual(self._count("get_buckets"), 0)
+            self.failUnlessEqual(ur.get_pushed_shares(), 1)
+            self.failUnlessEqual(len(self.find_uri_shares(ur.get_uri())), 10)
+        d.addCallback(_uploaded_again)
+        return d
+
+    def test_upload_missing_share_on_readonly_server(self):
+        # a readonly server is never asked to allocate the shares we expect
+        # it to hold, so it is asked what it holds instead
+        d = self._upload()
+        def _uploaded(ur):
+            self.cap = ur.get_uri()
+            [(shnum, serverid, sharefile)] = [
+                share for share in self.find_uri_shares(self.cap)
+                if share[0] == 0]
+            self.delete_shares_numbered(self.cap, [0])
+            wrapper = self.g.wrappers_by_id[serverid]
+            wrapper.original.readonly_storage = True
+            wrapper.version = wrapper.original.remote_get_version()
+            [w._clear_counters() for w in self.g.wrappers_by_id.values()]
+            self.readonly_wrapper = wrapper
+            return self._upload()
+        d.addCallback(_uploaded)
+        def _uploaded_again(ur):
+            self.failUnlessEqual(
+                self.readonly_wrapper.counter_by_methname["get_buckets"], 1)
+            self.failUnlessEqual(ur.get_pushed_shares(), 1)
+            self.failUnlessEqual(
+                sorted(set(shnum for (shnum, serverid, sharefile)
+                           in self.find_uri_shares(self.cap))),
+                list(range(10)))
+        d.addCallback(_uploaded_again)
+        return d
+
+    def test_check(self):
+        # a check finds every share
+        d = self._upload()
+        def _uploaded(ur):
+            self.si = uri.from_string(ur.get_uri()).get_storage_index()
+            self.cache.forget(self.si)
+            return self._new_node(ur.get_uri()).check(Monitor())
+        d.addCallback(_uploaded)
+        def _checked(cr):
+            locations = self.cache.get(self.si)
+            self.failUnless(locations.complete)
+            self.failUnlessEqual(
+                sorted(sum([list(shnums)
+                            for shnums in locations.shares.values()], [])),
+                list(range(10)))
+        d.addCallback(_checked)
+        return d
+
+    def test_download(self):
+        # a download after another one uses the buckets it found
+        d = self._upload()
+        def _uploaded(ur):
+            self.cap = ur.get_uri()
+            # the upload did not get any buckets
+            return download_to_data(self._new_node(self.cap))
+        d.addCallback(_uploaded)
+        def _downloaded(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnless(self._count("get_buckets") > 0)
+            [w._clear_counters() for w in self.g.wrappers_by_id.values()]
+            self.n = self._new_node(self.cap)
+            return download_to_data(self.n)
+        d.addCallback(_downloaded)
+        def _downloaded_again(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnlessEqual(self._count("get_buckets"), 0)
+            ds = self.n._cnode._download_status
+            self.failUnlessEqual(ds.dyhb_requests, [])
+        d.addCallback(_downloaded_again)
         return d
 
+    def test_download_dead_buckets(self):
+        # a download whose cached buckets fail asks the servers again
+        d = self._upload()
+        def _uploaded(ur):
+            self.cap = ur.get_uri()
+            return download_to_data(self._new_node(self.cap))
+        d.addCallback(_uploaded)
+        def _downloaded(data):
+            si = uri.from_string(self.cap).get_storage_index()
+            for (server, buckets, rtt) in self.cache.get(si).buckets.values():
+                for bucket in buckets.values():
+                    bucket.broken = True
+            [w._clear_counters() for w in self.g.wrappers_by_id.values()]
+            return download_to_data(self._new_node(self.cap))
+        d.addCallback(_downloaded)
+        def _downloaded_again(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnless(self._count("get_buckets") > 0)
+        d.addCallback(_downloaded_again)
+        return d
+
+class BrokenDecoder(CRSDecoder):
+    def decode_synchronously(self, shares, shareids):
+        buffers = CRSDecoder.decode_synchronously(self, shares, shareids)
+        def _corruptor(s, which):
+            return s[:which] + bchr(ord(s[which:which+1])^0x01) + s[which+1:]
+        buffers[0] = _corruptor(buffers[0], 0) # flip lsb of first byte
+        return buffers
+
 
 class PausingConsumer(MemoryConsumer):
     def __init__(self):
@@ -942,6 +1334,34 @@ class StallingConsumer(MemoryConsumer):
             self.halfway_cb()
         return MemoryConsumer.write(self, data)
 
+class SegmentRecordingConsumer(MemoryConsumer):
+    """I record which segments had been requested from my node each time a
+    segment was written to me, and can pause or stop at a given write."""
+    node = None
+
+    def __init__(self, pause_at=None, stop_at=None):
+        MemoryConsumer.__init__(self)
+        self.pause_at = pause_at
+        self.stop_at = stop_at
+        self.requested = []
+
+    def segments_requested(self):
+        ds = self.node._cnode._download_status
+        return sorted(set(e["segment_number"] for e in ds.segment_events))
+
+    def segment_finished(self, segnum):
+        ds = self.node._cnode._download_status
+        return any(e["segment_number"] == segnum and e["finish_time"]
+                   for e in ds.segment_events)
+
+    def write(self, data):
+        self.requested.append(self.segments_requested())
+        MemoryConsumer.write(self, data)
+        if len(self.requested) - 1 == self.pause_at:
+            self.producer.pauseProducing()
+        if len(self.requested) - 1 == self.stop_at:
+            self.producer.stopProducing()
+
 class Corruption(_Base, unittest.TestCase):
 
     def _corrupt_flip(self, ign, imm_uri, which):
@@ -1319,10 +1739,16 @@ class FakeNode(object):
         self.failed = None
         self.processed = None
         self._si_prefix = "si_prefix"
+        self.performance = ServerPerformance()
 
     def want_more_shares(self):
         self.want_more += 1
 
+    def rank_shares(self, shares):
+        return self.performance.rank(shares,
+                                     lambda s: s._server.get_serverid(),
+                                     1000)
+
     def fetch_failed(self, fetcher, f):
         self.failed = f
 
@@ -1410,6 +1836,25 @@ class Selection(unittest.TestCase):
         d.addCallback(_check2)
         return d
 
+    def test_prefer_fast_servers(self):
+        """Shares on servers which have been slow lately are used last,
+        however quickly they answered the DYHB."""
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 3, None)
+        shares = [MyShare(i, make_server(b"peer-%d" % i), i) for i in range(5)]
+        node.performance.record_rtt(shares[0]._server.get_serverid(), 10.0)
+        node.performance.record_rtt(shares[1]._server.get_serverid(), 0.1)
+        node.performance.record_rtt(shares[4]._server.get_serverid(), 1.0)
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check(ign):
+            # peer-1 is fast, peer-0 is slow, and peer-2 and peer-3 count as
+            # being as quick as peer-4
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[1], shares[2], shares[3]])
+        d.addCallback(_check)
+        return d
+
     def test_good_diversity_late(self):
         node = FakeNode()
         sf = MySegmentFetcher(node, 0, 3, None)
@@ -14,6 +14,7 @@ from past.builtins import chr as byteschr, long
 from zope.interface import implementer
 from twisted.trial import unittest
 from twisted.internet import defer
+from twisted.python import threadable
 from twisted.python.failure import Failure
 from foolscap.api import fireEventually
 from allmydata import uri
@@ -21,7 +22,8 @@ from allmydata.immutable import encode, upload, checker
 from allmydata.util import hashutil
 from allmydata.util.assertutil import _assert
 from allmydata.util.consumer import download_to_data
-from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader
+from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader, \
+     UploadUnhappinessError
 from allmydata.test.no_network import GridTestMixin
 
 class LostPeerError(Exception):
@@ -273,10 +275,11 @@ class ValidatedExtendedURIProxy(unittest.TestCase):
 
 class Encode(unittest.TestCase):
     def do_encode(self, max_segment_size, datalen, NUM_SHARES, NUM_SEGMENTS,
-                  expected_block_hashes, expected_share_hashes):
+                  expected_block_hashes, expected_share_hashes,
+                  pipeline_depth=encode.DEFAULT_PIPELINE_DEPTH):
         data = make_data(datalen)
         # force use of multiple segments
-        e = encode.Encoder()
+        e = encode.Encoder(pipeline_depth=pipeline_depth)
         u = upload.Data(data, convergence=b"some convergence string")
         u.set_default_encoding_parameters({'max_segment_size': max_segment_size,
                                            'k': 25, 'happy': 75, 'n': 100})
@@ -325,6 +328,7 @@ class Encode(unittest.TestCase):
                 for (hashnum, h) in peer.share_hashes:
                     self.failUnless(isinstance(hashnum, int))
                     self.failUnlessEqual(len(h), 32)
+            return verifycap
         d.addCallback(_check)
 
         return d
@@ -359,6 +363,94 @@ class Encode(unittest.TestCase):
         # 5 segments: 25, 25, 25, 25, 1
         return self.do_encode(25, 101, 100, 5, 15, 8)
 
+    @defer.inlineCallbacks
+    def test_pipeline_depth_does_not_change_result(self):
+        """
+        The verify cap produced by the Encoder does not depend on how many
+        segments it keeps in flight.
+        """
+        verifycaps = []
+        for depth in (1, 2, 5, 10):
+            verifycap = yield self.do_encode(25, 101, 100, 5, 15, 8,
+                                             pipeline_depth=depth)
+            verifycaps.append(verifycap.to_string())
+        self.assertEqual(len(set(verifycaps)), 1)
+
+    def test_encoding_off_reactor_thread(self):
+        """
+        The Encoder erasure-codes segments in a worker thread, and reports
+        how long each stage took.
+        """
+        in_io_thread = []
+        original = encode._encode_and_hash_blocks
+        def _encode_and_hash_blocks(codec, chunks):
+            in_io_thread.append(threadable.isInIOThread())
+            return original(codec, chunks)
+        self.patch(encode, "_encode_and_hash_blocks", _encode_and_hash_blocks)
+
+        data = make_data(101)
+        e = encode.Encoder(pipeline_depth=3)
+        u = upload.Data(data, convergence=b"some convergence string")
+        u.set_default_encoding_parameters({'max_segment_size': 25,
+                                           'k': 25, 'happy': 75, 'n': 100})
+        d = e.set_encrypted_uploadable(upload.EncryptAnUploadable(u))
+        def _ready(res):
+            shareholders = {}
+            servermap = {}
+            for shnum in range(100):
+                peer = FakeBucketReaderWriterProxy()
+                shareholders[shnum] = peer
+                servermap.setdefault(shnum, set()).add(peer.get_peerid())
+            e.set_shareholders(shareholders, servermap)
+            return e.start()
+        d.addCallback(_ready)
+        def _check(res):
+            self.assertEqual(in_io_thread, [False] * 5)
+            times = e.get_times()
+            for name in ("cumulative_reading", "cumulative_encoding",
+                         "cumulative_sending", "hashes_and_close",
+                         "total_encode_and_push"):
+                self.assertIn(name, times)
+                self.assertTrue(times[name] >= 0.0)
+        d.addCallback(_check)
+        return d
+
+    def test_lost_shareholder_stops_pipeline(self):
+        """
+        If too many shareholders fail while segments are in flight, the
+        upload fails with ``UploadUnhappinessError`` and later segments are
+        not sent.
+        """
+        data = make_data(101)
+        e = encode.Encoder(pipeline_depth=3)
+        u = upload.Data(data, convergence=b"some convergence string")
+        u.set_default_encoding_parameters({'max_segment_size': 25,
+                                           'k': 25, 'happy': 75, 'n': 100})
+        d = e.set_encrypted_uploadable(upload.EncryptAnUploadable(u))
+        all_shareholders = []
+        def _ready(res):
+            shareholders = {}
+            servermap = {}
+            for shnum in range(100):
+                # the first 30 shareholders go away during segment 1
+                mode = "lost" if shnum < 30 else "good"
+                peer = FakeBucketReaderWriterProxy(mode=mode,
+                                                   peerid=b"peer%d" % shnum)
+                shareholders[shnum] = peer
+                servermap.setdefault(shnum, set()).add(peer.get_peerid())
+                all_shareholders.append(peer)
+            e.set_shareholders(shareholders, servermap)
+            return e.start()
+        d.addCallback(_ready)
+        d.addCallbacks(lambda res: self.fail("upload should have failed"),
+                       lambda f: f.trap(UploadUnhappinessError))
+        def _check(res):
+            for peer in all_shareholders[30:]:
+                self.assertFalse(peer.closed)
+                self.assertEqual(sorted(peer.blocks), [0, 1])
+        d.addCallback(_check)
+        return d
+
 
 class Roundtrip(GridTestMixin, unittest.TestCase):
 
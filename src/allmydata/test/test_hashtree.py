@@ -40,6 +40,24 @@ class Complete(unittest.TestCase):
         self.failUnlessRaises(IndexError, ht.parent, 0)
         self.failUnlessRaises(IndexError, ht.needed_for, -1)
 
+    def test_nodes(self):
+        # each internal node is the pair_hash of its children, and the
+        # padding leaves are the empty-leaf hashes
+        for numleaves in [1, 2, 5, 8]:
+            ht = make_tree(numleaves)
+            self.failUnlessEqual(len(ht), 2*ht.get_leaf_index(0)+1)
+            for i in range(ht.get_leaf_index(0)):
+                self.failUnlessEqual(ht[i], hashtree.pair_hash(ht[2*i+1],
+                                                               ht[2*i+2]))
+            for i in range(numleaves, ht.get_leaf_index(0)+1):
+                self.failUnlessEqual(ht.get_leaf(i),
+                                     hashtree.empty_leaf_hash(i))
+        self.failUnlessEqual(list(ht)[-1], ht[-1])
+        self.failUnlessEqual(ht[7:9], [ht.get_leaf(0), ht.get_leaf(1)])
+
+    def test_bad_leaf(self):
+        self.failUnlessRaises(ValueError, hashtree.HashTree, [b"short"])
+
     def test_needed_hashes(self):
         ht = make_tree(8)
         self.failUnlessEqual(ht.needed_hashes(0), set([8, 4, 2]))
@@ -76,6 +94,16 @@ class Incomplete(unittest.TestCase):
         self.failUnlessRaises(IndexError, ht.get_leaf, 8)
         self.failUnlessEqual(ht.get_leaf_index(0), 7)
 
+    def test_slicing(self):
+        ht = make_tree(4)
+        iht = hashtree.IncompleteHashTree(4)
+        iht.set_hashes({0: ht[0], 1: ht[1], 2: ht[2]})
+        self.failUnlessEqual(iht[:4], [ht[0], ht[1], ht[2], None])
+        self.failUnlessEqual(iht[iht.get_leaf_index(0):], [None] * 4)
+        iht[2] = None
+        self.failUnlessEqual(iht[2], None)
+        self.failUnlessEqual(iht.needed_hashes(0), set([4, 2]))
+
     def test_needed_hashes(self):
         ht = hashtree.IncompleteHashTree(8)
         self.failUnlessEqual(ht.needed_hashes(0), set([8, 4, 2]))
@@ -196,6 +224,7 @@ class Incomplete(unittest.TestCase):
             pass
         else:
             self.fail("didn't catch bad hash")
+        self.failUnlessEqual(list(iht), current_hashes)
 
         # this should succeed
         try:
@@ -231,3 +260,26 @@ class Incomplete(unittest.TestCase):
             iht.set_hashes(chain, leaves={4: tagged_hash(b"tag", b"4")})
         except hashtree.BadHashError as e:
             self.fail("bad hash: %s" % e)
+
+    def test_check_many(self):
+        # several hash chains can be checked at once, and a single bad leaf
+        # among them means none of them are added
+        ht = make_tree(8)
+        iht = hashtree.IncompleteHashTree(8)
+        iht.set_hashes({0: ht[0]})
+        chains = {}
+        for leafnum in [0, 3, 6]:
+            for i in ht.needed_hashes(leafnum):
+                chains[i] = ht[i]
+        leaves = dict([(leafnum, tagged_hash(b"tag", b"%d" % leafnum))
+                       for leafnum in [0, 3, 6]])
+        bad_leaves = leaves.copy()
+        bad_leaves[3] = tagged_hash(b"bad tag", b"3")
+        current_hashes = list(iht)
+        self.failUnlessRaises(hashtree.BadHashError,
+                              iht.set_hashes, chains, bad_leaves)
+        self.failUnlessEqual(list(iht), current_hashes)
+        iht.set_hashes(chains, leaves)
+        for leafnum in [0, 3, 6]:
+            self.failUnlessEqual(iht.get_leaf(leafnum), ht.get_leaf(leafnum))
+            self.failUnlessEqual(iht.needed_hashes(leafnum), set())
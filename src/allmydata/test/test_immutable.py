@@ -27,6 +27,7 @@ from allmydata.interfaces import NotEnoughSharesError
 from allmydata.immutable.upload import Data
 from allmydata.immutable.downloader import finder
 from allmydata.immutable.literal import LiteralFileNode
+from allmydata.storage_client import ServerPerformance
 
 from .no_network import (
     NoNetworkServer,
@@ -126,6 +127,8 @@ class TestShareFinder(unittest.TestCase):
                 self.servers = servers
             def get_servers_for_psi(self, si):
                 return self.servers
+            def get_server_performance(self):
+                return ServerPerformance()
 
         class MockDownloadStatus(object):
             def add_dyhb_request(self, server, when):
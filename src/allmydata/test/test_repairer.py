@@ -15,7 +15,9 @@ from allmydata.test import common
 from allmydata.monitor import Monitor
 from allmydata import check_results
 from allmydata.interfaces import NotEnoughSharesError
-from allmydata.immutable import upload
+from allmydata.immutable import encode, upload
+from allmydata.immutable.repairer import Repairer as _Repairer, \
+     RepairUploader
 from allmydata.util.consumer import download_to_data
 from twisted.internet import defer
 from twisted.trial import unittest
@@ -522,6 +524,132 @@ class Repairer(GridTestMixin, unittest.TestCase, RepairTestMixin,
                       self.failUnlessEqual(newdata, common.TEST_DATA))
         return d
 
+    def _record_encoded_shares(self):
+        # remember which shares each segment was erasure-coded into
+        self.encoded_shares = []
+        original = encode._encode_and_hash_blocks
+        def _encode_and_hash_blocks(codec, chunks, desired_share_ids=None):
+            result = original(codec, chunks, desired_share_ids)
+            self.encoded_shares.append(sorted(result[0][1]))
+            return result
+        self.patch(encode, "_encode_and_hash_blocks", _encode_and_hash_blocks)
+
+    def _find_new_shares(self, old_shares):
+        return sorted(set(shnum for (shnum, serverid, sharefile)
+                          in self.find_uri_shares(self.uri)
+                          if (shnum, serverid) not in old_shares))
+
+    def _repair_and_verify(self, delete, corrupt=[], also_encoded=[],
+                           remove_servers=False):
+        d = self.upload_and_stash()
+        def _damage(ignored):
+            if remove_servers:
+                # take the servers away too, so that the missing shares can
+                # only go onto servers which hold other shares
+                for (shnum, serverid, sharefile) in self.find_uri_shares(self.uri):
+                    if shnum in delete:
+                        self.g.remove_server(serverid)
+            self.delete_shares_numbered(self.uri, delete)
+            self.corrupt_shares_numbered(self.uri, corrupt,
+                                         common._corrupt_share_hashes)
+            self.old_shares = set((shnum, serverid) for (shnum, serverid, sharefile)
+                                  in self.find_uri_shares(self.uri))
+            self._record_encoded_shares()
+        d.addCallback(_damage)
+        d.addCallback(lambda ignored:
+                      self.c0_filenode.check_and_repair(Monitor(),
+                                                        verify=False))
+        def _check_results(crr):
+            self.failUnless(crr.get_repair_successful())
+            self.failUnless(crr.get_post_repair_results().is_healthy())
+            new_shares = self._find_new_shares(self.old_shares)
+            for shnum in delete:
+                self.failUnlessIn(shnum, new_shares)
+            # every segment was encoded into just the shares which were
+            # written, and any others needed for their share hashes
+            self.failUnless(self.encoded_shares)
+            for shnums in self.encoded_shares:
+                self.failUnlessEqual(shnums,
+                                     sorted(set(new_shares) | set(also_encoded)))
+            return new_shares
+        d.addCallback(_check_results)
+        return d
+
+    def test_repair_encodes_only_missing_shares(self):
+        self.basedir = "repairer/Repairer/repair_encodes_only_missing_shares"
+        self.set_up_grid(num_clients=2)
+        d = self._repair_and_verify([2], remove_servers=True)
+        # share 2 has to go onto a server which holds another share, and
+        # each of the other shares is already on a server of its own, so
+        # there is nothing to gain from more copies of them
+        d.addCallback(lambda new_shares: self.failUnlessEqual(new_shares, [2]))
+        d.addCallback(lambda ignored:
+                      self.c0_filenode.check(Monitor(), verify=True))
+        d.addCallback(lambda vr: self.failUnless(vr.is_healthy()))
+        # the new share is good enough to download the file with
+        d.addCallback(lambda ignored:
+                      self.delete_shares_numbered(self.uri, [0, 1, 3, 4, 5,
+                                                             6, 7]))
+        d.addCallback(lambda ignored: download_to_data(self.c1_filenode))
+        d.addCallback(lambda newdata:
+                      self.failUnlessEqual(newdata, common.TEST_DATA))
+        return d
+
+    def test_repair_missing_subtree(self):
+        # shares 0-3 are a whole subtree of the share hash tree, so the
+        # nodes they need come from share 4, and no other share has to be
+        # made for them
+        self.basedir = "repairer/Repairer/repair_missing_subtree"
+        self.set_up_grid(num_clients=2)
+        d = self._repair_and_verify([0, 1, 2, 3])
+        d.addCallback(lambda ignored:
+                      self.c0_filenode.check(Monitor(), verify=True))
+        d.addCallback(lambda vr: self.failUnless(vr.is_healthy()))
+        return d
+
+    def test_repair_unreadable_share_hashes(self):
+        # the share hashes share 0 needs would be read from share 1, but
+        # those are corrupt, so they are read from share 2 instead, and the
+        # repairer has to work out the leaf of share 1 by encoding it too
+        self.basedir = "repairer/Repairer/repair_unreadable_share_hashes"
+        self.set_up_grid(num_clients=2)
+        d = self._repair_and_verify([0], corrupt=[1], also_encoded=[1],
+                                    remove_servers=True)
+        # share 0 is good again, even though share 1 is still corrupt
+        d.addCallback(lambda ignored:
+                      self.c0_filenode.check(Monitor(), verify=True))
+        d.addCallback(lambda vr:
+                      self.failUnlessEqual(sorted(vr.get_sharemap()),
+                                           [0] + list(range(2, 10))))
+        return d
+
+    def test_repair_without_check_results(self):
+        # with nothing to say where the other shares are, all of them are
+        # made, as before
+        self.basedir = "repairer/Repairer/repair_without_check_results"
+        self.set_up_grid(num_clients=2)
+        d = self.upload_and_stash()
+        def _repair(ignored):
+            self.delete_shares_numbered(self.uri, [2])
+            self._record_encoded_shares()
+            c0 = self.g.clients[0]
+            r = _Repairer(self.c0_filenode._cnode,
+                          storage_broker=c0.get_storage_broker(),
+                          secret_holder=c0._secret_holder,
+                          monitor=Monitor())
+            return r.start()
+        d.addCallback(_repair)
+        def _repaired(ur):
+            self.failUnlessIn(2, ur.get_sharemap())
+            self.failUnless(self.encoded_shares)
+            for shnums in self.encoded_shares:
+                self.failUnlessEqual(shnums, list(range(10)))
+        d.addCallback(_repaired)
+        d.addCallback(lambda ignored:
+                      self.c0_filenode.check(Monitor(), verify=True))
+        d.addCallback(lambda vr: self.failUnless(vr.is_healthy()))
+        return d
+
     def test_repairer_servers_of_happiness(self):
         # The repairer is supposed to generate and place as many of the
         # missing shares as possible without caring about how they are
@@ -757,3 +885,63 @@ class Repairer(GridTestMixin, unittest.TestCase, RepairTestMixin,
 # to do so it has to acquire shares from a server that has already tried to
 # serve it a corrupted share. (I don't think the current downloader would
 # pass this test, depending on the kind of corruption.)
+
+
+class _FakeServer(object):
+    def __init__(self, serverid):
+        self._serverid = serverid
+    def get_serverid(self):
+        return self._serverid
+    def get_name(self):
+        return self._serverid
+
+class _FakeBucket(object):
+    aborted = False
+    def abort(self):
+        self.aborted = True
+
+class RepairUploaderTests(unittest.TestCase):
+    def _tracker(self, serverid, shnums):
+        tracker = upload.ServerTracker(_FakeServer(serverid), 1000, 100, 10,
+                                       4, b"\x00" * 16, b"r" * 32, b"c" * 32)
+        for shnum in shnums:
+            tracker.buckets[shnum] = _FakeBucket()
+        return tracker
+
+    def _set_shareholders(self, upload_trackers, already_serverids):
+        placed = []
+        self.patch(upload.CHKUploader, "set_shareholders",
+                   lambda uploader, trackers, already, encoder:
+                   placed.extend(trackers))
+        uploader = RepairUploader(None, None, None, None)
+        uploader.set_shareholders(upload_trackers, already_serverids, None)
+        return dict((tracker.get_serverid(), sorted(tracker.buckets))
+                    for tracker in placed)
+
+    def test_copies_which_help_together(self):
+        # share 0 is missing, and the only server with room for it already
+        # holds share 3. The selector moves share 3 onto B and share 2 onto
+        # D, which is empty: neither copy spreads the shares any further on
+        # its own, but together they do, so both are kept.
+        already = {1: set([b"A"]), 2: set([b"B"]), 3: set([b"C"])}
+        trackers = [self._tracker(b"B", [3]),
+                    self._tracker(b"C", [0]),
+                    self._tracker(b"D", [2])]
+        placed = self._set_shareholders(trackers, already)
+        self.assertEqual(placed, {b"B": [3], b"C": [0], b"D": [2]})
+        for tracker in trackers:
+            for bucket in tracker.buckets.values():
+                self.assertFalse(bucket.aborted)
+
+    def test_copies_which_do_not_help(self):
+        # share 0 goes onto the empty server D, so the copies of shares 1
+        # and 2 are not needed, and their space is given back
+        already = {1: set([b"A"]), 2: set([b"B"]), 3: set([b"C"])}
+        copy_1 = self._tracker(b"B", [1])
+        copy_2 = self._tracker(b"C", [2])
+        copies = list(copy_1.buckets.values()) + list(copy_2.buckets.values())
+        trackers = [copy_1, copy_2, self._tracker(b"D", [0])]
+        placed = self._set_shareholders(trackers, already)
+        self.assertEqual(placed, {b"B": [], b"C": [], b"D": [0]})
+        for bucket in copies:
+            self.assertTrue(bucket.aborted)
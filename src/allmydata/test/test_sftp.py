@@ -10,13 +10,14 @@ from future.utils import PY2
 if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
-import re, struct, traceback, time, calendar
+import gc, re, struct, traceback, time, calendar
 from stat import S_IFREG, S_IFDIR
 
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from twisted.python.failure import Failure
 from twisted.internet.error import ProcessDone, ProcessTerminated
+from foolscap.eventual import flushEventualQueue
 from allmydata.util import deferredutil
 
 try:
@@ -29,7 +30,8 @@ except ImportError as e:
 else:
     conch_unavailable_reason = None  # type: ignore
 
-from allmydata.interfaces import IDirectoryNode, ExistingChildError, NoSuchChildError
+from allmydata.interfaces import IDirectoryNode, ExistingChildError, NoSuchChildError, \
+     NotEnoughSharesError, MDMF_VERSION
 from allmydata.mutable.common import NotWriteableError
 
 from allmydata.util.consumer import download_to_data
@@ -545,6 +547,122 @@ class Handler(GridTestMixin, ShouldFailMixin, ReallyEqualMixin, unittest.TestCas
         d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
         return d
 
+    def test_openFile_read_random_access(self):
+        # a file opened read-only is read a block at a time, as the blocks
+        # are asked for, rather than downloaded as a whole
+        self.patch(sftpd, "READ_BLOCK_SIZE", 1000)
+        DATA = b"".join([b"%09d\n" % (i,) for i in range(1050)])
+        d = self._set_up("openFile_read_random_access")
+        d.addCallback(lambda ign: self.root.add_file(u"large", upload.Data(DATA, None)))
+        d.addCallback(lambda ign: self.handler.openFile(b"large", sftp.FXF_READ, {}))
+        def _open(rf):
+            self.failUnlessIsInstance(rf, sftpd.RandomAccessReadOnlySFTPFile)
+            # count the reads that go to the grid
+            self.reads = []
+            read = rf.filenode.read
+            def _read(consumer, offset, size):
+                self.reads.append((offset, size))
+                return read(consumer, offset, size)
+            rf.filenode.read = _read
+            return rf
+        d.addCallback(_open)
+        def _read_end(rf):
+            # reading the end of the file reads only the last block
+            d2 = rf.readChunk(10400, 200)
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, DATA[10400:]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(self.reads, [(10000, 500)]))
+
+            # a read which is not sequential does not read ahead, and one
+            # across a block boundary reads both blocks
+            d2.addCallback(lambda ign: rf.readChunk(4900, 200))
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, DATA[4900:5100]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(self.reads[1:], [(4000, 1000), (5000, 1000)]))
+
+            # the next read starts where that one ended, so it is
+            # sequential, and the two blocks after it are read ahead
+            d2.addCallback(lambda ign: rf.readChunk(5100, 800))
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, DATA[5100:5900]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(self.reads[3:], [(6000, 1000), (7000, 1000)]))
+
+            # blocks already read are not read again
+            d2.addCallback(lambda ign: rf.readChunk(5900, 2000))
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, DATA[5900:7900]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(self.reads[5:], [(8000, 1000), (9000, 1000)]))
+
+            # but only a few blocks are kept
+            def _read_all(ign):
+                del self.reads[:]
+                return rf.readChunk(0, len(DATA))
+            d2.addCallback(_read_all)
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, DATA))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(len(rf._blocks), sftpd.READ_CACHE_BLOCKS))
+            d2.addCallback(lambda ign: self.assertEqual(
+                sorted(rf._blocks), list(range(11 - sftpd.READ_CACHE_BLOCKS, 11))))
+
+            d2.addCallback(lambda ign:
+                self.shouldFailWithSFTPError(sftp.FX_EOF, "readChunk starting at EOF",
+                                             rf.readChunk, len(DATA), 1))
+            d2.addCallback(lambda ign: rf.getAttrs())
+            d2.addCallback(lambda attrs: self._compareAttributes(attrs, {'permissions': S_IFREG | 0o666,
+                                                                        'size': len(DATA)}))
+            d2.addCallback(lambda ign: rf.close())
+            d2.addCallback(lambda ign:
+                self.shouldFailWithSFTPError(sftp.FX_BAD_MESSAGE, "readChunk on closed file",
+                                             rf.readChunk, 0, 1))
+            return d2
+        d.addCallback(_read_end)
+
+        # MDMF mutable files are read the same way
+        d.addCallback(lambda ign: self.client.create_mutable_file(publish.MutableData(DATA),
+                                                                  version=MDMF_VERSION))
+        d.addCallback(lambda node: self.handler.openFile(b"uri/"+node.get_uri(), sftp.FXF_READ, {}))
+        def _read_mdmf(rf):
+            self.failUnlessIsInstance(rf, sftpd.RandomAccessReadOnlySFTPFile)
+            d2 = rf.readChunk(10400, 200)
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, DATA[10400:]))
+            d2.addCallback(lambda ign: rf.readChunk(0, 1500))
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, DATA[:1500]))
+            d2.addCallback(lambda ign: rf.getAttrs())
+            d2.addCallback(lambda attrs: self.failUnlessReallyEqual(attrs['size'], len(DATA)))
+            d2.addCallback(lambda ign: rf.close())
+            return d2
+        d.addCallback(_read_mdmf)
+
+        d.addCallback(lambda ign: self.failUnlessEqual(sftpd.all_heisenfiles, {}))
+        d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
+        return d
+
+    def test_openFile_read_ahead_error(self):
+        # a block which fails to be read ahead is read again when it is
+        # asked for, and its failure is not left unhandled
+        self.patch(sftpd, "READ_BLOCK_SIZE", 1000)
+        DATA = b"".join([b"%09d\n" % (i,) for i in range(1050)])
+        d = self._set_up("openFile_read_ahead_error")
+        d.addCallback(lambda ign: self.root.add_file(u"large", upload.Data(DATA, None)))
+        d.addCallback(lambda ign: self.handler.openFile(b"large", sftp.FXF_READ, {}))
+        def _open(rf):
+            self.rf = rf
+            read = rf.filenode.read
+            def _read(consumer, offset, size):
+                if offset > 0:
+                    return defer.fail(NotEnoughSharesError("gone"))
+                return read(consumer, offset, size)
+            rf.filenode.read = _read
+            d2 = rf.readChunk(0, 100)
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, DATA[:100]))
+            d2.addCallback(lambda ign: flushEventualQueue())
+            def _collect(ign):
+                gc.collect()
+                self.failUnlessEqual(self.flushLoggedErrors(NotEnoughSharesError), [])
+                del rf.filenode.read
+            d2.addCallback(_collect)
+            d2.addCallback(lambda ign: rf.readChunk(1000, 100))
+            d2.addCallback(lambda data: self.failUnlessReallyEqual(data, DATA[1000:1100]))
+            d2.addCallback(lambda ign: rf.close())
+            return d2
+        d.addCallback(_open)
+        return d
+
     def test_openFile_read_error(self):
         # The check at the end of openFile_read tested this for large files,
         # but it trashed the grid in the process, so this needs to be a
@@ -460,6 +460,22 @@ class StringSpans(unittest.TestCase):
         self.failUnlessEqual(ds.get(long(2), long(4)), b"fear")
 
 
+    def test_touching_chunks(self):
+        # pieces which arrive next to each other read back as one
+        ds = DataSpans()
+        ds.add(4, b"ef")
+        ds.add(0, b"ab")
+        ds.add(2, b"cd")
+        ds.add(8, b"i")
+        self.failUnlessEqual(ds.get_chunks(), [(0, b"abcdef"), (8, b"i")])
+        self.failUnlessEqual(list(ds.get_spans()), [(0, 6), (8, 1)])
+        self.failUnlessEqual(ds.dump(), "len=7: [0-5],[8-8]")
+        self.failUnlessEqual(ds.get(1, 4), b"bcde")
+        self.failUnlessEqual(ds.get(1, 8), None)
+        ds.add(3, b"XY")
+        self.failUnlessEqual(ds.pop(0, 6), b"abcXYf")
+        self.failUnlessEqual(ds.len(), 1)
+
     def do_scan(self, klass):
         # do a test with gaps and spans of size 1 and 2
         #  left=(1,11) * right=(1,11) * gapsize=(1,2)
@@ -20,6 +20,7 @@ import stat
 import struct
 import shutil
 import gc
+import threading
 
 from twisted.trial import unittest
 
@@ -27,10 +28,14 @@ from twisted.internet import defer
 
 import itertools
 from allmydata import interfaces
-from allmydata.util import fileutil, hashutil, base32
+from allmydata.util import fileutil, hashutil, base32, log
+from allmydata.util.histogram import LatencyHistogram
 from allmydata.storage.server import StorageServer
+from allmydata.storage.diskio import ThreadedDiskIO
+from allmydata.storage.openfiles import OpenFileCache
 from allmydata.storage.shares import get_share_file
 from allmydata.storage.mutable import MutableShareFile
+from allmydata.storage.shareindex import ShareIndex
 from allmydata.storage.immutable import BucketWriter, BucketReader, ShareFile
 from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
      UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
@@ -442,6 +447,20 @@ class Server(unittest.TestCase):
         new_children_of_storedir = set(os.listdir(storedir))
         self.failUnlessEqual(children_of_storedir, new_children_of_storedir)
 
+    def test_get_buckets_batch(self):
+        ss = self.create("test_get_buckets_batch")
+        for (storage_index, sharenums) in [(b"si1", [0, 1]), (b"si3", [2])]:
+            already, writers = self.allocate(ss, storage_index, sharenums, 10)
+            for wb in writers.values():
+                wb.remote_write(0, storage_index * 3 + b"x")
+                wb.remote_close()
+        answer = ss.remote_get_buckets_batch([b"si1", b"si2", b"si3"])
+        self.failUnlessEqual([sorted(readers) for readers in answer],
+                             [[0, 1], [], [2]])
+        self.failUnlessEqual(answer[2][2].remote_read(0, 10), b"si3si3si3x")
+        v1 = ss.remote_get_version()[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+        self.failUnlessEqual(v1[b"maximum-storage-index-batch-size"], 100)
+
     def test_remove_incoming(self):
         ss = self.create("test_remove_incoming")
         already, writers = self.allocate(ss, b"vid", list(range(3)), 10)
@@ -696,6 +715,18 @@ class Server(unittest.TestCase):
         # add-lease on a missing storage index is silently ignored
         self.failUnlessEqual(ss.remote_add_lease(b"si18", b"", b""), None)
 
+        # and several at once, each getting its own answer
+        rs2b,cs2b = (hashutil.tagged_hash(b"blah", b"%d" % next(self._lease_secret)),
+                   hashutil.tagged_hash(b"blah", b"%d" % next(self._lease_secret)))
+        self.failUnlessEqual(ss.remote_add_leases([(b"si1", rs2b, cs2b),
+                                                   (b"si18", rs2b, cs2b),
+                                                   (b"si1", rs2a, cs2a)]),
+                             [5, 0, 5])
+        leases = list(ss.get_leases(b"si1"))
+        self.failUnlessEqual(len(leases), 4)
+        self.failUnlessEqual(set(l.renew_secret for l in leases),
+                             set([rs1, rs2, rs2a, rs2b]))
+
         # check that si0 is readable
         readers = ss.remote_get_buckets(b"si0")
         self.failUnlessEqual(len(readers), 5)
@@ -1264,6 +1295,14 @@ class MutableServer(unittest.TestCase):
                                       1: [b"1"*10],
                                       2: [b"2"*10]})
 
+        # several reads at once, each getting its own answer
+        answer = ss.remote_slot_readv_batch([(b"si1", [1], [(0, 5)]),
+                                             (b"si2", [], [(0, 5)]),
+                                             (b"si1", [0, 2], [(95, 10)])])
+        self.failUnlessEqual(answer, [{1: [b"1"*5]},
+                                      {},
+                                      {0: [b"0"*5], 2: [b"2"*5]}])
+
     def compare_leases_without_timestamps(self, leases_a, leases_b):
         self.failUnlessEqual(len(leases_a), len(leases_b))
         for i in range(len(leases_a)):
@@ -2948,6 +2987,11 @@ class Stats(unittest.TestCase):
         ss.setServiceParent(self.sparent)
         return ss
 
+    def failUnlessClose(self, value, expected, output):
+        # the percentiles come from a histogram, not the samples themselves
+        self.failUnless(abs(value - expected) <= 0.06 * expected + 1e-6,
+                        (value, expected, output))
+
     def test_latencies(self):
         ss = self.create("test_latencies")
         for i in range(10000):
@@ -2964,47 +3008,47 @@ class Stats(unittest.TestCase):
 
         self.failUnlessEqual(sorted(output.keys()),
                              sorted(["allocate", "renew", "cancel", "write", "get"]))
-        self.failUnlessEqual(len(ss.latencies["allocate"]), 1000)
-        self.failUnless(abs(output["allocate"]["mean"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["01_0_percentile"] - 9010) < 1, output)
-        self.failUnless(abs(output["allocate"]["10_0_percentile"] - 9100) < 1, output)
-        self.failUnless(abs(output["allocate"]["50_0_percentile"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["90_0_percentile"] - 9900) < 1, output)
-        self.failUnless(abs(output["allocate"]["95_0_percentile"] - 9950) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_0_percentile"] - 9990) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_9_percentile"] - 9999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["renew"]), 1000)
+        self.failUnlessEqual(output["allocate"]["samplesize"], 10000)
+        self.failUnless(abs(output["allocate"]["mean"] - 4999.5) < 1, output)
+        self.failUnlessClose(output["allocate"]["01_0_percentile"], 100, output)
+        self.failUnlessClose(output["allocate"]["10_0_percentile"], 1000, output)
+        self.failUnlessClose(output["allocate"]["50_0_percentile"], 5000, output)
+        self.failUnlessClose(output["allocate"]["90_0_percentile"], 9000, output)
+        self.failUnlessClose(output["allocate"]["95_0_percentile"], 9500, output)
+        self.failUnlessClose(output["allocate"]["99_0_percentile"], 9900, output)
+        self.failUnlessClose(output["allocate"]["99_9_percentile"], 9990, output)
+
+        self.failUnlessEqual(output["renew"]["samplesize"], 1000)
         self.failUnless(abs(output["renew"]["mean"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["01_0_percentile"] -  10) < 1, output)
-        self.failUnless(abs(output["renew"]["10_0_percentile"] - 100) < 1, output)
-        self.failUnless(abs(output["renew"]["50_0_percentile"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["90_0_percentile"] - 900) < 1, output)
-        self.failUnless(abs(output["renew"]["95_0_percentile"] - 950) < 1, output)
-        self.failUnless(abs(output["renew"]["99_0_percentile"] - 990) < 1, output)
-        self.failUnless(abs(output["renew"]["99_9_percentile"] - 999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["write"]), 20)
+        self.failUnlessClose(output["renew"]["01_0_percentile"],  10, output)
+        self.failUnlessClose(output["renew"]["10_0_percentile"], 100, output)
+        self.failUnlessClose(output["renew"]["50_0_percentile"], 500, output)
+        self.failUnlessClose(output["renew"]["90_0_percentile"], 900, output)
+        self.failUnlessClose(output["renew"]["95_0_percentile"], 950, output)
+        self.failUnlessClose(output["renew"]["99_0_percentile"], 990, output)
+        self.failUnlessClose(output["renew"]["99_9_percentile"], 999, output)
+
+        self.failUnlessEqual(output["write"]["samplesize"], 20)
         self.failUnless(abs(output["write"]["mean"] - 9) < 1, output)
         self.failUnless(output["write"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["write"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["write"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["write"]["90_0_percentile"] - 18) < 1, output)
-        self.failUnless(abs(output["write"]["95_0_percentile"] - 19) < 1, output)
+        self.failUnlessClose(output["write"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["write"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["write"]["90_0_percentile"], 18, output)
+        self.failUnlessClose(output["write"]["95_0_percentile"], 19, output)
         self.failUnless(output["write"]["99_0_percentile"] is None, output)
         self.failUnless(output["write"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["cancel"]), 10)
+        self.failUnlessEqual(output["cancel"]["samplesize"], 10)
         self.failUnless(abs(output["cancel"]["mean"] - 9) < 1, output)
         self.failUnless(output["cancel"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["cancel"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["cancel"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["cancel"]["90_0_percentile"] - 18) < 1, output)
+        self.failUnlessClose(output["cancel"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["cancel"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["cancel"]["90_0_percentile"], 18, output)
         self.failUnless(output["cancel"]["95_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["get"]), 1)
+        self.failUnlessEqual(output["get"]["samplesize"], 1)
         self.failUnless(output["get"]["mean"] is None, output)
         self.failUnless(output["get"]["01_0_percentile"] is None, output)
         self.failUnless(output["get"]["10_0_percentile"] is None, output)
@@ -3014,6 +3058,38 @@ class Stats(unittest.TestCase):
         self.failUnless(output["get"]["99_0_percentile"] is None, output)
         self.failUnless(output["get"]["99_9_percentile"] is None, output)
 
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.latencies.get.samplesize"], 1)
+        (buckets, count, total) = \
+            ss.get_histograms()["storage_server.latencies"]["get"]
+        self.failUnlessEqual((count, total), (1, 5.0))
+        self.failUnlessEqual([seen for (bound, seen) in buckets if bound < 5.0],
+                             [0] * len([b for b in buckets if b[0] < 5.0]))
+        self.failUnlessEqual([seen for (bound, seen) in buckets if bound > 5.0],
+                             [1] * len([b for b in buckets if b[0] > 5.0]))
+
+    def test_latency_windows(self):
+        now = [1000.0]
+        histogram = LatencyHistogram(get_time=lambda: now[0])
+        for i in range(100):
+            histogram.add(0.5)
+        now[0] += 1800
+        for i in range(100):
+            histogram.add(0.001)
+        self.failUnlessEqual(histogram.summarize(60)["samplesize"], 100)
+        self.failUnlessClose(histogram.summarize(60)["50_0_percentile"],
+                             0.001, None)
+        summary = histogram.summarize(3600)
+        self.failUnlessEqual(summary["samplesize"], 200)
+        self.failUnlessClose(summary["90_0_percentile"], 0.5, None)
+        # summaries are reused until something changes
+        self.failUnlessIdentical(histogram.summarize(3600), summary)
+        now[0] += 1800
+        self.failUnlessEqual(histogram.summarize(3600)["samplesize"], 100)
+        self.failUnlessEqual(histogram.summarize(300), None)
+        # everything ever recorded is still exported
+        self.failUnlessEqual(histogram.get_cumulative()[1], 200)
+
 
 class ShareFileTests(unittest.TestCase):
     """Tests for allmydata.storage.immutable.ShareFile."""
@@ -3048,3 +3124,608 @@ class ShareFileTests(unittest.TestCase):
         sf = self.get_sharefile()
         with self.assertRaises(IndexError):
             sf.cancel_lease(b"garbage")
+
+
+class ShareIndexTests(unittest.TestCase):
+    """Tests for a StorageServer which keeps a share index."""
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        return os.path.join("storage", "ShareIndex", name)
+
+    def create(self, name, **kwargs):
+        ss = StorageServer(self.workdir(name), b"\x00" * 20, share_index=True,
+                           **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def secrets(self, tag):
+        return (hashutil.tagged_hash(b"we_blah", tag),
+                hashutil.tagged_hash(b"renew_blah", tag),
+                hashutil.tagged_hash(b"cancel_blah", tag))
+
+    def upload(self, ss, storage_index, sharenums, tag=b"1"):
+        (we, renew_secret, cancel_secret) = self.secrets(tag)
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, renew_secret, cancel_secret, sharenums, 100,
+            FakeCanary())
+        for (shnum, bw) in writers.items():
+            bw.remote_write(0, b"%d" % shnum * 100)
+            bw.remote_close()
+        return already
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        index = ss.share_index
+        self.failUnlessEqual(index.get_shares(b"si1"), [])
+        self.upload(ss, b"si1", [0, 1, 2])
+        self.failUnlessEqual(index.get_shares(b"si1"), [0, 1, 2])
+        self.failUnlessEqual(sorted(ss.remote_get_buckets(b"si1").keys()),
+                             [0, 1, 2])
+        # an upload which is never closed is not indexed
+        ss.remote_allocate_buckets(b"si2", *(self.secrets(b"1")[1:] +
+                                             ([0], 100, FakeCanary())))
+        self.failUnlessEqual(index.get_shares(b"si2"), [])
+
+        totals = index.get_totals()
+        self.failUnlessEqual(totals["buckets"], 1)
+        self.failUnlessEqual(totals["shares-immutable"], 3)
+        self.failUnlessEqual(totals["shares-mutable"], 0)
+        sharefile = os.path.join(ss.sharedir, storage_index_to_dir(b"si1"), "0")
+        self.failUnlessEqual(totals["sharebytes"],
+                             3 * os.stat(sharefile).st_size)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.total_bucket_count"], 1)
+        self.failUnlessEqual(stats["storage_server.total_share_count"], 3)
+
+        # leases added to existing shares are recorded, and renewed ones
+        # only ever get later
+        now = time.time()
+        self.failUnlessEqual(self.upload(ss, b"si1", [0, 3], tag=b"2"),
+                             set([0, 1, 2]))
+        self.failUnlessEqual(index.get_shares(b"si1"), [0, 1, 2, 3])
+        ss.remote_add_lease(b"si1", *self.secrets(b"3")[1:])
+        ss.remote_renew_lease(b"si1", self.secrets(b"3")[1])
+        expiring = index.get_shares_with_leases_expiring_before(
+            now + 40*24*60*60, ["immutable"])
+        self.failUnlessEqual([shnum for (si, shnum) in expiring],
+                             [0, 1, 2, 3])
+        self.failUnlessEqual(set(si for (si, shnum) in expiring),
+                             set([b"si1"]))
+        self.failUnlessEqual(index.get_shares_with_leases_expiring_before(
+            now, ["immutable"]), [])
+        self.failUnlessEqual(index.get_shares_with_leases_expiring_before(
+            now + 40*24*60*60, ["mutable"]), [])
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        index = ss.share_index
+        secrets = self.secrets(b"1")
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        data = b"x" * 100
+        answer = writev(b"si1", secrets,
+                        {0: ([], [(0, data)], None),
+                         1: ([], [(0, data)], None)}, [])
+        self.failUnlessEqual(answer, (True, {}))
+        self.failUnlessEqual(index.get_shares(b"si1"), [0, 1])
+        self.failUnlessEqual(ss.remote_slot_readv(b"si1", [], [(0, 10)]),
+                             {0: [b"x" * 10], 1: [b"x" * 10]})
+        totals = index.get_totals()
+        self.failUnlessEqual(totals["shares-mutable"], 2)
+        size = totals["sharebytes"]
+
+        # growing a share updates its size
+        writev(b"si1", secrets, {1: ([], [(100, data)], None)}, [])
+        self.failUnlessEqual(index.get_totals()["sharebytes"], size + 100)
+
+        # deleting one removes it from the index
+        writev(b"si1", secrets, {0: ([], [], 0)}, [])
+        self.failUnlessEqual(index.get_shares(b"si1"), [1])
+        self.failUnlessEqual(ss.remote_slot_readv(b"si1", [], [(0, 1)]),
+                             {1: [b"x"]})
+
+    def test_build_at_startup(self):
+        basedir = self.workdir("test_build_at_startup")
+        ss = StorageServer(basedir, b"\x00" * 20)
+        ss.setServiceParent(self.sparent)
+        self.upload(ss, b"si1", [0, 1])
+        self.upload(ss, b"si2", [4])
+        d = ss.disownServiceParent()
+        def _restart(ign):
+            ss = self.create("test_build_at_startup")
+            self.failUnlessEqual(ss.share_index.get_shares(b"si1"), [0, 1])
+            self.failUnlessEqual(ss.share_index.get_totals()["shares"], 3)
+            # a fresh rebuild finds the same shares
+            self.failUnlessEqual(ss.share_index.rebuild(ss.sharedir), 3)
+            self.failUnlessEqual(ss.share_index.get_shares(b"si2"), [4])
+        d.addCallback(_restart)
+        return d
+
+    def test_rebuild_after_running_without_index(self):
+        basedir = self.workdir("test_rebuild_after_running_without_index")
+        ss = self.create("test_rebuild_after_running_without_index")
+        self.upload(ss, b"si1", [0])
+        d = ss.disownServiceParent()
+        def _restart_without_index(ign):
+            self.failUnless(os.path.exists(
+                os.path.join(basedir, "share_index.sqlite")))
+            ss = StorageServer(basedir, b"\x00" * 20)
+            ss.setServiceParent(self.sparent)
+            # nothing would keep the index up to date, so it is removed
+            self.failIf(os.path.exists(
+                os.path.join(basedir, "share_index.sqlite")))
+            self.upload(ss, b"si2", [0])
+            return ss.disownServiceParent()
+        d.addCallback(_restart_without_index)
+        def _restart_with_index(ign):
+            ss = self.create("test_rebuild_after_running_without_index")
+            self.failUnlessEqual(sorted(ss.remote_get_buckets(b"si1")), [0])
+            self.failUnlessEqual(sorted(ss.remote_get_buckets(b"si2")), [0])
+        d.addCallback(_restart_with_index)
+        return d
+
+    def test_rebuild_after_crash(self):
+        ss = self.create("test_rebuild_after_crash")
+        self.upload(ss, b"si1", [0])
+        # the node stops after a share has been written but before it has
+        # been indexed
+        self.patch(ss.share_index, "index_share_file",
+                   lambda storage_index, shnum, filename: None)
+        self.upload(ss, b"si2", [0])
+        self.failUnlessEqual(ss.share_index.get_shares(b"si2"), [])
+        # and starts again, without having closed the index
+        ss = StorageServer(self.workdir("test_rebuild_after_crash"),
+                           b"\x00" * 20, share_index=True)
+        self.addCleanup(ss.share_index.close)
+        self.failUnlessEqual(sorted(ss.remote_get_buckets(b"si1")), [0])
+        self.failUnlessEqual(sorted(ss.remote_get_buckets(b"si2")), [0])
+
+    def test_no_rebuild_after_clean_stop(self):
+        ss = self.create("test_no_rebuild_after_clean_stop")
+        self.upload(ss, b"si1", [0])
+        d = ss.disownServiceParent()
+        def _restart(ign):
+            self.patch(ShareIndex, "rebuild",
+                       lambda index, sharedir: self.fail("rebuilt"))
+            ss = self.create("test_no_rebuild_after_clean_stop")
+            self.failUnlessEqual(sorted(ss.remote_get_buckets(b"si1")), [0])
+        d.addCallback(_restart)
+        return d
+
+    def test_expire(self):
+        # every existing lease was granted before this cutoff
+        cutoff_date = int(time.time()) + 24*60*60
+        ss = self.create("test_expire", expiration_enabled=True,
+                         expiration_mode="cutoff-date",
+                         expiration_cutoff_date=cutoff_date,
+                         expiration_sharetypes=("immutable",))
+        self.failIf(ss.lease_checker.expiration_enabled)
+        self.upload(ss, b"si1", [0, 1])
+        ss.remote_slot_testv_and_readv_and_writev(
+            b"si2", self.secrets(b"1"), {0: ([], [(0, b"data")], None)}, [])
+
+        ss.lease_expirer.expire_leases()
+        self.failUnlessEqual(ss.share_index.get_shares(b"si1"), [])
+        self.failUnlessEqual(list(ss._get_bucket_shares(b"si1")), [])
+        self.failIf(os.path.exists(os.path.join(
+            ss.sharedir, storage_index_to_dir(b"si1"), "0")))
+        # mutable shares are not being expired
+        self.failUnlessEqual(ss.share_index.get_shares(b"si2"), [0])
+        stats = ss.get_stats()
+        self.failUnlessEqual(
+            stats["storage_server.lease_expirer.leases-cancelled"], 2)
+        self.failUnlessEqual(
+            stats["storage_server.lease_expirer.shares-removed"], 2)
+
+    def test_age_threshold(self):
+        ss = self.create("test_age_threshold", expiration_enabled=True,
+                         expiration_mode="age",
+                         expiration_override_lease_duration=60*60)
+        # a lease granted more than an hour ago, so expiring less than 31
+        # days less an hour from now, has expired
+        self.failUnlessEqual(ss.lease_expirer.get_expiration_threshold(1000),
+                             1000 + 31*24*60*60 - 60*60)
+
+
+class DiskIOTests(unittest.TestCase):
+    """Tests for allmydata.storage.diskio.ThreadedDiskIO."""
+
+    def setUp(self):
+        self.disk_io = ThreadedDiskIO(4)
+        self.disk_io.startService()
+        self.addCleanup(self.disk_io.stopService)
+
+    def test_ordering(self):
+        done = []
+        def _job(key, i):
+            # the later jobs are quicker, so only ordering keeps them back
+            time.sleep(0.02 / (i + 1))
+            done.append((key, i))
+            return i
+        ds = [self.disk_io.run(".", key, _job, key, i)
+              for i in range(5) for key in ("a", "b")]
+        stats = self.disk_io.get_stats()
+        self.failUnlessEqual(stats["storage_server.disk_io.queue_depth"], 10)
+        self.failUnlessEqual(stats["storage_server.disk_io.waiting_for_order"], 8)
+        d = defer.gatherResults(ds)
+        def _check(results):
+            self.failUnlessEqual(results, [0, 0, 1, 1, 2, 2, 3, 3, 4, 4])
+            for key in ("a", "b"):
+                self.failUnlessEqual([i for (k, i) in done if k == key],
+                                     list(range(5)))
+            stats = self.disk_io.get_stats()
+            self.failUnlessEqual(stats["storage_server.disk_io.queue_depth"], 0)
+            self.failUnlessEqual(stats["storage_server.disk_io.completed"], 10)
+            self.failUnlessEqual(stats["storage_server.disk_io.max_queue_depth"], 10)
+        d.addCallback(_check)
+        return d
+
+    def test_failure(self):
+        def _fail():
+            raise ValueError("oops")
+        d1 = self.disk_io.run(".", "a", _fail)
+        d2 = self.disk_io.run(".", "a", lambda: "ok")
+        d1 = self.assertFailure(d1, ValueError)
+        # a failure does not stop later jobs with the same key
+        d2.addCallback(self.failUnlessEqual, "ok")
+        return defer.gatherResults([d1, d2])
+
+    def test_per_device(self):
+        disk_io = ThreadedDiskIO(1, per_device=True)
+        disk_io.startService()
+        self.addCleanup(disk_io.stopService)
+        d = disk_io.run(self.mktemp(), None, lambda: 1)
+        def _check(res):
+            self.failUnlessEqual(res, 1)
+            stats = disk_io.get_stats()
+            device = os.stat(".").st_dev
+            self.failUnlessEqual(
+                stats["storage_server.disk_io.queue_depth.dev%d" % (device,)], 0)
+        d.addCallback(_check)
+        return d
+
+    def test_per_device_stats_share_directory_once(self):
+        disk_io = ThreadedDiskIO(1, per_device=True)
+        sharedir = self.mktemp()
+        os.makedirs(os.path.join(sharedir, "aa"))
+        stats = []
+        real_stat = os.stat
+        def _stat(path):
+            stats.append(path)
+            return real_stat(path)
+        self.patch(os, "stat", _stat)
+        disk_io.run(os.path.join(sharedir, "aa"), None, lambda: None)
+        self.failUnlessEqual(set(stats), {sharedir})
+        del stats[:]
+        # prefix directories that do not exist yet share their directory's
+        # device, and an existing one is not looked up again
+        for prefix in ("bb", "aa", "cc"):
+            disk_io.run(os.path.join(sharedir, prefix), None, lambda: None)
+        self.failUnlessEqual(stats, [])
+
+    def test_restart(self):
+        d = self.disk_io.run(".", "a", lambda: "ok")
+        def _restart(res):
+            self.failUnlessEqual(res, "ok")
+            self.disk_io.stopService()
+            self.disk_io.startService()
+            return self.disk_io.run(".", "a", lambda: "again")
+        d.addCallback(_restart)
+        d.addCallback(self.failUnlessEqual, "again")
+        return d
+
+
+class ThreadedServer(unittest.TestCase):
+    """Tests for a StorageServer which does its disk I/O in threads."""
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, **kwargs):
+        ss = StorageServer(os.path.join("storage", "ThreadedServer", name),
+                           b"\x00" * 20, disk_io_threads=2,
+                           stats_provider=FakeStatsProvider(), **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        renew_secret = hashutil.tagged_hash(b"blah", b"renew")
+        cancel_secret = hashutil.tagged_hash(b"blah", b"cancel")
+        d = ss.remote_allocate_buckets(b"si1", renew_secret, cancel_secret,
+                                       set([0]), 100, FakeCanary())
+        def _allocated(res):
+            (already, writers) = res
+            self.failUnlessEqual(already, set())
+            bw = writers[0]
+            # these are not waited for: the server keeps them in order
+            bw.remote_write(0, b"a" * 50)
+            bw.remote_write(50, b"b" * 50)
+            return bw.remote_close()
+        d.addCallback(_allocated)
+        d.addCallback(lambda ign: ss.remote_get_buckets(b"si1"))
+        d.addCallback(lambda readers: readers[0].remote_read(40, 20))
+        d.addCallback(self.failUnlessEqual, b"a" * 10 + b"b" * 10)
+        d.addCallback(lambda ign: ss.remote_add_leases([
+            (b"si1", hashutil.tagged_hash(b"blah", b"renew2"),
+             hashutil.tagged_hash(b"blah", b"cancel2")),
+            (b"si2", renew_secret, cancel_secret),
+        ]))
+        d.addCallback(self.failUnlessEqual, [1, 0])
+        d.addCallback(lambda ign: ss.remote_renew_lease(b"si1", renew_secret))
+        def _check_stats(ign):
+            self.failUnlessEqual(len(list(ss.get_leases(b"si1"))), 2)
+            stats = ss.get_stats()
+            self.failUnlessEqual(stats["storage_server.disk_io.queue_depth"], 0)
+            self.failUnless(stats["storage_server.disk_io.completed"] >= 8,
+                            stats)
+            self.failUnlessEqual(ss.get_latencies()["write"]["samplesize"], 2)
+        d.addCallback(_check_stats)
+        return d
+
+    def _renew_while_expiring(self, ss, expire):
+        # an immutable share whose lease was granted two hours ago, and so
+        # has expired under a one-hour lease duration
+        renew_secret = hashutil.tagged_hash(b"blah", b"renew")
+        cancel_secret = hashutil.tagged_hash(b"blah", b"cancel")
+        d = ss.remote_allocate_buckets(b"si1", renew_secret, cancel_secret,
+                                       set([0]), 10, FakeCanary())
+        def _allocated(res):
+            (already, writers) = res
+            writers[0].remote_write(0, b"0123456789")
+            return writers[0].remote_close()
+        d.addCallback(_allocated)
+        filename = os.path.join(ss.sharedir, storage_index_to_dir(b"si1"), "0")
+        def _backdate(ign):
+            sf = ShareFile(filename)
+            (lease,) = sf.get_leases()
+            lease.expiration_time = time.time() + 31*24*60*60 - 2*60*60
+            with open(filename, "rb+") as f:
+                sf._write_lease_record(f, 0, lease)
+            if ss.share_index is not None:
+                ss.share_index.index_share_file(b"si1", 0, filename)
+            # hold up the bucket's disk I/O until the renewal and the
+            # expiration are both waiting for it
+            event = threading.Event()
+            busy = ss.disk_io.run(os.path.dirname(os.path.dirname(filename)),
+                                  b"si1", event.wait)
+            renewed = ss.remote_renew_lease(b"si1", renew_secret)
+            expired = defer.maybeDeferred(expire)
+            event.set()
+            return defer.gatherResults([busy, renewed, expired])
+        d.addCallback(_backdate)
+        def _check(ign):
+            (lease,) = ShareFile(filename).get_leases()
+            self.failUnless(lease.get_expiration_time() > time.time() + 30*24*60*60)
+        d.addCallback(_check)
+        return d
+
+    def test_renew_while_crawler_expires(self):
+        ss = self.create("test_renew_while_crawler_expires",
+                         expiration_enabled=True,
+                         expiration_override_lease_duration=60*60)
+        lc = ss.lease_checker
+        prefixdir = os.path.join(ss.sharedir,
+                                 os.path.dirname(storage_index_to_dir(b"si1")))
+        si_s = str(si_b2a(b"si1"), "ascii")
+        return self._renew_while_expiring(
+            ss, lambda: lc.process_bucket(0, os.path.basename(prefixdir),
+                                          prefixdir, si_s))
+
+    def test_renew_while_index_expires(self):
+        ss = self.create("test_renew_while_index_expires", share_index=True,
+                         expiration_enabled=True,
+                         expiration_override_lease_duration=60*60)
+        return self._renew_while_expiring(ss, ss.lease_expirer.expire_leases)
+
+    def test_log_on_reactor_thread(self):
+        ss = self.create("test_log_on_reactor_thread")
+        secrets = (hashutil.tagged_hash(b"we_blah", b"1"),
+                   hashutil.tagged_hash(b"renew_blah", b"1"),
+                   hashutil.tagged_hash(b"cancel_blah", b"1"))
+        bucketdir = os.path.join(ss.sharedir, storage_index_to_dir(b"si2"))
+        fileutil.make_dirs(bucketdir)
+        # a truncated immutable share, which cannot be given a lease
+        with open(os.path.join(bucketdir, "0"), "wb") as f:
+            f.write(struct.pack(">L", 1))
+        logged = []
+        real_msg = log.msg
+        def _msg(*args, **kwargs):
+            logged.append(threading.current_thread())
+            return real_msg(*args, **kwargs)
+        def _err(*args, **kwargs):
+            logged.append(threading.current_thread())
+        self.patch(log, "msg", _msg)
+        self.patch(log, "err", _err)
+        d = ss.remote_slot_testv_and_readv_and_writev(
+            b"si1", secrets, {0: ([], [(0, b"data")], None)}, [])
+        d.addCallback(lambda ign: ss.remote_slot_readv(b"si1", [0], [(0, 4)]))
+        d.addCallback(self.failUnlessEqual, {0: [b"data"]})
+        d.addCallback(lambda ign: ss.remote_add_leases([
+            (b"si2", hashutil.tagged_hash(b"blah", b"renew"),
+             hashutil.tagged_hash(b"blah", b"cancel")),
+        ]))
+        d.addCallback(self.failUnlessEqual, [None])
+        def _check(ign):
+            self.failUnless(logged)
+            self.failUnlessEqual(set(logged), {threading.current_thread()})
+        d.addCallback(_check)
+        return d
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        secrets = (hashutil.tagged_hash(b"we_blah", b"1"),
+                   hashutil.tagged_hash(b"renew_blah", b"1"),
+                   hashutil.tagged_hash(b"cancel_blah", b"1"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        ds = []
+        for i in range(10):
+            # each write tests that the previous one has happened
+            testv = [(0, 1, b"eq", b"%d" % (i - 1,))] if i else []
+            ds.append(writev(b"si1", secrets,
+                             {0: (testv, [(0, b"%d" % (i,))], None)}, []))
+        ds.append(ss.remote_slot_readv(b"si1", [0], [(0, 1)]))
+        d = defer.gatherResults(ds)
+        def _check(results):
+            # (the empty read vector reads nothing from each existing share)
+            self.failUnlessEqual(results[:-1],
+                                 [(True, {})] + [(True, {0: []})] * 9)
+            self.failUnlessEqual(results[-1], {0: [b"9"]})
+        d.addCallback(_check)
+        return d
+
+
+class OpenFileCacheTests(unittest.TestCase):
+    """Tests for allmydata.storage.openfiles.OpenFileCache."""
+
+    def setUp(self):
+        self.basedir = self.mktemp()
+        fileutil.make_dirs(self.basedir)
+        self.cache = OpenFileCache(2)
+        self.addCleanup(self.cache.close)
+
+    def _file(self, name, contents):
+        path = os.path.join(self.basedir, name)
+        fileutil.write(path, contents)
+        return path
+
+    def test_lru(self):
+        a = self._file("a", b"aaaa")
+        b = self._file("b", b"bbbb")
+        c = self._file("c", b"cccc")
+        self.failUnlessEqual(self.cache.pread(a, 1, 2), b"aa")
+        self.failUnlessEqual(self.cache.pread(b, 0, 4), b"bbbb")
+        self.failUnlessEqual(self.cache.pread(a, 3, 10), b"a")
+        # b is now the least recently used, so c replaces it
+        self.failUnlessEqual(self.cache.pread(c, 0, 1), b"c")
+        self.failUnlessEqual(self.cache.pread(a, 4, 1), b"")
+        stats = self.cache.get_stats()
+        self.failUnlessEqual(stats["storage_server.open_files.open"], 2)
+        self.failUnlessEqual(stats["storage_server.open_files.hits"], 2)
+        self.failUnlessEqual(stats["storage_server.open_files.misses"], 3)
+        self.failUnlessEqual(stats["storage_server.open_files.evictions"], 1)
+
+    def test_invalidate(self):
+        a = self._file("a", b"old")
+        self.failUnlessEqual(self.cache.pread(a, 0, 3), b"old")
+        self.cache.invalidate(a)
+        os.unlink(a)
+        self._file("a", b"new")
+        self.failUnlessEqual(self.cache.pread(a, 0, 3), b"new")
+        self.cache.invalidate(self._file("b", b"never read"))
+        self.failUnlessEqual(
+            self.cache.get_stats()["storage_server.open_files.open"], 1)
+
+    def test_missing(self):
+        self.failUnlessRaises(EnvironmentError, self.cache.pread,
+                              os.path.join(self.basedir, "missing"), 0, 1)
+        self.failUnlessEqual(
+            self.cache.get_stats()["storage_server.open_files.open"], 0)
+
+    def test_invalidate_while_opening(self):
+        a = self._file("a", b"old")
+        real_open = os.open
+        def _open(path, flags):
+            # other files can be read while this one is being opened
+            self.failIf(self.cache._lock.locked())
+            fd = real_open(path, flags)
+            # and it is replaced before the descriptor is cached
+            self.cache.invalidate(path)
+            return fd
+        self.patch(os, "open", _open)
+        self.failUnlessEqual(self.cache.pread(a, 0, 3), b"old")
+        # the descriptor was not kept, so the new file is read next time
+        self.failUnlessEqual(
+            self.cache.get_stats()["storage_server.open_files.open"], 0)
+        self.patch(os, "open", real_open)
+        os.unlink(a)
+        self._file("a", b"new")
+        self.failUnlessEqual(self.cache.pread(a, 0, 3), b"new")
+
+
+class CachedFilesServer(unittest.TestCase):
+    """Tests for a StorageServer which keeps share files open."""
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, **kwargs):
+        ss = StorageServer(os.path.join("storage", "CachedFilesServer", name),
+                           b"\x00" * 20, open_file_cache_size=10, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def _open(self, ss):
+        return ss.get_stats()["storage_server.open_files.open"]
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        secrets = (hashutil.tagged_hash(b"we_blah", b"1"),
+                   hashutil.tagged_hash(b"renew_blah", b"1"),
+                   hashutil.tagged_hash(b"cancel_blah", b"1"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        writev(b"si1", secrets, {0: ([], [(0, b"first")], None)}, [])
+        self.failUnlessEqual(ss.remote_slot_readv(b"si1", [0], [(0, 5)]),
+                             {0: [b"first"]})
+        self.failUnlessEqual(self._open(ss), 1)
+
+        # growing the container moves the extra leases
+        big = b"x" * 10000
+        writev(b"si1", secrets, {0: ([(0, 5, b"eq", b"first")],
+                                     [(5, big)], None)}, [])
+        self.failUnlessEqual(ss.remote_slot_readv(b"si1", [0], [(0, 10005)]),
+                             {0: [b"first" + big]})
+
+        # emptying a share deletes it, and a new share is a new file
+        writev(b"si1", secrets, {0: ([], [], 0)}, [])
+        self.failUnlessEqual(self._open(ss), 0)
+        self.failUnlessEqual(ss.remote_slot_readv(b"si1", [0], [(0, 5)]), {})
+        writev(b"si1", secrets, {0: ([], [(0, b"again")], None)}, [])
+        self.failUnlessEqual(ss.remote_slot_readv(b"si1", [0], [(0, 10)]),
+                             {0: [b"again"]})
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        renew_secret = hashutil.tagged_hash(b"blah", b"renew")
+        cancel_secret = hashutil.tagged_hash(b"blah", b"cancel")
+        (already, writers) = ss.remote_allocate_buckets(
+            b"si1", renew_secret, cancel_secret, set([0]), 10, FakeCanary())
+        writers[0].remote_write(0, b"0123456789")
+        writers[0].remote_close()
+        readers = ss.remote_get_buckets(b"si1")
+        self.failUnlessEqual(readers[0].remote_read(2, 3), b"234")
+        self.failUnlessEqual(readers[0].remote_read(8, 5), b"89")
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.open_files.open"], 1)
+        # the header, then the two reads
+        self.failUnlessEqual(stats["storage_server.open_files.misses"], 1)
+        self.failUnlessEqual(stats["storage_server.open_files.hits"], 2)
+
+    def test_expired(self):
+        ss = self.create("test_expired", share_index=True,
+                         expiration_enabled=True,
+                         expiration_mode="cutoff-date",
+                         expiration_cutoff_date=int(time.time()) + 60)
+        renew_secret = hashutil.tagged_hash(b"blah", b"renew")
+        cancel_secret = hashutil.tagged_hash(b"blah", b"cancel")
+        (already, writers) = ss.remote_allocate_buckets(
+            b"si1", renew_secret, cancel_secret, set([0]), 10, FakeCanary())
+        writers[0].remote_write(0, b"0123456789")
+        writers[0].remote_close()
+        self.failUnlessEqual(ss.remote_get_buckets(b"si1")[0].remote_read(0, 1),
+                             b"0")
+        self.failUnlessEqual(self._open(ss), 1)
+        ss.lease_expirer.expire_leases()
+        self.failUnlessEqual(ss.remote_get_buckets(b"si1"), {})
+        self.failUnlessEqual(self._open(ss), 0)
@@ -55,6 +55,7 @@ from twisted.application.service import (
 from twisted.trial import unittest
 from twisted.internet.defer import (
     Deferred,
+    gatherResults,
     inlineCallbacks,
 )
 from twisted.python.filepath import (
@@ -68,7 +69,7 @@ from foolscap.ipb import (
     IConnectionHintHandler,
 )
 
-from .no_network import LocalWrapper
+from .no_network import LocalWrapper, wrap_storage_server
 from .common import (
     EMPTY_CLIENT_CONFIG,
     SyncTestCase,
@@ -81,6 +82,7 @@ from .common import (
 from .common_web import (
     do_http,
 )
+from .common_util import FakeCanary
 from .storage_plugin import (
     DummyStorageClient,
 )
@@ -91,15 +93,18 @@ from allmydata.util import base32, yamlutil
 from allmydata.storage_client import (
     IFoolscapStorageServer,
     NativeStorageServer,
+    ServerPerformance,
     StorageFarmBroker,
     _FoolscapStorage,
     _NullStorage,
+    _StorageServer,
 )
 from ..storage.server import (
     StorageServer,
 )
 from allmydata.interfaces import (
     IConnectionStatus,
+    IStorageBroker,
     IStorageServer,
 )
 
@@ -442,6 +447,203 @@ class FoolscapStorageServers(unittest.TestCase):
         )
 
 
+class QueuedLeases(unittest.TestCase):
+    """
+    Tests for ``_StorageServer.queue_add_lease``.
+    """
+    def setUp(self):
+        self.ss = StorageServer(self.mktemp(), b"\x00" * 20)
+        self.rref = wrap_storage_server(self.ss)
+        self.server = _StorageServer(lambda: self.rref)
+        # one bucket, holding two shares
+        (already, writers) = self.ss.remote_allocate_buckets(
+            b"si0", b"r" * 32, b"c" * 32, {0, 1}, 10, FakeCanary())
+        for bw in writers.values():
+            bw.remote_write(0, b"x" * 10)
+            bw.remote_close()
+
+    def queue_leases(self):
+        return gatherResults([
+            self.server.queue_add_lease(b"si%d" % (i,), b"%d" % (i,) * 32,
+                                        b"%d" % (i,) * 32)
+            for i in range(3)
+        ])
+
+    def test_batched(self):
+        """
+        Leases queued during one reactor turn are sent to the server in a
+        single ``add_leases`` call, and each caller gets its own result.
+        """
+        d = self.queue_leases()
+        def _check(results):
+            self.assertEqual(results, [2, 0, 0])
+            self.assertEqual(self.rref.counter_by_methname, {"add_leases": 1})
+            leases = list(self.ss._iter_share_files(b"si0"))[0].get_leases()
+            self.assertEqual(len(list(leases)), 2)
+        d.addCallback(_check)
+        return d
+
+    def test_old_server(self):
+        """
+        A server which does not advertise ``add_leases`` is sent one
+        ``add_lease`` call per lease instead.
+        """
+        v1 = self.rref.version[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+        del v1[b"maximum-add-leases-batch-size"]
+        d = self.queue_leases()
+        def _check(results):
+            self.assertEqual(results, [None, None, None])
+            self.assertEqual(self.rref.counter_by_methname, {"add_lease": 3})
+        d.addCallback(_check)
+        return d
+
+
+class QueuedReads(unittest.TestCase):
+    """
+    Tests for ``_StorageServer.queue_get_buckets`` and
+    ``_StorageServer.queue_slot_readv``.
+    """
+    def setUp(self):
+        self.ss = StorageServer(self.mktemp(), b"\x00" * 20)
+        self.rref = wrap_storage_server(self.ss)
+        self.server = _StorageServer(lambda: self.rref)
+        # two buckets, holding one share each
+        for storage_index in [b"si0", b"si2"]:
+            (already, writers) = self.ss.remote_allocate_buckets(
+                storage_index, b"r" * 32, b"c" * 32, {0}, 10, FakeCanary())
+            writers[0].remote_write(0, b"x" * 10)
+            writers[0].remote_close()
+
+    def queue_reads(self):
+        return gatherResults([
+            self.server.queue_get_buckets(b"si%d" % (i,))
+            for i in range(3)
+        ])
+
+    def test_batched(self):
+        """
+        ``get_buckets`` requests queued during one reactor turn are sent to
+        the server in a single ``get_buckets_batch`` call, and each caller
+        gets its own result.
+        """
+        d = self.queue_reads()
+        def _check(results):
+            self.assertEqual([sorted(buckets) for buckets in results],
+                             [[0], [], [0]])
+            self.assertEqual(self.rref.counter_by_methname,
+                             {"get_buckets_batch": 1})
+        d.addCallback(_check)
+        return d
+
+    def test_slot_readv(self):
+        """
+        ``slot_readv`` requests queued during one reactor turn are sent to
+        the server in a single ``slot_readv_batch`` call.
+        """
+        self.ss.remote_slot_testv_and_readv_and_writev(
+            b"si1", (b"w" * 32, b"r" * 32, b"c" * 32),
+            {0: ([], [(0, b"y" * 10)], None)}, [])
+        d = gatherResults([
+            self.server.queue_slot_readv(b"si%d" % (i,), [], [(0, 5)])
+            for i in [1, 3]
+        ])
+        def _check(results):
+            self.assertEqual(results, [{0: [b"y" * 5]}, {}])
+            self.assertEqual(self.rref.counter_by_methname,
+                             {"slot_readv_batch": 1})
+        d.addCallback(_check)
+        return d
+
+    def test_old_server(self):
+        """
+        A server which does not advertise the batched requests is sent one
+        ``get_buckets`` call per storage index instead.
+        """
+        v1 = self.rref.version[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+        del v1[b"maximum-storage-index-batch-size"]
+        d = self.queue_reads()
+        def _check(results):
+            self.assertEqual([sorted(buckets) for buckets in results],
+                             [[0], [], [0]])
+            self.assertEqual(self.rref.counter_by_methname,
+                             {"get_buckets": 3})
+        d.addCallback(_check)
+        return d
+
+    def test_failed_batch(self):
+        """
+        If a batch fails, its requests are sent again one at a time, so that
+        only the ones which fail by themselves report an error.
+        """
+        def remote_get_buckets_batch(storage_indexes):
+            raise ValueError("oops")
+        self.ss.remote_get_buckets_batch = remote_get_buckets_batch
+        d = self.queue_reads()
+        def _check(results):
+            self.assertEqual([sorted(buckets) for buckets in results],
+                             [[0], [], [0]])
+            self.assertEqual(self.rref.counter_by_methname,
+                             {"get_buckets_batch": 1, "get_buckets": 3})
+            self.flushLoggedErrors(ValueError)
+        d.addCallback(_check)
+        return d
+
+
+class ServerPerformanceTests(unittest.TestCase):
+    """
+    Tests for ``ServerPerformance``.
+    """
+    def test_rtt(self):
+        """
+        The round-trip time follows new samples by a quarter of the way.
+        """
+        p = ServerPerformance()
+        self.assertEqual(p.get_rtt(b"a"), None)
+        self.assertEqual(p.expected_time(b"a", 1000), None)
+        p.record_rtt(b"a", 1.0)
+        self.assertEqual(p.get_rtt(b"a"), 1.0)
+        p.record_rtt(b"a", 2.0)
+        self.assertEqual(p.get_rtt(b"a"), 1.25)
+        # small transfers only tell us about latency
+        p.record_transfer(b"a", 100, 1.25)
+        self.assertEqual(p.get_rtt(b"a"), 1.25)
+        self.assertEqual(p.get_bandwidth(b"a"), None)
+
+    def test_bandwidth(self):
+        """
+        Large transfers give the bandwidth, not counting one round trip.
+        """
+        p = ServerPerformance()
+        p.record_rtt(b"a", 1.0)
+        p.record_transfer(b"a", 100000, 3.0)
+        self.assertEqual(p.get_bandwidth(b"a"), 50000)
+        self.assertEqual(p.get_rtt(b"a"), 1.0)
+        self.assertEqual(p.expected_time(b"a"), 1.0)
+        self.assertEqual(p.expected_time(b"a", 50000), 2.0)
+
+    def test_rank(self):
+        """
+        Items are ranked by the expected time of their servers, with unknown
+        servers counted as middling and ties keeping their order.
+        """
+        p = ServerPerformance()
+        items = [(b"slow", 0), (b"unknown", 1), (b"fast", 2),
+                 (b"middle", 3), (b"unknown", 4)]
+        get_serverid = lambda item: item[0]
+        self.assertEqual(p.rank(items, get_serverid), items)
+        p.record_rtt(b"slow", 5.0)
+        p.record_rtt(b"fast", 0.1)
+        p.record_rtt(b"middle", 1.0)
+        self.assertEqual([i for (_, i) in p.rank(items, get_serverid)],
+                         [2, 1, 3, 4, 0])
+        # a big request favours bandwidth over latency
+        p.record_transfer(b"slow", 1000000, 5.5)
+        p.record_transfer(b"fast", 1000000, 100.1)
+        self.assertEqual([i for (_, i) in p.rank(items, get_serverid,
+                                                 10000000)],
+                         [3, 0, 1, 4, 2])
+
+
 class StoragePluginWebPresence(AsyncTestCase):
     """
     Tests for the web resources ``IFoolscapStorageServer`` plugins may expose.
@@ -590,6 +792,12 @@ class SpyHandler(object):
 
 class TestStorageFarmBroker(unittest.TestCase):
 
+    def test_interface(self):
+        """
+        ``StorageFarmBroker`` provides ``IStorageBroker``.
+        """
+        self.assertTrue(IStorageBroker.providedBy(make_broker()))
+
     def test_static_servers(self):
         broker = make_broker()
 
@@ -2143,6 +2143,13 @@ class SystemTest(SystemTestMixin, RunBinTahoeMixin, unittest.TestCase):
             self.failUnlessEqual(data["counters"]["uploader.files_uploaded"], 5)
             self.failUnlessEqual(data["stats"]["chk_upload_helper.upload_need_upload"], 1)
         d.addCallback(_got_stats_json)
+        d.addCallback(lambda res: self.GET("statistics?t=openmetrics"))
+        def _got_stats_openmetrics(res):
+            lines = res.splitlines()
+            self.failUnlessIn("tahoe_uploader_files_uploaded_total 5", lines)
+            self.failUnlessIn("# TYPE tahoe_storage_server_latencies_seconds histogram", lines)
+            self.failUnlessEqual(lines[-1], "# EOF")
+        d.addCallback(_got_stats_openmetrics)
 
         # TODO: mangle the second segment of a file, to test errors that
         # occur after we've already sent some good data, which uses a
@@ -34,10 +34,12 @@ from foolscap.api import fireEventually
 import allmydata # for __full_version__
 from allmydata import uri, monitor, client
 from allmydata.immutable import upload, encode
+from allmydata.immutable.keycache import get_convergence_key_cache
 from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError
 from allmydata.util import log, base32
 from allmydata.util.assertutil import precondition
 from allmydata.util.deferredutil import DeferredListShouldSucceed
+from allmydata.util.cputhreadpool import disable_thread_pool_for_test
 from allmydata.test.no_network import GridTestMixin
 from allmydata.storage_client import StorageFarmBroker
 from allmydata.storage.server import storage_index_to_dir
@@ -390,6 +392,27 @@ class GoodServer(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(self._check_large, SIZE_LARGE)
         return d
 
+    def test_stream_large(self):
+        data = self.get_data(SIZE_LARGE)
+        class SlowStream(object):
+            # delivers each read later, as an HTTP request body would
+            def __init__(self, data):
+                self._f = BytesIO(data)
+            def read(self, length):
+                return fireEventually(self._f.read(length))
+        def _upload():
+            d = self.u.upload(upload.Stream(SlowStream(data), len(data)))
+            d.addCallback(extract_uri)
+            return d
+        d = defer.gatherResults([_upload(), _upload()])
+        def _check(uris):
+            for newuri in uris:
+                self._check_large(newuri, SIZE_LARGE)
+            # the keys are random, so the same data gets different caps
+            self.failIfEqual(uris[0], uris[1])
+        d.addCallback(_check)
+        return d
+
     def test_filehandle_zero(self):
         data = self.get_data(SIZE_ZERO)
         d = upload_filehandle(self.u, BytesIO(data))
@@ -916,6 +939,98 @@ class FileHandleTests(unittest.TestCase):
         )
 
 
+class ConvergentKeyTests(unittest.TestCase):
+    """
+    Tests for computing convergent keys in the CPU thread pool, and for the
+    ``FileName`` key cache.
+    """
+    secret = b"\x42" * 16
+    params = {"k": 3, "happy": 5, "n": 10, "max_segment_size": 128 * 1024}
+
+    def _get_key(self, uploadable):
+        uploadable.set_default_encoding_parameters(self.params)
+        return uploadable.get_encryption_key()
+
+    def _make_file(self, contents):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(contents)
+        return fn
+
+    def _make_cache(self):
+        dbfile = self.mktemp()
+        return get_convergence_key_cache(dbfile)
+
+    def test_progress(self):
+        """
+        The key is the same however the file is split up for hashing, and
+        hashing progress is reported as each chunk is done.
+        """
+        progress = []
+        class Status(upload.UploadStatus):
+            def set_progress(self, which, value):
+                progress.append((which, value))
+        self.patch(upload.FileHandle, "CONVERGENT_HASH_CHUNK_SIZE", 4)
+        handle = upload.FileHandle(BytesIO(b"hello world"), self.secret)
+        handle.set_upload_status(Status())
+        d = self._get_key(handle)
+        def _got(key):
+            self.assertEqual(b64encode(key), b"oBcuR/wKdCgCV2GKKXqiNg==")
+            self.assertEqual(progress, [(0, 4/11), (0, 8/11), (0, 1.0),
+                                        (0, 1.0)])
+        d.addCallback(_got)
+        return d
+
+    def test_key_cache(self):
+        """
+        A ``FileName`` with a key cache records the key it computes, and a
+        later ``FileName`` for the same unchanged file uses it instead of
+        reading the file.
+        """
+        cache = self._make_cache()
+        fn = self._make_file(b"hello world")
+        d = self._get_key(upload.FileName(fn, self.secret, key_cache=cache))
+        def _computed(key):
+            self.assertEqual(b64encode(key), b"oBcuR/wKdCgCV2GKKXqiNg==")
+            def _read_and_hash(*args):
+                raise AssertionError("the file should not be read")
+            self.patch(upload, "_read_and_hash", _read_and_hash)
+            return self._get_key(upload.FileName(fn, self.secret,
+                                                 key_cache=cache))
+        d.addCallback(_computed)
+        d.addCallback(lambda key: self.assertEqual(
+            b64encode(key), b"oBcuR/wKdCgCV2GKKXqiNg=="))
+        return d
+
+    def test_key_cache_changed_file(self):
+        """
+        A recorded key is not used once the file has changed, or for a
+        different convergence secret.
+        """
+        cache = self._make_cache()
+        fn = self._make_file(b"hello world")
+        keys = []
+        d = self._get_key(upload.FileName(fn, self.secret, key_cache=cache))
+        d.addCallback(keys.append)
+        d.addCallback(lambda ign: self._get_key(
+            upload.FileName(fn, b"\x43" * 16, key_cache=cache)))
+        d.addCallback(keys.append)
+        def _change(ign):
+            with open(fn, "wb") as f:
+                f.write(b"goodbye world")
+            return self._get_key(upload.FileName(fn, self.secret,
+                                                 key_cache=cache))
+        d.addCallback(_change)
+        d.addCallback(keys.append)
+        def _check(ign):
+            expected = self._get_key(
+                upload.Data(b"goodbye world", self.secret))
+            self.assertEqual(len(set(keys)), 3)
+            return expected.addCallback(self.assertEqual, keys[2])
+        d.addCallback(_check)
+        return d
+
+
 class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
     ShouldFailMixin):
 
@@ -2073,6 +2188,11 @@ class EncryptAnUploadableTests(unittest.TestCase):
     """
     Tests for ``EncryptAnUploadable``.
     """
+    def setUp(self):
+        # These tests inspect results synchronously, so keep the encryption
+        # on this thread.
+        disable_thread_pool_for_test(self)
+
     def test_same_length(self):
         """
         ``EncryptAnUploadable.read_encrypted`` returns ciphertext of the same
@@ -25,6 +25,7 @@ from allmydata.util import jsonbytes
 from allmydata.util import pollmixin
 from allmydata.util import yamlutil
 from allmydata.util import rrefutil
+from allmydata.util import spillstack
 from allmydata.util.fileutil import EncryptedTemporaryFile
 from allmydata.test.common_util import ReallyEqualMixin
 from .no_network import fireNow, LocalWrapper
@@ -593,3 +594,31 @@ class RrefUtilTests(unittest.TestCase):
             )
             self.assertEqual(result.version, "Default")
             self.assertIdentical(result, rref)
+
+
+class SpillStackTests(unittest.TestCase):
+    def test_in_memory(self):
+        s = spillstack.SpillStack(10)
+        for i in range(5):
+            s.push(i)
+        self.assertEqual(len(s), 5)
+        self.assertEqual([s.pop() for i in range(5)], [4, 3, 2, 1, 0])
+        self.assertEqual(s.spilled, 0)
+        self.assertRaises(IndexError, s.pop)
+
+    def test_spill(self):
+        s = spillstack.SpillStack(4)
+        for i in range(20):
+            s.push([i, u"item %d" % (i,)])
+        self.assertEqual(len(s), 20)
+        self.assertTrue(s.spilled > 0)
+        # interleave pops and pushes across the spilled chunks
+        self.assertEqual(s.pop(), [19, u"item 19"])
+        s.push([100, u"new"])
+        popped = [s.pop()[0] for i in range(20)]
+        self.assertEqual(popped, [100] + list(range(18, -1, -1)))
+        self.assertEqual(len(s), 0)
+        s.close()
+
+    def test_too_small(self):
+        self.assertRaises(ValueError, spillstack.SpillStack, 1)
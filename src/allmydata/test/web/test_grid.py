@@ -26,6 +26,7 @@ from allmydata.util.consumer import download_to_data
 from allmydata.util.netstring import split_netstring
 from allmydata.unknown import UnknownNode
 from allmydata.storage.shares import get_share_file
+from allmydata.storage.server import StorageServer
 from allmydata.scripts.debug import CorruptShareOptions, corrupt_share
 from allmydata.immutable import upload
 from allmydata.mutable import publish
@@ -36,6 +37,7 @@ from ...web.common import (
 from .. import common_util as testutil
 from ..common import WebErrorMixin, ShouldFailMixin
 from ..no_network import GridTestMixin
+from ...webish import TahoeLAFSSite
 from .common import (
     assert_soup_has_favicon,
     unknown_immcap,
@@ -1063,6 +1065,65 @@ class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMi
         return d
 
 
+    def test_streamed_upload(self):
+        # big enough that the web server has to stop reading the request
+        # while the upload catches up
+        self.basedir = "web/Grid/streamed_upload"
+        self.set_up_grid()
+        DATA = b"streamed" * 400000
+        spooled = []
+        getContentFile = TahoeLAFSSite.getContentFile
+        def _getContentFile(site, length):
+            spooled.append(length)
+            return getContentFile(site, length)
+        self.patch(TahoeLAFSSite, "getContentFile", _getContentFile)
+        d = self.PUT("uri?stream=true", data=DATA)
+        def _uploaded(filecap):
+            self.failUnless(filecap.startswith(b"URI:CHK:"), filecap)
+            self.failUnlessEqual(spooled, [])
+            return self.GET("uri/%s" % (url_quote(filecap),))
+        d.addCallback(_uploaded)
+        d.addCallback(lambda data: self.failUnlessReallyEqual(data, DATA))
+        return d
+
+    def test_mutable_child_sizes(self):
+        # a client which has not seen the mutable files in a directory
+        # before finds their sizes while listing it, asking each server
+        # about all of them at once
+        self.basedir = "web/Grid/mutable_child_sizes"
+        self.set_up_grid(num_clients=2)
+        c0 = self.g.clients[0]
+        d = c0.create_dirnode()
+        def _created_dir(n):
+            self.rooturl = "uri/" + url_quote(n.get_uri())
+            self.rootnode = n
+        d.addCallback(_created_dir)
+        def _add(ign, name, size):
+            d1 = c0.create_mutable_file(publish.MutableData(b"x" * size))
+            d1.addCallback(lambda node: self.rootnode.set_node(name, node))
+            return d1
+        d.addCallback(_add, u"one", 100)
+        d.addCallback(_add, u"two", 200)
+        batches = []
+        slot_readv_batch = StorageServer.remote_slot_readv_batch
+        def _slot_readv_batch(ss, reads):
+            batches.append(set(storage_index
+                               for (storage_index, ign, ign) in reads))
+            return slot_readv_batch(ss, reads)
+        self.patch(StorageServer, "remote_slot_readv_batch", _slot_readv_batch)
+        d.addCallback(lambda ign: self.GET(self.rooturl + "?t=json",
+                                           clientnum=1))
+        def _check(res):
+            children = json.loads(res)[1]["children"]
+            self.failUnlessEqual(children[u"one"][1]["size"], 100)
+            self.failUnlessEqual(children[u"two"][1]["size"], 200)
+            storage_indexes = set(
+                uri.from_string(children[name][1]["rw_uri"]).get_storage_index()
+                for name in [u"one", u"two"])
+            self.failUnlessIn(storage_indexes, batches)
+        d.addCallback(_check)
+        return d
+
     def test_exceptions(self):
         self.basedir = "web/Grid/exceptions"
         self.set_up_grid(num_clients=1, num_servers=2)
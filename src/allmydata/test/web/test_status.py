@@ -23,8 +23,9 @@ from allmydata.web.status import (
 from zope.interface import implementer
 
 from allmydata.interfaces import IDownloadResults
-from allmydata.web.status import DownloadStatusElement
+from allmydata.web.status import DownloadStatusElement, MapupdateStatusElement
 from allmydata.immutable.downloader.status import DownloadStatus
+from allmydata.mutable.servermap import UpdateStatus
 
 from .common import (
     assert_soup_has_favicon,
@@ -238,3 +239,44 @@ class DownloadStatusElementTests(TrialTestCase):
         assert_soup_has_tag_with_content(
             self, soup, u"li", u"Total: None (None)"
         )
+
+    def test_download_status_element_readahead(self):
+        """
+        The read-ahead depth of the download is shown.
+        """
+        status = FakeDownloadStatus()
+        status.set_readahead(3)
+        result = self._render_download_status_element(status)
+        soup = BeautifulSoup(result, 'html5lib')
+
+        assert_soup_has_tag_with_content(
+            self, soup, u"li", u"Read-ahead: 3 segments"
+        )
+
+
+class MapupdateStatusElementTests(TrialTestCase):
+    """
+    Tests for ```allmydata.web.status.MapupdateStatusElement```.
+    """
+
+    def _render(self, status):
+        d = flattenString(None, MapupdateStatusElement(status))
+        return BeautifulSoup(self.successResultOf(d), 'html5lib')
+
+    def test_not_cached(self):
+        """
+        A servermap which was updated by querying servers is shown as such.
+        """
+        soup = self._render(UpdateStatus())
+        assert_soup_has_tag_with_content(self, soup, u"li", u"From cache?: No")
+
+    def test_cached(self):
+        """
+        A servermap which was served from the cache is shown with its age.
+        """
+        status = UpdateStatus()
+        status.set_cached_age(90)
+        soup = self._render(status)
+        assert_soup_has_tag_with_content(
+            self, soup, u"li", u"From cache?: Yes (updated 90 seconds earlier)"
+        )
@@ -0,0 +1,243 @@
+"""
+Tests for ``allmydata.web.streaming``.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from testtools.matchers import (
+    AfterPreprocessing,
+    Contains,
+    Equals,
+    Is,
+    IsInstance,
+    Not,
+)
+from testtools.twistedsupport import (
+    failed,
+    has_no_result,
+    succeeded,
+)
+
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+from twisted.web.resource import Resource
+from twisted.web.test.requesthelper import DummyChannel
+
+from ..common import (
+    SyncTestCase,
+)
+from ...webish import (
+    TahoeLAFSChannel,
+    TahoeLAFSSite,
+)
+from ...web.streaming import (
+    HIGH_WATER,
+    LOW_WATER,
+    StreamingBody,
+    can_stream,
+)
+
+
+class FakeTransport(DummyChannel.TCP, object):
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class CanStreamTests(SyncTestCase):
+    """
+    Tests for ``can_stream``.
+    """
+    def test_uploads(self):
+        """
+        PUTs of immutable files with ``stream=true`` can be streamed.
+        """
+        for uri in [b"/uri?stream=true",
+                    b"/uri?format=chk&stream=true",
+                    b"/uri/URI:DIR2:aaa:bbb/sub/file.txt?stream=true&replace=false"]:
+            self.assertThat(can_stream(b"PUT", uri), Equals(True), uri)
+
+    def test_others(self):
+        """
+        Nothing else can be streamed.
+        """
+        for (method, uri) in [(b"PUT", b"/uri"),
+                              (b"POST", b"/uri?stream=true"),
+                              (b"PUT", b"/uri?stream=false"),
+                              (b"PUT", b"/uri?stream=true&format=MDMF"),
+                              (b"PUT", b"/uri?stream=true&mutable=true"),
+                              (b"PUT", b"/uri?stream=true&format=bogus"),
+                              (b"PUT", b"/uri?stream=true&t=mkdir"),
+                              (b"PUT", b"/uri/URI:DIR2:a:b/f?stream=true&t=uri"),
+                              (b"PUT", b"/urix?stream=true")]:
+            self.assertThat(can_stream(method, uri), Equals(False), uri)
+
+
+class StreamingBodyTests(SyncTestCase):
+    """
+    Tests for ``StreamingBody``.
+    """
+    def setUp(self):
+        super(StreamingBodyTests, self).setUp()
+        self.transport = FakeTransport()
+        self.body = StreamingBody(self.transport, 10)
+
+    def test_read(self):
+        """
+        A read fires once it has as much data as it asked for, or the body
+        has ended.
+        """
+        d = self.body.read(4)
+        self.assertThat(d, has_no_result())
+        self.body.write(b"abc")
+        self.assertThat(d, has_no_result())
+        self.body.write(b"defg")
+        self.assertThat(d, succeeded(Equals(b"abcd")))
+        self.assertThat(self.body.read(2), succeeded(Equals(b"ef")))
+        d = self.body.read(4)
+        self.body.write(b"hi")
+        self.assertThat(d, has_no_result())
+        self.body.end()
+        self.assertThat(d, succeeded(Equals(b"ghi")))
+        self.assertThat(self.body.read(4), succeeded(Equals(b"")))
+        self.assertThat(self.body.when_complete(), succeeded(Is(None)))
+
+    def test_backpressure(self):
+        """
+        The transport is paused while more than ``HIGH_WATER`` bytes are
+        waiting to be read, and resumed once fewer than ``LOW_WATER`` are.
+        """
+        self.body.write(b"x" * (HIGH_WATER - 1))
+        self.assertThat(self.transport.paused, Equals(False))
+        self.body.write(b"x")
+        self.assertThat(self.transport.paused, Equals(True))
+        self.body.read(HIGH_WATER - LOW_WATER)
+        self.assertThat(self.transport.paused, Equals(True))
+        self.body.read(1)
+        self.assertThat(self.transport.paused, Equals(False))
+
+    def test_big_read(self):
+        """
+        The transport is not paused while a read is waiting for more than
+        ``HIGH_WATER`` bytes.
+        """
+        d = self.body.read(HIGH_WATER * 2)
+        self.body.write(b"x" * HIGH_WATER)
+        self.assertThat(self.transport.paused, Equals(False))
+        self.body.write(b"x" * HIGH_WATER)
+        self.assertThat(d, succeeded(Equals(b"x" * HIGH_WATER * 2)))
+
+    def test_discard(self):
+        """
+        Once discarded, the body throws data away and does not hold up the
+        transport.
+        """
+        self.body.write(b"x" * HIGH_WATER)
+        self.assertThat(self.transport.paused, Equals(True))
+        self.body.discard()
+        self.assertThat(self.transport.paused, Equals(False))
+        self.body.write(b"x" * HIGH_WATER)
+        self.assertThat(self.transport.paused, Equals(False))
+
+    def test_lost(self):
+        """
+        A read waiting when the connection is lost fails, as do later ones.
+        """
+        d = self.body.read(4)
+        complete = self.body.when_complete()
+        self.body.lose(Failure(ConnectionLost()))
+        lost = failed(AfterPreprocessing(lambda f: f.type,
+                                         Equals(ConnectionLost)))
+        self.assertThat(d, lost)
+        self.assertThat(complete, succeeded(Is(None)))
+        self.assertThat(self.body.read(1), lost)
+
+
+class StreamingRequestTests(SyncTestCase):
+    """
+    Tests for the handling of streamed uploads by ``TahoeLAFSRequest`` and
+    ``TahoeLAFSChannel``.
+    """
+    def _connect(self):
+        tempdir = FilePath(self.mktemp())
+        self.rendered = []
+        test = self
+        class Upload(Resource):
+            isLeaf = True
+            def render_PUT(self, request):
+                test.rendered.append(request)
+                return b"done"
+        self.clock = Clock()
+        site = TahoeLAFSSite(tempdir.path, Upload(), logPath=self.mktemp(),
+                             timeout=60, reactor=self.clock)
+        site.startFactory()
+        self.addCleanup(site.stopFactory)
+        channel = site.buildProtocol(None)
+        self.assertThat(channel, IsInstance(TahoeLAFSChannel))
+        self.transport = StringTransport()
+        channel.makeConnection(self.transport)
+        return channel
+
+    def _headers(self, path):
+        return (b"PUT " + path + b" HTTP/1.1\r\n"
+                b"Host: example.com\r\n"
+                b"Content-Length: 10\r\n"
+                b"\r\n")
+
+    def test_streamed(self):
+        """
+        A streamable upload is processed as soon as its headers arrive, and
+        its response ends only when all of its body has arrived.
+        """
+        channel = self._connect()
+        channel.dataReceived(self._headers(b"/uri?stream=true"))
+        [request] = self.rendered
+        self.assertThat(request.content, IsInstance(StreamingBody))
+        self.assertThat(request.finished, Equals(False))
+        channel.dataReceived(b"01234")
+        self.assertThat(request.finished, Equals(False))
+        channel.dataReceived(b"56789")
+        self.assertThat(self.rendered, Equals([request]))
+        self.assertThat(request.finished, Equals(True))
+        self.assertThat(self.transport.value(), Contains(b"done"))
+
+    def test_streamed_timeout(self):
+        """
+        A connection is not timed out while a streamed body is being read,
+        but is once the response is done and the channel waits for another
+        request.
+        """
+        channel = self._connect()
+        channel.dataReceived(self._headers(b"/uri?stream=true"))
+        self.clock.advance(120)
+        self.assertThat(self.transport.disconnecting, Equals(False))
+        channel.dataReceived(b"0123456789")
+        self.clock.advance(120)
+        self.assertThat(self.transport.disconnecting, Equals(True))
+
+    def test_not_streamed(self):
+        """
+        Other requests are processed once all of their body has arrived.
+        """
+        channel = self._connect()
+        channel.dataReceived(self._headers(b"/uri"))
+        self.assertThat(self.rendered, Equals([]))
+        channel.dataReceived(b"0123456789")
+        [request] = self.rendered
+        self.assertThat(request.content, Not(IsInstance(StreamingBody)))
+        self.assertThat(request.finished, Equals(True))
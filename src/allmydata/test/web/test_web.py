@@ -1723,6 +1723,30 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
                                                       self.NEWFILE_CONTENTS))
         return d
 
+    def test_PUT_NEWFILEURL_stream(self):
+        d = self.PUT(self.public_url + "/foo/new.txt?stream=true",
+                     self.NEWFILE_CONTENTS)
+        d.addCallback(self.failUnlessURIMatchesROChild, self._foo_node, u"new.txt")
+        d.addCallback(lambda res:
+                      self.failUnlessChildContentsAre(self._foo_node, u"new.txt",
+                                                      self.NEWFILE_CONTENTS))
+        return d
+
+    def test_PUT_NEWFILEURL_stream_mutable(self):
+        # a mutable file can't be changed by a streamed upload
+        d = self.shouldFail2(error.Error, "PUT_stream_mutable",
+                             "400 Bad Request",
+                             "stream=true can only be used to upload "
+                             "immutable files",
+                             self.PUT,
+                             self.public_url + "/foo/baz.txt?stream=true",
+                             self.NEWFILE_CONTENTS)
+        d.addCallback(lambda res:
+                      self.failUnlessMutableChildContentsAre(self._foo_node,
+                                                             u"baz.txt",
+                                                             self.BAZ_CONTENTS))
+        return d
+
     def test_PUT_NEWFILEURL_not_mutable(self):
         d = self.PUT(self.public_url + "/foo/new.txt?mutable=false",
                      self.NEWFILE_CONTENTS)
@@ -4519,6 +4543,15 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_check2)
         return d
 
+    def test_PUT_NEWFILE_URI_stream(self):
+        file_contents = b"New file contents here\n" * 1000
+        d = self.PUT("/uri?stream=true", file_contents)
+        def _check(uri):
+            self.failUnlessReallyEqual(self.get_all_contents()[uri],
+                                       file_contents)
+        d.addCallback(_check)
+        return d
+
     def test_PUT_NEWFILE_URI_not_mutable(self):
         file_contents = b"New file contents here\n"
         d = self.PUT("/uri?mutable=false", file_contents)
@@ -46,16 +46,19 @@ PORTED_MODULES = [
     "allmydata.immutable.downloader.fetcher",
     "allmydata.immutable.downloader.finder",
     "allmydata.immutable.downloader.node",
+    "allmydata.immutable.downloader.segcache",
     "allmydata.immutable.downloader.segmentation",
     "allmydata.immutable.downloader.share",
     "allmydata.immutable.downloader.status",
     "allmydata.immutable.encode",
     "allmydata.immutable.filenode",
     "allmydata.immutable.happiness_upload",
+    "allmydata.immutable.keycache",
     "allmydata.immutable.layout",
     "allmydata.immutable.literal",
     "allmydata.immutable.offloaded",
     "allmydata.immutable.repairer",
+    "allmydata.immutable.sharelocations",
     "allmydata.immutable.upload",
     "allmydata.interfaces",
     "allmydata.introducer",
@@ -68,6 +71,7 @@ PORTED_MODULES = [
     "allmydata.mutable.checker",
     "allmydata.mutable.common",
     "allmydata.mutable.filenode",
+    "allmydata.mutable.keypool",
     "allmydata.mutable.layout",
     "allmydata.mutable.publish",
     "allmydata.mutable.repairer",
@@ -80,6 +84,9 @@ PORTED_MODULES = [
     "allmydata.scripts.runner",
     "allmydata.scripts.types_",
     "allmydata.stats",
+    "allmydata.storage.diskio",
+    "allmydata.storage.openfiles",
+    "allmydata.storage.shareindex",
     "allmydata.storage_client",
     "allmydata.storage",
     "allmydata.storage.common",
@@ -120,6 +127,7 @@ PORTED_MODULES = [
     "allmydata.util.configutil",
     "allmydata.util.connection_status",
     "allmydata.util.consumer",
+    "allmydata.util.cputhreadpool",
     "allmydata.util.dbutil",
     "allmydata.util.deferredutil",
     "allmydata.util.dictutil",
@@ -129,6 +137,7 @@ PORTED_MODULES = [
     "allmydata.util.gcutil",
     "allmydata.util.happinessutil",
     "allmydata.util.hashutil",
+    "allmydata.util.histogram",
     "allmydata.util.humanreadable",
     "allmydata.util.i2p_provider",
     "allmydata.util.idlib",
@@ -143,6 +152,7 @@ PORTED_MODULES = [
     "allmydata.util.pollmixin",
     "allmydata.util.rrefutil",
     "allmydata.util.spans",
+    "allmydata.util.spillstack",
     "allmydata.util.statistics",
     "allmydata.util.time_format",
     "allmydata.util.tor_provider",
@@ -161,6 +171,7 @@ PORTED_MODULES = [
     "allmydata.web.status",
     "allmydata.web.storage",
     "allmydata.web.storage_plugins",
+    "allmydata.web.streaming",
     "allmydata.web.unlinked",
     "allmydata.webish",
     "allmydata.windows",
@@ -189,6 +200,7 @@ PORTED_TEST_MODULES = [
     "allmydata.test.mutable.test_filehandle",
     "allmydata.test.mutable.test_filenode",
     "allmydata.test.mutable.test_interoperability",
+    "allmydata.test.mutable.test_keypool",
     "allmydata.test.mutable.test_multiple_encodings",
     "allmydata.test.mutable.test_multiple_versions",
     "allmydata.test.mutable.test_problems",
@@ -209,6 +221,7 @@ PORTED_TEST_MODULES = [
     "allmydata.test.test_connections",
     "allmydata.test.test_connection_status",
     "allmydata.test.test_consumer",
+    "allmydata.test.test_cputhreadpool",
     "allmydata.test.test_crawler",
     "allmydata.test.test_crypto",
     "allmydata.test.test_deepcheck",
@@ -264,6 +277,7 @@ PORTED_TEST_MODULES = [
     "allmydata.test.web.test_private",
     "allmydata.test.web.test_root",
     "allmydata.test.web.test_status",
+    "allmydata.test.web.test_streaming",
     "allmydata.test.web.test_util",
     "allmydata.test.web.test_web",
     "allmydata.test.web.test_webish",
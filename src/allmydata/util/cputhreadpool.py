@@ -0,0 +1,113 @@
+"""
+A process-wide thread pool for CPU-bound work.
+
+Erasure coding, AES and hashing of large buffers are all done by C code
+which releases the GIL, so running them in worker threads lets a single
+upload or download use more than one core and, more importantly, keeps the
+reactor thread free to service network I/O (and every other client of this
+node) while the work happens.
+
+This is deliberately separate from the reactor's own thread pool, which is
+used for things like DNS lookups that must not queue up behind a backlog of
+multi-megabyte encode jobs.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import multiprocessing
+
+from twisted.python.threadpool import ThreadPool
+from twisted.internet import defer
+from twisted.internet.threads import deferToThreadPool
+
+
+def _default_max_threads():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+_pool = None
+_max_threads = _default_max_threads()
+_disabled = False
+
+
+def get_max_threads():
+    """
+    :return int: The maximum number of worker threads the pool will use.
+    """
+    return _max_threads
+
+
+def set_max_threads(max_threads):
+    """
+    Change the maximum number of worker threads.  This is normally called
+    once at node startup, from the ``[client]cpu.threads`` setting.
+
+    :param int max_threads: The new maximum, at least 1.
+    """
+    global _max_threads
+    if max_threads < 1:
+        raise ValueError("max_threads must be at least 1, not %d" % (max_threads,))
+    _max_threads = max_threads
+    if _pool is not None:
+        _pool.adjustPoolsize(0, max_threads)
+
+
+def _get_pool(reactor):
+    global _pool
+    if _pool is None:
+        _pool = ThreadPool(minthreads=0, maxthreads=_max_threads,
+                           name="tahoe-cpu")
+        _pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", _stop_pool)
+    return _pool
+
+
+def _stop_pool():
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        pool.stop()
+
+
+def defer_to_thread(f, *args, **kwargs):
+    """
+    Run ``f(*args, **kwargs)`` in the CPU thread pool.
+
+    ``f`` must not touch any state shared with the reactor thread: it is
+    given its inputs and hands back its result, nothing else.
+
+    :return Deferred: Fires (in the reactor thread) with the result of
+        ``f``, or fails with the exception it raised.
+    """
+    if _disabled:
+        return defer.maybeDeferred(f, *args, **kwargs)
+    from twisted.internet import reactor
+    return deferToThreadPool(reactor, _get_pool(reactor), f, *args, **kwargs)
+
+
+def disable_thread_pool_for_test(testcase):
+    """
+    For the duration of ``testcase``, make ``defer_to_thread`` run its
+    function synchronously in the calling thread.  This lets synchronous
+    unit tests (``successResultOf`` and friends) exercise code which would
+    otherwise offload work.
+
+    :param testcase: A ``TestCase`` whose cleanup re-enables the pool.
+    """
+    global _disabled
+    def _restore():
+        global _disabled
+        _disabled = False
+    testcase.addCleanup(_restore)
+    _disabled = True
@@ -90,6 +90,7 @@ CONVERGENT_ENCRYPTION_TAG = b"allmydata_immutable_content_to_key_with_added_secr
 
 CLIENT_RENEWAL_TAG = b"allmydata_client_renewal_secret_v1"
 CLIENT_CANCEL_TAG = b"allmydata_client_cancel_secret_v1"
+CLIENT_KEY_POOL_TAG = b"allmydata_client_key_pool_secret_v1"
 FILE_RENEWAL_TAG = b"allmydata_file_renewal_secret_v1"
 FILE_CANCEL_TAG = b"allmydata_file_cancel_secret_v1"
 BUCKET_RENEWAL_TAG = b"allmydata_bucket_renewal_secret_v1"
@@ -229,6 +230,10 @@ def my_cancel_secret_hash(my_secret):
     return tagged_hash(my_secret, CLIENT_CANCEL_TAG)
 
 
+def my_key_pool_secret_hash(my_secret):
+    return tagged_hash(my_secret, CLIENT_KEY_POOL_TAG)
+
+
 def file_renewal_secret_hash(client_renewal_secret, storage_index):
     return tagged_pair_hash(FILE_RENEWAL_TAG,
                             client_renewal_secret, storage_index)
@@ -312,5 +317,18 @@ def backupdb_dirhash(contents):
     return tagged_hash(BACKUPDB_DIRHASH_TAG, contents)
 
 
+CONVERGENCE_KEY_CACHE_TAG = b"allmydata_convergence_key_cache_params_v1"
+
+
+def convergence_key_cache_params(k, n, segsize, convergence):
+    """
+    Identify the parameters that go into a convergent encryption key,
+    without revealing the convergence secret, for use as part of a key
+    cache index.
+    """
+    tag = _convergence_hasher_tag(k, n, segsize, convergence)
+    return tagged_hash(CONVERGENCE_KEY_CACHE_TAG, tag)
+
+
 def permute_server_hash(peer_selection_index, server_permutation_seed):
     return hashlib.sha1(peer_selection_index + server_permutation_seed).digest()
@@ -0,0 +1,186 @@
+"""
+Latency histograms with logarithmic buckets, which can summarize the
+samples of the last few minutes without keeping the samples themselves.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import math
+import time
+from collections import deque
+
+# Bucket 0 holds everything below MIN_VALUE. Bucket i (for i >= 1) holds
+# values from MIN_VALUE * 10**((i-1)/BUCKETS_PER_DECADE) up to
+# MIN_VALUE * 10**(i/BUCKETS_PER_DECADE), so reporting the middle of a
+# bucket is never more than about 6% off. The last bucket also holds
+# everything above it.
+MIN_VALUE = 1e-6
+BUCKETS_PER_DECADE = 20
+NUM_BUCKETS = 10 * BUCKETS_PER_DECADE + 1
+
+# The upper bounds of the cumulative buckets exported by get_cumulative():
+# every fifth bucket boundary, from 10us to 100s.
+EXPORT_BOUNDS = [(i, MIN_VALUE * 10 ** (i / BUCKETS_PER_DECADE))
+                 for i in range(BUCKETS_PER_DECADE, 8 * BUCKETS_PER_DECADE + 1,
+                                BUCKETS_PER_DECADE // 4)]
+
+SLOT_SECONDS = 10
+MAX_WINDOW = 3600
+
+# (fraction, name, minimum number of samples) for the percentiles reported
+# by summarize(). Percentiles are only reported when there are enough
+# samples for them to be interpreted unambiguously.
+PERCENTILES = [(0.01, "01_0_percentile", 100),
+               (0.1, "10_0_percentile", 10),
+               (0.50, "50_0_percentile", 10),
+               (0.90, "90_0_percentile", 10),
+               (0.95, "95_0_percentile", 20),
+               (0.99, "99_0_percentile", 100),
+               (0.999, "99_9_percentile", 1000)]
+
+
+def bucket_for(value):
+    if value < MIN_VALUE:
+        return 0
+    i = int(math.floor(math.log10(value / MIN_VALUE) * BUCKETS_PER_DECADE)) + 1
+    return min(i, NUM_BUCKETS - 1)
+
+
+def bucket_middle(i):
+    if i == 0:
+        return 0.0
+    return MIN_VALUE * 10 ** ((i - 0.5) / BUCKETS_PER_DECADE)
+
+
+class _Slot(object):
+    """The samples recorded during one SLOT_SECONDS interval."""
+
+    def __init__(self, number):
+        self.number = number
+        self.counts = {} # bucket -> count
+        self.count = 0
+        self.total = 0.0
+        self.lowest = None
+        self.highest = None
+
+
+class LatencyHistogram(object):
+    """
+    I record latency samples (in seconds) in constant time and space, and
+    summarize those of the last ``window`` seconds (up to an hour) on
+    request. I also keep cumulative counts since I was created, for export
+    as an OpenMetrics histogram.
+
+    :param get_time: A function returning the current time, for tests.
+    """
+
+    def __init__(self, get_time=time.time):
+        self._get_time = get_time
+        self._slots = deque()
+        self._counts = [0] * NUM_BUCKETS # since the start, for export
+        self.count = 0
+        self.total = 0.0
+        self._summaries = {} # window -> (slot number, count, summary)
+
+    def add(self, value):
+        number = int(self._get_time() // SLOT_SECONDS)
+        if not self._slots or self._slots[-1].number != number:
+            self._slots.append(_Slot(number))
+            while self._slots[0].number <= number - MAX_WINDOW // SLOT_SECONDS:
+                self._slots.popleft()
+        slot = self._slots[-1]
+        i = bucket_for(value)
+        slot.counts[i] = slot.counts.get(i, 0) + 1
+        slot.count += 1
+        slot.total += value
+        if slot.lowest is None or value < slot.lowest:
+            slot.lowest = value
+        if slot.highest is None or value > slot.highest:
+            slot.highest = value
+        self._counts[i] += 1
+        self.count += 1
+        self.total += value
+
+    def _recent_slots(self, window):
+        first = (int(self._get_time() // SLOT_SECONDS)
+                 - int(math.ceil(window / SLOT_SECONDS)) + 1)
+        return [slot for slot in self._slots if slot.number >= first]
+
+    def summarize(self, window=MAX_WINDOW):
+        """
+        Summarize the samples of the last ``window`` seconds.
+
+        :return: None if there were none, otherwise a dict with
+            ``samplesize``, ``mean`` (None for a single sample), and the
+            percentiles named in ``PERCENTILES`` (each None if there were
+            too few samples for it).
+        """
+        key = (int(self._get_time() // SLOT_SECONDS), self.count)
+        cached = self._summaries.get(window)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        summary = self._summarize(self._recent_slots(window))
+        self._summaries[window] = (key, summary)
+        return summary
+
+    def _summarize(self, slots):
+        counts = {}
+        count = 0
+        total = 0.0
+        lowest = highest = None
+        for slot in slots:
+            for (i, n) in slot.counts.items():
+                counts[i] = counts.get(i, 0) + n
+            count += slot.count
+            total += slot.total
+            if lowest is None or slot.lowest < lowest:
+                lowest = slot.lowest
+            if highest is None or slot.highest > highest:
+                highest = slot.highest
+        if not count:
+            return None
+
+        summary = {"samplesize": count}
+        if count > 1:
+            summary["mean"] = total / count
+        else:
+            summary["mean"] = None
+        buckets = sorted(counts.items())
+        for (fraction, name, minimum) in PERCENTILES:
+            if count < minimum:
+                summary[name] = None
+                continue
+            # the same order statistic as samples[int(fraction*count)] of
+            # the sorted samples
+            rank = int(fraction * count)
+            seen = 0
+            for (i, n) in buckets:
+                seen += n
+                if seen > rank:
+                    break
+            summary[name] = max(lowest, min(highest, bucket_middle(i)))
+        return summary
+
+    def get_cumulative(self):
+        """
+        :return: A tuple of ``(buckets, count, total)`` describing every
+            sample I have recorded, where ``buckets`` is a list of
+            ``(upper_bound, count_of_samples_up_to_it)`` pairs.
+        """
+        buckets = []
+        seen = 0
+        start = 0
+        for (i, bound) in EXPORT_BOUNDS:
+            seen += sum(self._counts[start:i + 1])
+            start = i + 1
+            buckets.append((bound, seen))
+        return (buckets, self.count, self.total)
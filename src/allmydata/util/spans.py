@@ -7,6 +7,8 @@ from future.utils import PY2
 if PY2:
     from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
+from bisect import bisect_left
+
 
 class Spans(object):
     """I represent a compressed list of booleans, one per index (an integer).
@@ -27,14 +29,24 @@ class Spans(object):
     XYZ, I already requested bytes ABC, and I've already received bytes DEF:
     what bytes should I request now?'.
 
+    The spans never overlap or touch, so they are sorted by both start and
+    end, and I find the ones an operation affects by bisection: adding or
+    removing a range costs O(log N) plus the number of spans it covers,
+    rather than a scan of them all.
+
     The new downloader will use it to keep track of which bytes we've requested
     or received already.
     """
 
     def __init__(self, _span_or_start=None, length=None):
-        self._spans = list()
+        self._spans = []
+        self._len = 0
         if length is not None:
             self._spans.append( (_span_or_start, length) )
+            self._len = length
+        elif isinstance(_span_or_start, Spans):
+            self._spans = _span_or_start._spans[:]
+            self._len = _span_or_start._len
         elif _span_or_start:
             for (start,length) in _span_or_start:
                 self.add(start, length)
@@ -51,101 +63,66 @@ class Spans(object):
         except AssertionError:
             print("BAD:", self.dump())
             raise
+        assert self._len == sum([length for start,length in self._spans])
+
+    def _find(self, start, end, touching):
+        # Return the [lo:hi) range of spans which overlap [start:end), or
+        # (if 'touching') which overlap or are adjacent to it.
+        spans = self._spans
+        # spans[lo-1] is the last one to start before 'start'
+        lo = bisect_left(spans, (start,))
+        if lo:
+            (s_start, s_length) = spans[lo-1]
+            s_end = s_start + s_length
+            if s_end > start or (touching and s_end == start):
+                lo -= 1
+        # spans[hi] is the first one to start after 'end' (or at 'end')
+        hi = bisect_left(spans, (end+1,) if touching else (end,), lo)
+        return lo, hi
 
     def add(self, start, length):
         assert start >= 0
         assert length > 0
-        #print(" ADD [%d+%d -%d) to %s" % (start, length, start+length, self.dump()))
-        first_overlap = last_overlap = None
-        for i,(s_start,s_length) in enumerate(self._spans):
-            #print("  (%d+%d)-> overlap=%s adjacent=%s" % (s_start,s_length, overlap(s_start, s_length, start, length), adjacent(s_start, s_length, start, length)))
-            if (overlap(s_start, s_length, start, length)
-                or adjacent(s_start, s_length, start, length)):
-                last_overlap = i
-                if first_overlap is None:
-                    first_overlap = i
-                continue
-            # no overlap
-            if first_overlap is not None:
-                break
-        #print("  first_overlap", first_overlap, last_overlap)
-        if first_overlap is None:
-            # no overlap, so just insert the span and sort by starting
-            # position.
-            self._spans.insert(0, (start,length))
-            self._spans.sort()
-        else:
-            # everything from [first_overlap] to [last_overlap] overlapped
-            first_start,first_length = self._spans[first_overlap]
-            last_start,last_length = self._spans[last_overlap]
-            newspan_start = min(start, first_start)
-            newspan_end = max(start+length, last_start+last_length)
-            newspan_length = newspan_end - newspan_start
-            newspan = (newspan_start, newspan_length)
-            self._spans[first_overlap:last_overlap+1] = [newspan]
-        #print("  ADD done: %s" % self.dump())
-        self._check()
-
+        end = start + length
+        lo, hi = self._find(start, end, True)
+        if lo < hi:
+            # everything from [lo] to [hi-1] overlapped or touched, so
+            # merge them all into one span
+            (first_start, _) = self._spans[lo]
+            (last_start, last_length) = self._spans[hi-1]
+            self._len -= sum([l for (s, l) in self._spans[lo:hi]])
+            start = min(start, first_start)
+            end = max(end, last_start+last_length)
+        self._spans[lo:hi] = [(start, end - start)]
+        self._len += end - start
         return self
 
     def remove(self, start, length):
         assert start >= 0
         assert length > 0
-        #print(" REMOVE [%d+%d -%d) from %s" % (start, length, start+length, self.dump()))
-        first_complete_overlap = last_complete_overlap = None
-        for i,(s_start,s_length) in enumerate(self._spans):
-            s_end = s_start + s_length
-            o = overlap(s_start, s_length, start, length)
-            if o:
-                o_start, o_length = o
-                o_end = o_start+o_length
-                if o_start == s_start and o_end == s_end:
-                    # delete this span altogether
-                    if first_complete_overlap is None:
-                        first_complete_overlap = i
-                    last_complete_overlap = i
-                elif o_start == s_start:
-                    # we only overlap the left side, so trim the start
-                    #    1111
-                    #  rrrr
-                    #    oo
-                    # ->   11
-                    new_start = o_end
-                    new_end = s_end
-                    assert new_start > s_start
-                    new_length = new_end - new_start
-                    self._spans[i] = (new_start, new_length)
-                elif o_end == s_end:
-                    # we only overlap the right side
-                    #    1111
-                    #      rrrr
-                    #      oo
-                    # -> 11
-                    new_start = s_start
-                    new_end = o_start
-                    assert new_end < s_end
-                    new_length = new_end - new_start
-                    self._spans[i] = (new_start, new_length)
-                else:
-                    # we overlap the middle, so create a new span. No need to
-                    # examine any other spans.
-                    #    111111
-                    #      rr
-                    #    LL  RR
-                    left_start = s_start
-                    left_end = o_start
-                    left_length = left_end - left_start
-                    right_start = o_end
-                    right_end = s_end
-                    right_length = right_end - right_start
-                    self._spans[i] = (left_start, left_length)
-                    self._spans.append( (right_start, right_length) )
-                    self._spans.sort()
-                    break
-        if first_complete_overlap is not None:
-            del self._spans[first_complete_overlap:last_complete_overlap+1]
-        #print("  REMOVE done: %s" % self.dump())
-        self._check()
+        end = start + length
+        lo, hi = self._find(start, end, False)
+        if lo == hi:
+            return self
+        # everything from [lo] to [hi-1] overlapped, and all but the edges
+        # of the first and last of them go
+        new_spans = []
+        (first_start, _) = self._spans[lo]
+        if first_start < start:
+            #    1111
+            #      rrrr
+            # -> 11
+            new_spans.append( (first_start, start - first_start) )
+        (last_start, last_length) = self._spans[hi-1]
+        last_end = last_start + last_length
+        if last_end > end:
+            #    1111
+            #  rrrr
+            # ->   11
+            new_spans.append( (end, last_end - end) )
+        self._len -= sum([l for (s, l) in self._spans[lo:hi]])
+        self._len += sum([l for (s, l) in new_spans])
+        self._spans[lo:hi] = new_spans
         return self
 
     def dump(self):
@@ -163,14 +140,14 @@ class Spans(object):
             yield s
 
     def __bool__(self): # this gets us bool()
-        return bool(self.len())
+        return bool(self._len)
 
     #__nonzero__ = __bool__  # Python 2 backwards compatibility
 
     def len(self):
         # guess what! python doesn't allow __len__ to return a long, only an
         # int. So we stop using len(spans), use spans.len() instead.
-        return sum([length for start,length in self._spans])
+        return self._len
 
     def __add__(self, other):
         s = self.__class__(self)
@@ -204,13 +181,15 @@ class Spans(object):
 
     def __contains__(self, start_and_length):
         (start, length) = start_and_length
-        for span_start,span_length in self._spans:
-            o = overlap(start, length, span_start, span_length)
-            if o:
-                o_start,o_length = o
-                if o_start == start and o_length == length:
-                    return True
-        return False
+        if length <= 0:
+            return False
+        # the only span which could hold it is the last to start at or
+        # before 'start'
+        i = bisect_left(self._spans, (start+1,))
+        if not i:
+            return False
+        (span_start, span_length) = self._spans[i-1]
+        return start + length <= span_start + span_length
 
 def overlap(start0, length0, start1, length1):
     # return start2,length2 of the overlapping region, or None
@@ -236,20 +215,44 @@ class DataSpans(object):
     maintain a large array of characters (with gaps of empty elements). I can
     be used to manage access to a remote share, where some pieces have been
     retrieved, some have been requested, and others have not been read.
+
+    I hold the data I am given as memoryviews, in a sorted list of
+    non-overlapping chunks which are found by bisection. Chunks which touch
+    are not merged, and overwriting or removing part of a chunk just slices
+    it, so no data is copied until it is asked for with get() or pop().
     """
 
     def __init__(self, other=None):
-        self.spans = [] # (start, data) tuples, non-overlapping, merged
-        if other:
+        self.spans = [] # (start, memoryview) tuples, non-overlapping
+        self._len = 0
+        if isinstance(other, DataSpans):
+            self.spans = other.spans[:]
+            self._len = other._len
+        elif other:
             for (start, data) in other.get_chunks():
                 self.add(start, data)
 
     def __bool__(self): # this gets us bool()
-        return bool(self.len())
+        return bool(self.spans)
 
     def len(self):
         # return number of bytes we're holding
-        return sum([len(data) for (start,data) in self.spans])
+        return self._len
+
+    def _merged(self):
+        # yield (start, [data..]) for each run of touching chunks
+        run_start = run_end = None
+        run = []
+        for (start, data) in self.spans:
+            if start != run_end and run:
+                yield (run_start, run)
+                run = []
+            if not run:
+                run_start = run_end = start
+            run.append(data)
+            run_end += len(data)
+        if run:
+            yield (run_start, run)
 
     def _dump(self):
         # return iterator of sorted list of offsets, one per byte
@@ -259,189 +262,89 @@ class DataSpans(object):
 
     def dump(self):
         return "len=%d: %s" % (self.len(),
-                               ",".join(["[%d-%d]" % (start,start+len(data)-1)
-                                         for (start,data) in self.spans]) )
+                               ",".join(["[%d-%d]" % (start,
+                                                      start+len(run_bytes)-1)
+                                         for (start, run_bytes)
+                                         in self.get_chunks()]) )
 
     def get_chunks(self):
-        return list(self.spans)
+        return [(start, b"".join([data.tobytes() for data in run]))
+                for (start, run) in self._merged()]
 
     def get_spans(self):
         """Return a Spans object with a bit set for each byte I hold"""
-        return Spans([(start, len(data)) for (start,data) in self.spans])
+        s = Spans()
+        s._spans = [(start, sum([len(data) for data in run]))
+                    for (start, run) in self._merged()]
+        s._len = self._len
+        return s
 
     def assert_invariants(self):
-        if not self.spans:
-            return
-        prev_start = self.spans[0][0]
-        prev_end = prev_start + len(self.spans[0][1])
-        for start, data in self.spans[1:]:
-            if not start > prev_end:
-                # adjacent or overlapping: bad
+        prev_end = None
+        for start, data in self.spans:
+            if not data or (prev_end is not None and start < prev_end):
+                # empty or overlapping: bad
                 print("ASSERTION FAILED", self.spans)
                 raise AssertionError
+            prev_end = start + len(data)
+
+    def _find(self, start, end):
+        # Return the [lo:hi) range of chunks which overlap [start:end).
+        spans = self.spans
+        lo = bisect_left(spans, (start,))
+        if lo:
+            (s_start, s_data) = spans[lo-1]
+            if s_start + len(s_data) > start:
+                lo -= 1
+        hi = bisect_left(spans, (end,), lo)
+        return lo, hi
 
     def get(self, start, length):
         # returns a string of LENGTH, or None
-        #print("get", start, length, self.spans)
         end = start+length
-        for (s_start,s_data) in self.spans:
-            s_end = s_start+len(s_data)
-            #print(" ",s_start,s_end)
-            if s_start <= start < s_end:
-                # we want some data from this span. Because we maintain
-                # strictly merged and non-overlapping spans, everything we
-                # want must be in this span.
-                offset = start - s_start
-                if offset + length > len(s_data):
-                    #print(" None, span falls short")
-                    return None # span falls short
-                #print(" some", s_data[offset:offset+length])
-                return s_data[offset:offset+length]
-            if s_start >= end:
-                # we've gone too far: no further spans will overlap
-                #print(" None, gone too far")
-                return None
-        #print(" None, ran out of spans")
-        return None
+        lo, hi = self._find(start, end)
+        if lo == hi or self.spans[lo][0] > start:
+            return None
+        pieces = []
+        expected = self.spans[lo][0]
+        for (s_start, s_data) in self.spans[lo:hi]:
+            if s_start != expected:
+                return None # there is a gap
+            pieces.append(s_data[max(start-s_start, 0):end-s_start])
+            expected = s_start + len(s_data)
+        if expected < end:
+            return None # we fall short
+        if len(pieces) == 1:
+            return pieces[0].tobytes()
+        return b"".join([piece.tobytes() for piece in pieces])
 
     def add(self, start, data):
-        # first: walk through existing spans, find overlap, modify-in-place
-        #  create list of new spans
-        #  add new spans
-        #  sort
-        #  merge adjacent spans
-        #print("add", start, data, self.spans)
-        end = start + len(data)
-        i = 0
-        while len(data):
-            #print(" loop", start, data, i, len(self.spans), self.spans)
-            if i >= len(self.spans):
-                #print(" append and done")
-                # append a last span
-                self.spans.append( (start, data) )
-                break
-            (s_start,s_data) = self.spans[i]
-            # five basic cases:
-            #  a: OLD  b:OLDD  c1:OLD  c2:OLD   d1:OLDD  d2:OLD  e: OLLDD
-            #    NEW     NEW      NEW     NEWW      NEW      NEW     NEW
-            #
-            # we handle A by inserting a new segment (with "N") and looping,
-            # turning it into B or C. We handle B by replacing a prefix and
-            # terminating. We handle C (both c1 and c2) by replacing the
-            # segment (and, for c2, looping, turning it into A). We handle D
-            # by replacing a suffix (and, for d2, looping, turning it into
-            # A). We handle E by replacing the middle and terminating.
-            if start < s_start:
-                # case A: insert a new span, then loop with the remainder
-                #print(" insert new span")
-                s_len = s_start-start
-                self.spans.insert(i, (start, data[:s_len]))
-                i += 1
-                start = s_start
-                data = data[s_len:]
-                continue
-            s_len = len(s_data)
-            s_end = s_start+s_len
-            if s_start <= start < s_end:
-                #print(" modify this span", s_start, start, s_end)
-                # we want to modify some data in this span: a prefix, a
-                # suffix, or the whole thing
-                if s_start == start:
-                    if s_end <= end:
-                        #print(" replace whole segment")
-                        # case C: replace this segment
-                        self.spans[i] = (s_start, data[:s_len])
-                        i += 1
-                        start += s_len
-                        data = data[s_len:]
-                        # C2 is where len(data)>0
-                        continue
-                    # case B: modify the prefix, retain the suffix
-                    #print(" modify prefix")
-                    self.spans[i] = (s_start, data + s_data[len(data):])
-                    break
-                if start > s_start and end < s_end:
-                    # case E: modify the middle
-                    #print(" modify middle")
-                    prefix_len = start - s_start # we retain this much
-                    suffix_len = s_end - end # and retain this much
-                    newdata = s_data[:prefix_len] + data + s_data[-suffix_len:]
-                    self.spans[i] = (s_start, newdata)
-                    break
-                # case D: retain the prefix, modify the suffix
-                #print(" modify suffix")
-                prefix_len = start - s_start # we retain this much
-                suffix_len = s_len - prefix_len # we replace this much
-                #print("  ", s_data, prefix_len, suffix_len, s_len, data)
-                self.spans[i] = (s_start,
-                                 s_data[:prefix_len] + data[:suffix_len])
-                i += 1
-                start += suffix_len
-                data = data[suffix_len:]
-                #print("  now", start, data)
-                # D2 is where len(data)>0
-                continue
-            # else we're not there yet
-            #print(" still looking")
-            i += 1
-            continue
-        # now merge adjacent spans
-        #print(" merging", self.spans)
-        newspans = []
-        for (s_start,s_data) in self.spans:
-            if newspans and adjacent(newspans[-1][0], len(newspans[-1][1]),
-                                     s_start, len(s_data)):
-                newspans[-1] = (newspans[-1][0], newspans[-1][1] + s_data)
-            else:
-                newspans.append( (s_start, s_data) )
-        self.spans = newspans
-        self.assert_invariants()
-        #print(" done", self.spans)
+        # new data replaces whatever we held for those bytes
+        if not data:
+            return
+        self.remove(start, len(data))
+        i = bisect_left(self.spans, (start,))
+        self.spans.insert(i, (start, memoryview(data)))
+        self._len += len(data)
 
     def remove(self, start, length):
-        i = 0
         end = start + length
-        #print("remove", start, length, self.spans)
-        while i < len(self.spans):
-            (s_start,s_data) = self.spans[i]
-            if s_start >= end:
-                # this segment is entirely right of the removed region, and
-                # all further segments are even further right. We're done.
-                break
-            s_len = len(s_data)
-            s_end = s_start + s_len
-            o = overlap(start, length, s_start, s_len)
-            if not o:
-                i += 1
-                continue
-            o_start, o_len = o
-            o_end = o_start + o_len
-            if o_len == s_len:
-                # remove the whole segment
-                del self.spans[i]
-                continue
-            if o_start == s_start:
-                # remove a prefix, leaving the suffix from o_end to s_end
-                prefix_len = o_end - o_start
-                self.spans[i] = (o_end, s_data[prefix_len:])
-                i += 1
-                continue
-            elif o_end == s_end:
-                # remove a suffix, leaving the prefix from s_start to o_start
-                prefix_len = o_start - s_start
-                self.spans[i] = (s_start, s_data[:prefix_len])
-                i += 1
-                continue
-            # remove the middle, creating a new segment
-            # left is s_start:o_start, right is o_end:s_end
-            left_len = o_start - s_start
-            left = s_data[:left_len]
-            right_len = s_end - o_end
-            right = s_data[-right_len:]
-            self.spans[i] = (s_start, left)
-            self.spans.insert(i+1, (o_end, right))
-            break
-        #print(" done", self.spans)
+        lo, hi = self._find(start, end)
+        if lo == hi:
+            return
+        new_chunks = []
+        (first_start, first_data) = self.spans[lo]
+        if first_start < start:
+            # keep the prefix, from first_start to start
+            new_chunks.append( (first_start,
+                                first_data[:start-first_start]) )
+        (last_start, last_data) = self.spans[hi-1]
+        if last_start + len(last_data) > end:
+            # keep the suffix, from end to the end of the chunk
+            new_chunks.append( (end, last_data[end-last_start:]) )
+        self._len -= sum([len(data) for (_, data) in self.spans[lo:hi]])
+        self._len += sum([len(data) for (_, data) in new_chunks])
+        self.spans[lo:hi] = new_chunks
 
     def pop(self, start, length):
         data = self.get(start, length)
@@ -0,0 +1,88 @@
+"""
+A last-in, first-out stack which keeps a bounded number of items in memory
+and spills the rest to a temporary file.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import json
+import tempfile
+
+
+class SpillStack(object):
+    """
+    I am a stack of JSON-serializable items.  At most ``max_in_memory`` of
+    them are held in memory: when I grow beyond that, the older half of them
+    are written to an anonymous temporary file, and they are read back (most
+    recently spilled first) once the in-memory items have all been popped.
+
+    Since the items which get spilled are the ones at the bottom of the
+    stack, a depth-first walk which pushes the children of each node it
+    visits only reads back what it wrote after it has finished with
+    everything pushed since.
+    """
+
+    def __init__(self, max_in_memory):
+        if max_in_memory < 2:
+            raise ValueError("max_in_memory must be at least 2, not %d"
+                             % (max_in_memory,))
+        self._max_in_memory = max_in_memory
+        self._items = []
+        self._chunks = [] # (offset, count) of each chunk in self._file
+        self._file = None
+        self.spilled = 0 # how many times we've written a chunk out
+
+    def __len__(self):
+        return len(self._items) + sum(count for (offset, count) in self._chunks)
+
+    def push(self, item):
+        self._items.append(item)
+        if len(self._items) > self._max_in_memory:
+            self._spill()
+
+    def pop(self):
+        """
+        Remove and return the most recently pushed item.
+
+        :raise IndexError: If I am empty.
+        """
+        if not self._items and self._chunks:
+            self._unspill()
+        return self._items.pop()
+
+    def close(self):
+        """
+        Discard all remaining items, and the temporary file if there is one.
+        """
+        self._items = []
+        self._chunks = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _spill(self):
+        count = len(self._items) // 2
+        chunk, self._items = self._items[:count], self._items[count:]
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+        self._file.seek(0, 2)
+        offset = self._file.tell()
+        self._file.write(json.dumps(chunk).encode("utf-8"))
+        self._chunks.append((offset, count))
+        self.spilled += 1
+
+    def _unspill(self):
+        (offset, count) = self._chunks.pop()
+        self._file.seek(offset)
+        self._items = json.loads(self._file.read().decode("utf-8"))
+        self._file.seek(offset)
+        self._file.truncate()
@@ -32,7 +32,7 @@ from twisted.web.template import (
 from hyperlink import URL
 from twisted.python.filepath import FilePath
 
-from allmydata.util import base32, jsonbytes as json
+from allmydata.util import base32, log, jsonbytes as json
 from allmydata.util.encodingutil import (
     to_bytes,
     quote_output,
@@ -48,6 +48,7 @@ from allmydata.interfaces import IDirectoryNode, IFileNode, IFilesystemNode, \
      IImmutableFileNode, IMutableFileNode, ExistingChildError, \
      NoSuchChildError, EmptyPathnameComponentError, SDMF_VERSION, MDMF_VERSION
 from allmydata.blacklist import ProhibitedNode
+from allmydata.mutable.common import MODE_READ
 from allmydata.monitor import Monitor, OperationCancelledError
 from allmydata import dirnode
 from allmydata.web.common import (
@@ -701,6 +702,8 @@ class DirectoryAsHTML(Element):
             self.dirnode_children_error = text
 
         self.dirnode_children = children
+        if children is not None:
+            yield _get_child_sizes(children)
         defer.returnValue(self.dirnode_children)
 
     @renderer
@@ -841,7 +844,8 @@ class DirectoryAsHTML(Element):
             dlurl = "%s/file/%s/@@named=/%s" % (root, quoted_uri, nameurl)
             slots["filename"] = tags.a(name, href=dlurl, rel="noreferrer")
             slots["type"] = "SSK"
-            slots["size"] = "?"
+            size = target.get_size()
+            slots["size"] = "?" if size is None else str(size)
             info_link = "{}/uri/{}?t=info".format(root, quoted_uri)
 
         elif IImmutableFileNode.providedBy(target):
@@ -1019,8 +1023,35 @@ class DirectoryAsHTML(Element):
     def results(self, req, tag):
         return get_arg(req, "results", "")
 
+def _get_child_sizes(children):
+    """
+    Find the sizes of the mutable files among ``children`` (as returned by
+    ``IDirectoryNode.list``) which are not known yet. Their servermap
+    updates all start in the same turn, so each storage server is asked
+    about all of them in a single ``slot_readv_batch`` message.
+
+    :return Deferred: Fires when the lookups are done, after which the
+        ``get_size`` of each child that could be found reports its size.
+    """
+    def _failed(f, child):
+        log.msg(format="unable to find the size of %(si)s",
+                si=base32.b2a(child.get_storage_index()), failure=f,
+                level=log.UNUSUAL, umid="qz2VAg")
+    ds = []
+    for (child, metadata) in children.values():
+        if IMutableFileNode.providedBy(child) and child.get_size() is None:
+            d = child.get_servermap(MODE_READ)
+            d.addErrback(_failed, child)
+            ds.append(d)
+    return defer.DeferredList(ds)
+
 def _directory_json_metadata(req, dirnode):
     d = dirnode.list()
+    def _get_sizes(children):
+        d = _get_child_sizes(children)
+        d.addCallback(lambda ign: children)
+        return d
+    d.addCallback(_get_sizes)
     def _got(children):
         kids = {}
         for name, (childnode, metadata) in list(children.items()):
@@ -54,6 +54,7 @@ from allmydata.web.check_results import (
     LiteralCheckResultsRenderer,
 )
 from allmydata.web.info import MoreInfo
+from allmydata.web.streaming import get_immutable_uploadable, wants_stream
 from allmydata.util import jsonbytes as json
 
 
@@ -73,7 +74,7 @@ class ReplaceMeMixin(object):
             d.addCallback(_uploaded)
         else:
             assert file_format == "CHK"
-            uploadable = FileHandle(req.content, convergence=client.convergence)
+            uploadable = get_immutable_uploadable(req, client.convergence)
             d = self.parentnode.add_file(self.name, uploadable,
                                          overwrite=replace)
         def _done(filenode):
@@ -279,6 +280,9 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
                 if self.node.is_readonly():
                     raise WebError("PUT to a mutable file: replace or update"
                                    " requested with read-only cap")
+                if wants_stream(req):
+                    raise WebError("PUT to a mutable file: stream=true can"
+                                   " only be used to upload immutable files")
                 if offset is None:
                     return self.replace_my_contents(req)
 
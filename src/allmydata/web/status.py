@@ -133,6 +133,10 @@ class UploadResultsRendererMixin(Element):
     def time_total_encode_and_push(self, req, tag):
         return tag(self._get_time("total_encode_and_push"))
 
+    @renderer
+    def time_cumulative_reading(self, req, tag):
+        return tag(self._get_time("cumulative_reading"))
+
     @renderer
     def time_cumulative_encoding(self, req, tag):
         return tag(self._get_time("cumulative_encoding"))
@@ -675,6 +679,10 @@ class DownloadStatusElement(Element):
         return tag({True: "Yes",
                     False: "No"}[self._download_status.using_helper()])
 
+    @renderer
+    def readahead(self, req, tag):
+        return tag("%d segments" % (self._download_status.get_readahead(),))
+
     @renderer
     def total_size(self, req, tag):
         size = self._download_status.get_size()
@@ -1158,6 +1166,13 @@ class MapupdateStatusElement(Element):
     def status(self, req, tag):
         return tag(self._update_status.get_status())
 
+    @renderer
+    def cached(self, req, tag):
+        age = self._update_status.get_cached_age()
+        if age is None:
+            return tag("No")
+        return tag("Yes (updated %s earlier)" % abbreviate_time(age))
+
     @renderer
     def problems(self, req, tag):
         problems = self._update_status.problems
@@ -1550,6 +1565,62 @@ class Statistics(MultiFormatResource):
         req.setHeader("content-type", "text/plain")
         return json.dumps(stats, indent=1) + "\n"
 
+    @render_exception
+    def render_OPENMETRICS(self, req):
+        """
+        Render the counters and numeric stats as OpenMetrics counters and
+        gauges, and the histograms (such as storage latencies) as
+        OpenMetrics histograms, for scraping by Prometheus and friends.
+        """
+        stats = self._provider.get_stats()
+        histograms = self._provider.get_histograms()
+        req.setHeader("content-type",
+                      "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        lines = []
+        for (name, value) in sorted(stats["counters"].items()):
+            metric = _metric_name(name)
+            lines.append("# TYPE %s counter" % (metric,))
+            lines.append("%s_total %s" % (metric, _metric_value(value)))
+        for (name, value) in sorted(stats["stats"].items()):
+            if not isinstance(value, (int, long, float)):
+                continue
+            metric = _metric_name(name)
+            lines.append("# TYPE %s gauge" % (metric,))
+            lines.append("%s %s" % (metric, _metric_value(value)))
+        for (name, histogram) in sorted(histograms.items()):
+            metric = _metric_name(name) + "_seconds"
+            lines.append("# TYPE %s histogram" % (metric,))
+            lines.append("# UNIT %s seconds" % (metric,))
+            for (label, (buckets, count, total)) in sorted(histogram.items()):
+                for (bound, seen) in buckets:
+                    lines.append('%s_bucket{operation="%s",le="%s"} %d'
+                                 % (metric, label, repr(float(bound)), seen))
+                lines.append('%s_bucket{operation="%s",le="+Inf"} %d'
+                             % (metric, label, count))
+                lines.append('%s_count{operation="%s"} %d'
+                             % (metric, label, count))
+                lines.append('%s_sum{operation="%s"} %s'
+                             % (metric, label, repr(float(total))))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def _metric_name(name):
+    """
+    Turn one of our dotted stats names into a valid OpenMetrics metric name,
+    such as storage_server.disk_avail into tahoe_storage_server_disk_avail.
+    """
+    return "tahoe_" + "".join(c if c.isalnum() else "_" for c in name)
+
+
+def _metric_value(value):
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, float):
+        return repr(value)
+    return "%d" % (value,)
+
+
 class StatisticsElement(Element):
 
     loader = XMLFile(FilePath(__file__).sibling("statistics.xhtml"))
@@ -0,0 +1,221 @@
+"""
+Uploads which are encoded while their request body is still arriving.
+
+Normally the web server spools a request body to a temporary file, and a
+PUT upload starts only once all of it is there. With ``stream=true``, a
+``PUT /uri`` or ``PUT /uri/$DIRCAP/[SUBDIRS../]FILENAME`` of an immutable
+file instead starts as soon as its headers arrive, reading the body as it
+is received: the upload uses a random encryption key, since a convergent
+key depends on all of the data, and if the encoder falls behind the
+client, we stop reading from the connection until it catches up.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from collections import deque
+
+from twisted.internet import defer
+from twisted.web.http import parse_qs
+
+from allmydata.immutable.upload import FileHandle, Stream
+from allmydata.web.common import (
+    WebError,
+    get_arg,
+    boolean_of_arg,
+    get_format,
+)
+
+# we stop reading from the client once this much of the body is waiting to
+# be uploaded (unless the uploader is waiting for more), and start again
+# once it has taken all but LOW_WATER of it
+HIGH_WATER = 1024 * 1024
+LOW_WATER = HIGH_WATER // 2
+
+
+def wants_stream(req):
+    """
+    :return bool: Whether ``req`` asked for its upload to be streamed.
+    """
+    return boolean_of_arg(get_arg(req, "stream", "false"))
+
+
+class _Args(object):
+    # just enough of a request for get_arg, before there is one
+    fields = None
+
+    def __init__(self, args):
+        self.args = args
+
+
+def can_stream(method, uri):
+    """
+    :return bool: Whether a request for ``method`` and ``uri`` (as received,
+        with query arguments) is an upload which can be streamed.
+    """
+    if method != b"PUT":
+        return False
+    x = uri.split(b"?", 1)
+    if len(x) == 1:
+        return False
+    (path, argstring) = x
+    if path != b"/uri" and not path.startswith(b"/uri/"):
+        return False
+    req = _Args(parse_qs(argstring, 1))
+    try:
+        if not wants_stream(req) or get_format(req) != "CHK":
+            return False
+    except WebError:
+        return False # the request will fail later, with a better message
+    return not get_arg(req, "t", b"").strip()
+
+
+class StreamingBody(object):
+    """
+    I am the body of a request which is being processed while it arrives.
+    The request's channel gives me the data as it is received, and the
+    request's handler reads it from me, while I pause the request's
+    transport whenever too much is waiting.
+    """
+
+    def __init__(self, transport, size):
+        self._transport = transport
+        self.size = size
+        self._buffer = deque()
+        self._buffered = 0
+        self._paused = False
+        self._reading = None # (Deferred, length) of a read waiting for data
+        self._discarding = False
+        self._failure = None
+        self.complete = False
+        self._complete_waiters = []
+
+    def write(self, data):
+        """
+        The channel received ``data``, the next part of the body.
+        """
+        if self._discarding:
+            return
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._satisfy_read()
+        if self._buffered >= HIGH_WATER and self._reading is None:
+            # (the channel may resume the transport by itself, so this may
+            # be asked for more than once)
+            self._paused = True
+            self._transport.pauseProducing()
+
+    def end(self):
+        """
+        The channel has received all of the body.
+        """
+        self.complete = True
+        self._satisfy_read()
+        self._fire_complete()
+
+    def lose(self, reason):
+        """
+        The connection was lost before all of the body arrived.
+        """
+        if self.complete:
+            return
+        self._failure = reason
+        self.complete = True
+        if self._reading is not None:
+            (d, length) = self._reading
+            self._reading = None
+            d.errback(reason)
+        self._fire_complete()
+
+    def discard(self):
+        """
+        Nothing more will be read: throw away the rest of the body.
+        """
+        self._discarding = True
+        self._buffer.clear()
+        self._buffered = 0
+        self._resume()
+
+    def close(self):
+        pass
+
+    def read(self, length):
+        """
+        :return: A Deferred that fires with the next ``length`` bytes of the
+            body, or fewer at its end.
+        """
+        assert self._reading is None, "only one read at a time"
+        if self._failure is not None:
+            return defer.fail(self._failure)
+        d = defer.Deferred()
+        self._reading = (d, length)
+        self._satisfy_read()
+        if self._reading is not None:
+            # the uploader is waiting, so we need more whatever we hold
+            self._resume()
+        return d
+
+    def when_complete(self):
+        """
+        :return: A Deferred that fires when all of the body has been
+            received (or the connection has been lost).
+        """
+        if self.complete:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._complete_waiters.append(d)
+        return d
+
+    def _satisfy_read(self):
+        if self._reading is None:
+            return
+        (d, length) = self._reading
+        if self._buffered < length and not self.complete:
+            return
+        self._reading = None
+        chunks = []
+        wanted = length
+        while wanted and self._buffer:
+            chunk = self._buffer.popleft()
+            if len(chunk) > wanted:
+                self._buffer.appendleft(chunk[wanted:])
+                chunk = chunk[:wanted]
+            chunks.append(chunk)
+            wanted -= len(chunk)
+        data = b"".join(chunks)
+        self._buffered -= len(data)
+        if self._buffered < LOW_WATER:
+            self._resume()
+        d.callback(data)
+
+    def _resume(self):
+        if self._paused:
+            self._paused = False
+            self._transport.resumeProducing()
+
+    def _fire_complete(self):
+        waiters, self._complete_waiters = self._complete_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+
+def get_immutable_uploadable(req, convergence):
+    """
+    :return IUploadable: The body of the upload request ``req``. With
+        ``stream=true`` it gets a random encryption key, and is read as it
+        arrives if the request is being streamed.
+    """
+    if isinstance(req.content, StreamingBody):
+        return Stream(req.content, req.content.size)
+    if wants_stream(req):
+        # without a Content-Length the body had to be spooled after all
+        convergence = None
+    return FileHandle(req.content, convergence)
@@ -35,10 +35,11 @@ from allmydata.web.common import (
     url_for_string,
 )
 from allmydata.web import status
+from allmydata.web.streaming import get_immutable_uploadable
 
 def PUTUnlinkedCHK(req, client):
     # "PUT /uri", to create an unlinked file.
-    uploadable = FileHandle(req.content, client.convergence)
+    uploadable = get_immutable_uploadable(req, client.convergence)
     d = client.upload(uploadable)
     d.addCallback(lambda results: results.get_uri())
     # that fires with the URI of the new file
@@ -24,6 +24,7 @@ from io import (
 from twisted.application import service, strports, internet
 from twisted.web import static
 from twisted.web.http import (
+    HTTPChannel,
     parse_qs,
 )
 from twisted.web.server import (
@@ -39,6 +40,7 @@ from allmydata.util import log, fileutil
 
 from allmydata.web import introweb, root
 from allmydata.web.operations import OphandleTable
+from allmydata.web.streaming import StreamingBody, can_stream
 
 from .web.storage_plugins import (
     StoragePlugins,
@@ -91,6 +93,29 @@ class TahoeLAFSRequest(Request, object):
         else, ``None``.
     """
     fields = None
+    _streaming = False
+    # (command, path, version), set by TahoeLAFSChannel
+    request_line = None
+    _saved_timeout = None
+
+    def gotLength(self, length):
+        """
+        Called by channel when all the headers have been received.
+
+        Override the base implementation to start processing uploads which
+        can be streamed (see ``allmydata.web.streaming``) now, rather than
+        once all of the body has been received.
+        """
+        if (length and self.request_line is not None
+            and can_stream(*self.request_line[:2])):
+            self.content = StreamingBody(self.channel.transport, length)
+            # the body may stop arriving for a while when the upload falls
+            # behind, so the channel must not time the connection out until
+            # we are done with it
+            self._saved_timeout = self.channel.setTimeout(None)
+            self.requestReceived(*self.request_line)
+        else:
+            Request.gotLength(self, length)
 
     def requestReceived(self, command, path, version):
         """
@@ -100,7 +125,15 @@ class TahoeLAFSRequest(Request, object):
         and to provide less memory-intensive multipart/form-post handling for
         large file uploads.
         """
-        self.content.seek(0)
+        if isinstance(self.content, StreamingBody):
+            if self._streaming:
+                # we started processing when the headers arrived, and now
+                # the body is all here too
+                self.content.end()
+                return
+            self._streaming = True
+        else:
+            self.content.seek(0)
         self.args = {}
         self.stack = []
 
@@ -140,6 +173,41 @@ class TahoeLAFSRequest(Request, object):
         self.processing_started_timestamp = time.time()
         self.process()
 
+    def finish(self):
+        """
+        Override the base implementation so that the response to a request
+        whose body is being streamed does not end before that body has all
+        been received: the channel is not ready for the next request until
+        then. The rest of the body is thrown away.
+        """
+        content = getattr(self, "content", None)
+        if isinstance(content, StreamingBody) and not content.complete:
+            content.discard()
+            d = content.when_complete()
+            d.addCallback(lambda ign: self._finish_after_body())
+            return
+        return self._finish()
+
+    def _finish_after_body(self):
+        if not self._disconnected:
+            self._finish()
+
+    def _finish(self):
+        channel = self.channel
+        result = Request.finish(self)
+        if (self._saved_timeout is not None and not self._disconnected
+            and not channel.requests):
+            # the channel is waiting for its next request, which it should
+            # not wait for forever
+            channel.setTimeout(self._saved_timeout)
+        return result
+
+    def connectionLost(self, reason):
+        content = getattr(self, "content", None)
+        if isinstance(content, StreamingBody):
+            content.lose(reason)
+        Request.connectionLost(self, reason)
+
     def _tahoeLAFSSecurityPolicy(self):
         """
         Set response properties related to Tahoe-LAFS-imposed security policy.
@@ -153,6 +221,22 @@ class TahoeLAFSRequest(Request, object):
         self.setHeader("Referrer-Policy", "no-referrer")
 
 
+class TahoeLAFSChannel(HTTPChannel, object):
+    """
+    ``TahoeLAFSChannel`` tells each ``TahoeLAFSRequest`` its request line as
+    soon as that arrives, rather than only once all of the request has, so
+    that uploads can be streamed.
+    """
+    def lineReceived(self, line):
+        requests = len(self.requests)
+        HTTPChannel.lineReceived(self, line)
+        if len(self.requests) > requests:
+            # that was the request line of a new request
+            parts = line.split()
+            if len(parts) == 3:
+                self.requests[-1].request_line = tuple(parts)
+
+
 def _get_client_ip(request):
     try:
         get = request.getClientAddress
@@ -219,6 +303,7 @@ class TahoeLAFSSite(Site, object):
       strings to help keep them secret.
     """
     requestFactory = TahoeLAFSRequest
+    protocol = TahoeLAFSChannel
 
     def __init__(self, tempdir, *args, **kwargs):
         Site.__init__(self, *args, logFormatter=_logFormatter, **kwargs)